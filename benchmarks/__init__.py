@@ -0,0 +1,35 @@
+'''
+Benchmarks for the payment paths. Run a module from the project root, e.g.
+`python -m benchmarks.signatures`.
+'''
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'processor_di.settings')
+    os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmarks')
+    import django
+    django.setup()
+
+
+@contextmanager
+def test_database():
+    '''
+    Creates a throwaway test database from settings.DATABASES for the
+    duration of the block. SQLite test databases are files, not the default
+    in-memory database, so that worker processes can share them.
+    '''
+    from django.db import connection, connections
+
+    if connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+        connection.settings_dict['OPTIONS']['timeout'] = 30
+    old_name = connection.creation.create_test_db(verbosity=0, serialize=False)
+    try:
+        yield
+    finally:
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
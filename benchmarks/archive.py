@@ -0,0 +1,166 @@
+'''
+Hot query latency and table size before and after archiving settled
+payments (payments/archive.py), and the latency of looking up an archived
+payment by reference.
+
+Creates --rows payments spread evenly over the last --months months, all
+settled except for a mix of statuses in the last week, each with one
+ledger event, in a throwaway test database from settings.DATABASES. Then times the
+queries that run all day, archives everything older than
+--older-than-months and times them again. Use PostgreSQL and --rows
+50000000 for production sized numbers; SQLite sizes come from dbstat when
+it is compiled in, the database file otherwise.
+
+    python -m benchmarks.archive [--rows 1000000] [--months 24] [--older-than-months 6]
+'''
+import argparse
+import random
+import statistics
+import tempfile
+import time
+
+from datetime import timedelta
+
+from benchmarks import setup_django, test_database
+
+
+def table_size(tables):
+    '''
+    Bytes used by [tables] and their indexes.
+    '''
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT SUM(pg_total_relation_size(name)) FROM unnest(%s::text[]) AS name', [tables])
+            return cursor.fetchone()[0]
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name IN (%s))'
+                    % ', '.join(['%s'] * len(tables)), tables)
+                return cursor.fetchone()[0]
+            except Exception: #  dbstat not compiled in
+                cursor.execute('PRAGMA page_count')
+                pages = cursor.fetchone()[0]
+                cursor.execute('PRAGMA page_size')
+                return pages * cursor.fetchone()[0]
+    return None
+
+
+def vacuum():
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM' if connection.vendor == 'sqlite' else 'VACUUM FULL payments_payment, payments_paymentevent')
+
+
+def timed(query, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        query()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--months', type=int, default=24, help='Months the payments are spread over')
+    parser.add_argument('--older-than-months', type=int, default=6)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20, help='Runs of each query, the median is reported')
+    parser.add_argument('--lookups', type=int, default=200, help='Archived payments looked up by reference')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.db.models import Count
+    from django.utils import timezone
+    from django.utils.crypto import get_random_string
+
+    from payments import archive
+    from payments.models import Payment, PaymentEvent, PaymentStatus
+
+    settings.PAYMENT_ARCHIVE_DIR = tempfile.mkdtemp()
+    with test_database():
+        users = User.objects.bulk_create([User(username=f'archive{i}') for i in range(args.users)])
+        now = timezone.now()
+        span = args.months * 30 * 24 * 60 #  minutes
+        settled = (PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+        started = time.perf_counter()
+        for start in range(0, args.rows, 10_000):
+            payments = Payment.objects.bulk_create([
+                Payment(
+                    user=users[i % args.users],
+                    amount=(i % 1000 + 1) * 100,
+                    reference=f"{i:012d}{get_random_string(4)}",
+                    date=now - timedelta(minutes=age),
+                    status=PaymentStatus.values[i % 3] if age < 7 * 24 * 60 else settled[i % 2],
+                    processor=('paystack', 'credo')[i % 2],
+                )
+                for i in range(start, min(start + 10_000, args.rows))
+                for age in [span * (args.rows - i) // args.rows] #  minutes, oldest first as they were created
+            ])
+            PaymentEvent.objects.bulk_create([
+                PaymentEvent(payment=payment, source='WH', processor=payment.processor, gateway_status='success',
+                             occurred_at=payment.date, payload='{"status":"success"}', digest='0' * 64)
+                for payment in payments
+            ])
+        print(f"created {args.rows:,} payments in {time.perf_counter() - started:.1f}s")
+
+        user = users[0]
+        queries = {
+            'reconcile unprocessed': lambda: list(Payment.objects.filter(
+                status=PaymentStatus.UNPROCESSED, processor='paystack', date__lt=timezone.now() - timedelta(minutes=30),
+            ).order_by('id').values_list('id', flat=True)[:500]),
+            'user recent payments': lambda: list(Payment.objects.filter(user=user).order_by('-date')[:20]),
+            'status counts, 7 days': lambda: list(Payment.objects.filter(date__gte=timezone.now() - timedelta(days=7))
+                                                 .values('status', 'processor').annotate(n=Count('id'))),
+            'admin changelist': lambda: (Payment.objects.count(), list(Payment.objects.order_by('-id')[:100])),
+        }
+        sample = list(Payment.objects.filter(date__lt=archive.cutoff(args.older_than_months)).values_list('reference', flat=True)
+                      .order_by('?')[:args.lookups])
+
+        tables = ['payments_payment', 'payments_paymentevent']
+        vacuum()
+        before = {name: timed(query, args.repeat) for name, query in queries.items()}
+        size_before = table_size(tables)
+
+        started = time.perf_counter()
+        archived = sum(
+            entry['rows']
+            for date_from, date_to in archive.archivable_months(archive.cutoff(args.older_than_months))
+            for entry in [archive.archive_month(date_from, date_to)] if entry
+        )
+        elapsed = time.perf_counter() - started
+        print(f"archived {archived:,} payments ({archive.default_format()}) in {elapsed:.1f}s, {archived / elapsed:,.0f} rows/s")
+
+        vacuum()
+        after = {name: timed(query, args.repeat) for name, query in queries.items()}
+        size_after = table_size(tables)
+
+        print(f"{'query':<24} {'before ms':>10} {'after ms':>10}")
+        for name in queries:
+            print(f"{name:<24} {before[name]:>10.2f} {after[name]:>10.2f}")
+        if size_before:
+            print(f"{'payments + ledger':<24} {size_before / 2**20:>8.1f} MiB {size_after / 2**20:>6.1f} MiB")
+        archived_bytes = sum(path.stat().st_size for path in archive.archive_dir().iterdir())
+        print(f"{'archive files':<24} {'':>10} {archived_bytes / 2**20:>6.1f} MiB")
+
+        random.shuffle(sample)
+        lookups = []
+        for reference in sample:
+            started = time.perf_counter()
+            assert archive.find_archived(reference) is not None, reference
+            lookups.append((time.perf_counter() - started) * 1000)
+        missing = timed(lambda: archive.find_archived('000000000000zzzz'), args.repeat)
+        if lookups:
+            print(f"archive lookup p50 {statistics.median(lookups):.2f} ms, max {max(lookups):.2f} ms, "
+                  f"unknown reference {missing:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Batch payment initialization against the one-at-a-time checkout loop.
+
+The loop does what one payment_gateway_checkout POST per user does: pick a
+processor, save the payment with its own reference, and initialize it at
+the gateway. payments.batch.initialize_payments is given the same items.
+Both run against a throwaway test database and a local Paystack
+simulator, without rate limits and with every payment going to Paystack
+unless PAYMENT_ROUTING is on.
+
+The loop is linear in the number of items, so it is timed on --loop-items
+of them and extrapolated to --items to keep the run short.
+
+    python -m benchmarks.batch [--items 10000] [--loop-items 500] [--workers 32] [--latency 80]
+'''
+import argparse
+import json
+import time
+
+from contextlib import contextmanager
+
+from benchmarks import setup_django, test_database
+from benchmarks.simulators import PaystackSimulator, add_behaviour_arguments, behaviour_from_arguments
+
+
+@contextmanager
+def counting_queries(counter):
+    from django.db import connection
+
+    def count(execute, sql, params, many, context):
+        counter[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count):
+        yield
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--loop-items', type=int, default=500, help='Items the one-at-a-time loop is timed on')
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent gateway calls of the batch (also the bulkhead size)')
+    parser.add_argument('--users', type=int, default=1000)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+
+    from payments import paystack
+    from payments.batch import initialize_payments
+    from payments.models import Payment
+    from payments.routing import get_router
+    from payments.utils import save_with_unique_reference
+
+    # the batch may use as many connections as it has workers
+    settings.PAYMENT_BULKHEAD_SIZE = settings.PAYMENT_HTTP_POOL_MAXSIZE = args.workers
+    simulator = PaystackSimulator(behaviour_from_arguments(args)).start()
+    paystack.URL_ROOT = simulator.url
+    callback_url = 'http://testserver/payment_callback/'
+
+    with test_database():
+        User.objects.bulk_create([User(username=f'user{i}', email=f'user{i}@example.com') for i in range(args.users)])
+        users = list(User.objects.all())
+        items = [(users[i % len(users)], 40000, {'invoice': i}) for i in range(args.items)]
+        router = get_router()
+
+        queries = [0]
+        started = time.perf_counter()
+        with counting_queries(queries):
+            for user, amount, metadata in items[:args.loop_items]:
+                payment = Payment(user=user, amount=amount, processor=router.choose())
+                save_with_unique_reference(payment)
+                router.initialize_payment(payment, user.email, callback_url, json.dumps(metadata))
+        loop = (time.perf_counter() - started) / args.loop_items
+        loop_queries = queries[0] / args.loop_items
+        Payment.objects.all().delete()
+
+        queries = [0]
+        started = time.perf_counter()
+        with counting_queries(queries):
+            result = initialize_payments(items, callback_url, workers=args.workers, rate_limits={})
+        batch = time.perf_counter() - started
+
+    simulator.stop()
+    print(f"{args.items} items, gateway median {args.latency:g} ms, {args.workers} workers")
+    print(f"one at a time  {loop * args.items:>8.1f} s (timed on {args.loop_items}, {1 / loop:>7.1f} payments/s, {loop_queries:.1f} queries each)")
+    print(f"batch          {batch:>8.1f} s ({args.items / batch:>7.1f} payments/s, {queries[0] / args.items:.3f} queries each), "
+          f"{len(result['urls'])} initialized, {len(result['errors'])} failed")
+    print(f"speedup        {loop * args.items / batch:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Compares two benchmarks.load result files, e.g. from the base and head of a
+branch, scenario by scenario. Exits with status 1 if throughput dropped, or
+p95 latency or queries per request grew, by more than --threshold percent,
+or if a result on either side is not valid (requests failed, or a target
+rate was not reached), since its numbers do not measure the app.
+
+    python -m benchmarks.compare base.json head.json [--threshold 10]
+'''
+import argparse
+import json
+import sys
+
+
+# (label, how to read it from a result, whether higher is better)
+MEASURES = (
+    ('req/s', lambda result: result['requests_per_second'], True),
+    ('p50 ms', lambda result: result['latency_ms']['p50'], False),
+    ('p95 ms', lambda result: result['latency_ms']['p95'], False),
+    ('p99 ms', lambda result: result['latency_ms']['p99'], False),
+    ('queries/req', lambda result: result['db_queries_per_request'] or 0, False),
+    ('errors', lambda result: result['errors'], False),
+    ('gateway calls', lambda result: result['gateway_calls'], False),
+    ('rss MiB', lambda result: result['rss_mb'], False),
+)
+GATED = ('req/s', 'p95 ms', 'queries/req')
+
+
+def change(before, after):
+    if before == after:
+        return 0.0
+    if not before:
+        return float('inf')
+    return (after - before) / before * 100
+
+
+def compare(base, head, threshold):
+    '''
+    Prints the change of every measure of the scenarios in both [base] and
+    [head]. Returns the regressions beyond [threshold] percent, and the
+    scenarios not compared because a result is not valid.
+    '''
+    base_results = {(result['mode'], result['scenario']): result for result in base['results']}
+    regressions, invalid = [], []
+    for result in head['results']:
+        key = (result['mode'], result['scenario'])
+        before = base_results.get(key)
+        if before is None:
+            print(f"{key[0]} {key[1]}: not in the base results")
+            continue
+        warnings = [f"base: {warning}" for warning in before.get('warnings', ())] + [f"head: {warning}" for warning in result.get('warnings', ())]
+        if warnings:
+            print(f"{key[0]} {key[1]}: NOT VALID, not compared")
+            for warning in warnings:
+                print(f"    {warning}")
+            invalid.append(key)
+            continue
+        print(f"{key[0]} {key[1]}")
+        for label, read, higher_is_better in MEASURES:
+            old, new = read(before), read(result)
+            delta = change(old, new)
+            worse = -delta if higher_is_better else delta
+            flag = ''
+            if label in GATED and worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((key, label, old, new))
+            print(f"    {label:<14} {old:>10.2f} -> {new:>10.2f}  {delta:+7.1f}%{flag}")
+    return regressions, invalid
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent')
+    args = parser.parse_args()
+
+    with open(args.base) as base, open(args.head) as head:
+        base, head = json.load(base), json.load(head)
+    print(f"base {base.get('commit')} ({base['created_at']})\nhead {head.get('commit')} ({head['created_at']})\n")
+    regressions, invalid = compare(base, head, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) beyond {args.threshold:g}%")
+    if invalid:
+        print(f"\n{len(invalid)} scenario(s) not compared, their results are not valid")
+    if regressions or invalid:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Webhook replay with gateway redeliveries, with and without the idempotency
+layer (payments/idempotency.py).
+
+Builds a stream of signed Paystack charge.success webhooks in which
+--duplicate-ratio of the deliveries repeat one of the last --window events,
+the way retries follow the original within minutes, and replays it through
+payment_webhook against a throwaway test database, round robin over
+--processes simulated worker processes, each with its own in-memory filter
+synced every --sync-interval seconds. Reports database queries per 10k
+deliveries and how many redeliveries were answered without processing.
+
+    python -m benchmarks.dedup [--events 10000] [--duplicate-ratio 0.3] [--processes 4]
+'''
+import argparse
+import os
+import random
+import time
+
+from benchmarks import setup_django, test_database
+from benchmarks.batch import counting_queries
+from benchmarks.simulators import PaystackSimulator
+
+
+def build_stream(events, duplicate_ratio, window, seed=0):
+    '''
+    Returns the delivery order of [events] deliveries as indexes of unique
+    events, and the number of unique events.
+    '''
+    rng = random.Random(seed)
+    stream, unique = [], 0
+    for _ in range(events):
+        if unique and rng.random() < duplicate_ratio:
+            stream.append(rng.choice(stream[-window:]))
+        else:
+            stream.append(unique)
+            unique += 1
+    return stream, unique
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=10000, help='Deliveries replayed')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3, help='Share of the deliveries that are redeliveries')
+    parser.add_argument('--window', type=int, default=1000, help='Redeliveries repeat one of this many latest deliveries')
+    parser.add_argument('--processes', type=int, default=4, help='Simulated worker processes, each with its own filter')
+    parser.add_argument('--sync-interval', type=float, default=5, help='PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL. Real redeliveries come minutes apart, the replay runs them much closer')
+    args = parser.parse_args()
+
+    simulator = PaystackSimulator() #  only signs the webhooks
+    os.environ.update({'PAYSTACK_SECRET_KEY': simulator.secret_key, 'PAYMENT_LOG_LEVEL': 'ERROR'})
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+
+    from payments import idempotency, metrics
+    from payments.models import Payment, PaymentEvent, PaymentStatus, SeenWebhookEvent
+    from payments.utils import allocate_references
+
+    setup_test_environment()
+    stream, unique = build_stream(args.events, args.duplicate_ratio, args.window)
+    print(f"{args.events} deliveries of {unique} events ({1 - unique / args.events:.0%} redeliveries), {args.processes} processes")
+    print(f"{'dedup':<6} {'queries':>8} {'per 10k':>9} {'deliveries/s':>13} {'redeliveries answered':>22}")
+
+    with test_database():
+        user = User.objects.create_user(username='dedup', email='dedup@example.com')
+        references = allocate_references(Payment, unique)
+        Payment.objects.bulk_create([Payment(user=user, amount=40000, reference=reference, processor='paystack') for reference in references])
+        deliveries = [simulator.webhook(references[index]) for index in stream]
+        client = Client()
+
+        results = {}
+        for dedup in (False, True):
+            Payment.objects.update(status=PaymentStatus.UNPROCESSED)
+            PaymentEvent.objects.all().delete()
+            SeenWebhookEvent.objects.all().delete()
+            settings.PAYMENT_WEBHOOK_DEDUP = dedup
+            processes = [
+                idempotency.SeenEvents(
+                    settings.PAYMENT_WEBHOOK_DEDUP_FILTER_CAPACITY, settings.PAYMENT_WEBHOOK_DEDUP_FILTER_ERROR_RATE,
+                    settings.PAYMENT_WEBHOOK_DEDUP_FILTER_PERIOD, args.sync_interval)
+                for _ in range(args.processes)
+            ]
+            metrics.WEBHOOK_DUPLICATES.reset()
+
+            queries = [0]
+            started = time.perf_counter()
+            with counting_queries(queries):
+                for i, (body, headers) in enumerate(deliveries):
+                    idempotency._seen = processes[i % len(processes)]
+                    response = client.post('/payment_webhook/paystack/', body, content_type='application/json', headers=headers)
+                    assert response.status_code == 200, response.content
+            elapsed = time.perf_counter() - started
+
+            answered = sum(value for _, value in metrics.WEBHOOK_DUPLICATES.dump())
+            results[dedup] = queries[0]
+            print(f"{'on' if dedup else 'off':<6} {queries[0]:>8} {queries[0] * 10000 / args.events:>9.0f} {args.events / elapsed:>13.1f} "
+                  f"{answered:>11} of {args.events - unique:<7}")
+            assert Payment.objects.filter(status=PaymentStatus.COMPLETED).count() == unique
+
+    print(f"saved {(results[False] - results[True]) * 10000 / args.events:.0f} queries per 10k deliveries "
+          f"({1 - results[True] / results[False]:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Payment export throughput and memory: rows per second and peak RSS for each
+export format, payments and daily totals. Each export runs in its own
+forked process writing to /dev/null, so the peak RSS reported is that
+export's own.
+
+Runs against a throwaway test database created from settings.DATABASES.
+Use PostgreSQL (server-side cursors) and --rows 10000000 for production
+sized numbers.
+
+    python -m benchmarks.exports [--rows 1000000] [--formats csv,jsonl,parquet]
+'''
+import argparse
+import multiprocessing
+import resource
+import time
+
+from datetime import timedelta
+
+from benchmarks import setup_django, test_database
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 #  KiB on Linux
+
+
+def run_export(format, daily_totals, chunk_size, results):
+    from django.db import connections
+
+    from payments import exports
+
+    connections.close_all()
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    written = 0
+    with open('/dev/null', 'wb') as output:
+        for chunk in exports.export(exports.payments_queryset(), format, daily_totals, chunk_size):
+            output.write(chunk)
+            written += len(chunk)
+    results.put((time.perf_counter() - started, written, baseline, peak_rss_mb()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--formats', default='csv,jsonl,parquet')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connections
+    from django.utils import timezone
+    from django.utils.crypto import get_random_string
+
+    from payments import exports
+    from payments.models import Payment, PaymentStatus
+
+    with test_database():
+        user = User.objects.create(username='benchmark')
+        now = timezone.now()
+        started = time.perf_counter()
+        for start in range(0, args.rows, 10_000):
+            Payment.objects.bulk_create([
+                Payment(
+                    user=user,
+                    amount=(i % 1000 + 1) * 100,
+                    reference=f"{i:012d}{get_random_string(4)}",
+                    date=now - timedelta(minutes=i % 525_600),
+                    status=PaymentStatus.values[i % 3],
+                    processor=('paystack', 'credo')[i % 2],
+                )
+                for i in range(start, min(start + 10_000, args.rows))
+            ])
+        print(f"created {args.rows:,} payments in {time.perf_counter() - started:.1f}s")
+        connections.close_all()
+
+        context = multiprocessing.get_context('fork')
+        for format in args.formats.split(','):
+            if not exports.format_available(format):
+                print(f"{format}: skipped, not available")
+                continue
+            for daily_totals in (False, True):
+                results = context.Queue()
+                process = context.Process(target=run_export, args=(format, daily_totals, args.chunk_size, results))
+                process.start()
+                elapsed, written, baseline, peak = results.get()
+                process.join()
+                label = f"{format}{' daily totals' if daily_totals else ''}"
+                rate = f"{args.rows / elapsed:>12,.0f} rows/s" if not daily_totals else f"{elapsed:>9.2f}s total"
+                print(f"{label:<22} {rate}  {written / 2**20:>8.1f} MiB  peak RSS {peak:,.0f} MiB (+{peak - baseline:,.0f} MiB)")
+
+
+if __name__ == '__main__':
+    main()
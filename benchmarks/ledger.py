@@ -0,0 +1,91 @@
+'''
+Payment ledger throughput: how fast events are recorded in batches and how
+fast projections are rebuilt from them, from scratch and incrementally from
+snapshots.
+
+Runs against a throwaway test database created from settings.DATABASES.
+
+    python -m benchmarks.ledger [--payments 100000] [--events-per-payment 3]
+'''
+import argparse
+import random
+import time
+
+from datetime import timedelta
+
+from benchmarks import setup_django, test_database
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--payments', type=int, default=100_000)
+    parser.add_argument('--events-per-payment', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.utils import timezone
+
+    from payments import ledger
+    from payments.models import Payment, PaymentEventSource
+    from payments.utils import allocate_references
+
+    from store.utils import OnlineTransactionStatus
+
+    statuses = [OnlineTransactionStatus.PENDING, OnlineTransactionStatus.SUCCESSFUL, OnlineTransactionStatus.FAILED]
+
+    def events_for(payments, count):
+        for payment in payments:
+            for _ in range(count):
+                status = random.choice(statuses)
+                payload = {
+                    'status': True,
+                    'data': {
+                        'status': status,
+                        'reference': payment.reference,
+                        'payment_date': timezone.now() - timedelta(seconds=random.randint(0, 86400)),
+                        'nonce': random.random(), #  keeps payloads distinct
+                    },
+                }
+                yield ledger.build_event(payment, PaymentEventSource.VERIFICATION, payload)
+
+    with test_database():
+        user = User.objects.create(username='benchmark')
+        references = allocate_references(Payment, args.payments)
+        Payment.objects.bulk_create(
+            [Payment(user=user, amount=40000, reference=reference, processor='paystack') for reference in references],
+            batch_size=args.batch_size,
+        )
+        payments = list(Payment.objects.only('id', 'reference', 'processor'))
+
+        started = time.perf_counter()
+        events = list(events_for(payments, args.events_per_payment))
+        built = time.perf_counter() - started
+        started = time.perf_counter()
+        ledger.record_events(events, batch_size=args.batch_size)
+        recorded = time.perf_counter() - started
+        print(f"built {len(events):,} events in {built:.2f}s ({len(events) / built:,.0f}/s), "
+              f"recorded in {recorded:.2f}s ({len(events) / recorded:,.0f}/s)")
+
+        for label, options in [
+            ('rebuild from scratch + snapshot', {'from_scratch': True, 'take_snapshots': True}),
+            ('rebuild from snapshots, no new events', {'take_snapshots': True}),
+        ]:
+            started = time.perf_counter()
+            stats = ledger.rebuild_projections(batch_size=args.batch_size, **options)
+            elapsed = time.perf_counter() - started
+            print(f"{label}: {stats['events']:,} events, {stats['changed']:,} payments changed "
+                  f"in {elapsed:.2f}s ({stats['events'] / elapsed:,.0f} events/s)")
+
+        new_events = list(events_for(random.sample(payments, len(payments) // 10), 1))
+        ledger.record_events(new_events, batch_size=args.batch_size)
+        started = time.perf_counter()
+        stats = ledger.rebuild_projections(batch_size=args.batch_size, take_snapshots=True)
+        elapsed = time.perf_counter() - started
+        print(f"rebuild from snapshots after {len(new_events):,} new events: {stats['events']:,} events replayed "
+              f"in {elapsed:.2f}s ({stats['events'] / elapsed:,.0f} events/s)")
+
+
+if __name__ == '__main__':
+    main()
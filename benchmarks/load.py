@@ -0,0 +1,865 @@
+'''
+End-to-end load scenarios against the local gateway simulators (see
+benchmarks/simulators.py), under WSGI and ASGI. Reports requests per second,
+p50/p95/p99 latency, errors, database queries per request and memory for
+every scenario, and writes them to a JSON file that benchmarks.compare can
+diff against another run.
+
+Scenarios sending requests to the app:
+
+    checkout_burst  every user starts a payment at once (checkout and initialize)
+    callback_storm  users come back from the gateway, most of them more than once (callback and verify)
+    webhook_replay  signed Paystack and Credo webhooks, each delivered several times
+    checkout_return every payment's webhook and its callbacks, in random order
+    mixed           all of the above interleaved with checkout page views
+    webhook_rate    webhooks sent at --rate a second into the webhook queue (PAYMENT_WEBHOOK_QUEUE), drained alongside
+    failover        checkouts with PAYMENT_ROUTING on while Paystack is five times slower and fails half its calls
+
+Scenarios timing one layer, a "request" being one call of it:
+
+    gateway_pool    verify calls opening a connection each (as before payments/transport.py) and through the pooled transport
+    gateway_outage  verify calls to a gateway answering every call with a slow 503, through the circuit breaker
+    hot_queries     the reconciliation, user history and dashboard queries, with their query plans
+    cold_start      new processes loading the app and answering their first request, and processor lookups
+
+The app is driven in-process through Django's WSGI and ASGI request
+handlers (the test client and the async test client) by --concurrency
+workers, so no server sits in front of it. Each mode runs in a process of
+its own, since PAYMENT_ASYNC_VIEWS and the gateway URLs are read at
+startup. Runs against a throwaway test database created from
+settings.DATABASES, filled with --seed-rows older payments first (e.g.
+10000000 to time checkouts and the hot queries against a large table).
+
+A result is flagged as not valid, and the run exits with status 1, when
+requests failed with a 5xx (the reasons are counted, e.g. SQLite's
+"database is locked") or webhook_rate fell short of --rate. SQLite takes
+one writer at a time, so with more than a few clients it measures its own
+lock rather than the app: set DATABASE_ENGINE and the DATABASE_* variables
+(see processor_di/settings.py) to run the suite against PostgreSQL.
+
+    python -m benchmarks.load [--scenarios all] [--modes wsgi,asgi] [--requests 2000] [--concurrency 32] [--seed-rows 0] [--output results.json]
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from benchmarks import setup_django, test_database
+from benchmarks.simulators import Behaviour, CredoSimulator, PaystackSimulator, add_behaviour_arguments, behaviour_from_arguments
+
+
+MODES = ('wsgi', 'asgi')
+
+
+@dataclass
+class Call:
+    method: str
+    path: str
+    body: bytes = None
+    headers: dict = field(default_factory=dict)
+
+
+@dataclass
+class Context:
+    users: list
+    paystack: PaystackSimulator
+    credo: CredoSimulator
+    args: argparse.Namespace
+    mode: str
+    clients: list = field(default_factory=list)
+    run: Callable = None #  run_wsgi or run_asgi
+
+
+@dataclass
+class Measured:
+    '''
+    What a scenario that makes its own calls measured: [samples] of
+    (seconds, status), [elapsed] seconds, why calls failed in [errors],
+    numbers of its own in [details], and [warnings] that make the result
+    not valid.
+    '''
+    samples: list
+    elapsed: float
+    errors: Counter = field(default_factory=Counter)
+    details: dict = field(default_factory=dict)
+    warnings: list = field(default_factory=list)
+
+
+def _create_payments(context, count, processors=('paystack',)):
+    from payments.models import Payment
+    from payments.utils import allocate_references
+
+    references = allocate_references(Payment, count)
+    Payment.objects.bulk_create([
+        Payment(user=context.users[i % len(context.users)], amount=40000, reference=reference, processor=processors[i % len(processors)])
+        for i, reference in enumerate(references)
+    ], batch_size=1000)
+    return [(reference, processors[i % len(processors)]) for i, reference in enumerate(references)]
+
+
+def seed_payments(users, rows, days=365):
+    '''
+    Creates [rows] payments of [users] spread evenly over the last [days]
+    days, all settled except for a mix of statuses in the last two days, as
+    reconcile_payments leaves them.
+    '''
+    from django.utils import timezone as django_timezone
+    from django.utils.crypto import get_random_string
+
+    from payments.models import Payment, PaymentStatus
+
+    now = django_timezone.now()
+    span = days * 24 * 60 #  minutes
+    settled = (PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+    for start in range(0, rows, 10_000):
+        Payment.objects.bulk_create([
+            Payment(
+                user=users[i % len(users)],
+                amount=(i % 1000 + 1) * 100,
+                reference=f"seed{i:012d}{get_random_string(4)}",
+                date=now - timedelta(minutes=age),
+                status=PaymentStatus.values[i % 3] if age < 2 * 24 * 60 else settled[i % 2],
+                processor=('paystack', 'credo')[i % 2],
+            )
+            for i in range(start, min(start + 10_000, rows))
+            for age in [span * (rows - i) // rows] #  minutes, oldest first as they were created
+        ])
+
+
+def checkout_burst(context, count):
+    return [Call('post', '/payment_gateway_checkout/') for _ in range(count)]
+
+
+def callback_storm(context, count):
+    repeats = context.args.repeats
+    payments = _create_payments(context, max(1, count // repeats))
+    calls = [Call('get', f'/payment_callback/?reference={reference}') for reference, _ in payments for _ in range(repeats)]
+    random.shuffle(calls)
+    return calls[:count]
+
+
+def _webhook_call(context, reference, processor):
+    simulator = context.paystack if processor == 'paystack' else context.credo
+    body, headers = simulator.webhook(reference)
+    return Call('post', f'/payment_webhook/{processor}/', body, headers)
+
+
+def webhook_replay(context, count):
+    repeats = context.args.repeats
+    calls = []
+    for reference, processor in _create_payments(context, max(1, count // repeats), ('paystack', 'credo')):
+        calls.extend([_webhook_call(context, reference, processor)] * repeats)
+    random.shuffle(calls)
+    return calls[:count]
+
+
+def checkout_return(context, count):
+    repeats = context.args.repeats
+    calls = []
+    for reference, processor in _create_payments(context, max(1, count // (repeats + 1)), ('paystack', 'credo')):
+        calls.append(_webhook_call(context, reference, processor))
+        calls.extend(Call('get', f'/payment_callback/?reference={reference}') for _ in range(repeats))
+    random.shuffle(calls)
+    return calls[:count]
+
+
+def mixed(context, count):
+    calls = [
+        *checkout_burst(context, count * 4 // 10),
+        *callback_storm(context, count * 25 // 100),
+        *webhook_replay(context, count * 25 // 100),
+        *[Call('get', '/checkout/') for _ in range(count // 10)],
+    ]
+    random.shuffle(calls)
+    return calls
+
+
+def webhook_rate(context, count):
+    '''
+    Sends a webhook for each of [count] payments at --rate a second, open
+    loop, with the webhook queue on and one thread draining it, and checks
+    the rate was kept up and how long the queue took to empty.
+    '''
+    from django.conf import settings
+    from django.db import close_old_connections
+
+    from store.webhooks import drain_webhook_events, webhook_queue_stats
+
+    calls = [_webhook_call(context, reference, processor) for reference, processor in _create_payments(context, count, ('paystack', 'credo'))]
+    rate = context.args.rate
+    stop = threading.Event()
+    drain_failures = Counter()
+
+    def drain(): #  as process_webhooks does, a batch that fails is retried
+        while not stop.is_set():
+            try:
+                drained = drain_webhook_events()
+            except Exception as e:
+                drain_failures[f"{type(e).__name__}: {e}"[:200]] += 1
+                drained = 0
+            if not drained:
+                stop.wait(0.05)
+        close_old_connections()
+
+    queue = settings.PAYMENT_WEBHOOK_QUEUE
+    settings.PAYMENT_WEBHOOK_QUEUE = True
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+    errors = Counter()
+    try:
+        samples, elapsed = context.run(context.clients, calls, rate=rate, errors=errors)
+        answered = time.perf_counter()
+        backlog = webhook_queue_stats()
+        while backlog['pending'] + backlog['processing'] and time.perf_counter() - answered < 60:
+            time.sleep(0.1)
+            backlog = webhook_queue_stats()
+        drained = time.perf_counter() - answered
+    finally:
+        settings.PAYMENT_WEBHOOK_QUEUE = queue
+        stop.set()
+        drainer.join()
+
+    achieved = len(samples) / elapsed
+    measured = Measured(samples, elapsed, errors, details={
+        'target_per_second': rate,
+        'achieved_per_second': round(achieved, 1),
+        'queue_drained_seconds_after_last': round(drained, 2),
+        'left_in_queue': backlog['pending'] + backlog['processing'],
+        'failed_in_queue': backlog['failed'],
+        'drain_failures': dict(drain_failures),
+    })
+    if achieved < rate * 0.95:
+        measured.warnings.append(f"sent {achieved:.0f} webhooks/s of the {rate} targeted: the client or the app could not keep up, "
+                                 f"so the latencies are not those at {rate}/s")
+    if drain_failures:
+        reasons = ', '.join(f"{count} x {reason}" for reason, count in drain_failures.most_common(3))
+        measured.warnings.append(f"draining the queue failed {sum(drain_failures.values())} times ({reasons})")
+    if backlog['pending'] + backlog['processing']:
+        measured.warnings.append(f"{backlog['pending'] + backlog['processing']} webhooks still queued 60s after the last was answered")
+    return measured
+
+
+def _reset_breakers():
+    from django.conf import settings
+    from django.core.cache import caches
+
+    caches[settings.PAYMENT_CIRCUIT_BREAKER_CACHE_ALIAS].clear()
+
+
+def failover(context, count):
+    '''
+    [count] checkouts with routing on while Paystack is five times slower
+    and answers half its calls with a 503, counting the payments each
+    gateway initialized.
+    '''
+    from django.conf import settings
+
+    from payments import routing
+
+    paystack_behaviour, routing_on = context.paystack.behaviour, settings.PAYMENT_ROUTING
+    context.paystack.behaviour = replace(paystack_behaviour, latency=paystack_behaviour.latency * 5, error_rate=0.5)
+    settings.PAYMENT_ROUTING, routing._router = True, None #  the router is built from the settings on first use
+    before = {simulator: simulator.stats.copy() for simulator in (context.paystack, context.credo)}
+    errors = Counter()
+    try:
+        samples, elapsed = context.run(context.clients, checkout_burst(context, count), errors=errors)
+    finally:
+        context.paystack.behaviour = paystack_behaviour
+        settings.PAYMENT_ROUTING, routing._router = routing_on, None
+        _reset_breakers()
+
+    calls = {name: simulator.stats - before[simulator] for name, simulator in (('paystack', context.paystack), ('credo', context.credo))}
+    initialized = {name: stats['initialize', 200] for name, stats in calls.items()}
+    return Measured(samples, elapsed, errors, details={
+        'initialized': initialized,
+        'paystack_503s': calls['paystack']['initialize', 503],
+        'not_initialized': len(samples) - sum(initialized.values()),
+    })
+
+
+def _call_concurrently(mode, function, items, workers):
+    '''
+    Calls [function] (a coroutine function in asgi [mode]) with each of
+    [items] from [workers] threads or tasks. Returns [(seconds, status)],
+    the status being what [function] returned, and the elapsed time.
+    '''
+    if mode == 'asgi':
+        async def worker(share, samples):
+            for item in share:
+                started = time.perf_counter()
+                status = await function(item)
+                samples.append((time.perf_counter() - started, status))
+
+        async def run():
+            samples = []
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(items[i::workers], samples) for i in range(workers)))
+            return samples, time.perf_counter() - started
+
+        return asyncio.run(run())
+
+    samples = []
+
+    def worker(share):
+        results = []
+        for item in share:
+            started = time.perf_counter()
+            status = function(item)
+            results.append((time.perf_counter() - started, status))
+        samples.extend(results)
+
+    threads = [threading.Thread(target=worker, args=(items[i::workers],)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def _percentiles(samples):
+    latencies = sorted(seconds * 1000 for seconds, _ in samples)
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+        return quantiles[49], quantiles[94], quantiles[98], latencies[-1]
+    latency = latencies[0] if latencies else 0
+    return latency, latency, latency, latency
+
+
+def gateway_pool(context, count):
+    '''
+    [count] Paystack verify calls opening a connection each, as the
+    processors made them before payments/transport.py, then as many through
+    the pooled transport, counting the connections the simulator accepted
+    per call. The simulator speaks plain HTTP, so a connection is one TCP
+    handshake here; against the real gateways each also costs a TLS one.
+    '''
+    import httpx
+    import requests
+
+    from payments import paystack, transport
+
+    url = f"{paystack.URL_ROOT}/transaction/verify/{{}}"
+    headers = {'Authorization': paystack.AUTH_HEADER}
+    if context.mode == 'asgi':
+        async def unpooled(reference):
+            async with httpx.AsyncClient(timeout=transport.get_timeout()[1]) as client:
+                return (await client.get(url.format(reference), headers=headers)).status_code
+
+        async def pooled(reference):
+            return (await transport.arequest('paystack', 'GET', url.format(reference), endpoint='verify', headers=headers)).status_code
+    else:
+        def unpooled(reference):
+            return requests.get(url.format(reference), headers=headers, timeout=transport.get_timeout()).status_code
+
+        def pooled(reference):
+            return transport.request('paystack', 'GET', url.format(reference), endpoint='verify', headers=headers).status_code
+
+    references = [f'pool{i:06d}' for i in range(count)]
+    details = {}
+    for phase, function in (('connection per call', unpooled), ('pooled transport', pooled)):
+        connections = context.paystack.connections
+        samples, elapsed = _call_concurrently(context.mode, function, references, len(context.clients))
+        p50, _, p99, _ = _percentiles(samples)
+        details[phase] = {
+            'calls_per_second': round(len(samples) / elapsed, 1),
+            'p50_ms': round(p50, 2),
+            'p99_ms': round(p99, 2),
+            'connections_per_call': round((context.paystack.connections - connections) / len(samples), 3),
+        }
+    return Measured(samples, elapsed, details=details) #  the pooled calls
+
+
+def gateway_outage(context, count):
+    '''
+    [count] Paystack verify calls while every call takes --outage-latency
+    and answers 503, timing the calls the gateway answered against those
+    the circuit breaker failed at once.
+    '''
+    import httpx
+    import requests
+
+    from payments import paystack, resilience, transport
+
+    url = f"{paystack.URL_ROOT}/transaction/verify/{{}}"
+    headers = {'Authorization': paystack.AUTH_HEADER}
+
+    def outcome(error):
+        if isinstance(error, resilience.CircuitOpenError):
+            return 'circuit_open'
+        if isinstance(error, resilience.BulkheadFullError):
+            return 'bulkhead_full'
+        return 'error'
+
+    if context.mode == 'asgi':
+        async def call(reference):
+            try:
+                return str((await transport.arequest('paystack', 'GET', url.format(reference), endpoint='verify', headers=headers)).status_code)
+            except (resilience.GatewayUnavailable, httpx.HTTPError) as e:
+                return outcome(e)
+    else:
+        def call(reference):
+            try:
+                return str(transport.request('paystack', 'GET', url.format(reference), endpoint='verify', headers=headers).status_code)
+            except (resilience.GatewayUnavailable, requests.RequestException) as e:
+                return outcome(e)
+
+    behaviour = context.paystack.behaviour
+    context.paystack.behaviour = Behaviour(latency=context.args.outage_latency / 1000, distribution='fixed', error_rate=1.0)
+    try:
+        samples, elapsed = _call_concurrently(context.mode, call, [f'outage{i:06d}' for i in range(count)], len(context.clients))
+    finally:
+        context.paystack.behaviour = behaviour
+        _reset_breakers()
+
+    details = {}
+    for status in sorted({status for _, status in samples}):
+        p50, _, p99, _ = _percentiles([sample for sample in samples if sample[1] == status])
+        details[status] = {'calls': sum(1 for _, each in samples if each == status), 'p50_ms': round(p50, 3), 'p99_ms': round(p99, 3)}
+    return Measured(samples, elapsed, details=details)
+
+
+def hot_queries(context, count):
+    '''
+    The queries that run all day, [count] runs in all, with the plan the
+    database picked for each and the indexes it names.
+    '''
+    from django.db.models import Count, Sum
+    from django.utils import timezone as django_timezone
+
+    from payments.models import Payment, PaymentStatus
+
+    now = django_timezone.now()
+    user = context.users[0]
+    queries = {
+        'reconcile unprocessed': lambda: Payment.objects.filter(
+            status=PaymentStatus.UNPROCESSED, processor='paystack', date__lt=now - timedelta(minutes=30),
+        ).order_by('id').values_list('id', flat=True)[:500],
+        'user history': lambda: Payment.objects.filter(user=user).order_by('-date')[:20],
+        'dashboard, 7 days': lambda: Payment.objects.filter(
+            status=PaymentStatus.COMPLETED, processor='paystack', date__gte=now - timedelta(days=7),
+        ).values('processor').annotate(count=Count('id'), amount=Sum('amount')).order_by(),
+    }
+    indexes = [index.name for index in Payment._meta.indexes]
+    runs = max(1, count // len(queries))
+    samples, details = [], {'payments': Payment.objects.count()}
+    started = time.perf_counter()
+    for name, query in queries.items():
+        timings = []
+        for _ in range(runs):
+            began = time.perf_counter()
+            rows = len(list(query()))
+            timings.append((time.perf_counter() - began, name))
+        plan = ' | '.join(line.strip() for line in query().explain().splitlines())
+        p50, _, p99, _ = _percentiles(timings)
+        details[name] = {
+            'rows': rows, 'p50_ms': round(p50, 3), 'p99_ms': round(p99, 3),
+            'indexes': [index for index in indexes if index in plan] or None, 'plan': plan,
+        }
+        samples.extend(timings)
+    return Measured(samples, time.perf_counter() - started, details=details)
+
+
+COLD_START = '''
+import time
+started = time.perf_counter()
+import asyncio, json, sys
+import processor_di.{mode}
+loaded = time.perf_counter()
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+status = {request}.status_code
+print(json.dumps({{'load': loaded - started, 'first_request': time.perf_counter() - loaded, 'status': status,
+                  'processors_imported': [name for name in ('payments.paystack', 'payments.credo') if name in sys.modules]}}))
+'''
+FIRST_REQUEST = {'wsgi': "Client().get('/metrics')", 'asgi': "asyncio.run(AsyncClient().get('/metrics'))"}
+
+
+def cold_start(context, count):
+    '''
+    Starts --cold-starts processes that load the app through
+    processor_di.wsgi or .asgi and answer one request, and times looking up
+    the configured processor in this one.
+    '''
+    from payments.factory import get_payment_processor
+
+    script = COLD_START.format(mode=context.mode, request=FIRST_REQUEST[context.mode])
+    samples, loads, first_requests, warnings, imported = [], [], [], [], None
+    started = time.perf_counter()
+    for _ in range(context.args.cold_starts):
+        began = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+        seconds = time.perf_counter() - began
+        if process.returncode:
+            samples.append((seconds, 'failed'))
+            warnings.append(f"a cold start failed: {process.stderr.strip().splitlines()[-1] if process.stderr.strip() else process.returncode}")
+            continue
+        timings = json.loads(process.stdout.strip().splitlines()[-1])
+        samples.append((seconds, timings['status']))
+        imported = timings['processors_imported']
+        loads.append(timings['load'] * 1000)
+        first_requests.append(timings['first_request'] * 1000)
+    elapsed = time.perf_counter() - started
+
+    get_payment_processor()
+    lookups = 100_000
+    began = time.perf_counter()
+    for _ in range(lookups):
+        get_payment_processor()
+    lookup = time.perf_counter() - began
+    return Measured(samples, elapsed, warnings=warnings[:3], details={
+        'app_load_ms_p50': round(statistics.median(loads), 1) if loads else None,
+        'first_request_ms_p50': round(statistics.median(first_requests), 1) if first_requests else None,
+        'processors_imported_at_startup': imported,
+        'processor_lookup_us': round(lookup / lookups * 1e6, 3),
+    })
+
+
+SCENARIOS = {
+    'checkout_burst': checkout_burst,
+    'callback_storm': callback_storm,
+    'webhook_replay': webhook_replay,
+    'checkout_return': checkout_return,
+    'mixed': mixed,
+    'webhook_rate': webhook_rate,
+    'failover': failover,
+    'gateway_pool': gateway_pool,
+    'gateway_outage': gateway_outage,
+    'hot_queries': hot_queries,
+    'cold_start': cold_start,
+}
+
+
+def _send(client, call):
+    if call.method == 'get':
+        return client.get(call.path, headers=call.headers)
+    if call.body is None:
+        return client.post(call.path, headers=call.headers)
+    return client.post(call.path, call.body, content_type='application/json', headers=call.headers)
+
+
+def _failure(response):
+    '''
+    Why [response] failed, or None if it did not fail with a 5xx.
+    '''
+    if response.status_code < 500:
+        return None
+    if response.exc_info:
+        error = response.exc_info[1]
+        return f"{type(error).__name__}: {error}"[:200]
+    return f"HTTP {response.status_code}"
+
+
+def run_wsgi(clients, calls, rate=None, errors=None):
+    '''
+    Sends [calls] round robin from one thread per client, all starting at
+    once, each as soon as the previous one is answered, or at [rate] calls
+    a second in all. Returns [(seconds, status)] and the elapsed time, and
+    counts why calls failed in [errors].
+
+    At a [rate], latency is counted from when a call was due, so calls held
+    up by slow answers before them count as slow too.
+    '''
+    samples = []
+    origin = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(len(clients) + 1, action=lambda: origin.append(time.perf_counter()))
+
+    def worker(index, client, share):
+        barrier.wait()
+        results, failures = [], []
+        for i, call in enumerate(share):
+            if rate:
+                due = origin[0] + (i * len(clients) + index) / rate
+                time.sleep(max(0, due - time.perf_counter()))
+            else:
+                due = time.perf_counter()
+            response = _send(client, call)
+            results.append((time.perf_counter() - due, response.status_code))
+            failures.append(_failure(response))
+        samples.extend(results)
+        if errors is not None:
+            with lock:
+                errors.update(failure for failure in failures if failure)
+
+    threads = [threading.Thread(target=worker, args=(i, client, calls[i::len(clients)])) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - origin[0]
+
+
+def run_asgi(clients, calls, rate=None, errors=None):
+    '''
+    Async counterpart of run_wsgi(), one task per client on one event loop.
+    '''
+    async def worker(index, client, share, samples, origin):
+        for i, call in enumerate(share):
+            if rate:
+                due = origin + (i * len(clients) + index) / rate
+                await asyncio.sleep(max(0, due - time.perf_counter()))
+            else:
+                due = time.perf_counter()
+            response = await _send(client, call)
+            samples.append((time.perf_counter() - due, response.status_code))
+            failure = _failure(response)
+            if failure and errors is not None:
+                errors[failure] += 1
+
+    async def run():
+        samples = []
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i, client, calls[i::len(clients)], samples, started) for i, client in enumerate(clients)))
+        return samples, time.perf_counter() - started
+
+    return asyncio.run(run())
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return None
+
+
+def _metric_totals():
+    from payments import metrics
+
+    queries = requests = 0
+    for _, counts, total in metrics.HTTP_DB_QUERIES.dump():
+        queries += total
+        requests += sum(counts)
+    gateway_calls = sum(value for _, value in metrics.GATEWAY_REQUESTS.dump())
+    return queries, requests, gateway_calls
+
+
+def _wait_for_gateway_calls(timeout=10):
+    '''
+    Waits for gateway calls still being made after the responses were sent
+    (background verifications) so that they are counted with their scenario.
+    '''
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        calls = _metric_totals()[2]
+        if calls == last:
+            return
+        last = calls
+        time.sleep(0.5)
+
+
+def summarize(scenario, mode, measured, before, after, rss_before):
+    '''
+    The result of [scenario] from what it [measured], with the warnings that
+    make it not valid: requests that failed with a 5xx, and the scenario's
+    own.
+    '''
+    from django.db import connection
+
+    samples, elapsed = measured.samples, measured.elapsed
+    p50, p95, p99, slowest = _percentiles(samples)
+    statuses = Counter(status for _, status in samples)
+    queries, requests, gateway_calls = (a - b for a, b in zip(after, before))
+    errors = sum(count for status, count in statuses.items() if isinstance(status, int) and status >= 500)
+    warnings = []
+    if errors:
+        reasons = ', '.join(f"{count} x {reason}" for reason, count in measured.errors.most_common(3))
+        warnings.append(f"{errors} of {len(samples)} requests failed ({reasons or 'no exception recorded'})")
+        if any('database is locked' in reason for reason in measured.errors):
+            warnings.append('SQLite takes one writer at a time: lower --concurrency or run against PostgreSQL')
+    warnings.extend(measured.warnings)
+    return {
+        'scenario': scenario,
+        'mode': mode,
+        'database': connection.vendor,
+        'requests': len(samples),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(samples) / elapsed, 1) if elapsed else 0,
+        'latency_ms': {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2), 'max': round(slowest, 2)},
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        'errors': errors,
+        'error_reasons': dict(measured.errors.most_common(10)),
+        'db_queries_per_request': round(queries / requests, 2) if requests else None,
+        'gateway_calls': gateway_calls,
+        'rss_mb': round(_rss_mb() or 0, 1),
+        'rss_growth_mb': round((_rss_mb() or 0) - (rss_before or 0), 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), #  KiB on Linux
+        'details': measured.details,
+        'warnings': warnings,
+        'valid': not warnings,
+    }
+
+
+def run_worker(args):
+    '''
+    Runs every scenario in this process, in [args.worker] mode, and writes
+    the results to [args.worker_output].
+    '''
+    behaviour = behaviour_from_arguments(args)
+    paystack = PaystackSimulator(behaviour).start()
+    credo = CredoSimulator(behaviour).start()
+    os.environ.update({
+        'PAYMENT_ASYNC_VIEWS': str(args.worker == 'asgi'),
+        'PAYSTACK_API_URL': paystack.url,
+        'PAYSTACK_SECRET_KEY': paystack.secret_key,
+        'CREDO_API_URL': credo.url,
+        'CREDO_WEBHOOK_TOKEN': credo.webhook_token,
+        'CREDO_BUSINESS_CODE': credo.business_code,
+    })
+    os.environ.setdefault('PAYMENT_LOG_LEVEL', 'WARNING') #  one INFO line per payment would be measured too
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import AsyncClient, Client
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment() #  DEBUG off, so queries are not kept in memory, and the test client's host allowed
+    logging.getLogger('django.request').setLevel(logging.CRITICAL) #  failed requests are counted by reason in their result instead
+    results = []
+    with test_database():
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL') #  readers do not wait for the writer
+
+        users = [User.objects.create_user(username=f'load{i}', email=f'load{i}@example.com') for i in range(args.concurrency)]
+        if args.seed_rows:
+            started = time.perf_counter()
+            seed_payments(users, args.seed_rows)
+            print(f"{args.worker:<5} seeded {args.seed_rows:,} payments in {time.perf_counter() - started:.1f}s", flush=True)
+        context = Context(users, paystack, credo, args, args.worker)
+        if args.worker == 'asgi':
+            context.clients = [AsyncClient(raise_request_exception=False) for _ in users]
+            context.run = run_asgi
+        else:
+            context.clients = [Client(raise_request_exception=False) for _ in users]
+            context.run = run_wsgi
+        for client, user in zip(context.clients, users):
+            client.force_login(user)
+        context.run(context.clients, [Call('get', '/checkout/')] * len(context.clients)) #  warm up
+
+        for scenario in args.scenarios:
+            before, rss_before = _metric_totals(), _rss_mb()
+            calls = SCENARIOS[scenario](context, args.requests)
+            if isinstance(calls, Measured): #  the scenario made its calls itself
+                measured = calls
+            else:
+                errors = Counter()
+                measured = Measured(*context.run(context.clients, calls, errors=errors), errors)
+            _wait_for_gateway_calls()
+            result = summarize(scenario, args.worker, measured, before, _metric_totals(), rss_before)
+            results.append(result)
+            print_result(result)
+
+    paystack.stop()
+    credo.stop()
+    with open(args.worker_output, 'w') as output:
+        json.dump(results, output)
+
+
+def print_result(result):
+    latency = result['latency_ms']
+    rss = f"{result['rss_mb']:.0f} MiB (+{result['rss_growth_mb']:.0f})"
+    print(f"{result['mode']:<5} {result['scenario']:<15} {result['requests']:>6} req {result['requests_per_second']:>8.1f} req/s  "
+          f"p50 {latency['p50']:>7.1f} p95 {latency['p95']:>7.1f} p99 {latency['p99']:>7.1f} ms  "
+          f"errors {result['errors']:>4}  queries/req {result['db_queries_per_request'] or 0:>5.1f}  "
+          f"gateway calls {result['gateway_calls']:>5}  rss {rss}", flush=True)
+    for name, value in result['details'].items():
+        print(f"      {name}: {json.dumps(value) if isinstance(value, (dict, list)) else value}", flush=True)
+    for warning in result['warnings']:
+        print(f"      NOT A VALID BENCHMARK: {warning}", flush=True)
+
+
+def _commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}{'-dirty' if dirty else ''}"
+
+
+def _database():
+    setup_django()
+    from django.db import connection
+
+    return connection.vendor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scenarios', default='all', help=f"Comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--modes', default='wsgi,asgi')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent clients, each logged in as its own user')
+    parser.add_argument('--repeats', type=int, default=3, help='Callbacks per payment and deliveries per webhook')
+    parser.add_argument('--rate', type=int, default=1000, help='Webhooks a second sent by webhook_rate')
+    parser.add_argument('--seed-rows', type=int, default=0, help='Older payments created before the scenarios run')
+    parser.add_argument('--cold-starts', type=int, default=10, help='Processes started by cold_start')
+    parser.add_argument('--outage-latency', type=float, default=2000, help='ms the gateway takes to fail in gateway_outage')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--worker', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-output', help=argparse.SUPPRESS)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    args.scenarios = list(SCENARIOS) if args.scenarios == 'all' else args.scenarios.split(',')
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    database = _database()
+    if database == 'sqlite' and args.concurrency > 1:
+        print(f"SQLite takes one writer at a time: expect 'database is locked' failures with --concurrency {args.concurrency}, "
+              f"and set DATABASE_ENGINE to run against PostgreSQL", flush=True)
+    results = []
+    for mode in args.modes.split(','):
+        if mode not in MODES:
+            parser.error(f"unknown mode {mode!r}")
+        with tempfile.NamedTemporaryFile(suffix='.json') as worker_output:
+            subprocess.run([sys.executable, '-m', 'benchmarks.load', *sys.argv[1:], '--worker', mode, '--worker-output', worker_output.name], check=True)
+            with open(worker_output.name) as output:
+                results.extend(json.load(output))
+
+    report = {
+        'version': 2,
+        'commit': _commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(), 'database': database},
+        'arguments': {key: value for key, value in vars(args).items() if not key.startswith('worker')},
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"results written to {args.output}")
+    invalid = [f"{result['mode']} {result['scenario']}" for result in results if not result['valid']]
+    if invalid:
+        print(f"{len(invalid)} result(s) are not valid benchmarks, see their warnings: {', '.join(invalid)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+'''
+Instrumentation overhead: what the metrics middleware and the processor and
+gateway metrics add to request latency.
+
+Each case is called with and without the instrumentation in alternation
+and the difference in median latency is reported. At these latencies that
+difference is within the run-to-run noise, so the instrumentation is also
+timed on its own (the middleware around a view that returns at once, the
+processor wrapper and gateway metrics around a method that does nothing)
+and that cost, as a share of the median latency, is what is checked
+against the 2% budget.
+
+Views are served by the test client against a throwaway test database, and
+gateway calls go to a local stub gateway, so both are far faster than in
+production and the shares reported are upper bounds.
+
+    python -m benchmarks.metrics [--requests 5000]
+'''
+import argparse
+import statistics
+import time
+import timeit
+
+from benchmarks import setup_django, test_database
+from benchmarks.simulators import Behaviour, PaystackSimulator
+
+
+BUDGET = 0.02
+
+
+def timed(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def isolated_cost(instrumented, bare, count):
+    '''
+    Seconds [instrumented] takes per call over [bare].
+    '''
+    return (timeit.timeit(instrumented, number=count) - timeit.timeit(bare, number=count)) / count
+
+
+def compare(label, instrumented, bare, count, cost):
+    '''
+    Median seconds per call of [instrumented] and [bare], called [count]
+    times each in alternation so that both see the same noise. Returns
+    whether [cost], the instrumentation timed on its own, is within budget.
+    '''
+    for _ in range(10): #  warm up
+        instrumented(), bare()
+    with_metrics, without = [], []
+    for i in range(count):
+        if i % 2:
+            with_metrics.append(timed(instrumented))
+            without.append(timed(bare))
+        else:
+            without.append(timed(bare))
+            with_metrics.append(timed(instrumented))
+    on, off = statistics.median(with_metrics), statistics.median(without)
+    share = cost / off
+    print(f"{label:<24} {off * 1e6:>8.1f} us -> {on * 1e6:>8.1f} us ({(on - off) / off:+.2%})  "
+          f"instrumentation {cost * 1e6:.1f} us = {share:.2%}")
+    return share < BUDGET
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=5000, help='Calls per case, with and without instrumentation each')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.test import Client, override_settings
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from django.test.utils import setup_test_environment
+    from django.urls import resolve
+
+    from payments import metrics, paystack, transport
+    from payments.middleware import metrics_middleware
+
+    count = args.requests
+    started = time.perf_counter()
+    for _ in range(count * 10):
+        metrics.GATEWAY_REQUESTS.inc('paystack', 'verify', '200')
+    inc = (time.perf_counter() - started) / (count * 10)
+    started = time.perf_counter()
+    for _ in range(count * 10):
+        metrics.HTTP_LATENCY.observe(0.0123, 'store:checkout', 'GET', '2xx')
+    observe = (time.perf_counter() - started) / (count * 10)
+    print(f"Counter.inc {inc * 1e9:,.0f} ns, Histogram.observe {observe * 1e9:,.0f} ns")
+
+    simulator = PaystackSimulator(Behaviour(latency=0, distribution='fixed')).start()
+    paystack.URL_ROOT = simulator.url
+
+    setup_test_environment() #  allows the test client's host
+    within_budget = []
+    with test_database():
+        user = User.objects.create_user(username='benchmark', password='benchmark-password')
+        bare_middleware = [name for name in settings.MIDDLEWARE if name != 'payments.middleware.metrics_middleware']
+
+        response = HttpResponse()
+        view = lambda request: response
+        middleware = metrics_middleware(view)
+        for name, path in [('checkout view', '/checkout/'), ('login view', '/login/')]:
+            request = RequestFactory().get(path)
+            request.resolver_match = resolve(path)
+            cost = isolated_cost(lambda: middleware(request), lambda: view(request), count * 10)
+
+            # a client's handler loads the middleware on its first request
+            instrumented = Client()
+            instrumented.force_login(user)
+            instrumented.get(path)
+            bare = Client()
+            bare.force_login(user)
+            with override_settings(MIDDLEWARE=bare_middleware):
+                bare.get(path)
+
+            within_budget.append(compare(name, lambda: instrumented.get(path), lambda: bare.get(path), count, cost))
+
+        processor = paystack.PaystackProcessor()
+        verify = paystack.PaystackProcessor.verify_payment.__wrapped__
+        observe = transport._observe
+        nothing = lambda self, reference: True
+        instrumented_nothing = metrics.instrument(nothing, 'verify_payment')
+        cost = isolated_cost(
+            lambda: (instrumented_nothing(processor, 'benchmark'), observe('paystack', 'verify', 0.0, '200')),
+            lambda: (nothing(processor, 'benchmark'), None),
+            count * 10,
+        )
+
+        def verify_instrumented():
+            transport._observe = observe
+            processor.verify_payment('benchmark')
+
+        def verify_bare():
+            transport._observe = lambda *args: None
+            verify(processor, 'benchmark')
+
+        within_budget.append(compare('verify_payment (stub)', verify_instrumented, verify_bare, count, cost))
+        transport._observe = observe
+
+    simulator.stop()
+    print('within the 2% budget' if all(within_budget) else 'OVER the 2% budget')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''
+Webhook latency against the latency of the payment's side effects, with
+the side effects run inline in the transition's transaction (what
+post_successful_payment_actions used to invite) and written to the
+transactional outbox (payments/outbox.py) and delivered by a dispatcher
+running alongside.
+
+Signed Paystack webhooks are sent by --clients concurrent test clients,
+one per payment, against a throwaway test database. The side effect is a
+handler that sleeps for each of --side-effect-latencies milliseconds.
+Reports webhook p50/p99 and, for the outbox, how long the dispatcher took
+to deliver everything after the last webhook was answered.
+
+    python -m benchmarks.outbox [--webhooks 200] [--clients 8] [--side-effect-latencies 0 50 200]
+'''
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import setup_django, test_database
+from benchmarks.simulators import PaystackSimulator
+
+
+HANDLER = f'{__name__}.side_effect' #  the module's own globals when run with -m
+side_effect_latency = 0
+
+
+def side_effect(message):
+    time.sleep(side_effect_latency)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run_dispatcher(stop, threads):
+    from django.db import OperationalError, connections
+
+    from payments.outbox import dispatch_batch
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while not stop.is_set():
+            try:
+                claimed = dispatch_batch(100, executor)
+            except OperationalError: #  SQLite refuses a claim that races a webhook's write, as in dispatch_outbox try again
+                claimed = 0
+            if not claimed:
+                stop.wait(0.05)
+    connections.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--webhooks', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--side-effect-latencies', type=float, nargs='+', default=[0, 50, 200], metavar='MS')
+    args = parser.parse_args()
+
+    simulator = PaystackSimulator() #  only signs the webhooks
+    os.environ.update({'PAYSTACK_SECRET_KEY': simulator.secret_key, 'PAYMENT_LOG_LEVEL': 'ERROR'})
+    setup_django()
+    global side_effect_latency
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    from django.utils.module_loading import import_string
+
+    from benchmarks.load import Call, run_wsgi
+    from payments import outbox
+    from payments.models import OutboxMessage, Payment
+    from payments.utils import allocate_references
+
+    setup_test_environment()
+    settings.PAYMENT_OUTBOX_HANDLERS = {'payment.completed': [HANDLER], 'payment.failed': []}
+    settings.PAYMENT_OUTBOX_HANDLER_CONCURRENCY = {HANDLER: 16}
+    enqueue = outbox.enqueue
+
+    def run_inline(payments, status):
+        for payment in payments:
+            for handler in outbox.handlers_for(status):
+                import_string(handler)(OutboxMessage(payment_id=payment.pk))
+        return []
+
+    print(f"{args.webhooks} webhooks from {args.clients} clients")
+    print(f"{'side effect':>11} {'mode':<7} {'p50 ms':>8} {'p99 ms':>8} {'webhooks/s':>11} {'delivered after':>16}")
+    with test_database():
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL')
+        user = User.objects.create_user(username='outbox', email='outbox@example.com')
+        clients = [Client(raise_request_exception=False) for _ in range(args.clients)]
+
+        for latency in args.side_effect_latencies:
+            side_effect_latency = latency / 1000
+            for mode in ('inline', 'outbox'):
+                references = allocate_references(Payment, args.webhooks)
+                Payment.objects.bulk_create([Payment(user=user, amount=40000, reference=reference, processor='paystack') for reference in references])
+                calls = []
+                for reference in references:
+                    body, headers = simulator.webhook(reference)
+                    calls.append(Call('post', '/payment_webhook/paystack/', body, headers))
+
+                stop = threading.Event()
+                dispatcher = threading.Thread(target=run_dispatcher, args=(stop, 16))
+                if mode == 'inline':
+                    outbox.enqueue = run_inline
+                else:
+                    dispatcher.start()
+                try:
+                    samples, elapsed = run_wsgi(clients, calls)
+                finally:
+                    outbox.enqueue = enqueue
+
+                delivered = ''
+                if mode == 'outbox':
+                    answered = time.perf_counter()
+                    while OutboxMessage.objects.exists():
+                        time.sleep(0.01)
+                    delivered = f"{time.perf_counter() - answered:.2f} s"
+                    stop.set()
+                    dispatcher.join()
+
+                latencies = [seconds * 1000 for seconds, _ in samples]
+                failures = sum(status != 200 for _, status in samples)
+                print(f"{latency:>8g} ms {mode:<7} {statistics.median(latencies):>8.1f} {percentile(latencies, 0.99):>8.1f} "
+                      f"{len(samples) / elapsed:>11.1f} {delivered:>16}" + (f" ({failures} failed)" if failures else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Daily totals read from the rollups (payments/rollups.py) against summing
+Payment, and what keeping the rollups costs: the backfill, and the
+queries and latency the rollups add to each transition.
+
+Creates --rows payments spread evenly over the last --days days, all
+settled except for a mix of statuses in the last two days (older
+payments are settled by reconcile_payments), in a throwaway test
+database from settings.DATABASES, backfills their rollups
+with --processes processes, and times the daily totals of the last 30
+days and of all days both ways. Use PostgreSQL and --rows 20000000 for
+production sized numbers.
+
+    python -m benchmarks.rollups [--rows 1000000] [--days 730] [--processes 4] [--transitions 1000]
+'''
+import argparse
+import statistics
+import time
+
+from datetime import timedelta
+
+from benchmarks import setup_django, test_database
+from benchmarks.batch import counting_queries
+
+
+def timed(query, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        query()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=730, help='Days the payments are spread over')
+    parser.add_argument('--processes', type=int, default=4, help='Backfill processes')
+    parser.add_argument('--transitions', type=int, default=1000, help='Payments settled with and without the rollups')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each query, the median is reported')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.utils import timezone
+    from django.utils.crypto import get_random_string
+
+    from payments import exports, rollups, transitions
+    from payments.models import Payment, PaymentRollup, PaymentStatus
+
+    with test_database():
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode=WAL') #  lets the backfill processes read while one writes
+        user = User.objects.create(username='rollups')
+        now = timezone.now()
+        span = args.days * 24 * 60 #  minutes
+        settled = (PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+        started = time.perf_counter()
+        for start in range(0, args.rows, 10_000):
+            Payment.objects.bulk_create([
+                Payment(
+                    user=user,
+                    amount=(i % 1000 + 1) * 100,
+                    reference=f"{i:012d}{get_random_string(4)}",
+                    date=now - timedelta(minutes=age),
+                    status=PaymentStatus.values[i % 3] if age < 2 * 24 * 60 else settled[i % 2],
+                    processor=('paystack', 'credo')[i % 2],
+                )
+                for i in range(start, min(start + 10_000, args.rows))
+                for age in [span * (args.rows - i) // args.rows] #  minutes, oldest first as they were created
+            ])
+        print(f"created {args.rows:,} payments in {time.perf_counter() - started:.1f}s")
+
+        settings.PAYMENT_ROLLUPS = True
+        started = time.perf_counter()
+        call_command('backfill_rollups', processes=args.processes, chunk_days=30, stdout=open('/dev/null', 'w'))
+        print(f"backfilled {PaymentRollup.objects.count():,} rollup rows with {args.processes} processes "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        today = rollups.day_start(timezone.localdate() + timedelta(days=1))
+        windows = {'last 30 days': today - timedelta(days=30), f'all {args.days} days': None}
+        print(f"{'daily totals':<16} {'Payment ms':>11} {'rollups ms':>11} {'rows':>6}")
+        for name, date_from in windows.items():
+            settings.PAYMENT_ROLLUPS = False
+            scan = b''.join(exports.export_daily_totals('csv', date_from=date_from, date_to=today))
+            scanned = timed(lambda: b''.join(exports.export_daily_totals('csv', date_from=date_from, date_to=today)), args.repeat)
+            settings.PAYMENT_ROLLUPS = True
+            rolled_up = b''.join(exports.export_daily_totals('csv', date_from=date_from, date_to=today))
+            assert rolled_up == scan, 'rollups differ from the payments'
+            read = timed(lambda: b''.join(exports.export_daily_totals('csv', date_from=date_from, date_to=today)), args.repeat)
+            rows = scan.count(b'\n') - 1 #  less the header
+            print(f"{name:<16} {scanned:>11.1f} {read:>11.1f} {rows:>6}")
+
+        print(f"{'settling':<16} {'queries':>11} {'ms each':>11}")
+        for enabled in (True, False):
+            settings.PAYMENT_ROLLUPS = enabled
+            payments = Payment.objects.bulk_create([
+                Payment(user=user, amount=40000, reference=f"settle{enabled:d}{i:06d}{get_random_string(4)}", processor='paystack')
+                for i in range(args.transitions)
+            ])
+            queries = [0]
+            started = time.perf_counter()
+            with counting_queries(queries):
+                for payment in payments:
+                    transitions.transition(payment, PaymentStatus.COMPLETED)
+            elapsed = time.perf_counter() - started
+            print(f"{'with rollups' if enabled else 'without':<16} {queries[0] / len(payments):>11.1f} {elapsed * 1000 / len(payments):>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Webhook signature verifications per second on one core, before and after
+the precomputed verifiers in payments/signatures.py.
+
+    python -m benchmarks.signatures [--seconds 2] [--rotating-keys 1]
+'''
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from benchmarks import setup_django
+
+
+SECRET = 'sk_test_benchmark'
+TOKEN = 'credo-webhook-token'
+BUSINESS_CODE = '700607001390003'
+
+
+def run(label, func, seconds):
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            func()
+        count += 100
+    rate = count / (time.perf_counter() - started)
+    print(f"{label:<45} {rate:>12,.0f} verifications/s")
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=2, help='Time to run each case for')
+    parser.add_argument('--rotating-keys', type=int, default=1, help='Active secrets besides the current one')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.test import RequestFactory
+
+    from payments.signatures import HMACSignatureVerifier, StaticSignatureVerifier
+
+    previous = [f"{SECRET}_old{i}" for i in range(args.rotating_keys)]
+    paystack = HMACSignatureVerifier([SECRET], hashlib.sha512)
+    paystack_rotating = HMACSignatureVerifier([SECRET, *previous], hashlib.sha512)
+    credo = StaticSignatureVerifier([hashlib.sha512(f"{TOKEN}{BUSINESS_CODE}".encode()).hexdigest()])
+    credo_signature = hashlib.sha512(f"{TOKEN}{BUSINESS_CODE}".encode()).hexdigest()
+    factory = RequestFactory()
+
+    for size in (1024, 64 * 1024):
+        body = json.dumps({'event': 'charge.success', 'data': {'reference': 'x', 'padding': 'x' * size}}).encode()
+        signature = paystack.sign(body)
+        print(f"-- {len(body):,} byte body")
+
+        def paystack_before():
+            request = factory.post('/payment_webhook/', body, content_type='application/json')
+            payload_hash = hmac.new(SECRET.encode('utf-8'), request.body, hashlib.sha512).hexdigest()
+            assert hmac.compare_digest(payload_hash, signature)
+
+        def paystack_after(verifier=paystack):
+            request = factory.post('/payment_webhook/', body, content_type='application/json')
+            assert verifier.verify(request, signature)
+
+        run('paystack, per-request key', paystack_before, args.seconds)
+        run('paystack, precomputed key', paystack_after, args.seconds)
+        run(f'paystack, precomputed, {1 + len(previous)} active keys', lambda: paystack_after(paystack_rotating), args.seconds)
+
+    print('-- credo')
+
+    def credo_before():
+        request = factory.post('/payment_webhook/', b'{}', content_type='application/json')
+        expected = hashlib.sha512(f"{os.getenv('CREDO_WEBHOOK_TOKEN', TOKEN)}{os.getenv('CREDO_BUSINESS_CODE', BUSINESS_CODE)}".encode()).hexdigest()
+        assert expected == credo_signature
+
+    def credo_after():
+        request = factory.post('/payment_webhook/', b'{}', content_type='application/json')
+        assert credo.verify(request, credo_signature)
+
+    run('credo, per-request hash', credo_before, args.seconds)
+    run('credo, precomputed hash', credo_after, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
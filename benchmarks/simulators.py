@@ -0,0 +1,364 @@
+'''
+Local simulators of the Paystack and Credo APIs for load tests: transaction
+initialize, verify and list, with configurable latency and error
+distributions, and signed webhooks.
+
+The outcome of a reference (success, failure or still pending) is derived
+from a hash of it, so every process verifying a reference, and every replay
+of its webhook, sees the same outcome. Only the references initialized with
+a simulator, and when, are kept, for its transaction list to page through.
+
+Point the processors at a simulator with PAYSTACK_API_URL and CREDO_API_URL.
+To run both on their own:
+
+    python -m benchmarks.simulators [--paystack-port 8101] [--credo-port 8102] [--latency 80] [--error-rate 0.01]
+'''
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+@dataclass
+class Behaviour:
+    '''
+    How a simulated gateway answers. Latencies are in seconds.
+
+    [distribution] is 'fixed' ([latency] every time), 'uniform' (between
+    latency * (1 - spread) and latency * (1 + spread)) or 'lognormal' (a
+    median of [latency] and a log standard deviation of [spread]).
+    [error_rate] of the calls answer 503, and [slow_rate] of them take
+    [slow_latency] instead, to model a gateway's long tail or timeouts.
+    [failed_rate] and [pending_rate] of the references verify as failed or
+    still pending.
+    '''
+    latency: float = 0.08
+    distribution: str = 'lognormal'
+    spread: float = 0.5
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_latency: float = 5.0
+    failed_rate: float = 0.05
+    pending_rate: float = 0.0
+
+    def delay(self):
+        if self.slow_rate and random.random() < self.slow_rate:
+            return self.slow_latency
+        if self.distribution == 'fixed':
+            return self.latency
+        if self.distribution == 'uniform':
+            return max(0.0, random.uniform(self.latency * (1 - self.spread), self.latency * (1 + self.spread)))
+        if self.distribution == 'lognormal':
+            return self.latency * math.exp(random.gauss(0, self.spread))
+        raise ValueError(f"Unknown latency distribution {self.distribution!r}")
+
+    def fails(self):
+        return bool(self.error_rate) and random.random() < self.error_rate
+
+    def outcome(self, reference):
+        '''
+        'success', 'failed' or 'pending', always the same for [reference].
+        '''
+        draw = int.from_bytes(hashlib.blake2b(reference.encode(), digest_size=8).digest(), 'big') / 2**64
+        if draw < self.failed_rate:
+            return 'failed'
+        if draw < self.failed_rate + self.pending_rate:
+            return 'pending'
+        return 'success'
+
+
+def paystack_transaction(reference, outcome, amount=40000):
+    status = {'success': 'success', 'failed': 'failed', 'pending': 'ongoing'}[outcome]
+    return {
+        'id': int(hashlib.blake2b(reference.encode(), digest_size=6).hexdigest(), 16),
+        'status': status,
+        'reference': reference,
+        'amount': amount,
+        'currency': 'NGN',
+        'paid_at': datetime.now(timezone.utc).isoformat() if outcome == 'success' else None,
+    }
+
+
+def credo_transaction(reference, outcome, amount=40000):
+    # Credo reports 0 for a successful transaction and 3 for a failed one
+    return {
+        'businessRef': reference,
+        'transRef': hashlib.blake2b(reference.encode(), digest_size=8).hexdigest(),
+        'status': {'success': 0, 'failed': 3, 'pending': 1}[outcome],
+        'transAmount': amount / 100,
+        'currencyCode': 'NGN',
+        'transactionDate': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #  keep-alive, like the real gateways
+    disable_nagle_algorithm = True #  headers and body are written separately
+    simulator = None #  set on the subclass each simulator builds
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.simulator.record_connection() #  one handler per connection, however many requests it carries
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        simulator = self.simulator
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        time.sleep(simulator.behaviour.delay())
+        path, _, query = self.path.partition('?')
+        if simulator.behaviour.fails():
+            endpoint, status, payload = simulator.endpoint(method, path), 503, {'status': False, 'message': 'Service unavailable'}
+        else: #  GET requests get their query parameters as the body
+            endpoint, status, payload = simulator.respond(method, path, json.loads(body) if body else dict(parse_qsl(query)))
+        simulator.record(endpoint, status)
+        self._send(status, payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class GatewaySimulator:
+    '''
+    Base for the gateway simulators, serving on 127.0.0.1:[port] (0 picks a
+    free port) from its own threads.
+    '''
+    routes = () #  (method, path regex, endpoint name)
+
+    def __init__(self, behaviour=None, port=0):
+        self.behaviour = behaviour or Behaviour()
+        self.stats = Counter() #  (endpoint, status) -> requests
+        self.connections = 0 #  TCP connections accepted
+        self._stats_lock = threading.Lock()
+        self.transactions = {} #  reference -> (amount, time initialized)
+        self._transactions_lock = threading.Lock()
+        handler = type('Handler', (_GatewayHandler,), {'simulator': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name=f'{type(self).__name__}', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, endpoint, status):
+        with self._stats_lock:
+            self.stats[endpoint, status] += 1
+
+    def record_connection(self):
+        with self._stats_lock:
+            self.connections += 1
+
+    def add_transaction(self, reference, amount=40000, created_at=None):
+        with self._transactions_lock:
+            self.transactions[reference] = (amount, created_at or datetime.now(timezone.utc))
+
+    def page_of_transactions(self, date_from, date_to, page, per_page):
+        '''
+        Returns ((reference, amount, time initialized) of the transactions
+        initialized between [date_from] and [date_to] on the 0-based [page],
+        the number of pages).
+        '''
+        date_from, date_to = datetime.fromisoformat(date_from), datetime.fromisoformat(date_to)
+        with self._transactions_lock:
+            window = sorted(
+                (created_at, reference, amount) for reference, (amount, created_at) in self.transactions.items()
+                if date_from <= created_at <= date_to
+            )
+        page_count = max(1, math.ceil(len(window) / per_page))
+        return [(reference, amount, created_at) for created_at, reference, amount in window[page * per_page:(page + 1) * per_page]], page_count
+
+    def endpoint(self, method, path):
+        for route_method, pattern, name in self.routes:
+            if route_method == method and re.fullmatch(pattern, path):
+                return name
+        return 'unknown'
+
+    def respond(self, method, path, body):
+        '''
+        Returns (endpoint, HTTP status, payload) for a request that did not
+        fail.
+        '''
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                return (name, *getattr(self, name)(body, *match.groups()))
+        return 'unknown', 404, {'status': False, 'message': 'Not found'}
+
+
+class PaystackSimulator(GatewaySimulator):
+
+    routes = (
+        ('POST', r'/transaction/initialize', 'initialize'),
+        ('GET', r'/transaction/verify/([^/]+)', 'verify'),
+        ('GET', r'/transaction', 'list'),
+    )
+
+    def __init__(self, behaviour=None, port=0, secret_key='sk_test_simulator'):
+        super().__init__(behaviour, port)
+        self.secret_key = secret_key
+
+    def initialize(self, body):
+        reference = body.get('reference') or ''
+        self.add_transaction(reference, int(body.get('amount') or 0))
+        access_code = hashlib.blake2b(reference.encode(), digest_size=8).hexdigest()
+        return 200, {
+            'status': True,
+            'message': 'Authorization URL created',
+            'data': {'authorization_url': f"https://checkout.paystack.com/{access_code}", 'access_code': access_code, 'reference': reference},
+        }
+
+    def verify(self, body, reference):
+        return 200, {'status': True, 'message': 'Verification successful', 'data': paystack_transaction(reference, self.behaviour.outcome(reference))}
+
+    def list(self, body):
+        page, per_page = int(body.get('page', 1)), int(body.get('perPage', 50))
+        rows, page_count = self.page_of_transactions(body['from'], body['to'], page - 1, per_page)
+        return 200, {
+            'status': True,
+            'message': 'Transactions retrieved',
+            'data': [paystack_transaction(reference, self.behaviour.outcome(reference), amount) for reference, amount, _ in rows],
+            'meta': {'perPage': per_page, 'page': page, 'pageCount': page_count},
+        }
+
+    def webhook(self, reference, amount=40000):
+        '''
+        Returns (body, headers) of the charge.success webhook Paystack sends
+        for [reference], signed with the secret key.
+        '''
+        payload = {'event': 'charge.success', 'data': paystack_transaction(reference, 'success', amount)}
+        body = json.dumps(payload).encode()
+        signature = hmac.new(self.secret_key.encode(), body, hashlib.sha512).hexdigest()
+        return body, {'X-Paystack-Signature': signature}
+
+
+class CredoSimulator(GatewaySimulator):
+
+    routes = (
+        ('POST', r'/transaction/initialize', 'initialize'),
+        ('GET', r'/transaction/([^/]+)/verify', 'verify'),
+        ('GET', r'/transactions', 'list'), #  CREDO_TRANSACTIONS_PATH
+    )
+
+    def __init__(self, behaviour=None, port=0, webhook_token='credo_simulator_token', business_code='700607000000000'):
+        super().__init__(behaviour, port)
+        self.webhook_token = webhook_token
+        self.business_code = business_code
+
+    def initialize(self, body):
+        reference = body.get('reference') or ''
+        self.add_transaction(reference, int(body.get('amount') or 0))
+        credo_reference = hashlib.blake2b(reference.encode(), digest_size=8).hexdigest()
+        return 200, {
+            'status': 200,
+            'message': 'Successfully processed',
+            'data': {'authorizationUrl': f"https://pay.credodemo.com/{credo_reference}", 'reference': reference, 'credoReference': credo_reference},
+        }
+
+    def verify(self, body, reference):
+        return 200, {'status': 200, 'message': 'Transaction fetched successfully', 'data': credo_transaction(reference, self.behaviour.outcome(reference))}
+
+    def list(self, body):
+        page, size = int(body.get('page', 0)), int(body.get('size', 50)) #  Credo's pages are zero-based
+        rows, page_count = self.page_of_transactions(body['startDate'], body['endDate'], page, size)
+        return 200, {
+            'status': 200,
+            'message': 'Transactions fetched successfully',
+            'data': {
+                'content': [credo_transaction(reference, self.behaviour.outcome(reference), amount) for reference, amount, _ in rows],
+                'totalPages': page_count,
+                'number': page,
+                'size': size,
+            },
+        }
+
+    def webhook(self, reference, amount=40000):
+        '''
+        Returns (body, headers) of the transaction.successful webhook Credo
+        sends for [reference]. Credo signs with a hash of the webhook token and
+        business code rather than of the body.
+        '''
+        data = credo_transaction(reference, 'success', amount)
+        data['transactionDate'] = int(time.time() * 1000) #  webhooks carry a timestamp in ms
+        body = json.dumps({'event': 'transaction.successful', 'data': data}).encode()
+        signature = hashlib.sha512(f"{self.webhook_token}{self.business_code}".encode()).hexdigest()
+        return body, {'X-Credo-Signature': signature}
+
+
+def add_behaviour_arguments(parser):
+    parser.add_argument('--latency', type=float, default=80, help='Gateway latency in ms (the median for lognormal)')
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'lognormal'), default='lognormal')
+    parser.add_argument('--spread', type=float, default=0.5, help='Relative spread (uniform) or log standard deviation (lognormal)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of gateway calls answered with 503')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='Share of gateway calls that take --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=5000, help='ms')
+    parser.add_argument('--failed-rate', type=float, default=0.05, help='Share of references that verify as failed')
+    parser.add_argument('--pending-rate', type=float, default=0.0, help='Share of references that verify as still pending')
+
+
+def behaviour_from_arguments(args):
+    return Behaviour(
+        latency=args.latency / 1000,
+        distribution=args.distribution,
+        spread=args.spread,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency / 1000,
+        failed_rate=args.failed_rate,
+        pending_rate=args.pending_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--paystack-port', type=int, default=8101)
+    parser.add_argument('--credo-port', type=int, default=8102)
+    add_behaviour_arguments(parser)
+    args = parser.parse_args()
+
+    behaviour = behaviour_from_arguments(args)
+    paystack = PaystackSimulator(behaviour, args.paystack_port).start()
+    credo = CredoSimulator(behaviour, args.credo_port).start()
+    print(f"PAYSTACK_API_URL={paystack.url} PAYSTACK_SECRET_KEY={paystack.secret_key}")
+    print(f"CREDO_API_URL={credo.url} CREDO_WEBHOOK_TOKEN={credo.webhook_token} CREDO_BUSINESS_CODE={credo.business_code}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for simulator in (paystack, credo):
+            print(type(simulator).__name__, dict(simulator.stats))
+            simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Concurrency stress test for payment state transitions: many threads in
+several processes race to complete the same payments, the way a callback,
+a webhook and its redeliveries do. Reports transitions per second and the
+number of duplicate side effects, which must be zero.
+
+Runs against a throwaway test database created from settings.DATABASES.
+SQLite serializes writers, so run it against PostgreSQL for meaningful
+throughput numbers.
+
+    python -m benchmarks.transitions [--payments 500] [--processes 4] [--threads 8] [--racers 4]
+'''
+import argparse
+import multiprocessing
+import random
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import setup_django, test_database
+
+
+def race(ids, threads, racers):
+    '''
+    Transitions every payment in [ids] [racers] times over [threads] threads.
+    Returns the ids this process won.
+    '''
+    from django.db import OperationalError, close_old_connections, connections
+
+    from payments import transitions
+    from payments.models import Payment, PaymentStatus
+
+    connections.close_all()
+
+    def settle(payment_id):
+        payment = Payment(pk=payment_id, status=PaymentStatus.UNPROCESSED)
+        status = PaymentStatus.COMPLETED if payment_id % 10 else PaymentStatus.FAILED
+        try:
+            while True:
+                try:
+                    return payment_id if transitions.transition(payment, status) else None
+                except OperationalError: #  SQLite "database is locked"
+                    time.sleep(0.001)
+        finally:
+            close_old_connections()
+
+    attempts = [payment_id for payment_id in ids for _ in range(racers)]
+    random.shuffle(attempts)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return [payment_id for payment_id in executor.map(settle, attempts) if payment_id is not None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--payments', type=int, default=500)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='Threads per process')
+    parser.add_argument('--racers', type=int, default=4, help='Transitions attempted per payment in every process')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connections
+
+    from payments.models import Payment
+    from payments.utils import allocate_references
+
+    with test_database():
+        user = User.objects.create(username='benchmark')
+        references = allocate_references(Payment, args.payments)
+        Payment.objects.bulk_create([Payment(user=user, amount=40000, reference=reference) for reference in references])
+        ids = list(Payment.objects.values_list('id', flat=True))
+        connections.close_all()
+
+        started = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(args.processes) as pool:
+            won = [payment_id for result in pool.starmap(race, [(ids, args.threads, args.racers)] * args.processes) for payment_id in result]
+        elapsed = time.perf_counter() - started
+
+        attempts = len(ids) * args.racers * args.processes
+        wins = Counter(won)
+        duplicates = sum(count - 1 for count in wins.values())
+        print(f"attempts={attempts} transitions={len(wins)}/{len(ids)} duplicate side effects={duplicates}")
+        print(f"{attempts / elapsed:,.0f} attempts/s, {len(wins) / elapsed:,.0f} transitions/s over {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
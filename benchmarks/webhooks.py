@@ -0,0 +1,188 @@
+'''
+Webhook parsing: decoding recorded Paystack and Credo webhook bodies into
+GatewayEvents (payments/events.py), with the json module and with orjson
+when it is installed, against the previous path of json.loads followed by
+normalizing the payload dict in place.
+
+Reports events per second, and the memory blocks each event keeps alive
+and the peak memory of decoding one, from tracemalloc.
+
+    python -m benchmarks.webhooks [--events 100000]
+'''
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime, timezone as datetime_timezone
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from benchmarks import setup_django
+from store.utils import OnlineTransactionStatus
+
+
+# Recorded webhook bodies, with the customer and card details made up
+PAYSTACK_CHARGE_SUCCESS = json.dumps({
+    "event": "charge.success",
+    "data": {
+        "id": 302961,
+        "domain": "live",
+        "status": "success",
+        "reference": "VYO3q6OkEOnAHfni",
+        "amount": 40000,
+        "message": None,
+        "gateway_response": "Approved by Financial Institution",
+        "paid_at": "2024-09-02T09:31:32.000Z",
+        "created_at": "2024-09-02T09:30:58.000Z",
+        "channel": "card",
+        "currency": "NGN",
+        "ip_address": "102.89.34.151",
+        "metadata": {"custom_fields": [], "referrer": "https://example.com/checkout/"},
+        "fees_breakdown": None,
+        "log": None,
+        "fees": 600,
+        "fees_split": None,
+        "authorization": {
+            "authorization_code": "AUTH_8dfhjjdt",
+            "bin": "408408",
+            "last4": "4081",
+            "exp_month": "12",
+            "exp_year": "2030",
+            "channel": "card",
+            "card_type": "visa ",
+            "bank": "TEST BANK",
+            "country_code": "NG",
+            "brand": "visa",
+            "reusable": True,
+            "signature": "SIG_idyuhgd87dUYSHO92D",
+            "account_name": None,
+        },
+        "customer": {
+            "id": 84312,
+            "first_name": "Ada",
+            "last_name": "Obi",
+            "email": "ada@example.com",
+            "customer_code": "CUS_hdhye17yj8qd2tx",
+            "phone": None,
+            "metadata": None,
+            "risk_action": "default",
+            "international_format_phone": None,
+        },
+        "plan": {},
+        "subaccount": {},
+        "split": {},
+        "order_id": None,
+        "requested_amount": 40000,
+        "pos_transaction_data": None,
+        "source": {"type": "web", "source": "checkout", "entry_point": "request_inline", "identifier": None},
+    },
+}).encode()
+
+CREDO_TRANSACTION_SUCCESSFUL = json.dumps({
+    "event": "transaction.successful",
+    "data": {
+        "businessCode": "700607000000000",
+        "transRef": "iDE2KcGH8bXKSgh5ZRzH",
+        "businessRef": "VYO3q6OagqL6ULPE",
+        "debitedAmount": 400.0,
+        "transAmount": 400.0,
+        "transFeeAmount": 6.0,
+        "settlementAmount": 400.0,
+        "customerId": "ada@example.com",
+        "transactionDate": 1725269492000,
+        "channelId": 0,
+        "currencyCode": "NGN",
+        "status": 0,
+        "paymentMethodType": "MasterCard",
+        "paymentMethod": "Card",
+        "customer": {"customerEmail": "ada@example.com", "firstName": "Ada", "lastName": "Obi", "phoneNo": "2348030000000"},
+        "metadata": [{"insightTag": "term", "insightTagValue": "first"}],
+    },
+}).encode()
+
+
+def legacy_paystack(body):
+    payload = json.loads(body)
+    if payload["event"].lower() == "charge.success":
+        payload["event"] = OnlineTransactionStatus.SUCCESSFUL
+    if "paid_at" in payload["data"]:
+        payload["data"]["payment_date"] = parse_datetime(payload["data"]["paid_at"])
+    return payload
+
+
+def legacy_credo(body):
+    payload = json.loads(body)
+    if payload["event"].lower() == "transaction.successful":
+        payload["event"] = OnlineTransactionStatus.SUCCESSFUL
+    elif payload["event"].lower() == "transaction.failed":
+        payload["event"] = OnlineTransactionStatus.FAILED
+    if "transactionDate" in payload["data"]:
+        moment = datetime.utcfromtimestamp(payload["data"]["transactionDate"] / 1000)
+        payload["data"]["payment_date"] = timezone.make_aware(moment, datetime_timezone.utc).astimezone(timezone.get_current_timezone())
+    if "businessRef" in payload["data"]:
+        payload["data"]["reference"] = payload["data"]["businessRef"]
+    return payload
+
+
+def measure(decode, body, count):
+    '''
+    Returns (events per second, blocks kept alive per event, peak bytes of
+    decoding one event).
+    '''
+    for _ in range(1000): #  warm up
+        decode(body)
+    started = time.perf_counter()
+    for _ in range(count):
+        decode(body)
+    rate = count / (time.perf_counter() - started)
+
+    sample = min(count, 10000)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    kept = [decode(body) for _ in range(sample)]
+    blocks = (sys.getallocatedblocks() - blocks) / sample
+    del kept
+
+    tracemalloc.start()
+    decode(body)
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    decode(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rate, blocks, peak - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=100000, help='Events decoded per case')
+    args = parser.parse_args()
+
+    setup_django()
+    from payments import credo, events, paystack
+
+    fast_json = events.orjson
+    cases = [
+        ('paystack', PAYSTACK_CHARGE_SUCCESS, legacy_paystack, paystack.EVENT_DECODER.decode),
+        ('credo', CREDO_TRANSACTION_SUCCESSFUL, legacy_credo, credo.EVENT_DECODER.decode),
+    ]
+    print(f"{'case':<28} {'events/s':>10} {'blocks/event':>13} {'peak bytes':>11}")
+    for processor, body, legacy, decode in cases:
+        backends = [('json', None)] + ([('orjson', fast_json)] if fast_json is not None else [])
+        rate, blocks, peak = measure(legacy, body, args.events)
+        print(f"{processor + ' dict + normalize':<28} {rate:>10,.0f} {blocks:>13.1f} {peak:>11,}")
+        for label, backend in backends:
+            events.orjson = backend
+            rate, blocks, peak = measure(decode, body, args.events)
+            print(f"{f'{processor} decoder ({label})':<28} {rate:>10,.0f} {blocks:>13.1f} {peak:>11,}")
+    events.orjson = fast_json
+    if fast_json is None:
+        print('orjson is not installed, pip install orjson to compare it')
+
+
+if __name__ == '__main__':
+    main()
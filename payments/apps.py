@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class PaymentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'payments'
+
+    def ready(self):
+        from . import metrics
+        from .middleware import install_query_counter
+
+        connection_created.connect(install_query_counter, dispatch_uid='payments_query_counter')
+        if settings.PAYMENT_METRICS_DIR:
+            metrics.REGISTRY.start(settings.PAYMENT_METRICS_DIR, settings.PAYMENT_METRICS_FLUSH_INTERVAL)
@@ -0,0 +1,350 @@
+'''
+Cold payment archive.
+
+Almost all activity is on the last few days of payments, but
+payments_payment (and its indexes, and the ledger) keep every payment ever
+made, so reconciliation, reports and the admin slow down as it grows.
+`manage.py archive_payments` moves settled payments older than
+PAYMENT_ARCHIVE_AFTER_MONTHS whole months out of the database, one
+calendar month at a time, into compressed files in PAYMENT_ARCHIVE_DIR:
+Parquet with zstd when pyarrow is installed (pip install pyarrow), gzipped
+JSON lines otherwise. Each payment is archived with its ledger events.
+
+Rows are sorted by reference, and every file has a Bloom filter of its
+references next to it, so an archived payment is found by reference
+(find_payment) by reading the one file, and with Parquet the one row
+group, that holds it. manifest.json lists the files with their month, row
+count, reference range and checksum.
+
+Files and the manifest are written before anything is deleted, and a file
+is only marked complete in the manifest once its payments are deleted; an
+interrupted run finishes the deletion on the next one. Payments still
+waiting on the outbox are left in the database.
+'''
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from datetime import timedelta
+from importlib.util import find_spec
+from pathlib import Path
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Exists, Min, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .idempotency import BloomFilter
+from .models import DeadLetter, OutboxMessage, Payment, PaymentEvent, PaymentStatus
+
+
+PAYMENT_FIELDS = ('reference', 'id', 'user_id', 'amount', 'currency', 'date', 'status', 'processor')
+EVENT_FIELDS = ('source', 'processor', 'gateway_status', 'occurred_at', 'payload', 'digest', 'recorded_at')
+ARCHIVED_STATUSES = (PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+FORMATS = {'parquet': 'parquet', 'jsonl': 'jsonl.gz'} #  format: file extension
+MANIFEST = 'manifest.json'
+ROW_GROUP_SIZE = 10000
+
+_filters = {} #  file name -> BloomFilter of its references
+
+
+def archive_dir():
+    return Path(settings.PAYMENT_ARCHIVE_DIR)
+
+
+def format_available(format):
+    '''
+    Whether [format] can be written here, parquet needing pyarrow.
+    '''
+    return format in FORMATS and (format != 'parquet' or find_spec('pyarrow') is not None)
+
+
+def default_format():
+    return 'parquet' if format_available('parquet') else 'jsonl'
+
+
+def month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment):
+    return month_start(month_start(moment) + timedelta(days=32))
+
+
+def cutoff(months, now=None):
+    '''
+    The start of the month [months] whole months before the current one.
+    Payments dated before it can be archived.
+    '''
+    moment = month_start(timezone.localtime(now or timezone.now()))
+    for _ in range(months):
+        moment = month_start(moment - timedelta(days=1))
+    return moment
+
+
+def archivable(date_from, date_to):
+    '''
+    Settled payments dated in [[date_from], [date_to]) that have nothing
+    left to deliver in the outbox.
+    '''
+    return (
+        Payment.objects
+        .filter(date__gte=date_from, date__lt=date_to, status__in=ARCHIVED_STATUSES)
+        .exclude(Exists(OutboxMessage.objects.filter(payment_id=OuterRef('pk'))))
+        .exclude(Exists(DeadLetter.objects.filter(payment_id=OuterRef('pk'))))
+    )
+
+
+def archivable_months(before):
+    '''
+    Yields (start, end) of every month before [before] with payments to archive.
+    '''
+    oldest = Payment.objects.filter(date__lt=before, status__in=ARCHIVED_STATUSES).aggregate(oldest=Min('date'))['oldest']
+    if oldest is None:
+        return
+    start = month_start(timezone.localtime(oldest))
+    while start < before:
+        end = min(next_month(start), before)
+        yield start, end
+        start = end
+
+
+def load_manifest():
+    try:
+        with open(archive_dir() / MANIFEST) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {'archives': []}
+
+
+def _save_manifest(manifest):
+    # written to a temporary file and renamed, so readers never see half a manifest
+    directory = archive_dir()
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.manifest-', delete=False) as output:
+        json.dump(manifest, output, indent=2)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(output.name, directory / MANIFEST)
+
+
+def _rows(queryset, chunk_size):
+    '''
+    Yields the payments of [queryset] by reference, as dicts holding their
+    ledger events, fetching the events of [chunk_size] payments at a time.
+    '''
+    rows = queryset.order_by('reference').values_list(*PAYMENT_FIELDS).iterator(chunk_size=chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(dict(zip(PAYMENT_FIELDS, row)))
+        if len(chunk) >= chunk_size:
+            yield from _with_events(chunk)
+            chunk = []
+    if chunk:
+        yield from _with_events(chunk)
+
+
+def _with_events(chunk):
+    events = {}
+    for event in PaymentEvent.objects.filter(payment_id__in=[row['id'] for row in chunk]).order_by('id').values_list('payment_id', *EVENT_FIELDS):
+        events.setdefault(event[0], []).append(dict(zip(EVENT_FIELDS, event[1:])))
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for row in chunk:
+        row['events'] = encoder.encode(events.get(row['id'], []))
+        yield row
+
+
+def _parquet_schema(pyarrow):
+    return pyarrow.schema([
+        ('reference', pyarrow.string()),
+        ('id', pyarrow.int64()),
+        ('user_id', pyarrow.int64()),
+        ('amount', pyarrow.int64()),
+        ('currency', pyarrow.string()),
+        ('date', pyarrow.timestamp('us', tz='UTC')),
+        ('status', pyarrow.string()),
+        ('processor', pyarrow.string()),
+        ('events', pyarrow.string()), #  JSON list of the payment's ledger events
+    ])
+
+
+def _write_parquet(path, rows, on_row):
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = _parquet_schema(pyarrow)
+    with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+        chunk = []
+        for row in rows:
+            on_row(row)
+            chunk.append(row)
+            if len(chunk) >= ROW_GROUP_SIZE:
+                writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema), row_group_size=ROW_GROUP_SIZE)
+                chunk = []
+        if chunk:
+            writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema), row_group_size=ROW_GROUP_SIZE)
+
+
+def _write_jsonl(path, rows, on_row):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    with gzip.open(path, 'wt') as output:
+        for row in rows:
+            on_row(row)
+            output.write(encoder.encode(row) + '\n')
+
+
+WRITERS = {
+    'parquet': _write_parquet,
+    'jsonl': _write_jsonl,
+}
+
+
+def _checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as archived:
+        for block in iter(lambda: archived.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _delete(ids, batch_size):
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        _, counts = Payment.objects.filter(id__in=batch, status__in=ARCHIVED_STATUSES).delete()
+        deleted += counts.get(Payment._meta.label, 0)
+    return deleted
+
+
+def archive_month(date_from, date_to, format=None, chunk_size=2000, batch_size=1000):
+    '''
+    Archives the archivable payments dated in [[date_from], [date_to]) to a
+    new file and deletes them. Returns the manifest entry of the file, or
+    None if there was nothing to archive.
+
+    Raises ImportError if [format] is parquet and pyarrow is not installed.
+    '''
+    format = format or settings.PAYMENT_ARCHIVE_FORMAT or default_format()
+    directory = archive_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = timezone.now().strftime('%Y%m%d%H%M%S')
+    name = f"payments-{date_from:%Y-%m}-{stamp}.{FORMATS[format]}"
+
+    ids, references = [], []
+
+    def on_row(row):
+        ids.append(row['id'])
+        references.append(row['reference'])
+
+    rows = _rows(archivable(date_from, date_to), chunk_size)
+    partial = directory / f".{name}.partial"
+    WRITERS[format](partial, rows, on_row)
+    if not ids:
+        partial.unlink()
+        return None
+    os.replace(partial, directory / name)
+
+    bloom = BloomFilter(len(references), settings.PAYMENT_ARCHIVE_FILTER_ERROR_RATE)
+    for reference in references:
+        bloom.add(reference)
+    (directory / f"{name}.bloom").write_bytes(bytes(bloom.bits))
+
+    entry = {
+        'file': name,
+        'format': format,
+        'month': f"{date_from:%Y-%m}",
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'rows': len(ids),
+        'min_reference': references[0],
+        'max_reference': references[-1],
+        'filter_size': bloom.size,
+        'filter_hashes': bloom.hashes,
+        'sha256': _checksum(directory / name),
+        'archived_at': timezone.now().isoformat(),
+        'complete': False,
+    }
+    manifest = load_manifest()
+    manifest['archives'].append(entry)
+    _save_manifest(manifest)
+
+    _delete(ids, batch_size)
+    entry['complete'] = True
+    _save_manifest(manifest)
+    return entry
+
+
+def _read_ids(entry):
+    path = archive_dir() / entry['file']
+    if entry['format'] == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(path, columns=['id']).column('id').to_pylist()
+    with gzip.open(path, 'rt') as archived:
+        return [json.loads(line)['id'] for line in archived]
+
+
+def finish_incomplete(batch_size=1000):
+    '''
+    Deletes the payments of archive files whose deletion was interrupted.
+    Returns the number of files finished.
+    '''
+    manifest = load_manifest()
+    unfinished = [entry for entry in manifest['archives'] if not entry['complete']]
+    for entry in unfinished:
+        _delete(_read_ids(entry), batch_size)
+        entry['complete'] = True
+        _save_manifest(manifest)
+    return len(unfinished)
+
+
+def _filter(entry):
+    bloom = _filters.get(entry['file'])
+    if bloom is None:
+        bits = (archive_dir() / f"{entry['file']}.bloom").read_bytes()
+        bloom = _filters[entry['file']] = BloomFilter.from_bits(bits, entry['filter_size'], entry['filter_hashes'])
+    return bloom
+
+
+def _find_in_file(entry, reference):
+    path = archive_dir() / entry['file']
+    if entry['format'] == 'parquet':
+        import pyarrow.parquet
+        # row groups are sorted by reference, so their statistics rule out all but one
+        rows = pyarrow.parquet.read_table(path, filters=[('reference', '=', reference)]).to_pylist()
+        return rows[0] if rows else None
+    with gzip.open(path, 'rt') as archived:
+        for line in archived:
+            row = json.loads(line)
+            if row['reference'] == reference:
+                row['date'] = parse_datetime(row['date'])
+                return row
+            if row['reference'] > reference: #  sorted by reference
+                return None
+    return None
+
+
+def find_archived(reference):
+    '''
+    Returns the archived payment with [reference] as a dict of its fields,
+    its ledger events under 'events', and the file it is in under
+    'archive', or None if it is not archived.
+    '''
+    for entry in reversed(load_manifest()['archives']):
+        if not entry['min_reference'] <= reference <= entry['max_reference'] or reference not in _filter(entry):
+            continue
+        row = _find_in_file(entry, reference)
+        if row is not None:
+            row['events'] = json.loads(row['events'])
+            row['archive'] = entry['file']
+            return row
+    return None
+
+
+def find_payment(reference):
+    '''
+    Returns the payment with [reference] from the database, or from the
+    archive as a dict (see find_archived), or None.
+    '''
+    return Payment.objects.filter(reference=reference).first() or find_archived(reference)
@@ -0,0 +1,126 @@
+'''
+Batch payment initialization, for invoicing and bulk billing.
+
+The checkout view initializes one payment per request, each with its own
+reference, INSERT and gateway call. initialize_payments takes a whole
+cohort at once: references are allocated with one query per chunk and the
+payments inserted with one bulk_create per chunk, so that only the
+gateway calls are made one by one, from a thread pool kept within the
+gateway bulkhead and each processor's rate limit.
+'''
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+
+from .models import Payment
+from .ratelimit import RateLimiter
+from .routing import get_router
+from .utils import allocate_references
+
+
+logger = logging.getLogger(__name__)
+
+def _metadata(metadata):
+    if metadata is None:
+        return "{}"
+    return metadata if isinstance(metadata, str) else json.dumps(metadata)
+
+
+def create_payments(payments, batch_size=500, attempts=5):
+    '''
+    Gives [payments] fresh references and inserts them, [batch_size] per
+    INSERT. A chunk is retried with new references if another process took
+    one of its references since they were allocated.
+    '''
+    for start in range(0, len(payments), batch_size):
+        chunk = payments[start:start + batch_size]
+        for attempt in range(attempts):
+            for payment, reference in zip(chunk, allocate_references(Payment, len(chunk))):
+                payment.reference = reference
+            try:
+                with transaction.atomic(): #  savepoint, so a collision does not break an enclosing transaction
+                    Payment.objects.bulk_create(chunk)
+                break
+            except IntegrityError:
+                if attempt == attempts - 1:
+                    raise
+
+    if payments and payments[0].pk is None: #  backends that do not return ids from bulk inserts
+        ids = {}
+        for start in range(0, len(payments), batch_size):
+            references = [payment.reference for payment in payments[start:start + batch_size]]
+            ids.update(Payment.objects.filter(reference__in=references).values_list('reference', 'id'))
+        for payment in payments:
+            payment.pk = ids[payment.reference]
+    return payments
+
+
+def initialize_payments(items, callback_url, workers=None, rate_limits=None, batch_size=500):
+    '''
+    Creates and initializes a payment for every (user, amount, metadata) in
+    [items], [amount] being in kobo and [metadata] a dict, a JSON string or
+    None. Gateway calls are made [workers] at a time (at most
+    PAYMENT_BULKHEAD_SIZE) and at most [rate_limits][processor] per second
+    (PAYMENT_PROCESSOR_RATE_LIMITS by default).
+
+    Returns a dict of
+        references: the reference of every item, in order, None for failed items
+        urls: authorization URL by reference
+        errors: why an item failed, by its index in [items]
+
+    Payments no gateway would initialize are deleted, so that failed items
+    can simply be submitted again.
+    '''
+    router = get_router()
+    rate_limits = settings.PAYMENT_PROCESSOR_RATE_LIMITS if rate_limits is None else rate_limits
+    limiters = {name: RateLimiter(rate) for name, rate in rate_limits.items() if rate and rate > 0}
+    # more workers than the bulkhead lets through would only fail initializations
+    workers = min(workers or settings.PAYMENT_BULKHEAD_SIZE, settings.PAYMENT_BULKHEAD_SIZE)
+
+    references = [None] * len(items)
+    errors = {}
+    pending = [] #  (index, payment, email, metadata)
+    for index, (user, amount, metadata) in enumerate(items):
+        if not user.email:
+            errors[index] = "User has no email address"
+            continue
+        if amount <= 0:
+            errors[index] = "Amount must be positive"
+            continue
+        processor_name = router.choose()
+        if processor_name is None:
+            errors[index] = "No payment processor is available"
+            continue
+        pending.append((index, Payment(user=user, amount=amount, processor=processor_name), user.email, _metadata(metadata)))
+
+    create_payments([payment for _, payment, _, _ in pending], batch_size)
+
+    def initialize(entry):
+        _, payment, email, metadata = entry
+        try:
+            return router.initialize_payment(payment, email, callback_url, metadata, limiters)
+        except Exception:
+            # one broken item must not abort the batch and orphan the payments already created
+            logger.exception("Initializing payment %s failed", payment.reference)
+            return None
+        finally:
+            connections.close_all() #  connections are per thread, and pool threads would otherwise keep theirs open
+
+    urls = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (index, payment, _, _), payment_url in zip(pending, executor.map(initialize, pending)):
+            if payment_url:
+                references[index] = payment.reference
+                urls[payment.reference] = payment_url
+            else:
+                errors[index] = "No payment processor could initialize the payment"
+                failed.append(payment.pk)
+
+    for start in range(0, len(failed), batch_size):
+        Payment.objects.filter(pk__in=failed[start:start + batch_size]).delete()
+    return {'references': references, 'urls': urls, 'errors': errors}
@@ -1,10 +1,9 @@
 import hashlib
 import os
-import hashlib
 import json
-import requests
+import logging
 
-from datetime import datetime
+import httpx
 
 from django.http.request import HttpRequest
 from django.utils import timezone
@@ -13,20 +12,48 @@ from django.conf import settings
 
 from requests.exceptions import RequestException
 
+from . import events, resilience, signatures, transport
 from .interfaces import PaymentProcessor
 from store.utils import OnlineTransactionStatus
 
 
+logger = logging.getLogger(__name__)
+
 
 PUBLIC_KEY = os.getenv('CREDO_PUBLIC_KEY')
 SECRET_KEY = os.getenv('CREDO_SECRET_KEY')
 SPLIT_CODE = os.getenv('CREDO_SERVICE_CODE')
+WEBHOOK_TOKEN = os.getenv('CREDO_WEBHOOK_TOKEN')
+PREVIOUS_WEBHOOK_TOKENS = [token for token in os.getenv('CREDO_PREVIOUS_WEBHOOK_TOKENS', '').split(',') if token] #  still accepted while rotating tokens
+BUSINESS_CODE = os.getenv('CREDO_BUSINESS_CODE')
 
 CREDO_LIVE_URL="https://api.credocentral.com"
 CREDO_DEMO_URL="https://api.public.credodemo.com"
 
 
-URL_ROOT = CREDO_LIVE_URL if settings.LIVE else CREDO_DEMO_URL
+URL_ROOT = os.getenv('CREDO_API_URL') or (CREDO_LIVE_URL if settings.LIVE else CREDO_DEMO_URL) #  overridden to point at a simulator (see benchmarks/simulators.py)
+TRANSACTIONS_PATH = os.getenv('CREDO_TRANSACTIONS_PATH', '/transactions')
+
+SUCCESSFUL_STATUS = 0
+FAILED_STATUSES = (3,) #  transaction status codes known not to change; any other code can, and is treated as pending
+
+# Credo signs webhooks with a hash of the webhook token and business code
+# rather than of the body, so the expected signatures never change
+WEBHOOK_VERIFIER = signatures.StaticSignatureVerifier([
+    hashlib.sha512(f"{token}{BUSINESS_CODE}".encode()).hexdigest()
+    for token in [WEBHOOK_TOKEN, *PREVIOUS_WEBHOOK_TOKENS] if token
+])
+
+EVENT_DECODER = events.EventDecoder(
+    'credo',
+    statuses={
+        'transaction.successful': OnlineTransactionStatus.SUCCESSFUL,
+        'transaction.failed': OnlineTransactionStatus.FAILED,
+    },
+    reference_field='businessRef',
+    date_field='transactionDate',
+    parse_date=events.parse_epoch_milliseconds,
+)
 
 
 class CredoProcessor(PaymentProcessor):
@@ -34,11 +61,7 @@ class CredoProcessor(PaymentProcessor):
     name = 'credo'
     name_readable = 'Credo'
 
-    def initialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
-        initialize_url = f"{URL_ROOT}/transaction/initialize"
-
-        amount *= 100 #  convert amount to kobo value  
-
+    def _initialize_body(self, email, amount, reference, callback_url, metadata):
         body= {
                 'email': email,
                 'amount': str(int(amount)),
@@ -51,72 +74,201 @@ class CredoProcessor(PaymentProcessor):
 
         if SPLIT_CODE:
             body['serviceCode'] = SPLIT_CODE #  for split payments or dynamic settlement
+        return body
+
+    def _parse_initialize_response(self, response):
+        if response.status_code < 400:
+
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return ''
+            
+            if response_dict['status'] == 200 and 'data' in response_dict:
+                return response_dict['data']['authorizationUrl']
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return ''
 
+    def initialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
+        initialize_url = f"{URL_ROOT}/transaction/initialize"
 
         try:
-            response = requests.post(
+            response = transport.request(
+                self.name,
+                'POST',
                 initialize_url,
-                json=body,
+                endpoint='initialize',
+                json=self._initialize_body(email, amount, reference, callback_url, metadata),
                 headers={
                     'Authorization': PUBLIC_KEY,                    
                 }
             )
-            if response:
-
-                try:
-                    response_dict = response.json()
-                except json.JSONDecodeError:
-                    return ''
-                
-                if response_dict['status'] == 200 and 'data' in response_dict:
-                    return response_dict['data']['authorizationUrl']
-                print("response_dict: ", response_dict)
-            print("response: ", response.content)
+            return self._parse_initialize_response(response)
 
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
         except RequestException as e:
-            print("An error occured while making the request: ", e)
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
         except Exception as e:
-            print("An error occured: ", e)
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
         return ''
 
+    async def ainitialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
+        initialize_url = f"{URL_ROOT}/transaction/initialize"
+
+        try:
+            response = await transport.arequest(
+                self.name,
+                'POST',
+                initialize_url,
+                endpoint='initialize',
+                json=self._initialize_body(email, amount, reference, callback_url, metadata),
+                headers={
+                    'Authorization': PUBLIC_KEY,
+                }
+            )
+            return self._parse_initialize_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except httpx.HTTPError as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return ''
+
+    def _normalize_transaction(self, transaction):
+        gateway_status = transaction["status"]
+        if gateway_status == SUCCESSFUL_STATUS:
+            transaction["status"] = OnlineTransactionStatus.SUCCESSFUL
+        elif gateway_status in FAILED_STATUSES:
+            transaction["status"] = OnlineTransactionStatus.FAILED
+        else:
+            transaction["status"] = OnlineTransactionStatus.PENDING
+        transaction["final"] = gateway_status == SUCCESSFUL_STATUS or gateway_status in FAILED_STATUSES
+        if "transactionDate" in transaction:
+            payment_date_value = transaction["transactionDate"] 
+            date = timezone.make_aware(parse_datetime(payment_date_value), timezone=timezone.get_current_timezone())                       
+            transaction["payment_date"] = date
+        if "businessRef" in transaction and "reference" not in transaction:
+            transaction["reference"] = transaction["businessRef"]
+        return transaction
+
+    def _parse_verify_response(self, response):
+        if response.status_code < 400:
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return {}
+            
+            if response_dict["status"] == 200 and 'data' in response_dict:
+                self._normalize_transaction(response_dict["data"])
+                return response_dict
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return {}
 
     def verify_payment(self, reference):
 
         url = f"{URL_ROOT}/transaction/{reference}/verify"
 
         try:
-            response = requests.get(
+            response = transport.request(
+                self.name,
+                'GET',
                 url,
+                endpoint='verify',
                 headers={
                     'Authorization': SECRET_KEY,                    
                 }
             )
+            return self._parse_verify_response(response)
 
-            if response:
-                try:
-                    response_dict = response.json()
-                except json.JSONDecodeError:
-                    return {}
-                
-                if response_dict["status"] == 200 and 'data' in response_dict:
-                    if response_dict["data"]["status"] == 0:
-                        response_dict["data"]["status"] = OnlineTransactionStatus.SUCCESSFUL
-                    else:
-                        response_dict["data"]["status"] = OnlineTransactionStatus.FAILED
-                    if "transactionDate" in response_dict["data"]:
-                        payment_date_value = response_dict["data"]["transactionDate"] 
-                        date = timezone.make_aware(parse_datetime(payment_date_value), timezone=timezone.get_current_timezone())                       
-                        response_dict["data"]["payment_date"] = date
-                    return response_dict
-                print("response_dict: ", response_dict)
-            print("response: ", response.content)
-
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
         except RequestException as e:
-            print("An error occured while making the request: ", e)
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return {}
+
+    async def averify_payment(self, reference):
+
+        url = f"{URL_ROOT}/transaction/{reference}/verify"
+
+        try:
+            response = await transport.arequest(
+                self.name,
+                'GET',
+                url,
+                endpoint='verify',
+                headers={
+                    'Authorization': SECRET_KEY,
+                }
+            )
+            return self._parse_verify_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except httpx.HTTPError as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
         except Exception as e:
-            print("An error occured: ", e)
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
         return {}
 
+    def _parse_list_response(self, response):
+        if response.status_code < 400:
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return None
+
+            if response_dict["status"] == 200 and 'data' in response_dict:
+                data = response_dict["data"]
+                if isinstance(data, list):
+                    records, page_count = data, 1
+                else: #  paged: {"content": [...], "totalPages": n}
+                    records, page_count = data.get("content") or [], data.get("totalPages") or 1
+                return [self._normalize_transaction(record) for record in records], page_count
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return None
+
+    def list_transactions(self, date_from, date_to, page=1, per_page=100):
+        '''
+        Credo's transaction list path differs between API versions, so it is
+        configurable (CREDO_TRANSACTIONS_PATH). Credo's pages are zero-based.
+        '''
+
+        url = f"{URL_ROOT}{TRANSACTIONS_PATH}"
+
+        try:
+            response = transport.request(
+                self.name,
+                'GET',
+                url,
+                endpoint='list',
+                params={
+                    'startDate': date_from.isoformat(),
+                    'endDate': date_to.isoformat(),
+                    'page': page - 1, #  zero-based
+                    'size': per_page,
+                },
+                headers={
+                    'Authorization': SECRET_KEY,
+                }
+            )
+            return self._parse_list_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except RequestException as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return None
+
 
     def verify_event(self, request: HttpRequest):
         '''
@@ -124,39 +276,19 @@ class CredoProcessor(PaymentProcessor):
         in the request header which is a [HMAC SHA512] signature of the 
         combination of the webhook token and the business code.
 
-        This will compare the result to the header signature. 
+        This will compare the result to the header signature in constant time.
+        The signatures of the current and previous tokens are computed once, at import.
 
         Returns true if they are same.
         '''
         
         header_signature = request.headers.get('X-Credo-Signature', '')
-        token = os.getenv('CREDO_WEBHOOK_TOKEN')
-        business_code = os.getenv('CREDO_BUSINESS_CODE')
-        signed_content = f"{token}{business_code}"
-        sha512_hash = hashlib.sha512(signed_content.encode()).hexdigest()        
-        return sha512_hash == header_signature
+        return WEBHOOK_VERIFIER.verify(request, header_signature)
 
 
-    def format_payload_webhook(self, payload):
+    def decode_event(self, body):
         '''
-        Format payload to look like other payment processor payloads 
-        to avoid key error. Modelled to look like Paystack's payload.
+        Decodes a Credo webhook body. Credo's [businessRef] is our reference
+        and its [transactionDate] is a timestamp in milliseconds.
         '''
-
-        
-        if payload["event"].lower() == "transaction.successful":
-            payload["event"] = OnlineTransactionStatus.SUCCESSFUL
-        elif payload["event"].lower() == "transaction.failed":
-            payload["event"] = OnlineTransactionStatus.FAILED
-        if "transactionDate" in payload["data"]: #  convert timestamp to timezone aware python datetime
-            payment_date_value = payload["data"]["transactionDate"] 
-            timestamp = payment_date_value / 1000
-            transaction_datetime = datetime.utcfromtimestamp(timestamp)
-            transaction_datetime_utc = timezone.make_aware(transaction_datetime, timezone.utc) 
-            date = transaction_datetime_utc.astimezone(timezone.get_current_timezone())
-            payload["data"]["payment_date"] = date
-        if "businessRef" in payload["data"]:
-            payload["data"]["reference"] = payload["data"]["businessRef"]
-        return payload
-        
-
+        return EVENT_DECODER.decode(body)
@@ -0,0 +1,136 @@
+'''
+Typed webhook events.
+
+Each processor compiles an EventDecoder from a small schema (the gateway's
+event names and which fields hold the reference and the payment date) and
+decodes webhook bodies with it straight into a GatewayEvent. Only the
+fields the payment flow uses are read and checked, so a malformed event
+raises MalformedEventError before anything is written. The decoded body is
+kept on the event as is, without copying, for the payment ledger.
+
+Bodies are parsed with orjson when it is installed (pip install orjson),
+which is not a hard dependency.
+'''
+import json
+
+from dataclasses import dataclass, field
+from datetime import datetime, timezone as datetime_timezone
+from typing import Optional
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from store.utils import OnlineTransactionStatus
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class MalformedEventError(ValueError):
+    pass
+
+
+def loads(body):
+    '''
+    Parses a JSON [body] (bytes or str) with orjson if installed, json otherwise.
+    '''
+    try:
+        return orjson.loads(body) if orjson is not None else json.loads(body)
+    except ValueError as e: #  both libraries' decode errors are ValueErrors
+        raise MalformedEventError(f"Invalid JSON: {e}") from e
+
+
+@dataclass(frozen=True, slots=True)
+class GatewayEvent:
+    '''
+    A webhook event in the same shape whichever gateway sent it.
+
+    [status] is the normalized status of a transaction event the payment
+    flow acts on, None for other events. [payload] is the decoded body.
+    '''
+    processor: str
+    name: str
+    status: Optional[OnlineTransactionStatus]
+    reference: str
+    payment_date: Optional[datetime]
+    payload: dict = field(repr=False, compare=False)
+
+    @property
+    def key(self):
+        '''
+        Identifies the event so that redeliveries of the same event for the
+        same transaction are only queued once.
+        '''
+        reference = self.reference or self.payload["data"].get("id", "")
+        return f"{self.processor}:{self.name}:{reference}"[:128]
+
+    def as_payload(self):
+        '''
+        The normalized payload recorded in the payment ledger: the body with
+        the normalized event, reference and payment date.
+        '''
+        data = dict(self.payload["data"], reference=self.reference, payment_date=self.payment_date)
+        return dict(self.payload, event=self.status or self.name, data=data)
+
+
+def parse_iso_datetime(value):
+    moment = parse_datetime(value) if isinstance(value, str) else None
+    if moment is None:
+        raise ValueError(f"expected an ISO datetime, got {value!r}")
+    return moment
+
+
+def parse_epoch_milliseconds(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"expected a timestamp in milliseconds, got {value!r}")
+    moment = datetime.fromtimestamp(value / 1000, tz=datetime_timezone.utc)
+    return moment.astimezone(timezone.get_current_timezone())
+
+
+class EventDecoder:
+    '''
+    Decodes one gateway's webhook bodies into GatewayEvents.
+
+    [statuses] maps the gateway's event names (in any case) to the status
+    they report, [reference_field] and [date_field] are the keys of the
+    reference and payment date in the event's data, and [parse_date] turns
+    a payment date into an aware datetime, raising ValueError if it cannot.
+    '''
+    __slots__ = ('processor', 'statuses', 'reference_field', 'date_field', 'parse_date')
+
+    def __init__(self, processor, statuses, reference_field, date_field, parse_date):
+        self.processor = processor
+        self.statuses = {name.lower(): status for name, status in statuses.items()}
+        self.reference_field = reference_field
+        self.date_field = date_field
+        self.parse_date = parse_date
+
+    def decode(self, body):
+        '''
+        Decodes a webhook [body]. Raises MalformedEventError if it is not a
+        JSON event, or if a field the payment flow uses is missing or invalid.
+        '''
+        payload = loads(body)
+        if not isinstance(payload, dict):
+            raise MalformedEventError("The event is not a JSON object")
+        name, data = payload.get("event"), payload.get("data")
+        if not isinstance(name, str) or not isinstance(data, dict):
+            raise MalformedEventError("The event has no event name or data")
+
+        status = self.statuses.get(name.lower())
+        reference = data.get(self.reference_field) or ''
+        if not isinstance(reference, str):
+            raise MalformedEventError(f"Invalid {self.reference_field}: {reference!r}")
+        if status is not None and not reference:
+            raise MalformedEventError(f"{name} event without a {self.reference_field}")
+
+        payment_date = data.get(self.date_field)
+        if payment_date is not None:
+            try:
+                payment_date = self.parse_date(payment_date)
+            except ValueError as e:
+                raise MalformedEventError(f"Invalid {self.date_field}: {e}") from e
+
+        return GatewayEvent(self.processor, name, status, reference, payment_date, payload)
@@ -0,0 +1,201 @@
+'''
+Streaming payment exports for settlement and finance reports.
+
+Rows are read with a server-side cursor (QuerySet.iterator) and written
+through generators that yield encoded chunks, so memory use stays flat
+however many payments are exported. Daily totals are read from the
+rollups (see rollups.py) when PAYMENT_ROLLUPS is on. Used by
+`manage.py export_payments` and the staff-only export endpoint.
+
+Parquet output needs pyarrow, which is not a hard dependency.
+'''
+import csv
+import io
+
+from importlib.util import find_spec
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+from . import rollups
+from .models import Payment
+from .rollups import DAILY_TOTAL_FIELDS
+
+
+PAYMENT_FIELDS = ('reference', 'processor', 'status', 'amount', 'currency', 'date', 'user_id')
+FORMATS = {
+    # format: (content type, file extension)
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def payments_queryset(processor=None, status=None, date_from=None, date_to=None):
+    '''
+    Payments made with [processor] in [status] between [date_from]
+    (inclusive) and [date_to] (exclusive), any of which can be omitted.
+    '''
+    queryset = Payment.objects.all()
+    if processor:
+        queryset = queryset.filter(processor=processor)
+    if status:
+        queryset = queryset.filter(status=status)
+    if date_from:
+        queryset = queryset.filter(date__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(date__lt=date_to)
+    return queryset
+
+
+def payment_rows(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Returns (fields, rows), rows being an iterator of tuples.
+    '''
+    rows = queryset.order_by('id').values_list(*PAYMENT_FIELDS).iterator(chunk_size=chunk_size)
+    return PAYMENT_FIELDS, rows
+
+
+def daily_total_rows(queryset, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Returns (fields, rows) of payment counts and amounts per day, processor
+    and status, aggregated by the database.
+    '''
+    rows = (
+        queryset.annotate(day=TruncDate('date'))
+        .values_list('day', 'processor', 'status')
+        .annotate(count=Count('id'), amount=Sum('amount'))
+        .order_by('day', 'processor', 'status')
+        .iterator(chunk_size=chunk_size)
+    )
+    return DAILY_TOTAL_FIELDS, rows
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_csv(fields, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for chunk in _chunks(rows, chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def iter_jsonl(fields, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    for chunk in _chunks(rows, chunk_size):
+        yield ''.join(encoder.encode(dict(zip(fields, row))) + '\n' for row in chunk).encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    '''
+    Write-only file that hands what is written to it back to the generator
+    writing the parquet file.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _parquet_schema(pyarrow, fields):
+    types = {
+        'reference': pyarrow.string(),
+        'processor': pyarrow.string(),
+        'status': pyarrow.string(),
+        'amount': pyarrow.int64(),
+        'currency': pyarrow.string(),
+        'date': pyarrow.timestamp('us', tz='UTC'),
+        'user_id': pyarrow.int64(),
+        'day': pyarrow.date32(),
+        'count': pyarrow.int64(),
+    }
+    return pyarrow.schema([(field, types[field]) for field in fields])
+
+
+def iter_parquet(fields, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Writes one parquet row group per [chunk_size] rows.
+
+    Raises ImportError if pyarrow is not installed.
+    '''
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = _parquet_schema(pyarrow, fields)
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for chunk in _chunks(rows, chunk_size):
+        columns = dict(zip(fields, map(list, zip(*chunk))))
+        writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def format_available(format):
+    '''
+    Whether [format] can be written here, parquet needing pyarrow.
+    '''
+    return format in FORMATS and (format != 'parquet' or find_spec('pyarrow') is not None)
+
+
+WRITERS = {
+    'csv': iter_csv,
+    'jsonl': iter_jsonl,
+    'parquet': iter_parquet,
+}
+
+
+def export(queryset, format='csv', daily_totals=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Returns an iterator of encoded chunks of the payments in [queryset], or
+    of their per day, processor and status totals if [daily_totals].
+    '''
+    fields, rows = (daily_total_rows if daily_totals else payment_rows)(queryset, chunk_size)
+    return WRITERS[format](fields, rows, chunk_size)
+
+
+def export_daily_totals(format='csv', chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    '''
+    Returns an iterator of encoded chunks of the per day, processor and
+    status totals of the payments matching [filters] (see
+    payments_queryset), read from the rollups when PAYMENT_ROLLUPS is on.
+    '''
+    if settings.PAYMENT_ROLLUPS:
+        fields, rows = rollups.daily_total_rows(**filters)
+        return WRITERS[format](fields, rows, chunk_size)
+    return export(payments_queryset(**filters), format, True, chunk_size)
@@ -1,9 +1,17 @@
-from django.conf import settings
-from importlib import import_module
+from .registry import registry
 
-def get_payment_processor():
-    processor_path = settings.PAYMENT_PROCESSOR
-    module_path, class_name = processor_path.rsplit('.', 1)
-    module = import_module(module_path)
-    PaymentProcessor = getattr(module, class_name)
-    return PaymentProcessor()
\ No newline at end of file
+def get_payment_processor(name=None):
+    '''
+    Returns the deployment's payment processor, or the processor registered
+    as [name] in settings.PAYMENT_PROCESSORS (e.g. a Payment's [processor]).
+    Processors are created once per process and shared.
+    '''
+    return registry.get(name or registry.default_name())
+
+
+def get_payment_processor_for(payment):
+    '''
+    Returns the processor [payment] was made with, so that it is verified
+    with the gateway that holds the transaction.
+    '''
+    return get_payment_processor(payment.processor or None)
@@ -0,0 +1,265 @@
+'''
+Idempotency for webhook redeliveries.
+
+Paystack and Credo redeliver webhooks until they get an answer they like,
+and may deliver the same event more than once anyway. Redeliveries change
+nothing (transitions are conditional and the ledger drops repeated
+payloads), but each one still costs a payment lookup, a ledger write and a
+transaction. Each process therefore keeps the keys of processed events
+(GatewayEvent.key: processor, event name and reference) in a rotating
+Bloom filter, and a redelivery found there is answered without touching
+the database.
+
+The filter is shared through the SeenWebhookEvent table without adding a
+query to each event: every PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL seconds a
+process writes the keys it processed since its last sync in one INSERT
+and reads the keys the other processes wrote. A redelivery that reaches
+another process before that is simply processed again.
+
+A Bloom filter can say an event was seen when it was not. The filter is
+sized for PAYMENT_WEBHOOK_DEDUP_FILTER_ERROR_RATE (one in a million by
+default) at PAYMENT_WEBHOOK_DEDUP_FILTER_CAPACITY events per generation;
+the rare new event mistaken for a redelivery is settled like a lost
+webhook, by the payment callback or reconcile_payments.
+
+The filter keeps two generations and starts a new one every
+PAYMENT_WEBHOOK_DEDUP_FILTER_PERIOD seconds (or once the current one is
+full), dropping the oldest, so keys stay in memory for one to two periods.
+Processes only read back the keys written since their last sync (the last
+period when they start), so a redelivery is recognized for one to two
+periods after the event was processed, and processed again after that.
+Table rows are pruned after PAYMENT_WEBHOOK_DEDUP_TTL seconds by
+`manage.py prune_seen_webhook_events`.
+
+An event is only recorded as processed once the transaction applying it
+commits (see store/webhooks.py), so a delivery that failed is never
+answered as a redelivery.
+'''
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import SeenWebhookEvent
+
+
+logger = logging.getLogger(__name__)
+
+class BloomFilter:
+    '''
+    A Bloom filter for [capacity] keys (str) with a false positive rate of
+    [error_rate] once full.
+    '''
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)) #  bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bits(cls, bits, size, hashes):
+        '''
+        Rebuilds a filter from the [bits], [size] and [hashes] of a saved one.
+        '''
+        bloom = cls.__new__(cls)
+        bloom.capacity, bloom.size, bloom.hashes = None, size, hashes
+        bloom.bits, bloom.count, bloom._lock = bytearray(bits), 0, threading.Lock()
+        return bloom
+
+    def _positions(self, key):
+        # double hashing: the i-th position is h1 + i * h2
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock: #  setting a bit is a read-modify-write of its byte
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RotatingBloomFilter:
+    '''
+    Two generations of BloomFilter. Keys are added to the current one and
+    looked up in both, and a new generation replaces the previous one every
+    [period] seconds or when the current one holds [capacity] keys.
+    '''
+
+    def __init__(self, capacity, error_rate, period):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.period = period
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rotate(self):
+        if self.current.count < self.capacity and time.monotonic() - self.started < self.period:
+            return
+        with self._lock:
+            if self.current.count >= self.capacity or time.monotonic() - self.started >= self.period:
+                self.previous, self.current = self.current, BloomFilter(self.capacity, self.error_rate)
+                self.started = time.monotonic()
+
+    def add(self, key):
+        self._rotate()
+        self.current.add(key)
+
+    def __contains__(self, key):
+        self._rotate()
+        previous = self.previous
+        return key in self.current or (previous is not None and key in previous)
+
+
+class SeenEvents:
+    '''
+    The keys of processed events this process knows of: its own, and those
+    of other processes read from the SeenWebhookEvent table every
+    [sync_interval] seconds. Its own keys are written to the table in bulk
+    at the same time.
+    '''
+
+    def __init__(self, capacity, error_rate, period, sync_interval):
+        self.filter = RotatingBloomFilter(capacity, error_rate, period)
+        self.period = period
+        self.sync_interval = sync_interval
+        self.pending = []
+        self.synced_at = None #  start of the last sync, None before the first one
+        self.next_sync = 0
+        self._lock = threading.Lock()
+
+    def add(self, event):
+        self.filter.add(event.key)
+        with self._lock:
+            self.pending.append(SeenWebhookEvent(key=event.key, processor=event.processor))
+
+    def due(self):
+        return time.monotonic() >= self.next_sync
+
+    def sync(self):
+        '''
+        Writes this process's new keys to the table and reads the keys other
+        processes wrote since the last sync (since the filter period on the
+        first one), if a sync is due. Only one thread syncs at a time; the
+        others go on without waiting. Failures are logged and the keys that
+        were not written are dropped.
+        '''
+        if not self.due() or not self._lock.acquire(blocking=False):
+            return
+        try:
+            pending, self.pending = self.pending, []
+            self.next_sync = time.monotonic() + self.sync_interval
+        finally:
+            self._lock.release()
+
+        started = timezone.now()
+        try:
+            SeenWebhookEvent.objects.bulk_create(pending, ignore_conflicts=True)
+            # overlapping the last sync by an interval covers keys committed late
+            if self.synced_at is None:
+                since = started - timedelta(seconds=self.period)
+            else:
+                since = self.synced_at - timedelta(seconds=self.sync_interval)
+            for key in SeenWebhookEvent.objects.filter(seen_at__gte=since).values_list('key', flat=True).iterator():
+                self.filter.add(key)
+            self.synced_at = started
+        except DatabaseError:
+            logger.exception("Failed to sync the processed webhook event keys")
+
+    def __contains__(self, key):
+        return key in self.filter
+
+
+_seen = None
+_seen_lock = threading.Lock()
+
+
+def get_seen_events():
+    global _seen
+    if _seen is None:
+        with _seen_lock:
+            if _seen is None:
+                _seen = SeenEvents(
+                    settings.PAYMENT_WEBHOOK_DEDUP_FILTER_CAPACITY,
+                    settings.PAYMENT_WEBHOOK_DEDUP_FILTER_ERROR_RATE,
+                    settings.PAYMENT_WEBHOOK_DEDUP_FILTER_PERIOD,
+                    settings.PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL,
+                )
+    return _seen
+
+
+def _known(seen, event):
+    if event.key in seen:
+        metrics.WEBHOOK_DUPLICATES.inc(event.processor)
+        return True
+    return False
+
+
+def is_duplicate(event):
+    '''
+    Whether [event] is known to have been processed already. Only touches
+    the database to sync the keys every PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL
+    seconds.
+    '''
+    if not settings.PAYMENT_WEBHOOK_DEDUP:
+        return False
+    seen = get_seen_events()
+    seen.sync()
+    return _known(seen, event)
+
+
+async def ais_duplicate(event):
+    '''
+    Async counterpart of is_duplicate(), which only leaves the event loop to sync.
+    '''
+    if not settings.PAYMENT_WEBHOOK_DEDUP:
+        return False
+    seen = get_seen_events()
+    if seen.due():
+        await sync_to_async(seen.sync)()
+    return _known(seen, event)
+
+
+def mark_processed(event):
+    '''
+    Records [event] as processed once the current transaction commits (at
+    once outside a transaction), so a rolled back event is processed again
+    when it is redelivered.
+    '''
+    if settings.PAYMENT_WEBHOOK_DEDUP:
+        transaction.on_commit(lambda: _add(event))
+
+
+def _add(event):
+    seen = get_seen_events()
+    seen.add(event)
+    seen.sync() #  for processes that never check for duplicates, like the webhook queue workers
+
+
+def prune(ttl=None):
+    '''
+    Deletes the keys of events seen more than [ttl] seconds ago (default
+    PAYMENT_WEBHOOK_DEDUP_TTL). Returns the number deleted.
+    '''
+    cutoff = timezone.now() - timedelta(seconds=ttl if ttl is not None else settings.PAYMENT_WEBHOOK_DEDUP_TTL)
+    deleted, _ = SeenWebhookEvent.objects.filter(seen_at__lt=cutoff).delete()
+    return deleted
@@ -1,8 +1,27 @@
+from asgiref.sync import sync_to_async
 from django.http.request import HttpRequest
+from . import metrics, sync
 from .models import PaymentProcessorMixin
 
 
+# Timed and counted per processor and outcome wherever a processor implements them (see payments/metrics.py)
+INSTRUMENTED_METHODS = (
+    'initialize_payment', 'verify_payment', 'verify_event', 'list_transactions',
+    'ainitialize_payment', 'averify_payment', 'averify_event',
+)
+
+
 class PaymentProcessor(PaymentProcessorMixin):
+    def __init_subclass__(cls, **kwargs):
+        """
+        Wrap the gateway-facing methods each processor implements with `payments.metrics.instrument`.
+        """
+        super().__init_subclass__(**kwargs)
+        for method in INSTRUMENTED_METHODS:
+            if method in cls.__dict__:
+                setattr(cls, method, metrics.instrument(cls.__dict__[method], method))
+
+
     def initialize_payment(self, email, amount, reference, callback_url, metadata="{}"):
         """
         Initialize a payment transaction.
@@ -11,7 +30,7 @@ class PaymentProcessor(PaymentProcessorMixin):
 
         Parameters:
             email (str): The email address of the customer making the payment.
-            amount (float): The amount to be charged for the payment transaction.
+            amount (int): The amount to be charged for the payment transaction, in the currency's minor unit (kobo), as stored on `Payment.amount`.
             reference (str): A unique identifier or reference for this payment transaction.
             callback_url (str): A string containing the url to redirect the user to after payment attempt
             metadata (str, optional): A JSON-formatted string containing additional information or custom data to be associated with the payment. Defaults to an empty JSON string.
@@ -20,11 +39,11 @@ class PaymentProcessor(PaymentProcessorMixin):
             str: The URL to the payment provider's authorization page. If the request to the payment provider's API fails, an empty string is returned.
                 
         Example:
-            >>> initialize_payment("customer@example.com", 99.99, "ORDER123")
+            >>> initialize_payment("customer@example.com", 9999, "ORDER123")
             "https://paymentprovider.com/authorize/TXN987654321"
 
         Note:
-            The `amount` is converted to kobo (a subunit of the currency) to match the payment provider's requirements.
+            The `amount` is already in kobo (a subunit of the currency), which is what the payment providers expect.
             If the request to the payment provider's API's transaction initialize endpoint is successful, the method returns the authorization URL where the user can complete the payment process.
             If the request fails, an empty string is returned.
             The `metadata` parameter allows you to include any additional information relevant to the payment, which will be associated with the transaction in the payment provider's records.
@@ -86,4 +105,83 @@ class PaymentProcessor(PaymentProcessorMixin):
         """
         pass
 
-    
+
+    def decode_event(self, body):
+        """
+        Decode a verified webhook body into the uniform event type.
+
+        Parameters:
+            body (bytes): The raw request body of the webhook.
+
+        Returns:
+            GatewayEvent: The event name, its normalized `OnlineTransactionStatus` (None for events the payment flow does not act on), the payment reference and date, and the decoded body.
+
+        Raises:
+            MalformedEventError: If the body is not a JSON event or a field the payment flow uses is missing or invalid.
+
+        Note:
+            Processors normally build a `payments.events.EventDecoder` once, at import, and decode with it.
+        """
+        raise NotImplementedError
+
+
+    def list_transactions(self, date_from, date_to, page=1, per_page=100):
+        """
+        Fetch one page of the transactions made between two dates from the payment provider's transaction list endpoint.
+
+        Parameters:
+            date_from (datetime): Start of the window.
+            date_to (datetime): End of the window.
+            page (int, optional): The 1-based page to fetch. Defaults to 1.
+            per_page (int, optional): Transactions per page. Defaults to 100.
+
+        Returns:
+            tuple: `(transactions, page_count)`, where each transaction is normalized like the `data` returned by `verify_payment` (`reference`, `status` as an `OnlineTransactionStatus`, `final` when the gateway status can no longer change and, once paid, `payment_date`) and `page_count` is the number of pages in the window.
+            None if the request to the payment provider's API fails.
+
+        Note:
+            Processors that cannot list transactions keep this default, which raises NotImplementedError.
+        """
+        raise NotImplementedError
+
+
+    def sync_transactions(self, date_from, date_to, **options):
+        """
+        Bring the payments made between two dates up to date from the provider's transaction list, a page of transactions per request instead of one `verify_payment` request per reference.
+
+        Pages are fetched in parallel and matching `Payment` rows are updated in bulk. See `payments.sync.sync_transactions` for the options.
+
+        Returns:
+            dict: Pages fetched, transactions seen, payments matched and updated, and pages that could not be fetched.
+        """
+        return sync.sync_transactions(self, date_from, date_to, **options)
+
+
+    async def ainitialize_payment(self, email, amount, reference, callback_url, metadata="{}"):
+        """
+        Async variant of `initialize_payment`, for use from async views.
+
+        Processors should override this with a native implementation on a pooled async HTTP client (see `payments.transport.arequest`).
+        The default runs the sync `initialize_payment` in a worker thread so processors that only implement the sync interface keep working.
+        """
+        return await sync_to_async(self.initialize_payment, thread_sensitive=False)(
+            email, amount, reference, callback_url, metadata)
+
+
+    async def averify_payment(self, reference):
+        """
+        Async variant of `verify_payment`, for use from async views.
+
+        Processors should override this with a native implementation on a pooled async HTTP client (see `payments.transport.arequest`).
+        The default runs the sync `verify_payment` in a worker thread.
+        """
+        return await sync_to_async(self.verify_payment, thread_sensitive=False)(reference)
+
+
+    async def averify_event(self, request: HttpRequest):
+        """
+        Async variant of `verify_event`.
+
+        Signature checks are CPU-bound and, under ASGI, the request body has already been read by the time the view runs, so the default simply calls `verify_event`.
+        """
+        return self.verify_event(request)
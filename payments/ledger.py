@@ -0,0 +1,253 @@
+'''
+Payment ledger.
+
+Every normalized payload we get from a gateway (formatted webhooks,
+verification results and synced transactions) is appended to PaymentEvent. Payment.status and
+Payment.date are a projection of a payment's events: they are kept up to
+date incrementally by the transitions applied as events arrive, and can be
+rebuilt from the ledger with `manage.py rebuild_payment_projections`.
+PaymentSnapshot stores the projected state as of an event id so that a
+rebuild only replays the events recorded since. A rebuild settles the
+unprocessed payments it finds settled through the transitions. Any other
+difference, e.g. a settled payment whose settling event never reached the
+ledger, is reported as drift and only written with overwrite_drift, moved
+in the rollups and the status cache. Dates are only compared when the
+settling event carries the time the gateway gave it.
+'''
+import hashlib
+import json
+
+from datetime import datetime
+from enum import Enum
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from . import rollups, status as payment_status, transitions
+from .models import Payment, PaymentEvent, PaymentEventSource, PaymentSnapshot, PaymentStatus
+
+from store.utils import OnlineTransactionStatus
+
+
+# (source, gateway status) -> the status it settles an unprocessed payment
+# with. Mirrors what the webhook and callback handlers do.
+SETTLING_EVENTS = {
+    (PaymentEventSource.WEBHOOK, OnlineTransactionStatus.SUCCESSFUL.value): PaymentStatus.COMPLETED,
+    (PaymentEventSource.VERIFICATION, OnlineTransactionStatus.SUCCESSFUL.value): PaymentStatus.COMPLETED,
+    (PaymentEventSource.VERIFICATION, OnlineTransactionStatus.FAILED.value): PaymentStatus.FAILED,
+    (PaymentEventSource.SYNC, OnlineTransactionStatus.SUCCESSFUL.value): PaymentStatus.COMPLETED,
+    (PaymentEventSource.SYNC, OnlineTransactionStatus.FAILED.value): PaymentStatus.FAILED,
+}
+
+
+class LedgerJSONEncoder(DjangoJSONEncoder):
+    '''
+    Encodes normalized payloads, which hold OnlineTransactionStatus members
+    and datetimes.
+    '''
+
+    def default(self, o):
+        if isinstance(o, Enum):
+            return o.value
+        return super().default(o)
+
+
+def status_value(value):
+    return value.value if isinstance(value, Enum) else str(value)
+
+
+def build_event(payment, source, payload, processor_name=None):
+    '''
+    Returns an unsaved PaymentEvent for a normalized [payload] about [payment].
+    '''
+    data = payload.get("data") or {}
+    if source == PaymentEventSource.WEBHOOK:
+        gateway_status = status_value(payload.get("event", ""))
+    else:
+        gateway_status = status_value(data.get("status", ""))
+    occurred_at = data.get("payment_date")
+
+    canonical = json.dumps(payload, cls=LedgerJSONEncoder, sort_keys=True, separators=(',', ':'))
+    return PaymentEvent(
+        payment=payment,
+        source=source,
+        processor=processor_name or payment.processor,
+        gateway_status=gateway_status[:32],
+        occurred_at=occurred_at if isinstance(occurred_at, datetime) else None,
+        payload=canonical,
+        digest=hashlib.sha256(canonical.encode()).hexdigest(),
+    )
+
+
+def record_events(events, batch_size=500):
+    '''
+    Appends [events] in batches. Events already in the ledger (same payment,
+    source and payload) are skipped.
+    '''
+    PaymentEvent.objects.bulk_create(events, ignore_conflicts=True, batch_size=batch_size)
+
+
+def record_event(payment, source, payload, processor_name=None):
+    record_events([build_event(payment, source, payload, processor_name)])
+
+
+DRIFT_EXAMPLES = 100 #  drifted payments listed in the rebuild stats
+
+
+def apply_event(status, date, source, gateway_status, occurred_at):
+    '''
+    Folds one event into a payment's projected (status, date). The date is
+    the event's own [occurred_at], None when the gateway gave none.
+    '''
+    target = SETTLING_EVENTS.get((source, gateway_status))
+    if target is not None and status in transitions.allowed_from(target):
+        return target, occurred_at
+    return status, date
+
+
+def _write_projections(changes):
+    '''
+    Overwrites the status and date of payments whose projection had
+    drifted in a way no transition leads to, moving them in the rollups
+    and dropping their cached statuses. [changes] is a list of
+    (payment, old status, old date).
+    '''
+    # bulk_update() builds a CASE expression over every row, which costs more
+    # than the replay itself; one prepared UPDATE executed per row does not
+    if not changes:
+        return
+    payments = [payment for payment, _, _ in changes]
+    quote_name = connection.ops.quote_name
+    table = quote_name(Payment._meta.db_table)
+    status, date, pk = (quote_name(Payment._meta.get_field(name).column) for name in ('status', 'date', 'id'))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"UPDATE {table} SET {status} = %s, {date} = %s WHERE {pk} = %s",
+            [(payment.status, connection.ops.adapt_datetimefield_value(payment.date), payment.id) for payment in payments],
+        )
+    rollups.move(changes)
+    payment_status.invalidate([payment.reference for payment in payments])
+
+
+def _rebuild_batch(batch, low_water, high_water, use_snapshots, take_snapshots, dry_run, overwrite_drift, skipped, stats):
+    payment_ids = list(batch)
+    snapshots = {}
+    if use_snapshots:
+        snapshots = {snapshot.payment_id: snapshot for snapshot in PaymentSnapshot.objects.filter(payment_id__in=payment_ids)}
+    unsnapshotted = [payment_id for payment_id in payment_ids if payment_id not in snapshots]
+    if low_water and unsnapshotted:
+        # payments that missed the last snapshot also need their older events
+        older = (
+            PaymentEvent.objects.filter(payment_id__in=unsnapshotted, id__lte=low_water)
+            .order_by('payment_id', 'id')
+            .values_list('payment_id', 'id', 'source', 'gateway_status', 'occurred_at', 'recorded_at')
+        )
+        older_rows = {}
+        for payment_id, *row in older:
+            older_rows.setdefault(payment_id, []).append(row)
+        for payment_id, rows in older_rows.items():
+            batch[payment_id] = rows + batch[payment_id]
+    payments = Payment.objects.filter(id__in=payment_ids).only('id', 'reference', 'processor', 'amount', 'status', 'date').in_bulk()
+    # payments with events recorded after the rebuild started are being
+    # settled right now, leave them to the live transitions
+    late = set(PaymentEvent.objects.filter(payment_id__in=payment_ids, id__gt=high_water).values_list('payment_id', flat=True))
+
+    settled, corrected, new_snapshots = [], [], []
+    for payment_id, rows in batch.items():
+        payment = payments.get(payment_id)
+        if payment is None or payment_id in late:
+            skipped.add(payment_id)
+            continue
+
+        snapshot = snapshots.get(payment_id)
+        if snapshot is not None:
+            status, date, replay_after = snapshot.status, snapshot.date, snapshot.last_event_id
+        else:
+            status, date, replay_after = PaymentStatus.UNPROCESSED, None, 0
+        settled_at = None #  when the settling event was recorded, the date of a payment settled here without one of its own
+        for event_id, source, gateway_status, occurred_at, recorded_at in rows:
+            if event_id > replay_after:
+                previous = status
+                status, date = apply_event(status, date, source, gateway_status, occurred_at)
+                if status != previous:
+                    settled_at = recorded_at
+
+        if status in transitions.TRANSITIONS.get(payment.status, ()):
+            settled.append((payment, status, date or settled_at))
+        elif status != payment.status or (date is not None and date != payment.date):
+            stats['drifted'] += 1
+            if len(stats['drift']) < DRIFT_EXAMPLES:
+                stats['drift'].append((payment.reference, payment.status, status, payment.date, date))
+            if overwrite_drift:
+                corrected.append((payment, payment.status, payment.date))
+                payment.status = status
+                payment.date = date or payment.date
+        if take_snapshots:
+            new_snapshots.append(PaymentSnapshot(payment_id=payment_id, status=status, date=date, last_event_id=high_water))
+
+    if dry_run:
+        return len(settled) + len(corrected)
+    with transaction.atomic():
+        # settling unprocessed payments is a transition like any other, with its
+        # outbox messages, rollups and cache invalidation
+        applied = transitions.bulk_transition(settled)
+        _write_projections(corrected)
+        PaymentSnapshot.objects.bulk_create(
+            new_snapshots, update_conflicts=True, unique_fields=['payment'],
+            update_fields=['status', 'date', 'last_event_id', 'taken_at'],
+        )
+    return len(applied) + len(corrected)
+
+
+def rebuild_projections(from_scratch=False, take_snapshots=False, chunk_size=10_000, batch_size=1000, dry_run=False,
+                        overwrite_drift=False, progress=None):
+    '''
+    Replays the ledger into Payment.status and Payment.date, starting from
+    the snapshots unless [from_scratch]. Payments without events (e.g. ones
+    settled before the ledger existed) are left as they are. Payments whose
+    projection differs in a way no transition leads to are counted under
+    'drifted', the first DRIFT_EXAMPLES listed under 'drift' as (reference,
+    stored status, projected status, stored date, projected date), and only
+    overwritten with [overwrite_drift].
+
+    Events are streamed in (payment, id) order and applied [batch_size]
+    payments at a time. [progress] is called with the running stats after
+    every batch. Returns the stats.
+    '''
+    high_water = PaymentEvent.objects.aggregate(last=Max('id'))['last'] or 0
+    low_water = 0
+    if not from_scratch:
+        low_water = PaymentSnapshot.objects.aggregate(first=Min('last_event_id'))['first'] or 0
+
+    events = (
+        PaymentEvent.objects.filter(id__gt=low_water, id__lte=high_water)
+        .order_by('payment_id', 'id')
+        .values_list('payment_id', 'id', 'source', 'gateway_status', 'occurred_at', 'recorded_at')
+    )
+    stats = {'events': 0, 'payments': 0, 'changed': 0, 'drifted': 0, 'drift': [], 'from_event': low_water, 'to_event': high_water}
+    skipped = set()
+
+    def flush(batch):
+        stats['changed'] += _rebuild_batch(
+            batch, low_water, high_water, not from_scratch, take_snapshots, dry_run, overwrite_drift, skipped, stats)
+        stats['payments'] += len(batch)
+        if progress:
+            progress(stats)
+
+    batch = {}
+    for payment_id, *row in events.iterator(chunk_size=chunk_size):
+        if payment_id not in batch and len(batch) >= batch_size:
+            flush(batch)
+            batch = {}
+        batch.setdefault(payment_id, []).append(row)
+        stats['events'] += 1
+    if batch:
+        flush(batch)
+
+    if take_snapshots and not dry_run:
+        # payments without new events are still as of their snapshot
+        PaymentSnapshot.objects.filter(last_event_id__lt=high_water).exclude(payment_id__in=skipped).update(
+            last_event_id=high_water, taken_at=timezone.now())
+    return stats
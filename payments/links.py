@@ -0,0 +1,166 @@
+'''
+Payment links initialized ahead of checkout.
+
+Initializing a transaction with the gateway is the slowest step of the
+checkout POST. With PAYMENT_LINK_PREFETCH on, the checkout page starts a
+payment for the user in the background as soon as it is viewed, and the
+POST hands back its authorization URL at once, falling back to
+initializing the payment there and then when no link is ready.
+
+Links are per user rather than a shared pool because the gateways tie a
+transaction to the customer's email when it is initialized. Links are
+handed out until PAYMENT_LINK_TTL seconds after they were made; expired
+links that were never handed out are deleted with their payments by
+`manage.py prune_payment_links`.
+'''
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import metrics
+from .models import Payment, PaymentLink, PaymentStatus
+from .routing import get_router
+from .utils import save_with_unique_reference
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set() #  (user id, amount) of the links being made
+_in_flight_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.PAYMENT_LINK_PREFETCH_WORKERS, thread_name_prefix='payment-links')
+    return _executor
+
+
+def ready_links(user, amount):
+    '''
+    Unexpired links for [user] and [amount] that were not handed out yet and
+    whose payments are still unprocessed, those expiring first first.
+    '''
+    return PaymentLink.objects.filter(
+        payment__user=user, payment__amount=amount, payment__status=PaymentStatus.UNPROCESSED,
+        claimed_at__isnull=True, expires_at__gt=timezone.now(),
+    ).order_by('expires_at')
+
+
+def create_link(user, amount, callback_url):
+    '''
+    Initializes a payment of [amount] for [user] with the processor the
+    router picks and stores its link. Returns the link, or None if no
+    processor could initialize it.
+    '''
+    router = get_router()
+    processor_name = router.choose()
+    if processor_name is None:
+        metrics.PAYMENT_LINK_PREFETCHES.inc('failed')
+        return None
+
+    payment = Payment(user=user, amount=amount, processor=processor_name)
+    save_with_unique_reference(payment)
+    payment_url = router.initialize_payment(payment, user.email, callback_url)
+    if not payment_url:
+        payment.delete() #  never shown to the user
+        metrics.PAYMENT_LINK_PREFETCHES.inc('failed')
+        return None
+
+    link = PaymentLink.objects.create(
+        payment=payment,
+        authorization_url=payment_url,
+        expires_at=timezone.now() + timedelta(seconds=settings.PAYMENT_LINK_TTL),
+    )
+    metrics.PAYMENT_LINK_PREFETCHES.inc('ok')
+    return link
+
+
+def _create_link_in_background(key, user, amount, callback_url):
+    try:
+        create_link(user, amount, callback_url)
+    except Exception:
+        metrics.PAYMENT_LINK_PREFETCHES.inc('failed')
+        logger.exception("Failed to prefetch a payment link", extra={'user_id': user.pk})
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(key)
+        close_old_connections()
+
+
+def prefetch_link(user, amount, callback_url):
+    '''
+    Starts making a link for [user] and [amount] in the background unless one
+    is ready or being made. Returns whether it did.
+    '''
+    key = (user.pk, amount)
+    with _in_flight_lock:
+        if key in _in_flight:
+            return False
+    if ready_links(user, amount).exists():
+        return False
+    with _in_flight_lock:
+        if key in _in_flight:
+            return False
+        _in_flight.add(key)
+    _get_executor().submit(_create_link_in_background, key, user, amount, callback_url)
+    return True
+
+
+def claim_link(user, amount):
+    '''
+    Hands out a ready link for [user] and [amount], or returns None. A link
+    is only ever handed out once, however many checkouts race for it, and
+    never once its payment has settled.
+    '''
+    now = timezone.now()
+    for link in ready_links(user, amount).select_related('payment')[:3]:
+        claimable = PaymentLink.objects.filter(pk=link.pk, claimed_at__isnull=True, payment__status=PaymentStatus.UNPROCESSED)
+        if claimable.update(claimed_at=now):
+            # the payment is dated from the checkout, not from when its link was made
+            Payment.objects.filter(pk=link.payment_id).update(date=now)
+            link.claimed_at = link.payment.date = now
+            metrics.PAYMENT_LINK_CLAIMS.inc('hit')
+            return link
+    metrics.PAYMENT_LINK_CLAIMS.inc('miss')
+    return None
+
+
+def observe_redirect(source, started):
+    '''
+    Records the checkout POST latency, [started] being its time.perf_counter()
+    start and [source] 'link' or 'gateway'.
+    '''
+    metrics.CHECKOUT_REDIRECT.observe(time.perf_counter() - started, source)
+
+
+def prune_links(batch_size=1000):
+    '''
+    Deletes expired links that were never handed out, with their payments,
+    and forgets handed out links older than PAYMENT_LINK_TTL (their payments
+    are kept). Returns (expired, claimed) counts.
+    '''
+    now = timezone.now()
+    expired = 0
+    while True:
+        payment_ids = list(
+            PaymentLink.objects.filter(claimed_at__isnull=True, expires_at__lte=now)
+            .values_list('payment_id', flat=True)[:batch_size]
+        )
+        if not payment_ids:
+            break
+        _, deleted = Payment.objects.filter(id__in=payment_ids, link__claimed_at__isnull=True).delete()
+        expired += deleted.get(Payment._meta.label, 0)
+    claimed, _ = PaymentLink.objects.filter(claimed_at__lte=now - timedelta(seconds=settings.PAYMENT_LINK_TTL)).delete()
+    return expired, claimed
@@ -0,0 +1,108 @@
+'''
+Structured, non-blocking logging for the payments and store apps.
+
+NonBlockingHandler only puts records on a bounded in-memory queue; a
+listener thread formats them (as JSON lines with JSONFormatter) and writes
+them to stderr, so a slow or blocked stderr never holds up a request. When
+the queue is full, records are dropped and counted in
+payment_log_records_dropped_total instead of blocking.
+
+Context goes in `extra`, which JSONFormatter writes out as fields:
+
+    logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+'''
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import sys
+import weakref
+
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from . import metrics
+
+
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RESERVED)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+_handlers = weakref.WeakSet()
+
+
+class NonBlockingHandler(QueueHandler):
+
+    def __init__(self, queue_size=10000, stream=None):
+        self.queue_size = queue_size
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        super().__init__(queue.Queue(queue_size))
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+        _handlers.add(self)
+
+    def setFormatter(self, fmt):
+        # records are formatted by the listener thread, not the logging one
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # the message is rendered now, as its arguments may change before the
+        # listener gets to it. Everything else, formatting included, is left to
+        # the listener
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_RECORDS_DROPPED.inc()
+
+    def restart(self):
+        '''
+        Starts a new listener. Used in forked children, which do not inherit
+        the parent's listener thread.
+        '''
+        self.queue = queue.Queue(self.queue_size)
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=False)
+        self.listener.start()
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop() #  writes out what is still queued
+        super().close()
+
+
+def _restart_handlers():
+    for handler in list(_handlers):
+        handler.restart()
+
+
+def _stop_handlers():
+    for handler in list(_handlers):
+        if handler.listener._thread is not None:
+            handler.listener.stop()
+
+
+os.register_at_fork(after_in_child=_restart_handlers)
+atexit.register(_stop_handlers)
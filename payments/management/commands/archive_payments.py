@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from payments import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves settled payments older than PAYMENT_ARCHIVE_AFTER_MONTHS whole months, with their ledger events, '
+        'into compressed files in PAYMENT_ARCHIVE_DIR, one file per month. Run it monthly.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-months', type=int, default=settings.PAYMENT_ARCHIVE_AFTER_MONTHS, help='Whole months before the current one to keep')
+        parser.add_argument('--format', choices=sorted(archive.FORMATS), help='Default PAYMENT_ARCHIVE_FORMAT, or parquet when pyarrow is installed')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payments deleted per query')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be archived')
+        parser.add_argument('--lookup', metavar='REFERENCE', help='Print the archived payment with this reference and exit')
+
+    def handle(self, *args, **options):
+        if options['lookup']:
+            payment = archive.find_archived(options['lookup'])
+            if payment is None:
+                raise CommandError(f"No archived payment with reference {options['lookup']}")
+            for field, value in payment.items():
+                self.stdout.write(f'{field}: {value}')
+            return
+
+        format = options['format'] or settings.PAYMENT_ARCHIVE_FORMAT or archive.default_format()
+        if not archive.format_available(format):
+            raise CommandError(f'Archive format {format!r} is not available (parquet needs pyarrow: pip install pyarrow)')
+
+        if not options['dry_run']:
+            finished = archive.finish_incomplete(options['batch_size'])
+            if finished:
+                self.stdout.write(f'Finished {finished} interrupted archive(s)')
+
+        before = archive.cutoff(options['older_than_months'])
+        archived = 0
+        for date_from, date_to in archive.archivable_months(before):
+            if options['dry_run']:
+                count = archive.archivable(date_from, date_to).count()
+                if count:
+                    self.stdout.write(f'{date_from:%Y-%m}: {count} payment(s)')
+                archived += count
+                continue
+            entry = archive.archive_month(date_from, date_to, format, batch_size=options['batch_size'])
+            if entry is not None:
+                self.stdout.write(f"{entry['month']}: {entry['rows']} payment(s) to {entry['file']}")
+                archived += entry['rows']
+
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {archived} payment(s) dated before {before:%Y-%m-%d}'))
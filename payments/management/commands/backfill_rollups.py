@@ -0,0 +1,85 @@
+import multiprocessing
+import time
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Min
+from django.utils import timezone
+
+from payments import rollups, transport
+from payments.models import Payment
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+def backfill_chunk(args):
+    day_from, day_to, dry_run = args
+    try:
+        return day_from, day_to, rollups.repair(day_from, day_to, confirm=False, dry_run=dry_run)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        'Builds the daily payment totals (PaymentRollup) of existing payments, a range of days per process. '
+        'Run it once after turning PAYMENT_ROLLUPS on; it only adds what is missing, so it is safe to run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=parse_day, help='First day (YYYY-MM-DD), default the oldest payment\'s')
+        parser.add_argument('--to', dest='day_to', type=parse_day, help='Day to stop before (YYYY-MM-DD), default tomorrow')
+        parser.add_argument('--chunk-days', type=int, default=7, help='Days per chunk of work')
+        parser.add_argument('--processes', type=int, default=4)
+        parser.add_argument('--dry-run', action='store_true', help='Only report the totals that would be added')
+
+    def handle(self, *args, **options):
+        if not settings.PAYMENT_ROLLUPS and not options['dry_run']:
+            # payments settled after the backfill would be missing from the totals
+            raise CommandError('Turn PAYMENT_ROLLUPS on before backfilling the rollups')
+        day_to = options['day_to'] or timezone.localdate() + timedelta(days=1)
+        day_from = options['day_from']
+        if day_from is None:
+            oldest = Payment.objects.filter(status__in=rollups.ROLLUP_STATUSES).aggregate(oldest=Min('date'))['oldest']
+            if oldest is None:
+                self.stdout.write('No settled payments to roll up')
+                return
+            day_from = timezone.localdate(oldest)
+        archived_until = rollups.archived_until()
+        if archived_until and day_from < archived_until:
+            self.stdout.write(f'Skipping the archived days before {archived_until}')
+            day_from = archived_until
+
+        chunks = [(start, end, options['dry_run']) for start, end in rollups.day_chunks(day_from, day_to, options['chunk_days'])]
+        started = time.monotonic()
+        changed = 0
+
+        def report(result):
+            nonlocal changed
+            start, end, deltas = result
+            changed += len(deltas)
+            if deltas:
+                self.stdout.write(f'{start} to {end}: {len(deltas)} total(s) {"to add" if options["dry_run"] else "added"}')
+
+        if options['processes'] <= 1:
+            for chunk in chunks:
+                report(backfill_chunk(chunk))
+        else:
+            # children must not inherit the parent's database or gateway sockets
+            connections.close_all()
+            transport.close_adapters()
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                for result in pool.imap_unordered(backfill_chunk, chunks):
+                    report(result)
+
+        verb = 'Would update' if options['dry_run'] else 'Updated'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {changed} daily total(s) from {day_from} to {day_to} in {time.monotonic() - started:.1f}s'))
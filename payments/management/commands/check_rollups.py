@@ -0,0 +1,42 @@
+import logging
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments import rollups
+from payments.management.commands.backfill_rollups import parse_day
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the daily payment totals of recent days from the payments and repairs those that drifted. '
+        'Run it daily.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='Days to check, ending today')
+        parser.add_argument('--from', dest='day_from', type=parse_day, help='First day (YYYY-MM-DD), instead of --days')
+        parser.add_argument('--to', dest='day_to', type=parse_day, help='Day to stop before (YYYY-MM-DD), default tomorrow')
+        parser.add_argument('--dry-run', action='store_true', help='Only report drifted totals')
+
+    def handle(self, *args, **options):
+        day_to = options['day_to'] or timezone.localdate() + timedelta(days=1)
+        day_from = options['day_from'] or timezone.localdate() - timedelta(days=options['days'] - 1)
+        archived_until = rollups.archived_until()
+        if archived_until and day_from < archived_until:
+            self.stdout.write(f'Skipping the archived days before {archived_until}')
+            day_from = archived_until
+
+        deltas = rollups.repair(day_from, day_to, dry_run=options['dry_run'])
+        for (day, processor, status), (count, amount) in sorted(deltas.items()):
+            logger.warning(
+                "Daily payment total drifted", extra={'day': str(day), 'processor': processor, 'status': status, 'count': count, 'amount': amount})
+            self.stdout.write(f'{day} {processor} {status}: {count:+d} payment(s), {amount:+d}')
+
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(deltas)} drifted daily total(s) from {day_from} to {day_to}'))
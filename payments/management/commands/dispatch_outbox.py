@@ -0,0 +1,107 @@
+import logging
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from payments import transport
+from payments.outbox import dispatch_batch, outbox_stats, requeue_dead_letters
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_dispatcher(threads, batch_size, poll_interval, once, report_interval, write):
+    '''
+    Dispatches batches of outbox messages, delivering each batch on [threads]
+    threads, and reports the delivery rate and outbox depth every
+    [report_interval] seconds through [write].
+    '''
+    dispatched = last_value = 0
+    started = last_report = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix='outbox') as executor:
+        try:
+            while True:
+                try:
+                    claimed = dispatch_batch(batch_size, executor)
+                except Exception:
+                    logger.exception("Outbox dispatcher failed to dispatch a batch")
+                    connections.close_all()
+                    time.sleep(poll_interval)
+                    continue
+                dispatched += claimed
+                if not claimed:
+                    if once:
+                        break
+                    time.sleep(poll_interval)
+
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    stats = outbox_stats()
+                    write(
+                        f"[pid {os.getpid()}] dispatched={dispatched} rate={(dispatched - last_value) / (now - last_report):.1f}/s "
+                        f"pending={stats['pending']} delivering={stats['delivering']} dead={stats['dead']} "
+                        f"oldest_pending_age={stats['oldest_pending_age']:.1f}s"
+                    )
+                    last_report, last_value = now, dispatched
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connections.close_all()
+
+    elapsed = time.monotonic() - started
+    write(f"[pid {os.getpid()}] dispatched {dispatched} messages in {elapsed:.1f}s ({dispatched / elapsed if elapsed else 0:.1f}/s)")
+
+
+class Command(BaseCommand):
+    help = 'Delivers the payment outbox (side effects of payment transitions) to its handlers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Number of dispatcher processes')
+        parser.add_argument('--threads', type=int, default=16, help='Deliveries in flight per process (see also PAYMENT_OUTBOX_CONCURRENCY)')
+        parser.add_argument('--batch-size', type=int, default=settings.PAYMENT_OUTBOX_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when nothing is due')
+        parser.add_argument('--report-interval', type=float, default=30.0, help='Seconds between delivery rate reports')
+        parser.add_argument('--once', action='store_true', help='Exit once nothing is due')
+        parser.add_argument('--stats', action='store_true', help='Print the outbox depth and exit')
+        parser.add_argument('--requeue-dead-letters', nargs='*', type=int, metavar='ID',
+                            help='Move the dead letters with these ids (all of them if none are given) back to the outbox and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in outbox_stats().items():
+                self.stdout.write(f"{name}: {value}")
+            return
+
+        if options['requeue_dead_letters'] is not None:
+            requeued = requeue_dead_letters(options['requeue_dead_letters'] or None)
+            self.stdout.write(f"Requeued {requeued} dead letters")
+            return
+
+        dispatcher_args = (
+            options['threads'], options['batch_size'], options['poll_interval'],
+            options['once'], options['report_interval'], self.stdout.write,
+        )
+        if options['processes'] <= 1:
+            run_dispatcher(*dispatcher_args)
+            return
+
+        # children must not inherit the parent's database or gateway sockets
+        connections.close_all()
+        transport.close_adapters()
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_dispatcher, args=dispatcher_args) for _ in range(options['processes'])]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
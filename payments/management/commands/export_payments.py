@@ -0,0 +1,62 @@
+import sys
+import time
+
+from datetime import datetime, time as datetime_time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from payments import exports
+from payments.models import PaymentStatus
+
+
+def parse_day(value):
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+    return timezone.make_aware(datetime.combine(day, datetime_time.min))
+
+
+class Command(BaseCommand):
+    help = 'Exports payments, or their daily totals per processor and status, as CSV, JSON lines or Parquet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(exports.FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help='File to write to, - for stdout (default)')
+        parser.add_argument('--processor', help='Only export payments made with this processor')
+        parser.add_argument('--status', choices=PaymentStatus.values, help='Only export payments in this status')
+        parser.add_argument('--from', dest='date_from', type=parse_day, help='First day to export (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='date_to', type=parse_day, help='Day to stop before (YYYY-MM-DD)')
+        parser.add_argument('--daily-totals', action='store_true', help='Export payment counts and amounts per day, processor and status')
+        parser.add_argument('--chunk-size', type=int, default=exports.DEFAULT_CHUNK_SIZE, help='Rows fetched per round trip and written per chunk')
+
+    def handle(self, *args, **options):
+        if not exports.format_available(options['format']):
+            raise CommandError(f"{options['format']} export needs pyarrow (pip install pyarrow)")
+
+        filters = {
+            'processor': options['processor'],
+            'status': options['status'],
+            'date_from': options['date_from'],
+            'date_to': options['date_to'],
+        }
+        if options['daily_totals']:
+            chunks = exports.export_daily_totals(options['format'], options['chunk_size'], **filters)
+        else:
+            chunks = exports.export(exports.payments_queryset(**filters), options['format'], chunk_size=options['chunk_size'])
+
+        started = time.monotonic()
+        written = 0
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+
+        if options['output'] != '-':
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} bytes to {options['output']} in {time.monotonic() - started:.1f}s"))
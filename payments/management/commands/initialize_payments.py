@@ -0,0 +1,102 @@
+import csv
+import json
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from payments.batch import initialize_payments
+
+
+OUTPUT_FIELDS = ('row', 'username', 'amount', 'reference', 'authorization_url', 'error')
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates and initializes payments in bulk, e.g. to bill a whole cohort. Reads a CSV with a '
+        'username and amount (in kobo) column and an optional metadata column of JSON objects, and '
+        'writes every row back with its reference and authorization URL, or why it failed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='CSV file to read, - for stdin')
+        parser.add_argument('--callback-url', required=True, help='Absolute URL the gateways send the user back to, e.g. https://example.com/payment_callback/')
+        parser.add_argument('--output', default='-', help='CSV file to write to, - for stdout (default)')
+        parser.add_argument('--workers', type=int, help='Concurrent gateway initializations (default PAYMENT_BULKHEAD_SIZE)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per user lookup and INSERT')
+        parser.add_argument('--rate', action='append', default=[], metavar='PROCESSOR=CALLS_PER_SECOND',
+                            help='Override PAYMENT_PROCESSOR_RATE_LIMITS for a processor. Can be repeated')
+
+    def handle(self, *args, **options):
+        rate_limits = dict(settings.PAYMENT_PROCESSOR_RATE_LIMITS)
+        for value in options['rate']:
+            name, _, rate = value.partition('=')
+            try:
+                rate_limits[name] = float(rate)
+            except ValueError:
+                raise CommandError(f'Invalid --rate {value!r}, expected PROCESSOR=CALLS_PER_SECOND')
+
+        source = sys.stdin if options['input'] == '-' else open(options['input'], newline='')
+        try:
+            rows = list(csv.DictReader(source))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        if rows and not {'username', 'amount'} <= rows[0].keys():
+            raise CommandError('The input needs a username and an amount column')
+
+        User = get_user_model()
+        users = {}
+        usernames = list({row['username'] for row in rows})
+        for start in range(0, len(usernames), options['batch_size']):
+            users.update(User.objects.in_bulk(usernames[start:start + options['batch_size']], field_name='username'))
+
+        # rows that cannot become payments are reported without being submitted
+        errors, items, item_rows = {}, [], []
+        for number, row in enumerate(rows, start=1):
+            user = users.get(row['username'])
+            try:
+                amount = int(row['amount'])
+                metadata = json.loads(row['metadata']) if row.get('metadata') else None
+            except ValueError as e:
+                errors[number] = f'Invalid row: {e}'
+                continue
+            if user is None:
+                errors[number] = 'Unknown user'
+                continue
+            items.append((user, amount, metadata))
+            item_rows.append(number)
+
+        started = time.monotonic()
+        result = initialize_payments(
+            items, options['callback_url'],
+            workers=options['workers'], rate_limits=rate_limits, batch_size=options['batch_size'],
+        )
+        elapsed = time.monotonic() - started
+        errors.update((item_rows[index], error) for index, error in result['errors'].items())
+        references = dict(zip(item_rows, result['references']))
+
+        output = sys.stdout if options['output'] == '-' else open(options['output'], 'w', newline='')
+        try:
+            writer = csv.DictWriter(output, OUTPUT_FIELDS)
+            writer.writeheader()
+            for number, row in enumerate(rows, start=1):
+                reference = references.get(number)
+                writer.writerow({
+                    'row': number,
+                    'username': row['username'],
+                    'amount': row['amount'],
+                    'reference': reference or '',
+                    'authorization_url': result['urls'].get(reference, ''),
+                    'error': errors.get(number, ''),
+                })
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(
+            f"Initialized {len(result['urls'])} of {len(rows)} payments in {elapsed:.1f}s "
+            f"({len(items) / elapsed if elapsed else 0:.1f} payments/s), {len(errors)} failed"
+        ))
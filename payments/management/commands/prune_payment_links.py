@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from payments.links import prune_links
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes prefetched payment links that expired without being handed out, with their payments, '
+        'and forgets handed out links older than PAYMENT_LINK_TTL. Run it every few minutes when PAYMENT_LINK_PREFETCH is on.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payments deleted per query')
+
+    def handle(self, *args, **options):
+        expired, claimed = prune_links(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {expired} expired payment link(s) and forgot {claimed} handed out one(s)'))
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from payments.idempotency import prune
+
+
+class Command(BaseCommand):
+    help = (
+        'Forgets the keys of webhook events processed more than PAYMENT_WEBHOOK_DEDUP_TTL seconds ago. '
+        'Run it daily when PAYMENT_WEBHOOK_DEDUP is on.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl', type=int, default=settings.PAYMENT_WEBHOOK_DEDUP_TTL, help='Seconds to keep keys for')
+
+    def handle(self, *args, **options):
+        deleted = prune(options['ttl'])
+        self.stdout.write(self.style.SUCCESS(f'Forgot {deleted} webhook event key(s)'))
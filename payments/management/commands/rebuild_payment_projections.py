@@ -0,0 +1,57 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from payments import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds Payment.status and Payment.date from the payment ledger. Only the events recorded '
+        'since the last snapshots are replayed unless --from-scratch is given. Payments whose stored status '
+        'or date differs from the ledger in a way no transition leads to are reported, and only overwritten '
+        'with --overwrite-drift.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-scratch', action='store_true', help='Ignore snapshots and replay every event')
+        parser.add_argument('--snapshot', action='store_true', help='Save snapshots of the rebuilt projections')
+        parser.add_argument('--chunk-size', type=int, default=10_000, help='Events fetched per round trip')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payments rebuilt per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many payments would change')
+        parser.add_argument('--overwrite-drift', action='store_true', help='Also overwrite drifted payments with the ledger, e.g. moving settled payments back')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+
+        def progress(stats):
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"events={stats['events']} payments={stats['payments']} changed={stats['changed']} "
+                f"rate={stats['events'] / elapsed if elapsed else 0:.0f} events/s"
+            )
+
+        stats = ledger.rebuild_projections(
+            from_scratch=options['from_scratch'],
+            take_snapshots=options['snapshot'],
+            chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'],
+            overwrite_drift=options['overwrite_drift'],
+            progress=progress if options['verbosity'] > 1 else None,
+        )
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{'[dry run] ' if options['dry_run'] else ''}Replayed {stats['events']} events "
+            f"({stats['from_event']}, {stats['to_event']}] for {stats['payments']} payments in {elapsed:.1f}s "
+            f"({stats['events'] / elapsed if elapsed else 0:.0f} events/s): {stats['changed']} payments changed"
+        ))
+        if stats['drifted']:
+            action = 'overwritten' if options['overwrite_drift'] and not options['dry_run'] else 'left as they are, see --overwrite-drift'
+            self.stdout.write(self.style.WARNING(f"{stats['drifted']} payments differ from the ledger ({action}):"))
+            for reference, status, projected, date, projected_date in stats['drift']:
+                self.stdout.write(f"  {reference}: {status} {date:%Y-%m-%d %H:%M:%S}, ledger says {projected} "
+                                  f"{f'{projected_date:%Y-%m-%d %H:%M:%S}' if projected_date else '(no date)'}")
+            if stats['drifted'] > len(stats['drift']):
+                self.stdout.write(f"  and {stats['drifted'] - len(stats['drift'])} more")
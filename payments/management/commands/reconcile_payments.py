@@ -0,0 +1,135 @@
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from payments import ledger, transitions, verification
+from payments.factory import get_payment_processor
+from payments.models import Payment, PaymentEventSource, PaymentStatus
+from payments.ratelimit import RateLimiter
+from payments.registry import registry
+
+from store.utils import OnlineTransactionStatus
+
+
+PAYMENT_STATUSES = {
+    OnlineTransactionStatus.SUCCESSFUL: PaymentStatus.COMPLETED,
+    OnlineTransactionStatus.FAILED: PaymentStatus.FAILED,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-verifies unprocessed payments with their gateways and records the result. '
+        'Payments are read in primary key order, so an interrupted run can be resumed from its checkpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processor', help='Only reconcile payments made with this processor')
+        parser.add_argument('--older-than', type=int, default=60, help='Only reconcile payments older than this many minutes (default 60)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Payments read per query')
+        parser.add_argument('--workers', type=int, help='Concurrent gateway verifications (default PAYMENT_BULKHEAD_SIZE)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per conditional UPDATE')
+        parser.add_argument('--rate', action='append', default=[], metavar='PROCESSOR=CALLS_PER_SECOND',
+                            help='Override PAYMENT_PROCESSOR_RATE_LIMITS for a processor. Can be repeated')
+        parser.add_argument('--checkpoint', help='File the last reconciled payment id is written to after every chunk')
+        parser.add_argument('--resume', action='store_true', help='Start after the payment id stored in --checkpoint')
+        parser.add_argument('--limit', type=int, help='Stop after this many payments')
+        parser.add_argument('--dry-run', action='store_true', help='Verify payments but do not save the results')
+
+    def handle(self, *args, **options):
+        if options['resume'] and not options['checkpoint']:
+            raise CommandError('--resume needs --checkpoint')
+
+        rate_limits = dict(settings.PAYMENT_PROCESSOR_RATE_LIMITS)
+        for value in options['rate']:
+            name, _, rate = value.partition('=')
+            try:
+                rate_limits[name] = float(rate)
+            except ValueError:
+                raise CommandError(f'Invalid --rate {value!r}, expected PROCESSOR=CALLS_PER_SECOND')
+        limiters = {name: RateLimiter(rate) for name, rate in rate_limits.items() if rate > 0}
+        processors = {name: get_payment_processor(name) for name in registry.names()}
+
+        def verify(payment):
+            limiter = limiters.get(payment.processor)
+            if limiter:
+                limiter.acquire()
+            return verification.verify_payment(processors[payment.processor], payment.reference)
+
+        queryset = Payment.objects.filter(
+            status=PaymentStatus.UNPROCESSED,
+            date__lt=timezone.now() - timedelta(minutes=options['older_than']),
+            processor__in=processors,
+        ).exclude(
+            link__isnull=False, link__claimed_at__isnull=True, #  prefetched links never handed out, see prune_payment_links
+        ).only('id', 'reference', 'processor', 'status', 'date').order_by('id')
+        if options['processor']:
+            queryset = queryset.filter(processor=options['processor'])
+
+        last_id = self.load_checkpoint(options['checkpoint']) if options['resume'] else 0
+        verified = updated = unverified = 0
+        started = time.monotonic()
+
+        # more workers than the bulkhead lets through would only fail verifications
+        workers = min(options['workers'] or settings.PAYMENT_BULKHEAD_SIZE, settings.PAYMENT_BULKHEAD_SIZE)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while options['limit'] is None or verified < options['limit']:
+                chunk_size = options['chunk_size']
+                if options['limit'] is not None:
+                    chunk_size = min(chunk_size, options['limit'] - verified)
+                chunk = list(queryset.filter(id__gt=last_id)[:chunk_size])
+                if not chunk:
+                    break
+
+                changed, events = [], []
+                for payment, payload in zip(chunk, executor.map(verify, chunk)):
+                    if not payload:
+                        unverified += 1
+                        continue
+                    events.append(ledger.build_event(payment, PaymentEventSource.VERIFICATION, payload))
+                    status = PAYMENT_STATUSES.get(payload["data"]["status"])
+                    if status is None:
+                        continue
+                    changed.append((payment, status, payload["data"].get("payment_date")))
+
+                last_id = chunk[-1].id
+                if not options['dry_run']:
+                    ledger.record_events(events, batch_size=options['batch_size'])
+                    # payments settled by a callback or webhook since they were read are left alone
+                    changed = transitions.bulk_transition(changed, batch_size=options['batch_size'])
+                    self.save_checkpoint(options['checkpoint'], last_id)
+
+                verified += len(chunk)
+                updated += len(changed)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"verified={verified} updated={updated} unverified={unverified} "
+                    f"last_id={last_id} rate={verified / elapsed:.1f} refs/s"
+                )
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{'[dry run] ' if options['dry_run'] else ''}Verified {verified} payments in {elapsed:.1f}s "
+            f"({verified / elapsed if elapsed else 0:.1f} refs/s): {updated} updated, {unverified} could not be verified"
+        ))
+
+    def load_checkpoint(self, path):
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return json.load(f)['last_id']
+
+    def save_checkpoint(self, path, last_id):
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'last_id': last_id, 'saved_at': timezone.now().isoformat()}, f)
+        os.replace(tmp_path, path)
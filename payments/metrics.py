@@ -0,0 +1,291 @@
+'''
+In-process metrics for the payment processors and views, served in the
+Prometheus text format at /metrics.
+
+Counters and histograms are dicts keyed by label values and updated under a
+lock per metric, so recording a sample costs about a microsecond and never
+leaves the process. With several worker processes (gunicorn workers, the
+webhook workers), set PAYMENT_METRICS_DIR: every process then writes its
+values to its own file there every PAYMENT_METRICS_FLUSH_INTERVAL seconds
+and on exit, and /metrics adds up the files of every process. Files of
+exited processes are kept so that counters never go backwards; clear the
+directory when the service is deployed.
+'''
+import atexit
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+
+from bisect import bisect_left
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {} #  label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def reset(self):
+        self._lock = threading.Lock() #  may have been held by another thread when the process forked
+        self.values = {}
+
+    def dump(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, into, dumped):
+        for labels, value in dumped:
+            labels = tuple(labels)
+            into[labels] = into.get(labels, 0) + value
+
+    def render(self, values):
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {} #  label values -> [count per bucket (and one for +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def reset(self):
+        self._lock = threading.Lock() #  may have been held by another thread when the process forked
+        self.values = {}
+
+    def dump(self):
+        with self._lock:
+            return [[list(labels), list(counts), total] for labels, (counts, total) in self.values.items()]
+
+    def merge(self, into, dumped):
+        for labels, counts, total in dumped:
+            labels = tuple(labels)
+            entry = into.setdefault(labels, [[0] * (len(self.buckets) + 1), 0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+
+    def render(self, values):
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = 'le="{}"'.format(bound if bound == '+Inf' else _number(bound))
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.directory = None
+        self._file_name = None
+        self._interval = None
+        self._stop = threading.Event()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def dump(self):
+        return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    def reset(self):
+        '''
+        Forgets every value. Only for a freshly forked child, where no other
+        thread is recording.
+        '''
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def flush(self):
+        '''
+        Writes this process's values to its file in the metrics directory.
+        '''
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, self._file_name)
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(self.dump(), file, separators=(',', ':'))
+        os.replace(temporary, path) #  readers never see a partial file
+
+    def _flush_periodically(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except OSError:
+                pass #  try again at the next interval
+
+    def start(self, directory, interval=5):
+        '''
+        Starts writing this process's values to [directory] every [interval]
+        seconds. Safe to call again in a forked child, which starts over with
+        empty values and a file of its own.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._file_name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+        self._interval = interval
+        self._stop = threading.Event()
+        threading.Thread(target=self._flush_periodically, args=(interval,), name='metrics-flusher', daemon=True).start()
+
+    def _after_fork(self):
+        # the child inherits the parent's values, which the parent reports itself
+        self.reset()
+        if self.directory:
+            self.start(self.directory, self._interval)
+
+    def collect(self):
+        '''
+        Returns {metric name: values} for this process, plus every other
+        process writing to the metrics directory.
+        '''
+        collected = {name: {} for name in self.metrics}
+        dumps = [self.dump()]
+        if self.directory:
+            for file_name in os.listdir(self.directory):
+                if not file_name.endswith('.json') or file_name == self._file_name:
+                    continue
+                try:
+                    with open(os.path.join(self.directory, file_name)) as file:
+                        dumps.append(json.load(file))
+                except (OSError, ValueError):
+                    continue #  removed or being replaced
+        for dumped in dumps:
+            for name, metric in self.metrics.items():
+                metric.merge(collected[name], dumped.get(name, ()))
+        return collected
+
+    def render(self):
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+os.register_at_fork(after_in_child=REGISTRY._after_fork)
+atexit.register(lambda: REGISTRY.flush())
+
+GATEWAY_REQUESTS = REGISTRY.counter(
+    'payment_gateway_requests_total', 'Requests sent to the payment gateways, by HTTP status or failure.',
+    ('processor', 'endpoint', 'status'))
+GATEWAY_LATENCY = REGISTRY.histogram(
+    'payment_gateway_request_seconds', 'Payment gateway request latency.', ('processor', 'endpoint'))
+PROCESSOR_CALLS = REGISTRY.counter(
+    'payment_processor_calls_total', 'PaymentProcessor method calls, by outcome.', ('processor', 'method', 'outcome'))
+PROCESSOR_LATENCY = REGISTRY.histogram(
+    'payment_processor_call_seconds', 'PaymentProcessor method latency.', ('processor', 'method'))
+HTTP_LATENCY = REGISTRY.histogram(
+    'payment_http_request_seconds', 'View latency, up to the response being returned.', ('view', 'method', 'status'))
+HTTP_DB_QUERIES = REGISTRY.histogram(
+    'payment_http_db_queries', 'Database queries per request.', ('view',), buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+PAYMENT_LINK_CLAIMS = REGISTRY.counter(
+    'payment_link_claims_total', 'Checkout POSTs answered with a pre-initialized payment link (hit) or not (miss).', ('outcome',))
+PAYMENT_LINK_PREFETCHES = REGISTRY.counter(
+    'payment_link_prefetches_total', 'Payment links initialized ahead of checkout, by outcome.', ('outcome',))
+CHECKOUT_REDIRECT = REGISTRY.histogram(
+    'payment_checkout_redirect_seconds', 'Checkout POST latency up to the redirect to the gateway, by where the link came from.', ('source',))
+WEBHOOK_DUPLICATES = REGISTRY.counter(
+    'payment_webhook_duplicates_total', 'Webhook redeliveries answered without processing.', ('processor',))
+OUTBOX_DELIVERIES = REGISTRY.counter(
+    'payment_outbox_deliveries_total', 'Outbox messages handed to their handler, by outcome (delivered, retry, dead).', ('handler', 'outcome'))
+OUTBOX_DELAY = REGISTRY.histogram(
+    'payment_outbox_delivery_delay_seconds', 'Time from an outbox message being written to its delivery.', ('handler',),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    'payment_log_records_dropped_total', 'Log records dropped because the logging queue was full.')
+
+
+def _observe_call(processor, method, started, outcome):
+    PROCESSOR_CALLS.inc(processor, method, outcome)
+    PROCESSOR_LATENCY.observe(time.perf_counter() - started, processor, method)
+
+
+def instrument(function, method):
+    '''
+    Wraps the PaymentProcessor method [function] to time it and count its
+    outcomes: 'ok', 'failed' (it returned None, '' or False, which is how the
+    processors report errors) or 'exception'.
+    '''
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await function(self, *args, **kwargs)
+            except BaseException:
+                _observe_call(self.name, method, started, 'exception')
+                raise
+            _observe_call(self.name, method, started, 'ok' if result else 'failed')
+            return result
+    else:
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = function(self, *args, **kwargs)
+            except BaseException:
+                _observe_call(self.name, method, started, 'exception')
+                raise
+            _observe_call(self.name, method, started, 'ok' if result else 'failed')
+            return result
+    return wrapper
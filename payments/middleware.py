@@ -0,0 +1,71 @@
+'''
+Request metrics: latency per view, method and status class, and the number
+of database queries each request made (see payments/metrics.py).
+
+Queries are counted by an execute wrapper installed on every database
+connection (see PaymentsConfig.ready) that adds to a counter held in a
+context variable, so queries made from sync_to_async threads on behalf of
+an async view are counted too.
+'''
+import contextvars
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'} #  anything else is counted as 'other'
+
+_queries = contextvars.ContextVar('payment_request_queries', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    counter = _queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def _record(request, response, started, counter):
+    match = request.resolver_match
+    view = match.view_name if match else 'unmatched'
+    method = request.method if request.method in METHODS else 'other'
+    metrics.HTTP_LATENCY.observe(time.perf_counter() - started, view, method, f"{response.status_code // 100}xx")
+    metrics.HTTP_DB_QUERIES.observe(counter[0], view)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            counter = [0]
+            token = _queries.set(counter)
+            try:
+                response = await get_response(request)
+            finally:
+                _queries.reset(token)
+            _record(request, response, started, counter)
+            return response
+
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            counter = [0]
+            token = _queries.set(counter)
+            try:
+                response = get_response(request)
+            finally:
+                _queries.reset(token)
+            _record(request, response, started, counter)
+            return response
+
+    return middleware
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.3 on 2026-10-18 07:32
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_alter_payment_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='processor',
+            field=models.CharField(choices=[('paystack', 'Paystack'), ('credo', 'Credo')], default='', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('processor', models.CharField(max_length=20)),
+                ('event_key', models.CharField(max_length=128, unique=True)),
+                ('body', models.TextField()),
+                ('status', models.CharField(choices=[('PD', 'Pending'), ('PR', 'Processing'), ('DN', 'Done'), ('FD', 'Failed')], default='PD', max_length=2)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claim_token', models.CharField(blank=True, db_index=True, default='', max_length=32)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='webhook_event_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,145 @@
+'''
+Expands the payments table for amounts stored as integer minor units with a
+currency code, a right-sized reference column and the indexes used by
+reconciliation, dashboards and user history.
+
+This is the first of three migrations that change the table while workers
+running the previous code still write to it:
+
+    0004 (expand)    adds currency, with a database default, and amount_minor,
+                     nullable, which the model's amount now maps to. Triggers
+                     keep amount and amount_minor in step whichever code
+                     writes a row
+    0011 (backfill)  fills amount_minor of the existing rows in batches
+    0012 (contract)  drops the triggers and the float amount, makes
+                     amount_minor NOT NULL and shrinks reference. Old code
+                     breaks once it has run, so apply it only when no worker
+                     runs the code from before 0004, e.g. by deploying with
+                     `manage.py migrate payments 0011` and running
+                     `manage.py migrate` afterwards
+
+The migration is not atomic so that it can run on a large, live table: on
+PostgreSQL the columns are added without a table rewrite, the reference
+length constraint is added NOT VALID and validated afterwards, and indexes
+are built concurrently. It cannot be reversed.
+'''
+from django.db import migrations, models
+
+import payments.operations
+
+
+POSTGRESQL_TRIGGER = '''
+CREATE FUNCTION payments_payment_sync_amount() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        IF NEW.amount_minor IS NULL THEN
+            NEW.amount_minor := round(NEW.amount * 100);
+        ELSIF NEW.amount IS NULL THEN
+            NEW.amount := NEW.amount_minor / 100.0;
+        END IF;
+    ELSIF NEW.amount IS DISTINCT FROM OLD.amount THEN
+        NEW.amount_minor := round(NEW.amount * 100);
+    ELSIF NEW.amount_minor IS DISTINCT FROM OLD.amount_minor THEN
+        NEW.amount := NEW.amount_minor / 100.0;
+    END IF;
+    RETURN NEW;
+END
+$$;
+CREATE TRIGGER payments_payment_sync_amount BEFORE INSERT OR UPDATE ON payments_payment
+    FOR EACH ROW EXECUTE FUNCTION payments_payment_sync_amount();
+'''
+
+# SQLite triggers cannot change the row being written, so they update it
+# afterwards (recursive triggers are off, so that update fires nothing)
+SQLITE_TRIGGERS = ('''
+CREATE TRIGGER payments_payment_sync_amount_insert AFTER INSERT ON payments_payment
+BEGIN
+    UPDATE payments_payment SET
+        amount_minor = COALESCE(NEW.amount_minor, CAST(ROUND(NEW.amount * 100) AS INTEGER)),
+        amount = COALESCE(NEW.amount, NEW.amount_minor / 100.0)
+    WHERE id = NEW.id;
+END
+''', '''
+CREATE TRIGGER payments_payment_sync_amount_update AFTER UPDATE OF amount, amount_minor ON payments_payment
+WHEN NEW.amount IS NOT OLD.amount OR NEW.amount_minor IS NOT OLD.amount_minor
+BEGIN
+    UPDATE payments_payment SET
+        amount_minor = CASE WHEN NEW.amount IS NOT OLD.amount THEN CAST(ROUND(NEW.amount * 100) AS INTEGER) ELSE NEW.amount_minor END,
+        amount = CASE WHEN NEW.amount IS NOT OLD.amount THEN NEW.amount ELSE NEW.amount_minor / 100.0 END
+    WHERE id = NEW.id;
+END
+''')
+
+
+def expand(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        # new code no longer writes the float amount and SQLite checks NOT NULL
+        # before its triggers run. Done first: rebuilding the table for it
+        # would drop the columns and defaults added below
+        Payment = apps.get_model('payments', 'Payment')
+        old_field = Payment._meta.get_field('amount')
+        new_field = old_field.clone()
+        new_field.null = True
+        new_field.set_attributes_from_name('amount')
+        new_field.model = Payment
+        schema_editor.alter_field(Payment, old_field, new_field)
+
+    # the default stays in the database (Django drops the ones it adds) so
+    # that old code, which does not know the column, can still insert
+    schema_editor.execute("ALTER TABLE payments_payment ADD COLUMN currency varchar(3) DEFAULT 'NGN' NOT NULL")
+    schema_editor.execute('ALTER TABLE payments_payment ADD COLUMN amount_minor bigint NULL')
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(POSTGRESQL_TRIGGER)
+        # shrinking a varchar rewrites the table, so until 0012 does it a
+        # validated CHECK keeps longer references out
+        schema_editor.execute('ALTER TABLE payments_payment ADD CONSTRAINT payment_reference_length CHECK (char_length(reference) <= 32) NOT VALID')
+        schema_editor.execute('ALTER TABLE payments_payment VALIDATE CONSTRAINT payment_reference_length')
+    elif schema_editor.connection.vendor == 'sqlite':
+        for trigger in SQLITE_TRIGGERS:
+            schema_editor.execute(trigger)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('payments', '0003_webhookevent'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='payment',
+                    name='currency',
+                    field=models.CharField(default='NGN', max_length=3),
+                ),
+                # the float column stays in the database for old code until 0012
+                migrations.RemoveField(
+                    model_name='payment',
+                    name='amount',
+                ),
+                migrations.AddField(
+                    model_name='payment',
+                    name='amount',
+                    field=models.BigIntegerField(db_column='amount_minor', null=True, help_text="Amount in the currency's minor unit, e.g. kobo"),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(expand),
+            ],
+        ),
+        payments.operations.AddIndexOnline(
+            model_name='payment',
+            index=models.Index(condition=models.Q(('status', 'UP')), fields=['processor', 'date'], name='payment_unprocessed_idx'),
+        ),
+        payments.operations.AddIndexOnline(
+            model_name='payment',
+            index=models.Index(fields=['user', '-date'], name='payment_user_date_idx'),
+        ),
+        payments.operations.AddIndexOnline(
+            model_name='payment',
+            index=models.Index(fields=['status', 'processor', 'date'], name='payment_status_proc_date_idx'),
+        ),
+    ]
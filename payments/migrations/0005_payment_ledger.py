@@ -0,0 +1,46 @@
+# Generated by Django 4.2.3 on 2026-10-18 07:46
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_payment_compact_schema'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentSnapshot',
+            fields=[
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='payments.payment')),
+                ('status', models.CharField(choices=[('UP', 'Unprocessed'), ('CM', 'Completed'), ('FD', 'Failed')], max_length=2)),
+                ('date', models.DateTimeField(null=True)),
+                ('last_event_id', models.BigIntegerField()),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PaymentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('WH', 'Webhook'), ('VF', 'Verification')], max_length=2)),
+                ('processor', models.CharField(max_length=20)),
+                ('gateway_status', models.CharField(help_text='Normalized transaction status or event name', max_length=32)),
+                ('occurred_at', models.DateTimeField(blank=True, help_text='Payment date reported by the gateway', null=True)),
+                ('payload', models.TextField(help_text='Canonical JSON of the normalized payload')),
+                ('digest', models.CharField(help_text='SHA-256 of [payload]', max_length=64)),
+                ('recorded_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='events', to='payments.payment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['payment', 'id'], name='payment_event_payment_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='paymentevent',
+            constraint=models.UniqueConstraint(fields=('payment', 'source', 'digest'), name='payment_event_unique_payload'),
+        ),
+    ]
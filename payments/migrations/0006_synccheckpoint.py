@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_payment_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('processor', models.CharField(max_length=20, unique=True)),
+                ('synced_until', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='paymentevent',
+            name='source',
+            field=models.CharField(choices=[('WH', 'Webhook'), ('VF', 'Verification'), ('SY', 'Transaction sync')], max_length=2),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentLink',
+            fields=[
+                ('payment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='link', serialize=False, to='payments.payment')),
+                ('authorization_url', models.URLField(max_length=1024)),
+                ('expires_at', models.DateTimeField()),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('claimed_at__isnull', True)), fields=['expires_at'], name='payment_link_unclaimed_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:39
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SeenWebhookEvent',
+            fields=[
+                ('key', models.CharField(max_length=128, primary_key=True, serialize=False)),
+                ('processor', models.CharField(max_length=20)),
+                ('seen_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
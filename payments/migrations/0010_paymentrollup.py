@@ -0,0 +1,29 @@
+# Generated by Django 4.2.3 on 2026-10-18 08:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_seenwebhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('processor', models.CharField(max_length=20)),
+                ('status', models.CharField(choices=[('UP', 'Unprocessed'), ('CM', 'Completed'), ('FD', 'Failed')], max_length=2)),
+                ('shard', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('amount', models.BigIntegerField(default=0, help_text="Amount in the currency's minor unit, e.g. kobo")),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='paymentrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'processor', 'status', 'shard'), name='payment_rollup_key'),
+        ),
+    ]
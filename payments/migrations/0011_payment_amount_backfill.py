@@ -0,0 +1,36 @@
+'''
+Fills amount_minor of the payments created before 0004 from their float
+amount, in batches that commit one at a time so that no transaction holds
+locks on the whole table. Rows written since 0004 were filled by its
+triggers. See 0004 for the migrations around it.
+'''
+from django.db import migrations
+
+
+BACKFILL_BATCH_SIZE = 10_000
+
+
+def backfill_amount_minor(apps, schema_editor):
+    # the float column is no longer in the migration state, hence the SQL
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT MAX(id) FROM payments_payment')
+        last_id = cursor.fetchone()[0] or 0
+        for start in range(0, last_id + 1, BACKFILL_BATCH_SIZE):
+            cursor.execute(
+                'UPDATE payments_payment SET amount_minor = CAST(ROUND(amount * 100) AS bigint) '
+                'WHERE id >= %s AND id < %s AND amount_minor IS NULL',
+                [start, start + BACKFILL_BATCH_SIZE],
+            )
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('payments', '0010_paymentrollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_amount_minor, migrations.RunPython.noop),
+    ]
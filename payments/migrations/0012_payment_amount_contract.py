@@ -0,0 +1,86 @@
+'''
+Contracts the payments table once no worker runs the code from before
+0004 (see there): drops the amount triggers and the float amount, makes
+amount_minor NOT NULL and shrinks the reference column to 32 characters.
+
+On PostgreSQL NOT NULL is proven by a CHECK validated without blocking
+writes, but shrinking reference rewrites the table under an exclusive
+lock, so run this migration when a pause in writes is acceptable. It
+cannot be reversed.
+'''
+from django.db import migrations, models
+
+
+def drop_float_amount(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP TRIGGER IF EXISTS payments_payment_sync_amount ON payments_payment')
+        schema_editor.execute('DROP FUNCTION IF EXISTS payments_payment_sync_amount()')
+    elif schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TRIGGER IF EXISTS payments_payment_sync_amount_insert')
+        schema_editor.execute('DROP TRIGGER IF EXISTS payments_payment_sync_amount_update')
+    schema_editor.execute('ALTER TABLE payments_payment DROP COLUMN amount')
+
+
+def _alter(apps, schema_editor, name, **attributes):
+    Payment = apps.get_model('payments', 'Payment')
+    old_field = Payment._meta.get_field(name)
+    new_field = old_field.clone()
+    for attribute, value in attributes.items():
+        setattr(new_field, attribute, value)
+    new_field.set_attributes_from_name(name)
+    new_field.model = Payment
+    schema_editor.alter_field(Payment, old_field, new_field)
+
+
+def set_amount_not_null(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        # SET NOT NULL skips its table scan when a validated CHECK already proves it
+        schema_editor.execute('ALTER TABLE payments_payment ADD CONSTRAINT payment_amount_not_null CHECK (amount_minor IS NOT NULL) NOT VALID')
+        schema_editor.execute('ALTER TABLE payments_payment VALIDATE CONSTRAINT payment_amount_not_null')
+        schema_editor.execute('ALTER TABLE payments_payment ALTER COLUMN amount_minor SET NOT NULL')
+        schema_editor.execute('ALTER TABLE payments_payment DROP CONSTRAINT payment_amount_not_null')
+        return
+    _alter(apps, schema_editor, 'amount', null=False)
+
+
+def shrink_reference(apps, schema_editor):
+    _alter(apps, schema_editor, 'reference', max_length=32)
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE payments_payment DROP CONSTRAINT payment_reference_length')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('payments', '0011_payment_amount_backfill'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_float_amount),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='payment',
+                    name='amount',
+                    field=models.BigIntegerField(db_column='amount_minor', help_text="Amount in the currency's minor unit, e.g. kobo"),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(set_amount_not_null),
+            ],
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='payment',
+                    name='reference',
+                    field=models.CharField(blank=True, max_length=32, unique=True),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(shrink_reference),
+            ],
+        ),
+    ]
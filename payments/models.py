@@ -1,11 +1,12 @@
-import os
-import importlib
+from decimal import Decimal
 
 from django.contrib.auth import get_user_model
 from django.db import models
 from django.utils import timezone
+from django.utils.functional import lazy
 from django.utils.translation import gettext_lazy as _
-from django.conf import settings
+
+from .registry import registry
 
 
 # Create your models here.
@@ -14,22 +15,13 @@ class PaymentProcessorMixin:
     name = None
     name_readable = None
 
-def get_supported_payment_processors():
-    processors = {}
-    payments_dir = os.path.join(settings.BASE_DIR, 'payments')
-
-    for filename in os.listdir(payments_dir):
-        if filename.endswith('.py') and filename != '__init__.py':
-            module_name = f"payments.{filename[:-3]}"
-            module = importlib.import_module(module_name)
-            for obj in module.__dict__.values():
-                if isinstance(obj, type) and issubclass(obj, PaymentProcessorMixin):
-                    if obj.name is not None:
-                        processors[obj.name] = obj.name_readable
-
-    return processors
-
-supported_payment_processors = get_supported_payment_processors()
+def get_processor_choices():
+    '''
+    Choices for Payment.processor. The readable names are resolved lazily so
+    that processor modules are not imported when the models are loaded.
+    '''
+    readable_name = lazy(registry.readable_name, str)
+    return [(name, readable_name(name)) for name in registry.names()]
 
 
 class PaymentStatus(models.TextChoices):
@@ -40,12 +32,239 @@ class PaymentStatus(models.TextChoices):
 
 class Payment(models.Model):
     user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
-    amount = models.FloatField()
-    reference = models.CharField(max_length=64, unique=True, blank=True)
+    amount = models.BigIntegerField(db_column='amount_minor', help_text=_("Amount in the currency's minor unit, e.g. kobo")) #  the column the float amount was moved to, see migration 0004
+    currency = models.CharField(max_length=3, default='NGN')
+    reference = models.CharField(max_length=32, unique=True, blank=True)
     date = models.DateTimeField(default=timezone.now)
     status = models.CharField(
         max_length=2, choices=PaymentStatus.choices, default=PaymentStatus.UNPROCESSED)
-    processor = models.CharField(max_length=20, choices=[(processor_name, processor_name_readable) for processor_name, processor_name_readable in supported_payment_processors.items()], default='')
+    processor = models.CharField(max_length=20, choices=get_processor_choices(), default='')
+
+    class Meta:
+        indexes = [
+            # unprocessed payments by processor older than X (reconciliation)
+            models.Index(fields=['processor', 'date'], condition=models.Q(status=PaymentStatus.UNPROCESSED), name='payment_unprocessed_idx'),
+            # a user's payments by date
+            models.Index(fields=['user', '-date'], name='payment_user_date_idx'),
+            # dashboards and reports by status, processor and date range
+            models.Index(fields=['status', 'processor', 'date'], name='payment_status_proc_date_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"{self.user} [Ref-{self.reference}] payment"  
+
+    @property
+    def amount_major(self) -> Decimal:
+        '''
+        The amount in the currency's major unit, e.g. naira
+        '''
+        return Decimal(self.amount) / 100
+
+
+class WebhookEventStatus(models.TextChoices):
+    PENDING = 'PD', _('Pending')
+    PROCESSING = 'PR', _('Processing')
+    DONE = 'DN', _('Done')
+    FAILED = 'FD', _('Failed')
+
+
+class WebhookEvent(models.Model):
+    '''
+    A verified webhook event waiting to be applied by the webhook workers
+    (manage.py process_webhooks). [event_key] identifies the event so that
+    gateway redeliveries are only stored once.
+    '''
+    processor = models.CharField(max_length=20)
+    event_key = models.CharField(max_length=128, unique=True)
+    body = models.TextField()
+    status = models.CharField(
+        max_length=2, choices=WebhookEventStatus.choices, default=WebhookEventStatus.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claim_token = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'id'], name='webhook_event_status_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.processor} webhook [{self.event_key}]"
+
+
+class PaymentEventSource(models.TextChoices):
+    WEBHOOK = 'WH', _('Webhook')
+    VERIFICATION = 'VF', _('Verification')
+    SYNC = 'SY', _('Transaction sync')
+
+
+class PaymentEvent(models.Model):
+    '''
+    Append-only ledger of what the gateways told us about a payment: every
+    normalized webhook payload, verification result and synced transaction,
+    in the order they were recorded. Payment.status and Payment.date are a
+    projection of these events (see payments/ledger.py). Identical payloads
+    from the same source are only recorded once.
+    '''
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='events', db_index=False) #  covered by the indexes below
+    source = models.CharField(max_length=2, choices=PaymentEventSource.choices)
+    processor = models.CharField(max_length=20)
+    gateway_status = models.CharField(max_length=32, help_text=_("Normalized transaction status or event name"))
+    occurred_at = models.DateTimeField(null=True, blank=True, help_text=_("Payment date reported by the gateway"))
+    payload = models.TextField(help_text=_("Canonical JSON of the normalized payload"))
+    digest = models.CharField(max_length=64, help_text=_("SHA-256 of [payload]"))
+    recorded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['payment', 'source', 'digest'], name='payment_event_unique_payload'),
+        ]
+        indexes = [
+            # replaying a payment's events in order
+            models.Index(fields=['payment', 'id'], name='payment_event_payment_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.get_source_display()} event [{self.gateway_status}] for payment {self.payment_id}"
+
+
+class PaymentSnapshot(models.Model):
+    '''
+    The projected state of a payment after all its events up to
+    [last_event_id], so that rebuilding projections only replays newer events.
+    '''
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, primary_key=True, related_name='snapshot')
+    status = models.CharField(max_length=2, choices=PaymentStatus.choices)
+    date = models.DateTimeField(null=True)
+    last_event_id = models.BigIntegerField()
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return f"Payment {self.payment_id} snapshot at event {self.last_event_id}"
+
+
+class SyncCheckpoint(models.Model):
+    '''
+    How far the transactions of a processor have been synced from its
+    transaction list (manage.py sync_transactions).
+    '''
+    processor = models.CharField(max_length=20, unique=True)
+    synced_until = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.processor} synced until {self.synced_until}"
+
+
+class PaymentLink(models.Model):
+    '''
+    A gateway authorization URL obtained for [payment] before the user asked
+    to pay, handed out by the checkout POST until [expires_at] (see
+    payments/links.py).
+    '''
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, primary_key=True, related_name='link')
+    authorization_url = models.URLField(max_length=1024)
+    expires_at = models.DateTimeField()
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # expired links that were never handed out (pruning)
+            models.Index(fields=['expires_at'], condition=models.Q(claimed_at__isnull=True), name='payment_link_unclaimed_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"Payment {self.payment_id} link{' (claimed)' if self.claimed_at else ''}"
+
+
+class OutboxMessage(models.Model):
+    '''
+    A side effect of a payment transition (receipt email, enrollment, ERP
+    notification...) written in the same transaction as the transition and
+    delivered to [handler] by `manage.py dispatch_outbox` (see
+    payments/outbox.py). Delivered messages are deleted, messages that run
+    out of attempts are moved to DeadLetter.
+    '''
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='outbox_messages')
+    event = models.CharField(max_length=32)
+    handler = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    claim_token = models.CharField(max_length=32, blank=True, default='', db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at', 'id'], name='outbox_message_available_idx'),
+            # earlier messages of the same payment and handler (delivery order)
+            models.Index(fields=['payment', 'handler', 'id'], name='outbox_message_order_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.event} for payment {self.payment_id} to {self.handler}"
+
+
+class DeadLetter(models.Model):
+    '''
+    An outbox message that failed [attempts] times, kept for inspection and
+    requeued with `manage.py dispatch_outbox --requeue-dead-letters`.
+    '''
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='dead_letters')
+    event = models.CharField(max_length=32)
+    handler = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveSmallIntegerField()
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField()
+    failed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return f"{self.event} for payment {self.payment_id} to {self.handler} (failed)"
+
+
+class SeenWebhookEvent(models.Model):
+    '''
+    A webhook event that has been processed, by its idempotency key
+    (GatewayEvent.key), so that gateway redeliveries are answered without
+    being processed again (see payments/idempotency.py). Processes only read
+    back recent rows, so this recognizes redeliveries for one to two
+    PAYMENT_WEBHOOK_DEDUP_FILTER_PERIODs, not for as long as the rows are
+    kept. Pruned after PAYMENT_WEBHOOK_DEDUP_TTL by
+    `manage.py prune_seen_webhook_events`.
+    '''
+    key = models.CharField(max_length=128, primary_key=True)
+    processor = models.CharField(max_length=20)
+    seen_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self) -> str:
+        return self.key
+
+
+class PaymentRollup(models.Model):
+    '''
+    The number and total amount of the payments of a day (in TIME_ZONE),
+    processor and settled status, kept up to date by the transitions (see
+    payments/rollups.py). A total can be split over several [shard] rows so
+    that concurrent transitions do not all wait on the same row; sum them.
+    '''
+    day = models.DateField()
+    processor = models.CharField(max_length=20)
+    status = models.CharField(max_length=2, choices=PaymentStatus.choices)
+    shard = models.PositiveSmallIntegerField(default=0)
+    count = models.BigIntegerField(default=0)
+    amount = models.BigIntegerField(default=0, help_text=_("Amount in the currency's minor unit, e.g. kobo"))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'processor', 'status', 'shard'], name='payment_rollup_key'),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.day} {self.processor} {self.get_status_display()} payments"
@@ -0,0 +1,29 @@
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexOnline(AddIndex):
+    '''
+    AddIndex that builds the index with CREATE INDEX CONCURRENTLY on
+    PostgreSQL so writes to the table are not blocked while it builds.
+    Other databases get a plain CREATE INDEX.
+
+    Concurrent index builds cannot run in a transaction, so migrations using
+    this operation must set atomic = False.
+    '''
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+    def describe(self):
+        return f"Concurrently create index {self.index.name} on field(s) {', '.join(self.index.fields)} of model {self.model_name}"
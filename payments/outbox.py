@@ -0,0 +1,283 @@
+'''
+Transactional outbox for the side effects of payment transitions.
+
+Receipt emails, enrollment updates and ERP notifications must not run
+inside the request that settles a payment, where they would hold the
+transaction (and its row locks) open while they talk to other systems.
+Instead, the transitions in transitions.py write one OutboxMessage per
+handler subscribed to the transition in PAYMENT_OUTBOX_HANDLERS, in the same
+transaction as the status change: a payment is never settled without its
+side effects being recorded, and side effects are never recorded for a
+transition that rolled back.
+
+`manage.py dispatch_outbox` delivers the messages in batches. Messages of
+the same payment and handler are delivered one at a time in the order they
+were written. A failed delivery is retried after an exponential backoff,
+and after PAYMENT_OUTBOX_MAX_ATTEMPTS attempts the message is moved to the
+DeadLetter table, letting the messages behind it through. Delivery is at
+least once: a handler may see a message again if its dispatcher dies after
+delivering it, so handlers should be idempotent (the message id is a good
+idempotency key).
+
+A handler is a function taking an OutboxMessage. Handlers marked with
+@batch_handler are called once per batch with all its messages for them
+instead, and return a dict of the errors of the messages they failed to
+deliver, by message id.
+'''
+import logging
+import threading
+import uuid
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Exists, F, Min, OuterRef, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .models import DeadLetter, OutboxMessage, PaymentStatus
+
+
+logger = logging.getLogger(__name__)
+
+EVENTS = {
+    PaymentStatus.COMPLETED: 'payment.completed',
+    PaymentStatus.FAILED: 'payment.failed',
+}
+MAX_RETRY_DELAY = 3600 #  seconds
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def batch_handler(function):
+    '''
+    Marks [function] as a handler that takes a list of messages.
+    '''
+    function.batch = True
+    return function
+
+
+def handlers_for(status):
+    '''
+    The dotted paths of the handlers subscribed to transitions to [status].
+    '''
+    return settings.PAYMENT_OUTBOX_HANDLERS.get(EVENTS.get(status), ())
+
+
+def enqueue(payments, status):
+    '''
+    Writes the messages for [payments] having moved to [status]. Must be
+    called in the transaction that moved them.
+    '''
+    handlers = handlers_for(status)
+    if not handlers:
+        return []
+    now = timezone.now()
+    messages = [
+        OutboxMessage(
+            payment_id=payment.pk,
+            event=EVENTS[status],
+            handler=handler,
+            payload={
+                'reference': payment.reference,
+                'status': status,
+                'date': payment.date.isoformat() if payment.date else None,
+            },
+            available_at=now,
+            created_at=now,
+        )
+        for payment in payments for handler in handlers
+    ]
+    return OutboxMessage.objects.bulk_create(messages)
+
+
+def claim_messages(batch_size):
+    '''
+    Claims up to [batch_size] messages that are due (and messages whose claim
+    has timed out) for this dispatcher, oldest first. A message is only
+    claimed once every earlier message of its payment and handler is gone,
+    so a payment's messages to a handler are delivered in order.
+    '''
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    claimable = Q(available_at__lte=now) & (
+        Q(claimed_at__isnull=True)
+        | Q(claimed_at__lt=now - timedelta(seconds=settings.PAYMENT_OUTBOX_VISIBILITY_TIMEOUT))
+    )
+    earlier = OutboxMessage.objects.filter(
+        payment_id=OuterRef('payment_id'), handler=OuterRef('handler'), id__lt=OuterRef('id'))
+
+    with transaction.atomic():
+        qs = OutboxMessage.objects.filter(claimable).filter(~Exists(earlier)).order_by('available_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        ids = list(qs.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        OutboxMessage.objects.filter(claimable, id__in=ids).update(
+            claim_token=token,
+            claimed_at=now,
+            attempts=F('attempts') + 1,
+        )
+    return list(OutboxMessage.objects.filter(claim_token=token).order_by('id'))
+
+
+def _semaphore(handler):
+    with _semaphores_lock:
+        if handler not in _semaphores:
+            limit = settings.PAYMENT_OUTBOX_HANDLER_CONCURRENCY.get(handler, settings.PAYMENT_OUTBOX_CONCURRENCY)
+            _semaphores[handler] = threading.BoundedSemaphore(limit)
+        return _semaphores[handler]
+
+
+def _is_batch_handler(handler):
+    try:
+        return getattr(import_string(handler), 'batch', False)
+    except ImportError:
+        return False
+
+
+def _deliver(handler, messages):
+    '''
+    Hands [messages] to [handler], at most PAYMENT_OUTBOX_CONCURRENCY
+    deliveries to the same handler at once per process. Returns the errors
+    of the messages that were not delivered, by message id.
+    '''
+    try:
+        function = import_string(handler)
+    except ImportError as e:
+        return {message.id: f'Unknown handler: {e}' for message in messages}
+
+    with _semaphore(handler):
+        if getattr(function, 'batch', False):
+            try:
+                return function(messages) or {}
+            except Exception as e:
+                logger.exception("Outbox handler %s failed", handler)
+                return {message.id: repr(e) for message in messages}
+
+        errors = {}
+        for message in messages:
+            try:
+                function(message)
+            except Exception as e:
+                logger.exception("Outbox handler %s failed", handler, extra={'reference': message.payload.get('reference')})
+                errors[message.id] = repr(e)
+        return errors
+
+
+def _deliver_on_thread(handler, messages):
+    try:
+        return _deliver(handler, messages)
+    finally:
+        close_old_connections()
+
+
+def _retry_delay(attempts):
+    return min(settings.PAYMENT_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def dispatch_batch(batch_size=None, executor=None):
+    '''
+    Claims and delivers one batch of messages, concurrently on the threads
+    of [executor] when given. Delivered messages are deleted, failed
+    ones rescheduled or moved to the dead letters. Returns the number of
+    messages claimed.
+    '''
+    messages = claim_messages(batch_size or settings.PAYMENT_OUTBOX_BATCH_SIZE)
+    if not messages:
+        return 0
+
+    # a batch handler gets all of its messages at once, other handlers one message per task
+    by_handler = defaultdict(list)
+    for message in messages:
+        by_handler[message.handler].append(message)
+    tasks = []
+    for handler, batch in by_handler.items():
+        if _is_batch_handler(handler):
+            tasks.append((handler, batch))
+        else:
+            tasks.extend((handler, [message]) for message in batch)
+
+    errors = {}
+    if executor is None:
+        for handler, batch in tasks:
+            errors.update(_deliver(handler, batch))
+    else:
+        for future in [executor.submit(_deliver_on_thread, handler, batch) for handler, batch in tasks]:
+            errors.update(future.result())
+
+    now = timezone.now()
+    delivered, retries, dead = [], [], []
+    for message in messages:
+        error = errors.get(message.id)
+        if error is None:
+            delivered.append(message.id)
+            metrics.OUTBOX_DELAY.observe((now - message.created_at).total_seconds(), message.handler)
+            outcome = 'delivered'
+        elif message.attempts >= settings.PAYMENT_OUTBOX_MAX_ATTEMPTS:
+            dead.append(message)
+            outcome = 'dead'
+        else:
+            message.last_error = error
+            message.available_at = now + timedelta(seconds=_retry_delay(message.attempts))
+            message.claim_token, message.claimed_at = '', None
+            retries.append(message)
+            outcome = 'retry'
+        metrics.OUTBOX_DELIVERIES.inc(message.handler, outcome)
+
+    with transaction.atomic():
+        DeadLetter.objects.bulk_create([
+            DeadLetter(
+                payment_id=message.payment_id, event=message.event, handler=message.handler, payload=message.payload,
+                attempts=message.attempts, last_error=errors[message.id], created_at=message.created_at,
+                failed_at=now,
+            )
+            for message in dead
+        ])
+        OutboxMessage.objects.filter(id__in=delivered + [message.id for message in dead]).delete()
+        OutboxMessage.objects.bulk_update(retries, ['last_error', 'available_at', 'claim_token', 'claimed_at'])
+    for message in dead:
+        logger.error("Outbox message %s moved to the dead letters", message.id, extra={'reference': message.payload.get('reference')})
+    return len(messages)
+
+
+def requeue_dead_letters(ids=None):
+    '''
+    Moves dead letters (those with [ids], or all of them) back to the outbox
+    with fresh attempts. Returns the number requeued.
+    '''
+    with transaction.atomic():
+        qs = DeadLetter.objects.select_for_update().order_by('id')
+        if ids is not None:
+            qs = qs.filter(id__in=ids)
+        letters = list(qs)
+        OutboxMessage.objects.bulk_create([
+            OutboxMessage(
+                payment_id=letter.payment_id, event=letter.event, handler=letter.handler, payload=letter.payload,
+                created_at=letter.created_at, last_error=letter.last_error,
+            )
+            for letter in letters
+        ])
+        DeadLetter.objects.filter(id__in=[letter.id for letter in letters]).delete()
+    return len(letters)
+
+
+def outbox_stats():
+    '''
+    Returns the number of messages waiting, being delivered and dead, and
+    the age in seconds of the oldest waiting message.
+    '''
+    now = timezone.now()
+    claimed = Q(claimed_at__gte=now - timedelta(seconds=settings.PAYMENT_OUTBOX_VISIBILITY_TIMEOUT))
+    oldest = OutboxMessage.objects.exclude(claimed).aggregate(oldest=Min('created_at'))['oldest']
+    return {
+        'pending': OutboxMessage.objects.exclude(claimed).count(),
+        'delivering': OutboxMessage.objects.filter(claimed).count(),
+        'dead': DeadLetter.objects.count(),
+        'oldest_pending_age': (now - oldest).total_seconds() if oldest else 0,
+    }
@@ -1,8 +1,9 @@
 import hashlib
-import hmac
 import os
-import requests
 import json
+import logging
+
+import httpx
 
 from django.http.request import HttpRequest
 from django.urls import reverse
@@ -12,29 +13,43 @@ from django.conf import settings
 
 from requests.exceptions import RequestException
 
+from . import events, resilience, signatures, transport
 from .interfaces import PaymentProcessor
 
 from store.utils import OnlineTransactionStatus
 
 
-URL_ROOT = "https://api.paystack.co"
+logger = logging.getLogger(__name__)
+
+
+URL_ROOT = os.getenv('PAYSTACK_API_URL', "https://api.paystack.co") #  overridden to point at a simulator (see benchmarks/simulators.py)
 SECRET_KEY = os.getenv('PAYSTACK_SECRET_KEY')
 SPLIT_CODE = os.getenv('PAYSTACK_SPLIT_CODE')
+PREVIOUS_SECRET_KEYS = [key for key in os.getenv('PAYSTACK_PREVIOUS_SECRET_KEYS', '').split(',') if key] #  still accepted on webhooks while rotating keys
 
 
 AUTH_HEADER = f"Bearer {SECRET_KEY}"
 
+PENDING_STATUSES = ("abandoned", "ongoing", "pending", "processing", "queued") #  transaction statuses that can still change, abandoned ones included: the customer can come back to the checkout
+FAILED_STATUSES = ("failed", "reversed")
+
+WEBHOOK_VERIFIER = signatures.HMACSignatureVerifier([SECRET_KEY, *PREVIOUS_SECRET_KEYS], hashlib.sha512)
+
+EVENT_DECODER = events.EventDecoder(
+    'paystack',
+    statuses={'charge.success': OnlineTransactionStatus.SUCCESSFUL},
+    reference_field='reference',
+    date_field='paid_at',
+    parse_date=events.parse_iso_datetime,
+)
+
 
 class PaystackProcessor(PaymentProcessor):
 
     name = 'paystack'
     name_readable = 'Paystack'
 
-    def initialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
-        initialize_url = f"{URL_ROOT}/transaction/initialize"
-
-        amount *= 100 #  convert amount to kobo value
-
+    def _initialize_body(self, email, amount, reference, callback_url, metadata):
         body = {
             'email': email,
             'amount': str(amount),
@@ -47,100 +62,212 @@ class PaystackProcessor(PaymentProcessor):
 
         if SPLIT_CODE:
             body['split_code'] = SPLIT_CODE #  for split payments or dynamic settlement
+        return body
+
+    def _parse_initialize_response(self, response):
+        if response.status_code < 400:
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return ''
+    
+            if response_dict['status'] == True and 'data' in response_dict:
+                return response_dict['data']['authorization_url']            
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return ''
+
+    def initialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
+        initialize_url = f"{URL_ROOT}/transaction/initialize"
 
         try:
-            response = requests.post(
+            response = transport.request(
+                self.name,
+                'POST',
                 initialize_url,
-                json=body,
+                endpoint='initialize',
+                json=self._initialize_body(email, amount, reference, callback_url, metadata),
                 headers={
                     'Authorization': AUTH_HEADER
                 }
             )
-
-            if response:
-                try:
-                    response_dict = response.json()
-                except json.JSONDecodeError:
-                    return ''
-        
-                if response_dict['status'] == True and 'data' in response_dict:
-                    return response_dict['data']['authorization_url']            
-                print("response_dict: ", response_dict)
-            print("response: ", response.content)
+            return self._parse_initialize_response(response)
             
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
         except RequestException as e:
-            print("An error occured while making the request: ", e)
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return ''
+
+    async def ainitialize_payment(self, email, amount, reference, callback_url="", metadata="{}"):
+        initialize_url = f"{URL_ROOT}/transaction/initialize"
+
+        try:
+            response = await transport.arequest(
+                self.name,
+                'POST',
+                initialize_url,
+                endpoint='initialize',
+                json=self._initialize_body(email, amount, reference, callback_url, metadata),
+                headers={
+                    'Authorization': AUTH_HEADER
+                }
+            )
+            return self._parse_initialize_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except httpx.HTTPError as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
         except Exception as e:
-            print("An error occured: ", e)
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
         return ''
 
+    def _normalize_transaction(self, transaction):
+        gateway_status = transaction["status"]
+        if gateway_status == "success":
+            transaction["status"] = OnlineTransactionStatus.SUCCESSFUL
+        elif gateway_status in FAILED_STATUSES:
+            transaction["status"] = OnlineTransactionStatus.FAILED
+        else:
+            if gateway_status not in PENDING_STATUSES:
+                logger.warning("Unknown transaction status %r, treated as pending", gateway_status, extra={'processor': self.name})
+            transaction["status"] = OnlineTransactionStatus.PENDING
+        transaction["final"] = gateway_status == "success" or gateway_status in FAILED_STATUSES
+        if transaction.get("paid_at"): #  null until the transaction is paid
+            payment_date_value = transaction["paid_at"]
+            transaction["payment_date"] = parse_datetime(payment_date_value)
+        return transaction
+
+    def _parse_verify_response(self, response):
+        if response.status_code < 400:
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return {}
+            
+
+            if response_dict["status"] == True and 'data' in response_dict:
+                self._normalize_transaction(response_dict["data"])
+                return response_dict
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return {}
+
     def verify_payment(self, reference):
 
         url = f"{URL_ROOT}/transaction/verify/{reference}"
 
         try:
-            response = requests.get(
+            response = transport.request(
+                self.name,
+                'GET',
                 url,
+                endpoint='verify',
                 headers={
                     'Authorization': AUTH_HEADER
                 }
             )
+            return self._parse_verify_response(response)
 
-            if response:
-                try:
-                    response_dict = response.json()
-                except json.JSONDecodeError:
-                    return {}
-                
-
-                if response_dict["status"] == True and 'data' in response_dict:
-                    if response_dict["data"]["status"] == "success":
-                        response_dict["data"]["status"] = OnlineTransactionStatus.SUCCESSFUL
-                    else:
-                        response_dict["data"]["status"] = OnlineTransactionStatus.FAILED
-                    if "paid_at" in response_dict["data"]:
-                        payment_date_value = response_dict["data"]["paid_at"]
-                        response_dict["data"]["payment_date"] = parse_datetime(payment_date_value)
-                    return response_dict
-                print("response_dict: ", response_dict)
-            print("response: ", response.content)
-
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
         except RequestException as e:
-            print("An error occured while making the request: ", e)
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
         except Exception as e:
-            print("An error occured: ", e)
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
         return {}
 
+    async def averify_payment(self, reference):
+
+        url = f"{URL_ROOT}/transaction/verify/{reference}"
+
+        try:
+            response = await transport.arequest(
+                self.name,
+                'GET',
+                url,
+                endpoint='verify',
+                headers={
+                    'Authorization': AUTH_HEADER
+                }
+            )
+            return self._parse_verify_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except httpx.HTTPError as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return {}
+
+    def _parse_list_response(self, response):
+        if response.status_code < 400:
+            try:
+                response_dict = response.json()
+            except json.JSONDecodeError:
+                return None
+
+            if response_dict["status"] == True and 'data' in response_dict:
+                transactions = [self._normalize_transaction(transaction) for transaction in response_dict["data"]]
+                page_count = (response_dict.get("meta") or {}).get("pageCount") or 1
+                return transactions, page_count
+            logger.warning("Gateway rejected the request: %s", response_dict, extra={'processor': self.name, 'status_code': response.status_code})
+        logger.warning("Unexpected gateway response: %s", response.content[:2000], extra={'processor': self.name, 'status_code': response.status_code})
+        return None
+
+    def list_transactions(self, date_from, date_to, page=1, per_page=100):
+
+        url = f"{URL_ROOT}/transaction"
+
+        try:
+            response = transport.request(
+                self.name,
+                'GET',
+                url,
+                endpoint='list',
+                params={
+                    'from': date_from.isoformat(),
+                    'to': date_to.isoformat(),
+                    'page': page,
+                    'perPage': per_page,
+                },
+                headers={
+                    'Authorization': AUTH_HEADER
+                }
+            )
+            return self._parse_list_response(response)
+
+        except resilience.GatewayUnavailable as e:
+            logger.warning("Payment gateway unavailable: %s", e, extra={'processor': self.name})
+        except RequestException as e:
+            logger.error("An error occured while making the request: %s", e, extra={'processor': self.name})
+        except Exception as e:
+            logger.exception("An error occured: %s", e, extra={'processor': self.name})
+        return None
+
 
     def verify_event(self, request: HttpRequest):
         '''
         Verify that an event is from Paystack using the header [X-Paystack-Signature]
         in the request header which is a [HMAC SHA512] signature of the request payload
-        signed using the SECRET_KEY
+        signed using the SECRET_KEY (or one of PREVIOUS_SECRET_KEYS while keys are
+        being rotated)
 
-        This will create a hash using the secret key and the request body and the running
-        a comparison between the header and the one created here. 
+        The signature is computed as the request body is read and compared with
+        the header signature in constant time.
 
         Returns true if they are same.
         '''
-
-        payload = request.body
         header_signature = request.headers.get('x-paystack-signature', '')
-
-        payload_hash = hmac.new(SECRET_KEY.encode(
-            'utf-8'), payload, hashlib.sha512).hexdigest()
-
-        return hmac.compare_digest(payload_hash, header_signature)
+        return WEBHOOK_VERIFIER.verify(request, header_signature)
     
-    def format_payload_webhook(self, payload):
+    def decode_event(self, body):
         '''
-        Formats payload to universal format followed by all integrated payment gateways to 
-        avoid key errors. Paystack payload structure is mostly used to model/format 
-        other payment gateway payloads.
+        Decodes a Paystack webhook body. charge.success events report a
+        successful transaction, dated by [paid_at].
         '''
-        if payload["event"].lower() == "charge.success":
-            payload["event"] = OnlineTransactionStatus.SUCCESSFUL
-        if "paid_at" in payload["data"]:
-            payment_date_value = payload["data"]["paid_at"]
-            payload["data"]["payment_date"] = parse_datetime(payment_date_value)
-        return payload
+        return EVENT_DECODER.decode(body)
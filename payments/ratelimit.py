@@ -0,0 +1,29 @@
+import threading
+import time
+
+
+class RateLimiter:
+    '''
+    Token bucket shared between threads. Allows [rate] calls per second on
+    average, with bursts of up to [burst] calls.
+
+    Callers that find the bucket empty reserve the next token and sleep until
+    it is due, so waiting callers are served in order.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
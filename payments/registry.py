@@ -0,0 +1,88 @@
+import threading
+
+from importlib import import_module
+
+from django.conf import settings
+
+
+class ProcessorRegistry:
+    '''
+    The payment processors a deployment can use, keyed by processor name
+    (the value stored on Payment.processor).
+
+    Processors are declared in settings.PAYMENT_PROCESSORS as dotted paths
+    and are only imported the first time they are needed. Each processor is
+    instantiated once per process and the instance is reused.
+    '''
+
+    def __init__(self):
+        self._paths = None
+        self._classes = {}
+        self._instances = {}
+        self._lock = threading.RLock()
+
+    @property
+    def paths(self):
+        if self._paths is None:
+            with self._lock:
+                if self._paths is None:
+                    self._paths = dict(settings.PAYMENT_PROCESSORS)
+        return self._paths
+
+    def names(self):
+        return list(self.paths)
+
+    def register(self, name, processor):
+        '''
+        Registers [processor], a PaymentProcessor subclass or its dotted path, as [name].
+        '''
+        with self._lock:
+            if isinstance(processor, str):
+                self.paths[name] = processor
+                self._classes.pop(name, None)
+            else:
+                self.paths[name] = f"{processor.__module__}.{processor.__qualname__}"
+                self._classes[name] = processor
+            self._instances.pop(name, None)
+
+    def get_class(self, name):
+        processor_class = self._classes.get(name)
+        if processor_class is None:
+            with self._lock:
+                processor_class = self._classes.get(name)
+                if processor_class is None:
+                    module_path, class_name = self.paths[name].rsplit('.', 1)
+                    processor_class = self._classes[name] = getattr(import_module(module_path), class_name)
+        return processor_class
+
+    def get(self, name):
+        '''
+        Returns the shared instance of the processor registered as [name].
+        Raises KeyError for unknown processors.
+        '''
+        processor = self._instances.get(name)
+        if processor is None:
+            with self._lock:
+                processor = self._instances.get(name)
+                if processor is None:
+                    processor = self._instances[name] = self.get_class(name)()
+        return processor
+
+    def default_name(self):
+        '''
+        Name of the deployment's processor, settings.PAYMENT_PROCESSOR. A
+        processor path that is not in PAYMENT_PROCESSORS gets registered.
+        '''
+        for name, path in self.paths.items():
+            if path == settings.PAYMENT_PROCESSOR:
+                return name
+        module_path, class_name = settings.PAYMENT_PROCESSOR.rsplit('.', 1)
+        processor_class = getattr(import_module(module_path), class_name)
+        self.register(processor_class.name, processor_class)
+        return processor_class.name
+
+    def readable_name(self, name):
+        return self.get_class(name).name_readable
+
+
+registry = ProcessorRegistry()
@@ -0,0 +1,297 @@
+'''
+Circuit breakers and bulkheads for gateway calls.
+
+A circuit breaker is kept per processor and endpoint (e.g. paystack's
+initialize and verify calls break separately). After
+PAYMENT_CIRCUIT_BREAKER_FAILURES failed calls (connection errors, timeouts
+and 5xx responses) within PAYMENT_CIRCUIT_BREAKER_WINDOW seconds the breaker
+opens and calls fail immediately with CircuitOpenError instead of waiting on
+a gateway that is down. After PAYMENT_CIRCUIT_BREAKER_RESET_TIMEOUT seconds a
+single probe call is let through: if it succeeds the breaker closes, if not
+it stays open for another reset timeout.
+
+Breaker state lives in the Django cache named by
+PAYMENT_CIRCUIT_BREAKER_CACHE_ALIAS, so with a shared cache (memcached,
+redis, database) every worker process sees the same breakers. With the
+default local-memory cache each process keeps its own. A call through a
+closed breaker reads the cache once and only writes to it when it fails;
+async calls use the cache's async methods, so they never run a database
+cache query on the event loop.
+
+A bulkhead caps the calls in flight to each gateway from one process at
+PAYMENT_BULKHEAD_SIZE, so a slow gateway can only tie up that many threads.
+Calls that cannot get a slot within PAYMENT_BULKHEAD_TIMEOUT seconds fail
+with BulkheadFullError.
+'''
+import asyncio
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class GatewayUnavailable(Exception):
+    '''
+    Raised instead of calling a gateway that is known to be failing or busy.
+    '''
+
+
+class CircuitOpenError(GatewayUnavailable):
+    pass
+
+
+class BulkheadFullError(GatewayUnavailable):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold, window, reset_timeout, cache_alias='default'):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.cache_alias = cache_alias
+        self._failures_key = f"payment-breaker:{name}:failures"
+        self._opened_key = f"payment-breaker:{name}:opened_at"
+        self._probe_key = f"payment-breaker:{name}:probe"
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _state(self, opened_at):
+        if opened_at is None:
+            return 'closed'
+        if time.time() - opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def state(self):
+        return self._state(self.cache.get(self._opened_key))
+
+    async def astate(self):
+        return self._state(await self.cache.aget(self._opened_key))
+
+    def allow(self, state):
+        '''
+        Returns whether a call may go through now, the breaker being in
+        [state]. Once the reset timeout has passed only the first caller gets
+        through, as the probe. A probe that never reports back is given up
+        after another reset timeout, when the next caller becomes the probe.
+        '''
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        # cache.add is atomic, so only one process wins the probe
+        return self.cache.add(self._probe_key, 1, self.reset_timeout)
+
+    async def aallow(self, state):
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        return await self.cache.aadd(self._probe_key, 1, self.reset_timeout)
+
+    def release(self, state):
+        '''
+        Gives back the probe slot allow() took in [state] for a call that was
+        not made after all, so that the next caller becomes the probe.
+        '''
+        if state == 'half-open':
+            self.cache.delete(self._probe_key)
+
+    async def arelease(self, state):
+        if state == 'half-open':
+            await self.cache.adelete(self._probe_key)
+
+    def record_success(self, state):
+        '''
+        Records a successful call let through in [state]. Failures are
+        counted over a window rather than in a row, so a success only
+        touches the cache when it was the probe.
+        '''
+        if state != 'closed':
+            self.cache.delete_many([self._opened_key, self._probe_key, self._failures_key])
+
+    async def arecord_success(self, state):
+        if state != 'closed':
+            await self.cache.adelete_many([self._opened_key, self._probe_key, self._failures_key])
+
+    def record_failure(self, state):
+        '''
+        Records a failed call let through in [state], opening the breaker
+        once there are failure_threshold failures in the window.
+        '''
+        if state != 'closed':
+            # failed probe, stay open for another reset timeout
+            self.cache.set(self._opened_key, time.time(), None)
+            self.cache.delete(self._probe_key)
+            return
+
+        if self.cache.add(self._failures_key, 1, self.window):
+            failures = 1
+        else:
+            try:
+                failures = self.cache.incr(self._failures_key)
+            except ValueError: #  expired between add and incr
+                failures = 1
+                self.cache.set(self._failures_key, 1, self.window)
+        if failures >= self.failure_threshold:
+            self.cache.set(self._opened_key, time.time(), None)
+            self.cache.delete(self._failures_key)
+
+    async def arecord_failure(self, state):
+        if state != 'closed':
+            await self.cache.aset(self._opened_key, time.time(), None)
+            await self.cache.adelete(self._probe_key)
+            return
+
+        if await self.cache.aadd(self._failures_key, 1, self.window):
+            failures = 1
+        else:
+            try:
+                failures = await self.cache.aincr(self._failures_key)
+            except ValueError: #  expired between add and incr
+                failures = 1
+                await self.cache.aset(self._failures_key, 1, self.window)
+        if failures >= self.failure_threshold:
+            await self.cache.aset(self._opened_key, time.time(), None)
+            await self.cache.adelete(self._failures_key)
+
+
+class Bulkhead:
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._async_semaphores = weakref.WeakKeyDictionary() #  event loop -> asyncio.Semaphore
+
+    def acquire(self):
+        return self._semaphore.acquire(timeout=self.timeout)
+
+    def release(self):
+        self._semaphore.release()
+
+    def _async_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.size)
+        return semaphore
+
+    async def aacquire(self):
+        try:
+            await asyncio.wait_for(self._async_semaphore().acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def arelease(self):
+        self._async_semaphore().release()
+
+
+_breakers = {}
+_bulkheads = {}
+_lock = threading.Lock()
+
+
+def get_breaker(name, endpoint):
+    '''
+    Returns the circuit breaker for the [endpoint] of the processor [name].
+    '''
+    key = f"{name}:{endpoint}"
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = _breakers[key] = CircuitBreaker(
+                    key,
+                    failure_threshold=settings.PAYMENT_CIRCUIT_BREAKER_FAILURES,
+                    window=settings.PAYMENT_CIRCUIT_BREAKER_WINDOW,
+                    reset_timeout=settings.PAYMENT_CIRCUIT_BREAKER_RESET_TIMEOUT,
+                    cache_alias=settings.PAYMENT_CIRCUIT_BREAKER_CACHE_ALIAS,
+                )
+    return breaker
+
+
+def get_bulkhead(name):
+    '''
+    Returns this process's bulkhead for the processor [name].
+    '''
+    bulkhead = _bulkheads.get(name)
+    if bulkhead is None:
+        with _lock:
+            bulkhead = _bulkheads.get(name)
+            if bulkhead is None:
+                bulkhead = _bulkheads[name] = Bulkhead(settings.PAYMENT_BULKHEAD_SIZE, settings.PAYMENT_BULKHEAD_TIMEOUT)
+    return bulkhead
+
+
+def _is_failure(response):
+    return response.status_code >= 500
+
+
+def call(name, endpoint, send):
+    '''
+    Calls [send]() (which makes one gateway request and returns its response)
+    behind the circuit breaker for [endpoint] and the bulkhead of the
+    processor [name].
+
+    Raises CircuitOpenError or BulkheadFullError without calling [send].
+    '''
+    breaker = get_breaker(name, endpoint)
+    state = breaker.state()
+    if not breaker.allow(state):
+        raise CircuitOpenError(f"{name} {endpoint} circuit is open")
+
+    bulkhead = get_bulkhead(name)
+    if not bulkhead.acquire():
+        breaker.release(state)
+        raise BulkheadFullError(f"{name} has {bulkhead.size} calls in flight")
+    try:
+        response = send()
+    except Exception:
+        breaker.record_failure(state)
+        raise
+    finally:
+        bulkhead.release()
+
+    if _is_failure(response):
+        breaker.record_failure(state)
+    else:
+        breaker.record_success(state)
+    return response
+
+
+async def acall(name, endpoint, send):
+    '''
+    Async counterpart of call(), [send] returns an awaitable.
+    '''
+    breaker = get_breaker(name, endpoint)
+    state = await breaker.astate()
+    if not await breaker.aallow(state):
+        raise CircuitOpenError(f"{name} {endpoint} circuit is open")
+
+    bulkhead = get_bulkhead(name)
+    if not await bulkhead.aacquire():
+        await breaker.arelease(state)
+        raise BulkheadFullError(f"{name} has {bulkhead.size} calls in flight")
+    try:
+        response = await send()
+    except Exception:
+        await breaker.arecord_failure(state)
+        raise
+    finally:
+        bulkhead.arelease()
+
+    if _is_failure(response):
+        await breaker.arecord_failure(state)
+    else:
+        await breaker.arecord_success(state)
+    return response
@@ -0,0 +1,235 @@
+'''
+Daily payment totals per processor and status, maintained as payments settle.
+
+Summing Payment for finance dashboards and daily total exports reads every
+payment in the range, and gets slower every month. Instead, the
+transitions in transitions.py add each settled payment to its PaymentRollup
+row (day, processor, status) in the transaction that settles it, so daily
+totals are read from a handful of rows per day. Unprocessed payments
+change and disappear too often to roll up. They are few, and
+daily_total_rows() adds them from Payment through its unprocessed index.
+
+Every webhook settling a payment today would update the same row and wait
+for the previous transaction's lock on it, so each total is spread over
+PAYMENT_ROLLUP_SHARDS rows, picked at random, and summed when read.
+
+`manage.py backfill_rollups` builds the totals of existing payments, and
+`manage.py check_rollups` recomputes the totals of recent days from Payment
+and repairs any that drifted (e.g. payments changed outside the
+transitions). Both only add the difference to the rows, so they can run
+while payments settle. Days already moved to the archive (see archive.py)
+are left as they are: their payments are no longer in the database to be
+counted.
+'''
+import random
+
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import archive
+from .models import Payment, PaymentRollup, PaymentStatus
+
+
+ROLLUP_STATUSES = (PaymentStatus.COMPLETED, PaymentStatus.FAILED)
+DAILY_TOTAL_FIELDS = ('day', 'processor', 'status', 'count', 'amount')
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _totals(payments, status):
+    '''
+    The count and amount of [payments], now in [status], by rollup key. Read
+    from the database when the payments were loaded without their amount.
+    '''
+    if any({'amount', 'processor', 'date'} & payment.get_deferred_fields() for payment in payments):
+        rows = (
+            Payment.objects.filter(id__in=[payment.pk for payment in payments])
+            .annotate(day=TruncDate('date')).values_list('day', 'processor')
+            .annotate(count=Count('id'), amount=Sum('amount')).order_by()
+        )
+        return {(day, processor, status): (count, amount) for day, processor, count, amount in rows}
+
+    totals = defaultdict(lambda: [0, 0])
+    for payment in payments:
+        total = totals[timezone.localdate(payment.date), payment.processor, status]
+        total[0] += 1
+        total[1] += payment.amount
+    return {key: tuple(total) for key, total in totals.items()}
+
+
+def _add(deltas, shard=None):
+    '''
+    Adds the (count, amount) of [deltas] to their rollup rows, creating
+    missing rows. Rows are updated in key order, so that concurrent
+    transactions lock them in the same order.
+    '''
+    for (day, processor, status), (count, amount) in sorted(deltas.items()):
+        row = {
+            'day': day, 'processor': processor, 'status': status,
+            'shard': random.randrange(settings.PAYMENT_ROLLUP_SHARDS) if shard is None else shard,
+        }
+        changes = {'count': F('count') + count, 'amount': F('amount') + amount}
+        if not PaymentRollup.objects.filter(**row).update(**changes):
+            PaymentRollup.objects.bulk_create([PaymentRollup(**row)], ignore_conflicts=True)
+            PaymentRollup.objects.filter(**row).update(**changes)
+
+
+def record(payments, status):
+    '''
+    Adds [payments], having just moved to [status], to the rollups. Must be
+    called in the transaction that moved them.
+    '''
+    if settings.PAYMENT_ROLLUPS and status in ROLLUP_STATUSES and payments:
+        _add(_totals(payments, status))
+
+
+def move(changes):
+    '''
+    Moves payments whose status or date was changed outside the transitions
+    (see ledger.py) from the rollups of their old status and day to those of
+    their new ones. [changes] is a list of (payment, old status, old date).
+    Must be called in the transaction that changed them.
+    '''
+    if not settings.PAYMENT_ROLLUPS:
+        return
+    totals = defaultdict(lambda: [0, 0])
+    for payment, status, date in changes:
+        for key_status, key_date, sign in ((status, date, -1), (payment.status, payment.date, 1)):
+            if key_status in ROLLUP_STATUSES:
+                total = totals[timezone.localdate(key_date), payment.processor, key_status]
+                total[0] += sign
+                total[1] += sign * payment.amount
+    deltas = {key: tuple(total) for key, total in totals.items() if total != [0, 0]}
+    if deltas:
+        _add(deltas)
+
+
+def archived_until():
+    '''
+    The first day whose payments have not been archived, or None if nothing
+    has been.
+    '''
+    ends = [entry['date_to'] for entry in archive.load_manifest()['archives']]
+    if not ends:
+        return None
+    return timezone.localdate(max(datetime.fromisoformat(end) for end in ends))
+
+
+def derive(day_from, day_to):
+    '''
+    The totals by rollup key of the days from [day_from] to [day_to]
+    (excluded), computed from Payment.
+    '''
+    rows = (
+        Payment.objects
+        .filter(date__gte=day_start(day_from), date__lt=day_start(day_to), status__in=ROLLUP_STATUSES)
+        .annotate(day=TruncDate('date')).values_list('day', 'processor', 'status')
+        .annotate(count=Count('id'), amount=Sum('amount')).order_by()
+    )
+    return {(day, processor, status): (count, amount) for day, processor, status, count, amount in rows}
+
+
+def stored(day_from, day_to):
+    '''
+    The totals by rollup key of the days from [day_from] to [day_to]
+    (excluded), read from the rollups.
+    '''
+    rows = (
+        PaymentRollup.objects.filter(day__gte=day_from, day__lt=day_to)
+        .values_list('day', 'processor', 'status')
+        .annotate(total_count=Sum('count'), total_amount=Sum('amount')).order_by()
+    )
+    return {(day, processor, status): (count, amount) for day, processor, status, count, amount in rows}
+
+
+def drift(day_from, day_to):
+    '''
+    What has to be added to the rollups of the days from [day_from] to
+    [day_to] (excluded) to match Payment, by rollup key.
+    '''
+    derived, rolled_up = derive(day_from, day_to), stored(day_from, day_to)
+    deltas = {}
+    for key in derived.keys() | rolled_up.keys():
+        count, amount = derived.get(key, (0, 0))
+        stored_count, stored_amount = rolled_up.get(key, (0, 0))
+        if (count, amount) != (stored_count, stored_amount):
+            deltas[key] = (count - stored_count, amount - stored_amount)
+    return deltas
+
+
+def repair(day_from, day_to, confirm=True, dry_run=False):
+    '''
+    Brings the rollups of the days from [day_from] to [day_to] (excluded)
+    in line with Payment and returns the differences found, by rollup key.
+
+    A payment settling between reading Payment and reading the rollups
+    looks like drift, so with [confirm] a difference is only repaired if
+    it is found again by a second read.
+    '''
+    deltas = drift(day_from, day_to)
+    if deltas and confirm:
+        again = drift(day_from, day_to)
+        deltas = {key: delta for key, delta in deltas.items() if again.get(key) == delta}
+    if deltas and not dry_run:
+        with transaction.atomic():
+            _add(deltas, shard=0)
+    return deltas
+
+
+def day_chunks(day_from, day_to, days):
+    '''
+    Splits the days from [day_from] to [day_to] (excluded) into ranges of
+    [days] days.
+    '''
+    chunks = []
+    while day_from < day_to:
+        chunks.append((day_from, min(day_from + timedelta(days=days), day_to)))
+        day_from += timedelta(days=days)
+    return chunks
+
+
+def daily_total_rows(processor=None, status=None, date_from=None, date_to=None):
+    '''
+    Returns (fields, rows) of payment counts and amounts per day, processor
+    and status like exports.daily_total_rows(), for the days from
+    [date_from] to [date_to] (excluded), both midnights. Settled totals are
+    read from the rollups, unprocessed ones from Payment.
+    '''
+    rows = []
+    if status is None or status in ROLLUP_STATUSES:
+        rollups = PaymentRollup.objects.all()
+        if processor:
+            rollups = rollups.filter(processor=processor)
+        if status:
+            rollups = rollups.filter(status=status)
+        if date_from:
+            rollups = rollups.filter(day__gte=timezone.localdate(date_from))
+        if date_to:
+            rollups = rollups.filter(day__lt=timezone.localdate(date_to))
+        rows.extend(
+            rollups.values_list('day', 'processor', 'status')
+            .annotate(total_count=Sum('count'), total_amount=Sum('amount'))
+            .filter(total_count__gt=0).order_by()
+        )
+    if status is None or status == PaymentStatus.UNPROCESSED:
+        unprocessed = Payment.objects.filter(status=PaymentStatus.UNPROCESSED)
+        if processor:
+            unprocessed = unprocessed.filter(processor=processor)
+        if date_from:
+            unprocessed = unprocessed.filter(date__gte=date_from)
+        if date_to:
+            unprocessed = unprocessed.filter(date__lt=date_to)
+        rows.extend(
+            unprocessed.annotate(day=TruncDate('date')).values_list('day', 'processor', 'status')
+            .annotate(count=Count('id'), amount=Sum('amount')).order_by()
+        )
+    rows.sort(key=lambda row: row[:3])
+    return DAILY_TOTAL_FIELDS, iter(rows)
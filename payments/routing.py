@@ -0,0 +1,193 @@
+'''
+Routes new payments to the healthiest of several live processors.
+
+Every initialize_payment call feeds a rolling window of latencies and
+outcomes per processor. New payments go to a processor picked at random,
+weighted by its configured weight and its recent latency and error rate.
+A processor whose initialize circuit breaker is open (see resilience.py) is
+out of rotation; once the breaker lets a probe through it is back in, and
+callers that don't get the probe fail over. If the chosen processor fails,
+the payment fails over to the next one and Payment.processor is updated,
+so verification goes back to the gateway that actually holds the
+transaction.
+'''
+import asyncio
+import random
+import threading
+import time
+
+from collections import deque
+
+from django.conf import settings
+
+from . import resilience
+from .registry import registry
+
+
+ENDPOINT = 'initialize' #  the breaker that takes a processor out of rotation
+
+
+class ProcessorHealth:
+
+    def __init__(self, window):
+        self.calls = deque(maxlen=window) #  (latency, ok) of the latest calls
+
+    @property
+    def error_rate(self):
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls)
+
+    @property
+    def latency(self):
+        '''
+        Mean latency in seconds of the recent calls, 0 if there are none.
+        '''
+        if not self.calls:
+            return 0.0
+        return sum(latency for latency, _ in self.calls) / len(self.calls)
+
+    def record(self, latency, ok):
+        self.calls.append((latency, ok))
+
+
+class ProcessorRouter:
+
+    def __init__(self, names, weights=None, window=50):
+        self.names = list(names)
+        self.weights = {name: (weights or {}).get(name, 1.0) for name in self.names}
+        self.health = {name: ProcessorHealth(window) for name in self.names}
+        self._lock = threading.Lock()
+
+    def score(self, name):
+        health = self.health[name]
+        # a processor with no history is treated like one answering in 100ms
+        latency = health.latency or 0.1
+        return self.weights[name] * (1 - health.error_rate) / latency
+
+    def _pick(self, candidates):
+        if not candidates:
+            return None
+        with self._lock:
+            scores = [max(self.score(name), 1e-6) for name in candidates]
+        return random.choices(candidates, weights=scores)[0]
+
+    def choose(self, exclude=()):
+        '''
+        Picks the processor for a new payment, or None if every processor not
+        in [exclude] is out of rotation.
+        '''
+        return self._pick([
+            name for name in self.names
+            if name not in exclude and resilience.get_breaker(name, ENDPOINT).state() != 'open'
+        ])
+
+    async def achoose(self, exclude=()):
+        '''
+        Async counterpart of choose(), reading the breakers with the cache's
+        async methods.
+        '''
+        names = [name for name in self.names if name not in exclude]
+        states = await asyncio.gather(*(resilience.get_breaker(name, ENDPOINT).astate() for name in names))
+        return self._pick([name for name, state in zip(names, states) if state != 'open'])
+
+    def record(self, name, latency, ok):
+        with self._lock:
+            self.health[name].record(latency, ok)
+
+    def _next_processor(self, payment, tried):
+        if not tried and payment.processor in self.names:
+            return payment.processor #  picked by the caller with choose()
+        return self.choose(exclude=tried)
+
+    async def _anext_processor(self, payment, tried):
+        if not tried and payment.processor in self.names:
+            return payment.processor
+        return await self.achoose(exclude=tried)
+
+    def initialize_payment(self, payment, email, callback_url, metadata="{}", limiters=None):
+        '''
+        Initializes [payment] with its processor (normally picked with
+        choose() before the payment was saved), failing over to the other
+        processors. Returns the authorization URL, or '' if every processor
+        failed. [limiters] maps processor names to the RateLimiter acquired
+        before each call to that processor, failovers included.
+        '''
+        tried = []
+        while True:
+            name = self._next_processor(payment, tried)
+            if name is None:
+                return ''
+            if name != payment.processor:
+                payment.processor = name
+                payment.save(update_fields=['processor'])
+            limiter = (limiters or {}).get(name)
+            if limiter:
+                limiter.acquire()
+
+            started = time.monotonic()
+            payment_url = registry.get(name).initialize_payment(
+                email, payment.amount, payment.reference, callback_url, metadata)
+            self.record(name, time.monotonic() - started, bool(payment_url))
+            if payment_url:
+                return payment_url
+            tried.append(name)
+
+    async def ainitialize_payment(self, payment, email, callback_url, metadata="{}"):
+        '''
+        Async counterpart of initialize_payment().
+        '''
+        tried = []
+        while True:
+            name = await self._anext_processor(payment, tried)
+            if name is None:
+                return ''
+            if name != payment.processor:
+                payment.processor = name
+                await payment.asave(update_fields=['processor'])
+
+            started = time.monotonic()
+            payment_url = await registry.get(name).ainitialize_payment(
+                email, payment.amount, payment.reference, callback_url, metadata)
+            self.record(name, time.monotonic() - started, bool(payment_url))
+            if payment_url:
+                return payment_url
+            tried.append(name)
+
+    def stats(self):
+        breakers = {name: resilience.get_breaker(name, ENDPOINT).state() for name in self.names}
+        with self._lock:
+            return {
+                name: {
+                    'weight': self.weights[name],
+                    'latency': health.latency,
+                    'error_rate': health.error_rate,
+                    'breaker': breakers[name],
+                }
+                for name, health in self.health.items()
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    '''
+    Returns the process-wide router. With PAYMENT_ROUTING off it only
+    routes to the deployment's processor (settings.PAYMENT_PROCESSOR).
+    '''
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                if settings.PAYMENT_ROUTING:
+                    names = settings.PAYMENT_ROUTING_PROCESSORS or registry.names()
+                else:
+                    names = [registry.default_name()]
+                _router = ProcessorRouter(
+                    names,
+                    weights=settings.PAYMENT_ROUTING_WEIGHTS,
+                    window=settings.PAYMENT_ROUTING_WINDOW,
+                )
+    return _router
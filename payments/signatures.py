@@ -0,0 +1,96 @@
+'''
+Webhook signature verifiers.
+
+Keys are encoded and HMAC objects keyed once, when the processor module is
+imported; each verification only copies the keyed HMAC and feeds it the body.
+Several secrets can be active at once so that a secret can be rotated
+without dropping the webhooks signed with the old one in the meantime.
+Signatures are always compared in constant time.
+'''
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+
+def read_body_chunks(request, chunk_size=BODY_CHUNK_SIZE):
+    '''
+    Yields the body of [request] in chunks as it is read from the client, and
+    keeps it so that request.body still works afterwards. Yields the buffered
+    body if it has already been read.
+    '''
+    if hasattr(request, '_body'):
+        yield request.body
+        return
+
+    # same limit request.body enforces
+    content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    if settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None and content_length > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+        raise RequestDataTooBig('Request body exceeded settings.DATA_UPLOAD_MAX_MEMORY_SIZE.')
+
+    chunks = []
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        yield chunk
+    request._body = b''.join(chunks)
+
+
+class HMACSignatureVerifier:
+    '''
+    Verifies signatures that are a hex HMAC of the request body, signed with
+    any one of [secrets].
+    '''
+
+    def __init__(self, secrets, digestmod=hashlib.sha512):
+        self._macs = [hmac.new(secret.encode('utf-8'), digestmod=digestmod) for secret in secrets if secret]
+
+    def sign(self, body):
+        '''
+        Signature of [body] with the current (first) secret.
+        '''
+        mac = self._macs[0].copy()
+        mac.update(body)
+        return mac.hexdigest()
+
+    def verify(self, request, signature):
+        if not self._macs or not signature:
+            return False
+
+        macs = [mac.copy() for mac in self._macs]
+        for chunk in read_body_chunks(request):
+            for mac in macs:
+                mac.update(chunk)
+
+        signature = signature.encode('utf-8')
+        verified = False
+        for mac in macs:
+            # no early exit, every active secret is checked
+            verified |= hmac.compare_digest(mac.hexdigest().encode('ascii'), signature)
+        return verified
+
+
+class StaticSignatureVerifier:
+    '''
+    Verifies signatures that do not depend on the request body, e.g. a hash
+    of a shared token, against precomputed [signatures].
+    '''
+
+    def __init__(self, signatures):
+        self._signatures = [signature.encode('utf-8') for signature in signatures if signature]
+
+    def verify(self, request, signature):
+        if not self._signatures or not signature:
+            return False
+
+        signature = signature.encode('utf-8')
+        verified = False
+        for expected in self._signatures:
+            verified |= hmac.compare_digest(expected, signature)
+        return verified
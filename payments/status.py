@@ -0,0 +1,71 @@
+'''
+Cached payment status reads, for the payment status page and its long-poll
+endpoint.
+
+Statuses are read through CACHES[PAYMENT_STATUS_CACHE_ALIAS]: unprocessed
+payments are cached for PAYMENT_STATUS_CACHE_TTL seconds, settled ones for
+an hour. Transitions drop the cached status of the payments they settle
+once their transaction commits (see transitions.py), so with a cache
+shared between processes a waiting page sees the new status on its next
+read, whichever process settled the payment.
+'''
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from .models import Payment, PaymentStatus
+
+
+SETTLED_TTL = 3600 #  seconds, settled statuses only change if the ledger is rebuilt
+
+
+def _cache():
+    return caches[settings.PAYMENT_STATUS_CACHE_ALIAS]
+
+
+def _key(reference):
+    return f"payment-status:{reference}"
+
+
+def _timeout(status):
+    return settings.PAYMENT_STATUS_CACHE_TTL if status == PaymentStatus.UNPROCESSED else SETTLED_TTL
+
+
+def get_status(reference):
+    '''
+    Returns (user id, status) of the payment with [reference], or None if
+    there is no such payment.
+    '''
+    cache = _cache()
+    entry = cache.get(_key(reference))
+    if entry is None:
+        entry = Payment.objects.filter(reference=reference).values_list('user_id', 'status').first()
+        if entry is None:
+            return None
+        cache.set(_key(reference), entry, _timeout(entry[1]))
+    return entry
+
+
+async def aget_status(reference):
+    '''
+    Async counterpart of get_status().
+    '''
+    cache = _cache()
+    entry = await cache.aget(_key(reference))
+    if entry is None:
+        entry = await Payment.objects.filter(reference=reference).values_list('user_id', 'status').afirst()
+        if entry is None:
+            return None
+        await cache.aset(_key(reference), entry, _timeout(entry[1]))
+    return entry
+
+
+def invalidate(references):
+    '''
+    Drops the cached statuses of [references] when the current transaction
+    commits (at once outside a transaction), so that the next read gets
+    the committed status.
+    '''
+    keys = [_key(reference) for reference in references]
+    if keys:
+        transaction.on_commit(lambda: _cache().delete_many(keys))
@@ -0,0 +1,79 @@
+'''
+Bulk transaction sync from the gateways' transaction list endpoints.
+
+One list request returns a page of transactions, where verify_payment
+needs a request per reference. Pages after the first are fetched in
+parallel, and every page is applied to the matching payments with one
+ledger insert and one conditional UPDATE per status (see transitions.py).
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ledger, transitions
+from .models import Payment, PaymentEventSource, PaymentStatus
+from .ratelimit import RateLimiter
+
+
+def apply_transactions(processor, transactions, batch_size=500):
+    '''
+    Records normalized [transactions] in the payment ledger and settles the
+    matching unprocessed payments. Payments of prefetched links that were
+    never handed out are left alone, like reconcile_payments does. Returns
+    (matched, updated).
+    '''
+    by_reference = {transaction["reference"]: transaction for transaction in transactions if transaction.get("reference")}
+    payments = Payment.objects.filter(reference__in=by_reference).exclude(
+        link__isnull=False, link__claimed_at__isnull=True, #  prefetched links never handed out, see prune_payment_links
+    ).only('id', 'reference', 'processor', 'status', 'date')
+
+    events, changes = [], []
+    for payment in payments:
+        transaction = by_reference[payment.reference]
+        events.append(ledger.build_event(payment, PaymentEventSource.SYNC, {"data": transaction}, processor.name))
+        status = ledger.SETTLING_EVENTS.get((PaymentEventSource.SYNC, ledger.status_value(transaction["status"])))
+        if status is not None and payment.status == PaymentStatus.UNPROCESSED:
+            changes.append((payment, status, transaction.get("payment_date")))
+
+    ledger.record_events(events, batch_size=batch_size)
+    return len(events), len(transitions.bulk_transition(changes, batch_size=batch_size))
+
+
+def sync_transactions(processor, date_from, date_to, per_page=100, workers=4, rate=None, batch_size=500):
+    '''
+    Pages through the transactions [processor] made between [date_from] and
+    [date_to], [workers] pages at a time and at most [rate] requests per
+    second, and applies them as they arrive.
+
+    Returns the stats of the run. A run with failed pages should be retried
+    before the window is considered synced.
+    '''
+    limiter = RateLimiter(rate) if rate else None
+
+    def fetch(page):
+        if limiter:
+            limiter.acquire()
+        return processor.list_transactions(date_from, date_to, page, per_page)
+
+    stats = {'pages': 0, 'transactions': 0, 'matched': 0, 'updated': 0, 'failed_pages': 0}
+
+    def apply(result):
+        if result is None:
+            stats['failed_pages'] += 1
+            return
+        transactions, _ = result
+        matched, updated = apply_transactions(processor, transactions, batch_size)
+        stats['pages'] += 1
+        stats['transactions'] += len(transactions)
+        stats['matched'] += matched
+        stats['updated'] += updated
+
+    first = fetch(1)
+    apply(first)
+    if first is None:
+        return stats
+
+    _, page_count = first
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # only the HTTP requests run in the pool, pages are applied here, in order
+        for result in executor.map(fetch, range(2, page_count + 1)):
+            apply(result)
+    return stats
@@ -1,3 +1,1259 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
 
-# Create your tests here.
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+import requests
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import RequestDataTooBig
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from benchmarks.simulators import Behaviour, CredoSimulator, GatewaySimulator, PaystackSimulator
+from payments import archive, batch, credo, events, exports, factory, idempotency, ledger, links, metrics, outbox, paystack, resilience, rollups, routing, signatures, status as payment_status, sync, transitions, transport, verification
+from payments.models import DeadLetter, OutboxMessage, Payment, PaymentEventSource, PaymentLink, PaymentRollup, PaymentStatus, SeenWebhookEvent
+from payments.registry import ProcessorRegistry
+from payments.utils import allocate_references, generate_reference, save_with_unique_reference
+from store.utils import OnlineTransactionStatus
+
+
+class QuietTestCase(SimpleTestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO) #  expected warnings are checked with assertLogs
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+
+class PaymentTestCase(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        for cache in caches.all(): #  cached statuses and breakers of earlier tests
+            cache.clear()
+        self.user = User.objects.create_user(username='customer', email='customer@example.com')
+
+    def make_payment(self, reference='ref-1', status=PaymentStatus.UNPROCESSED, processor='paystack', **fields):
+        fields.setdefault('amount', 40000)
+        return Payment.objects.create(user=self.user, reference=reference, status=status, processor=processor, **fields)
+
+    def status(self, payment):
+        return Payment.objects.get(pk=payment.pk).status
+
+
+def serve(simulator):
+    '''
+    Starts [simulator] and points the Paystack processor at it for the test.
+    '''
+    simulator.start()
+    patcher = mock.patch.object(paystack, 'URL_ROOT', simulator.url)
+    patcher.start()
+    return lambda: (patcher.stop(), simulator.stop())
+
+
+class FakeProcessor:
+    '''
+    Returns the verification payloads it is given, in order, counting calls.
+    '''
+    name = 'fake'
+
+    def __init__(self, *payloads):
+        self.payloads = list(payloads)
+        self.calls = 0
+
+    def verify_payment(self, reference):
+        self.calls += 1
+        return self.payloads.pop(0)
+
+
+def verified(status, final):
+    return {'status': True, 'data': {'reference': 'ref-1', 'status': status, 'final': final}}
+
+
+class PaystackStatusTests(QuietTestCase):
+
+    def normalize(self, status):
+        return paystack.PaystackProcessor()._normalize_transaction({'reference': 'ref-1', 'status': status})
+
+    def test_abandoned_transactions_are_pending(self):
+        transaction = self.normalize('abandoned')
+        self.assertEqual(transaction['status'], OnlineTransactionStatus.PENDING)
+        self.assertFalse(transaction['final'])
+
+    def test_final_statuses(self):
+        for status, expected in (('success', OnlineTransactionStatus.SUCCESSFUL), ('failed', OnlineTransactionStatus.FAILED),
+                                 ('reversed', OnlineTransactionStatus.FAILED)):
+            transaction = self.normalize(status)
+            self.assertEqual(transaction['status'], expected)
+            self.assertTrue(transaction['final'])
+
+    def test_unknown_statuses_are_pending(self):
+        with self.assertLogs('payments.paystack', 'WARNING'):
+            transaction = self.normalize('on_hold')
+        self.assertEqual(transaction['status'], OnlineTransactionStatus.PENDING)
+        self.assertFalse(transaction['final'])
+
+    def test_credo_failures_are_final(self):
+        transaction = credo.CredoProcessor()._normalize_transaction({'reference': 'ref-1', 'status': 3})
+        self.assertEqual(transaction['status'], OnlineTransactionStatus.FAILED)
+        self.assertTrue(transaction['final'])
+
+    def test_other_credo_codes_are_pending(self):
+        for code in (1, 2, 4):
+            transaction = credo.CredoProcessor()._normalize_transaction({'reference': 'ref-1', 'status': code})
+            self.assertEqual(transaction['status'], OnlineTransactionStatus.PENDING)
+            self.assertFalse(transaction['final'])
+
+
+class VerificationCacheTests(QuietTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = verification.VerificationCache(verification.LRUCache(100), pending_ttl=60)
+
+    def test_final_results_are_cached_until_evicted(self):
+        processor = FakeProcessor(verified(OnlineTransactionStatus.SUCCESSFUL, True))
+        self.assertEqual(self.cache.verify(processor, 'ref-1')['data']['status'], OnlineTransactionStatus.SUCCESSFUL)
+        self.assertEqual(self.cache.verify(processor, 'ref-1')['data']['status'], OnlineTransactionStatus.SUCCESSFUL)
+        self.assertEqual(processor.calls, 1)
+        self.assertIsNone(self.cache.backend._entries[self.cache.key(processor, 'ref-1')][1])
+
+    def test_terminal_results_of_non_final_statuses_expire(self):
+        self.assertEqual(self.cache.timeout(verified(OnlineTransactionStatus.FAILED, False)), 60)
+        self.assertEqual(self.cache.timeout(verified(OnlineTransactionStatus.PENDING, False)), 60)
+        self.assertEqual(self.cache.timeout({'data': {'status': OnlineTransactionStatus.FAILED}}), 60)
+        self.assertIsNone(self.cache.timeout(verified(OnlineTransactionStatus.FAILED, True)))
+
+    def test_failed_calls_are_not_cached(self):
+        processor = FakeProcessor({}, verified(OnlineTransactionStatus.PENDING, False))
+        self.assertEqual(self.cache.verify(processor, 'ref-1'), {})
+        self.assertEqual(self.cache.verify(processor, 'ref-1')['data']['status'], OnlineTransactionStatus.PENDING)
+        self.assertEqual(processor.calls, 2)
+
+
+class RecordedPaystack(GatewaySimulator):
+    '''
+    Serves recorded pages of Paystack's transaction list.
+    '''
+    routes = (('GET', r'/transaction', 'list'),)
+
+    def __init__(self, pages):
+        super().__init__(Behaviour(latency=0, distribution='fixed'))
+        self.pages = pages
+        self.requested = []
+
+    def list(self, body):
+        page = int(body['page'])
+        self.requested.append(page)
+        return 200, {'status': True, 'message': 'Transactions retrieved', 'data': self.pages[page - 1],
+                     'meta': {'total': sum(map(len, self.pages)), 'perPage': 2, 'page': page, 'pageCount': len(self.pages)}}
+
+
+def recorded_transaction(reference, status, paid_at=None):
+    return {'id': abs(hash(reference)), 'domain': 'test', 'status': status, 'reference': reference, 'amount': 40000,
+            'gateway_response': 'Approved' if status == 'success' else 'The transaction was not completed',
+            'paid_at': paid_at, 'created_at': '2024-05-02T09:59:12.000Z', 'channel': 'card', 'currency': 'NGN'}
+
+
+class SyncTransactionsTests(PaymentTestCase):
+
+    def sync(self, simulator, **options):
+        self.addCleanup(serve(simulator))
+        now = timezone.now()
+        return sync.sync_transactions(paystack.PaystackProcessor(), now - timedelta(days=1), now + timedelta(minutes=1), **options)
+
+    def test_pages_of_recorded_responses(self):
+        paid = self.make_payment('ref-paid')
+        declined = self.make_payment('ref-declined')
+        abandoned = self.make_payment('ref-abandoned')
+        settled = self.make_payment('ref-settled', status=PaymentStatus.FAILED)
+        prefetched = self.make_payment('ref-prefetched')
+        PaymentLink.objects.create(payment=prefetched, authorization_url='https://checkout.paystack.com/x', expires_at=timezone.now() + timedelta(minutes=10))
+        gateway = RecordedPaystack([
+            [recorded_transaction('ref-paid', 'success', '2024-05-02T10:00:00.000Z'), recorded_transaction('ref-declined', 'failed')],
+            [recorded_transaction('ref-abandoned', 'abandoned'), recorded_transaction('ref-settled', 'success', '2024-05-02T10:00:00.000Z')],
+            [recorded_transaction('ref-prefetched', 'abandoned'), recorded_transaction('ref-unknown', 'success', '2024-05-02T10:00:00.000Z')],
+        ])
+
+        stats = self.sync(gateway, per_page=2, workers=2)
+
+        self.assertEqual(sorted(gateway.requested), [1, 2, 3])
+        self.assertEqual(stats, {'pages': 3, 'transactions': 6, 'matched': 4, 'updated': 2, 'failed_pages': 0})
+        self.assertEqual(self.status(paid), PaymentStatus.COMPLETED)
+        self.assertEqual(self.status(declined), PaymentStatus.FAILED)
+        self.assertEqual(self.status(abandoned), PaymentStatus.UNPROCESSED)
+        self.assertEqual(self.status(settled), PaymentStatus.FAILED)
+        self.assertEqual(self.status(prefetched), PaymentStatus.UNPROCESSED)
+        self.assertFalse(prefetched.events.exists())
+
+    def test_simulator_transaction_list(self):
+        simulator = PaystackSimulator(Behaviour(latency=0, distribution='fixed', failed_rate=0))
+        payments = [self.make_payment(f'ref-{i}') for i in range(5)]
+        for payment in payments:
+            simulator.add_transaction(payment.reference)
+
+        stats = self.sync(simulator, per_page=2)
+
+        self.assertEqual(stats['pages'], 3)
+        self.assertEqual(stats['updated'], 5)
+        self.assertEqual(simulator.stats['list', 200], 3)
+        self.assertFalse(Payment.objects.filter(status=PaymentStatus.UNPROCESSED).exists())
+
+
+class PaymentLinkTests(PaymentTestCase):
+
+    def make_link(self, reference='ref-1', **fields):
+        payment = self.make_payment(reference, **fields)
+        return PaymentLink.objects.create(payment=payment, authorization_url='https://checkout.paystack.com/x', expires_at=timezone.now() + timedelta(minutes=10))
+
+    def test_claimed_once(self):
+        link = self.make_link()
+        self.assertEqual(links.claim_link(self.user, 40000).pk, link.pk)
+        self.assertIsNone(links.claim_link(self.user, 40000))
+
+    def test_links_of_settled_payments_are_not_handed_out(self):
+        self.make_link(status=PaymentStatus.FAILED)
+        self.assertIsNone(links.claim_link(self.user, 40000))
+
+    def test_expired_links_are_not_handed_out(self):
+        link = self.make_link()
+        PaymentLink.objects.filter(pk=link.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(links.claim_link(self.user, 40000))
+
+
+class Response:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def breaker(cache_alias='default', **options):
+    options = {'failure_threshold': 2, 'window': 60, 'reset_timeout': 30, **options}
+    return resilience.CircuitBreaker(f"test:{uuid.uuid4()}", cache_alias=cache_alias, **options)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = breaker()
+        patcher = mock.patch.dict(resilience._breakers, {'paystack:verify': self.breaker})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call(self, status_code=200):
+        send = mock.Mock(return_value=Response(status_code))
+        return resilience.call('paystack', 'verify', send), send
+
+    def test_opens_after_failures_and_probes_after_the_reset_timeout(self):
+        self.call(503)
+        self.call(503)
+        self.assertEqual(self.breaker.state(), 'open')
+        send = mock.Mock()
+        with self.assertRaises(resilience.CircuitOpenError):
+            resilience.call('paystack', 'verify', send)
+        send.assert_not_called()
+
+        with mock.patch('payments.resilience.time.time', return_value=resilience.time.time() + 31):
+            self.assertEqual(self.breaker.state(), 'half-open')
+            self.assertTrue(self.breaker.allow('half-open'))
+            self.assertFalse(self.breaker.allow('half-open')) #  one probe at a time
+            self.breaker.record_success('half-open')
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_failed_probe_stays_open(self):
+        self.breaker.cache.set(self.breaker._opened_key, resilience.time.time() - 31)
+        self.assertEqual(self.call(500)[0].status_code, 500)
+        self.assertEqual(self.breaker.state(), 'open')
+
+    def test_successes_of_a_closed_breaker_do_not_write_to_the_cache(self):
+        cache = self.breaker.cache
+        writes = {method: mock.DEFAULT for method in ('set', 'add', 'incr', 'delete', 'delete_many')}
+        with mock.patch.multiple(cache, **writes) as patched:
+            for _ in range(3):
+                self.call(200)
+        for method in patched.values():
+            method.assert_not_called()
+
+    def test_bulkhead_rejects_calls_over_its_size(self):
+        bulkhead = resilience.Bulkhead(1, timeout=0.01)
+        with mock.patch.dict(resilience._bulkheads, {'paystack': bulkhead}):
+            self.assertTrue(bulkhead.acquire())
+            try:
+                with self.assertRaises(resilience.BulkheadFullError):
+                    self.call()
+            finally:
+                bulkhead.release()
+            self.assertEqual(self.call()[0].status_code, 200)
+
+
+    def test_a_probe_the_bulkhead_rejects_gives_back_its_slot(self):
+        self.breaker.cache.set(self.breaker._opened_key, resilience.time.time() - 31)
+        bulkhead = resilience.Bulkhead(1, timeout=0.01)
+        with mock.patch.dict(resilience._bulkheads, {'paystack': bulkhead}):
+            self.assertTrue(bulkhead.acquire())
+            try:
+                with self.assertRaises(resilience.BulkheadFullError):
+                    self.call()
+            finally:
+                bulkhead.release()
+            self.assertEqual(self.call()[0].status_code, 200)
+        self.assertEqual(self.breaker.state(), 'closed')
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'breakers': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'test_breakers'},
+})
+class AsyncCircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        call_command('createcachetable', 'test_breakers', verbosity=0)
+        self.breaker = breaker('breakers')
+        patcher = mock.patch.dict(resilience._breakers, {'paystack:verify': self.breaker})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def acall(self, status_code):
+        async def send():
+            return Response(status_code)
+        return await resilience.acall('paystack', 'verify', send)
+
+    async def test_database_cache_from_the_event_loop(self):
+        await self.acall(503)
+        await self.acall(503)
+        self.assertEqual(await self.breaker.astate(), 'open')
+        with self.assertRaises(resilience.CircuitOpenError):
+            await self.acall(200)
+
+        await self.breaker.cache.aset(self.breaker._opened_key, resilience.time.time() - 31, None)
+        self.assertEqual((await self.acall(200)).status_code, 200)
+        self.assertEqual(await self.breaker.astate(), 'closed')
+
+
+class RouterTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.breakers = {name: breaker(failure_threshold=1) for name in ('paystack', 'credo')}
+        patcher = mock.patch.dict(resilience._breakers, {f'{name}:initialize': b for name, b in self.breakers.items()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = routing.ProcessorRouter(['paystack', 'credo'])
+
+    def open(self, name):
+        self.breakers[name].record_failure('closed')
+
+    def test_processors_with_an_open_breaker_are_out_of_rotation(self):
+        self.open('paystack')
+        self.assertEqual({self.router.choose() for _ in range(20)}, {'credo'})
+        self.open('credo')
+        self.assertIsNone(self.router.choose())
+
+    def test_half_open_processors_are_not_held_by_an_unfinished_trial(self):
+        self.open('credo')
+        self.breakers['credo'].cache.set(self.breakers['credo']._opened_key, resilience.time.time() - 31)
+        for _ in range(3): #  choosing without calling leaves nothing to clear
+            self.assertEqual(self.router.choose(exclude=['paystack']), 'credo')
+
+    async def test_achoose(self):
+        self.open('paystack')
+        self.assertEqual(await self.router.achoose(), 'credo')
+
+    def test_fails_over_and_updates_the_payment(self):
+        payment = self.make_payment(processor='paystack')
+        processors = {'paystack': mock.Mock(initialize_payment=mock.Mock(return_value='')),
+                      'credo': mock.Mock(initialize_payment=mock.Mock(return_value='https://pay.credodemo.com/x'))}
+        with mock.patch.object(routing.registry, 'get', side_effect=processors.get):
+            url = self.router.initialize_payment(payment, 'customer@example.com', 'http://testserver/payment_callback/')
+        self.assertEqual(url, 'https://pay.credodemo.com/x')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).processor, 'credo')
+        self.assertEqual(self.router.health['paystack'].error_rate, 1.0)
+
+    def test_scores_favour_fast_healthy_processors(self):
+        for _ in range(5):
+            self.router.record('paystack', 0.05, True)
+            self.router.record('credo', 0.5, False)
+        self.assertGreater(self.router.score('paystack'), self.router.score('credo'))
+
+
+RECEIPTS = {'payment.completed': ['store.side_effects.send_receipt'], 'payment.failed': []}
+
+
+@override_settings(PAYMENT_ROLLUPS=True, PAYMENT_OUTBOX_HANDLERS=RECEIPTS)
+class LedgerRebuildTests(PaymentTestCase):
+
+    def record(self, payment, source, status):
+        ledger.record_event(payment, source, {'data': {'reference': payment.reference, 'status': status}})
+
+    def totals(self):
+        today = timezone.localdate()
+        return rollups.stored(today, today + timedelta(days=1))
+
+    def test_settles_unprocessed_payments_through_the_transitions(self):
+        payment = self.make_payment()
+        self.record(payment, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.SUCCESSFUL)
+        payment_status.get_status(payment.reference) #  cached as unprocessed
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stats = ledger.rebuild_projections(from_scratch=True)
+
+        self.assertEqual(stats['changed'], 1)
+        self.assertEqual(self.status(payment), PaymentStatus.COMPLETED)
+        self.assertEqual(OutboxMessage.objects.get(payment=payment).event, 'payment.completed')
+        self.assertEqual(self.totals(), {(timezone.localdate(), 'paystack', PaymentStatus.COMPLETED): (1, 40000)})
+        self.assertEqual(payment_status.get_status(payment.reference)[1], PaymentStatus.COMPLETED)
+
+    def test_drift_is_reported_not_written(self):
+        payment = self.make_payment()
+        transitions.transition(payment, PaymentStatus.COMPLETED) #  its settling event never reached the ledger
+        self.record(payment, PaymentEventSource.WEBHOOK, 'charge.pending')
+        date = Payment.objects.get(pk=payment.pk).date
+
+        stats = ledger.rebuild_projections(from_scratch=True)
+
+        self.assertEqual((stats['changed'], stats['drifted']), (0, 1))
+        self.assertEqual(stats['drift'][0][:3], (payment.reference, PaymentStatus.COMPLETED, PaymentStatus.UNPROCESSED))
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).date, date)
+
+    def test_dates_without_an_event_time_are_not_drift(self):
+        payment = self.make_payment()
+        transitions.transition(payment, PaymentStatus.COMPLETED) #  dated when it was settled, after the event was recorded
+        self.record(payment, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.SUCCESSFUL)
+        self.assertEqual(ledger.rebuild_projections(from_scratch=True)['drifted'], 0)
+
+    def test_overwritten_drift_moves_the_rollups(self):
+        payment = self.make_payment()
+        transitions.transition(payment, PaymentStatus.COMPLETED)
+        self.record(payment, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.FAILED)
+        OutboxMessage.objects.all().delete()
+
+        stats = ledger.rebuild_projections(from_scratch=True, overwrite_drift=True)
+
+        self.assertEqual((stats['changed'], stats['drifted']), (1, 1))
+        self.assertEqual(self.status(payment), PaymentStatus.FAILED)
+        day = timezone.localdate()
+        self.assertEqual(self.totals(), {(day, 'paystack', PaymentStatus.COMPLETED): (0, 0), (day, 'paystack', PaymentStatus.FAILED): (1, 40000)})
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_snapshots_limit_the_replay(self):
+        first = self.make_payment('ref-1')
+        self.record(first, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.SUCCESSFUL)
+        ledger.rebuild_projections(take_snapshots=True)
+        second = self.make_payment('ref-2')
+        self.record(second, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.FAILED)
+
+        stats = ledger.rebuild_projections()
+
+        self.assertEqual((stats['events'], stats['changed']), (1, 1))
+        self.assertEqual(self.status(second), PaymentStatus.FAILED)
+
+    def test_dry_run(self):
+        payment = self.make_payment()
+        self.record(payment, PaymentEventSource.VERIFICATION, OnlineTransactionStatus.FAILED)
+        self.assertEqual(ledger.rebuild_projections(dry_run=True)['changed'], 1)
+        self.assertEqual(self.status(payment), PaymentStatus.UNPROCESSED)
+
+
+@override_settings(PAYMENT_ROLLUPS=True, PAYMENT_ROLLUP_SHARDS=4)
+class RollupTests(PaymentTestCase):
+
+    def settle(self, count, status=PaymentStatus.COMPLETED, processor='paystack', days_ago=0):
+        date = timezone.now() - timedelta(days=days_ago)
+        payments = [self.make_payment(uuid.uuid4().hex, processor=processor, date=date) for _ in range(count)]
+        transitions.bulk_transition([(payment, status, None) for payment in payments])
+        return payments
+
+    def export(self, **filters):
+        return b''.join(exports.export_daily_totals('csv', **filters))
+
+    def test_settled_payments_are_added_to_sharded_totals(self):
+        for _ in range(10):
+            self.settle(1)
+        self.settle(2, PaymentStatus.FAILED, 'credo')
+        today = timezone.localdate()
+        self.assertEqual(rollups.stored(today, today + timedelta(days=1)), {
+            (today, 'paystack', PaymentStatus.COMPLETED): (10, 400000),
+            (today, 'credo', PaymentStatus.FAILED): (2, 80000),
+        })
+        self.assertLessEqual(PaymentRollup.objects.filter(processor='paystack').count(), 4)
+
+    def test_exports_match_summing_the_payments(self):
+        self.settle(3)
+        self.settle(2, PaymentStatus.FAILED, days_ago=3)
+        self.make_payment('unprocessed')
+        from_rollups = self.export()
+        with self.settings(PAYMENT_ROLLUPS=False):
+            self.assertEqual(self.export(), from_rollups)
+        self.assertEqual(from_rollups.count(b'\n'), 4) #  header and three totals
+
+    def test_nothing_is_recorded_when_off(self):
+        with self.settings(PAYMENT_ROLLUPS=False):
+            self.settle(2)
+        self.assertFalse(PaymentRollup.objects.exists())
+
+    def test_repair_adds_the_drift(self):
+        payments = self.settle(2)
+        Payment.objects.filter(pk=payments[0].pk).update(status=PaymentStatus.FAILED) #  outside the transitions
+        today = timezone.localdate()
+        tomorrow = today + timedelta(days=1)
+        deltas = rollups.repair(today, tomorrow)
+        self.assertEqual(deltas, {(today, 'paystack', PaymentStatus.COMPLETED): (-1, -40000), (today, 'paystack', PaymentStatus.FAILED): (1, 40000)})
+        self.assertEqual(rollups.drift(today, tomorrow), {})
+
+    def test_backfill(self):
+        with self.settings(PAYMENT_ROLLUPS=False):
+            self.settle(2, days_ago=10)
+            with self.assertRaises(CommandError):
+                call_command('backfill_rollups', processes=1, stdout=io.StringIO())
+        call_command('backfill_rollups', processes=1, stdout=io.StringIO())
+        day = timezone.localdate(timezone.now() - timedelta(days=10))
+        self.assertEqual(rollups.stored(day, day + timedelta(days=1)), {(day, 'paystack', PaymentStatus.COMPLETED): (2, 80000)})
+        call_command('backfill_rollups', processes=1, stdout=io.StringIO()) #  safe to run again
+        self.assertEqual(rollups.stored(day, day + timedelta(days=1)), {(day, 'paystack', PaymentStatus.COMPLETED): (2, 80000)})
+
+    def test_daily_total_fields_are_shared(self):
+        self.assertIs(exports.DAILY_TOTAL_FIELDS, rollups.DAILY_TOTAL_FIELDS)
+
+
+class TransportTests(QuietTestCase):
+
+    def test_threads_share_the_processor_pool(self):
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(transport.get_session('paystack')))
+        thread.start()
+        thread.join()
+        session = transport.get_session('paystack')
+        self.assertIsNot(sessions[0], session)
+        self.assertIs(sessions[0].get_adapter('https://api.paystack.co'), session.get_adapter('https://api.paystack.co'))
+        self.assertIs(session.get_adapter('https://api.paystack.co'), transport.get_adapter('paystack'))
+
+    def test_connections_are_kept_alive(self):
+        simulator = PaystackSimulator(Behaviour(latency=0, distribution='fixed', failed_rate=0))
+        self.addCleanup(serve(simulator))
+        processor = paystack.PaystackProcessor()
+        for i in range(5):
+            self.assertEqual(processor.verify_payment(f'ref-{i}')['data']['status'], OnlineTransactionStatus.SUCCESSFUL)
+        self.assertEqual(simulator.stats['verify', 200], 5)
+        self.assertEqual(simulator.connections, 1)
+
+    def test_timeouts_are_always_set(self):
+        with mock.patch.object(transport.get_session('credo'), 'request') as send:
+            send.return_value.status_code = 200
+            transport.request('credo', 'GET', 'https://api.credocentral.com/transactions')
+        self.assertEqual(send.call_args.kwargs['timeout'], transport.get_timeout())
+
+
+class ReconcileTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        behaviour = Behaviour(latency=0, distribution='fixed', failed_rate=0.3, pending_rate=0.3)
+        self.addCleanup(serve(PaystackSimulator(behaviour)))
+        patcher = mock.patch.object(verification, '_verification_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.outcome = behaviour.outcome
+        old = timezone.now() - timedelta(hours=2)
+        self.payments = [self.make_payment(f'ref-{i}', date=old) for i in range(12)]
+        self.recent = self.make_payment('ref-recent')
+
+    def reconcile(self, *args):
+        call_command('reconcile_payments', '--processor', 'paystack', '--chunk-size', '5', *args, stdout=io.StringIO())
+
+    def expected(self, payment):
+        return {'success': PaymentStatus.COMPLETED, 'failed': PaymentStatus.FAILED, 'pending': PaymentStatus.UNPROCESSED}[self.outcome(payment.reference)]
+
+    def test_settles_verified_payments(self):
+        self.reconcile()
+        for payment in self.payments:
+            self.assertEqual(self.status(payment), self.expected(payment), payment.reference)
+            self.assertEqual(payment.events.count(), 1)
+        self.assertEqual(self.status(self.recent), PaymentStatus.UNPROCESSED)
+        self.assertFalse(self.recent.events.exists())
+
+    def test_resumes_from_the_checkpoint(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        checkpoint = os.path.join(directory.name, 'reconcile.json')
+        self.reconcile('--limit', '5', '--checkpoint', checkpoint)
+        self.assertEqual(sum(payment.events.count() for payment in self.payments), 5)
+        self.reconcile('--checkpoint', checkpoint, '--resume')
+        self.assertEqual(sum(payment.events.count() for payment in self.payments), 12)
+
+    def test_dry_run(self):
+        self.reconcile('--dry-run')
+        self.assertFalse(Payment.objects.exclude(status=PaymentStatus.UNPROCESSED).exists())
+
+
+class ReferenceTests(PaymentTestCase):
+
+    def test_time_ordered_references_sort_by_creation_time(self):
+        with mock.patch('payments.utils.time.time_ns', side_effect=[1_700_000_000_000_000_000, 1_700_000_000_001_000_000]):
+            first, second = generate_reference(), generate_reference()
+        self.assertEqual(len(first), 16)
+        self.assertLess(first, second)
+
+    @override_settings(PAYMENT_REFERENCE_FORMAT='random')
+    def test_random_references(self):
+        self.assertEqual(len(generate_reference(20)), 20)
+
+    def test_collisions_are_retried(self):
+        taken = self.make_payment(reference='taken')
+        payment = Payment(user=self.user, amount=40000, processor='paystack')
+        with mock.patch('payments.utils.generate_reference', side_effect=[taken.reference, 'fresh']):
+            save_with_unique_reference(payment)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).reference, 'fresh')
+
+    def test_gives_up_after_the_last_attempt(self):
+        self.make_payment(reference='taken')
+        payment = Payment(user=self.user, amount=40000, processor='paystack')
+        with mock.patch('payments.utils.generate_reference', return_value='taken'):
+            with self.assertRaises(IntegrityError):
+                save_with_unique_reference(payment, attempts=3)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_allocated_references_skip_taken_ones(self):
+        self.make_payment(reference='taken')
+        with mock.patch('payments.utils.generate_reference', side_effect=['taken', 'a', 'b', 'c']):
+            references = allocate_references(Payment, 2)
+        self.assertEqual(sorted(references), ['a', 'b'])
+
+
+class AmountTests(PaymentTestCase):
+
+    def test_amounts_are_stored_in_minor_units(self):
+        payment = self.make_payment(amount=40050)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).amount, 40050)
+        self.assertEqual(payment.amount_major, Decimal('400.50'))
+        self.assertEqual(payment.currency, 'NGN')
+
+    def test_processors_send_the_stored_amount(self):
+        for processor in (paystack.PaystackProcessor(), credo.CredoProcessor()):
+            body = processor._initialize_body('customer@example.com', 40050, 'ref-1', '', '{}')
+            self.assertEqual(body['amount'], '40050')
+
+    def test_reconciliation_does_not_scan_payments(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('reads the SQLite query plan')
+        queryset = Payment.objects.filter(
+            status=PaymentStatus.UNPROCESSED, processor='paystack', date__lt=timezone.now()).values_list('id')
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        # either the partial unprocessed index or the (status, processor, date) one serves it
+        self.assertIn('USING COVERING INDEX payment_', plan)
+        self.assertNotIn('SCAN payments_payment', plan)
+
+
+class RegistryTests(QuietTestCase):
+
+    @override_settings(PAYMENT_PROCESSORS={'paystack': 'payments.paystack.PaystackProcessor', 'credo': 'payments.credo.CredoProcessor'})
+    def test_processors_are_imported_once_and_shared(self):
+        registry = ProcessorRegistry()
+        self.assertEqual(registry.names(), ['paystack', 'credo'])
+        self.assertEqual(registry._classes, {}) #  nothing imported until needed
+        processor = registry.get('credo')
+        self.assertIsInstance(processor, credo.CredoProcessor)
+        self.assertIs(registry.get('credo'), processor)
+        self.assertEqual(list(registry._classes), ['credo'])
+        self.assertEqual(registry.readable_name('paystack'), 'Paystack')
+
+    @override_settings(PAYMENT_PROCESSORS={'paystack': 'payments.paystack.PaystackProcessor'})
+    def test_unknown_processors(self):
+        with self.assertRaises(KeyError):
+            ProcessorRegistry().get('stripe')
+
+    @override_settings(PAYMENT_PROCESSORS={}, PAYMENT_PROCESSOR='payments.credo.CredoProcessor')
+    def test_the_default_processor_is_registered(self):
+        registry = ProcessorRegistry()
+        self.assertEqual(registry.default_name(), 'credo')
+        self.assertEqual(registry.names(), ['credo'])
+
+    def test_registering_replaces_the_instance(self):
+        registry = ProcessorRegistry()
+        first = registry.get('paystack')
+        registry.register('paystack', paystack.PaystackProcessor)
+        self.assertIsNot(registry.get('paystack'), first)
+
+    def test_payments_use_their_processor(self):
+        payment = Payment(processor='credo')
+        self.assertIsInstance(factory.get_payment_processor_for(payment), credo.CredoProcessor)
+        self.assertIs(factory.get_payment_processor_for(payment), factory.get_payment_processor('credo'))
+
+
+def signed_request(body):
+    return RequestFactory().post('/payments/webhook/', body, content_type='application/json')
+
+
+class SignatureTests(SimpleTestCase):
+
+    body = b'{"event":"charge.success","data":{"reference":"ref-1"}}' * 2000 #  several read chunks
+
+    def test_any_active_secret_verifies(self):
+        verifier = signatures.HMACSignatureVerifier(['current', 'previous'])
+        for secret in ('current', 'previous'):
+            signature = hmac.new(secret.encode(), self.body, hashlib.sha512).hexdigest()
+            self.assertTrue(verifier.verify(signed_request(self.body), signature))
+        self.assertEqual(verifier.sign(self.body), hmac.new(b'current', self.body, hashlib.sha512).hexdigest())
+
+    def test_wrong_or_missing_signatures(self):
+        verifier = signatures.HMACSignatureVerifier(['current', ''])
+        self.assertFalse(verifier.verify(signed_request(self.body), hmac.new(b'retired', self.body, hashlib.sha512).hexdigest()))
+        self.assertFalse(verifier.verify(signed_request(self.body), ''))
+        self.assertFalse(signatures.HMACSignatureVerifier(['']).verify(signed_request(self.body), 'anything'))
+
+    def test_the_streamed_body_is_kept(self):
+        request = signed_request(self.body)
+        verifier = signatures.HMACSignatureVerifier(['current'])
+        self.assertTrue(verifier.verify(request, verifier.sign(self.body)))
+        self.assertEqual(request.body, self.body)
+        self.assertTrue(verifier.verify(request, verifier.sign(self.body))) #  from the buffered body
+
+    @override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_oversized_bodies_are_refused(self):
+        verifier = signatures.HMACSignatureVerifier(['current'])
+        with self.assertRaises(RequestDataTooBig):
+            verifier.verify(signed_request(self.body), verifier.sign(self.body))
+
+    def test_static_signatures(self):
+        verifier = signatures.StaticSignatureVerifier(['expected', 'previous', ''])
+        self.assertTrue(verifier.verify(signed_request(b''), 'previous'))
+        self.assertFalse(verifier.verify(signed_request(b''), 'other'))
+        self.assertFalse(verifier.verify(signed_request(b''), None))
+
+
+class ExportTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.payments = [
+            self.make_payment(reference=f'ref-{i}', amount=(i + 1) * 100, status=PaymentStatus.values[i % 3],
+                              processor=('paystack', 'credo')[i % 2])
+            for i in range(7)
+        ]
+
+    def test_csv_in_small_chunks(self):
+        chunks = list(exports.export(exports.payments_queryset(), 'csv', chunk_size=2))
+        self.assertEqual(len(chunks), 4) #  header with the first two rows, then two rows a chunk
+        lines = b''.join(chunks).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(exports.PAYMENT_FIELDS))
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [f'ref-{i}' for i in range(7)])
+
+    def test_jsonl_filtered(self):
+        chunks = exports.export(exports.payments_queryset(processor='credo', status=PaymentStatus.UNPROCESSED), 'jsonl')
+        rows = [json.loads(line) for line in b''.join(chunks).splitlines()]
+        self.assertEqual([row['reference'] for row in rows], ['ref-3'])
+        self.assertEqual(rows[0]['amount'], 400)
+
+    def test_parquet(self):
+        if not exports.format_available('parquet'):
+            self.skipTest('needs pyarrow')
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(io.BytesIO(b''.join(exports.export(exports.payments_queryset(), 'parquet', chunk_size=3))))
+        self.assertEqual(table.num_rows, 7)
+        self.assertEqual(table.column('amount').to_pylist(), [(i + 1) * 100 for i in range(7)])
+
+    def test_daily_totals(self):
+        lines = b''.join(exports.export(exports.payments_queryset(), 'csv', daily_totals=True)).decode().splitlines()
+        self.assertEqual(lines[0], ','.join(exports.DAILY_TOTAL_FIELDS))
+        self.assertEqual(sum(int(line.split(',')[3]) for line in lines[1:]), 7)
+
+    def test_the_endpoint_is_staff_only(self):
+        client = Client()
+        client.force_login(self.user)
+        response = client.get(reverse('payments:export_payments'))
+        self.assertEqual(response.status_code, 302)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = client.get(reverse('payments:export_payments'), {'format': 'jsonl', 'processor': 'paystack'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment; filename="payment-export-', response['Content-Disposition'])
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 4)
+
+    def test_the_endpoint_rejects_bad_filters(self):
+        self.user.is_staff = True
+        self.user.save()
+        client = Client()
+        client.force_login(self.user)
+        for query in ({'format': 'xlsx'}, {'status': 'XX'}, {'from': '18/10/2026'}):
+            self.assertEqual(client.get(reverse('payments:export_payments'), query).status_code, 400)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def registry(self, directory=None):
+        registry = metrics.MetricsRegistry()
+        requests = registry.counter('test_requests_total', 'Requests.', ('view',))
+        latency = registry.histogram('test_seconds', 'Latency.', ('view',), buckets=(0.1, 1))
+        if directory:
+            registry.start(directory, interval=3600)
+            self.addCleanup(registry._stop.set)
+        return registry, requests, latency
+
+    def test_render(self):
+        registry, requests, latency = self.registry()
+        requests.inc('checkout')
+        requests.inc('checkout', amount=2)
+        latency.observe(0.05, 'checkout')
+        latency.observe(2, 'checkout')
+        rendered = registry.render()
+        self.assertIn('# TYPE test_requests_total counter\ntest_requests_total{view="checkout"} 3\n', rendered)
+        self.assertIn('test_seconds_bucket{view="checkout",le="0.1"} 1\n', rendered)
+        self.assertIn('test_seconds_bucket{view="checkout",le="1"} 1\n', rendered)
+        self.assertIn('test_seconds_bucket{view="checkout",le="+Inf"} 2\n', rendered)
+        self.assertIn('test_seconds_sum{view="checkout"} 2.05\n', rendered)
+        self.assertIn('test_seconds_count{view="checkout"} 2\n', rendered)
+
+    def test_every_process_is_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            worker, worker_requests, _ = self.registry(directory)
+            worker_requests.inc('checkout', amount=2)
+            worker.flush()
+
+            server, server_requests, _ = self.registry(directory)
+            server_requests.inc('checkout')
+            server_requests.inc('webhook')
+            self.assertEqual(server.collect()['test_requests_total'], {('checkout',): 3, ('webhook',): 1})
+
+            server.reset()
+            self.assertEqual(server.collect()['test_requests_total'], {('checkout',): 2})
+
+    def test_instrumented_outcomes(self):
+        calls = metrics.PROCESSOR_CALLS.values
+        fake = type('Instrumented', (), {
+            'name': 'instrumented',
+            'initialize_payment': metrics.instrument(lambda self, ok: 'https://pay' if ok else '', 'initialize_payment'),
+            'verify_payment': metrics.instrument(lambda self: 1 / 0, 'verify_payment'),
+        })()
+        fake.initialize_payment(True)
+        fake.initialize_payment(False)
+        with self.assertRaises(ZeroDivisionError):
+            fake.verify_payment()
+        self.assertEqual(calls[('instrumented', 'initialize_payment', 'ok')], 1)
+        self.assertEqual(calls[('instrumented', 'initialize_payment', 'failed')], 1)
+        self.assertEqual(calls[('instrumented', 'verify_payment', 'exception')], 1)
+
+    def test_endpoint(self):
+        response = Client().get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn(b'# TYPE payment_gateway_requests_total counter', response.content)
+
+    @override_settings(PAYMENT_METRICS_TOKEN='scrape')
+    def test_endpoint_token(self):
+        self.assertEqual(Client().get('/metrics').status_code, 401)
+        self.assertEqual(Client().get('/metrics', HTTP_AUTHORIZATION='Bearer scrape').status_code, 200)
+
+
+class SimulatorTests(SimpleTestCase):
+
+    def simulator(self, simulator_class, **behaviour):
+        simulator = simulator_class(Behaviour(latency=0, distribution='fixed', **behaviour)).start()
+        self.addCleanup(simulator.stop)
+        return simulator
+
+    def test_outcomes_are_stable_and_follow_the_rates(self):
+        behaviour = Behaviour(failed_rate=0.2, pending_rate=0.1)
+        outcomes = [behaviour.outcome(f'ref-{i}') for i in range(5000)]
+        self.assertEqual(outcomes, [behaviour.outcome(f'ref-{i}') for i in range(5000)])
+        self.assertAlmostEqual(outcomes.count('failed') / 5000, 0.2, delta=0.03)
+        self.assertAlmostEqual(outcomes.count('pending') / 5000, 0.1, delta=0.03)
+
+    def test_initialize_verify_and_list(self):
+        simulator = self.simulator(PaystackSimulator, failed_rate=0)
+        session = requests.Session()
+        self.addCleanup(session.close)
+        response = session.post(f'{simulator.url}/transaction/initialize', json={'reference': 'ref-1', 'amount': '40000'})
+        self.assertTrue(response.json()['data']['authorization_url'])
+        self.assertEqual(session.get(f'{simulator.url}/transaction/verify/ref-1').json()['data']['status'], 'success')
+
+        now = timezone.now()
+        listed = session.get(f'{simulator.url}/transaction', params={
+            'from': (now - timedelta(minutes=1)).isoformat(), 'to': (now + timedelta(minutes=1)).isoformat()}).json()
+        self.assertEqual([row['reference'] for row in listed['data']], ['ref-1'])
+        self.assertEqual(listed['meta']['pageCount'], 1)
+        self.assertEqual(session.get(f'{simulator.url}/nowhere').status_code, 404)
+        self.assertEqual(simulator.stats, {('initialize', 200): 1, ('verify', 200): 1, ('list', 200): 1, ('unknown', 404): 1})
+
+    def test_errors(self):
+        simulator = self.simulator(CredoSimulator, error_rate=1)
+        response = requests.get(f'{simulator.url}/transaction/ref-1/verify')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(simulator.stats, {('verify', 503): 1})
+
+    def test_webhooks_are_signed(self):
+        paystack_simulator = PaystackSimulator(secret_key='sk_test_simulator')
+        credo_simulator = CredoSimulator(webhook_token='token', business_code='700607000000000')
+        self.addCleanup(paystack_simulator.server.server_close)
+        self.addCleanup(credo_simulator.server.server_close)
+
+        body, headers = paystack_simulator.webhook('ref-1')
+        self.assertTrue(signatures.HMACSignatureVerifier(['sk_test_simulator']).verify(signed_request(body), headers['X-Paystack-Signature']))
+        self.assertEqual(json.loads(body)['data']['reference'], 'ref-1')
+
+        body, headers = credo_simulator.webhook('ref-1')
+        expected = hashlib.sha512(b'token700607000000000').hexdigest()
+        self.assertTrue(signatures.StaticSignatureVerifier([expected]).verify(signed_request(body), headers['X-Credo-Signature']))
+        self.assertEqual(json.loads(body)['data']['businessRef'], 'ref-1')
+
+
+class BatchInitializeTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.processor = mock.Mock(initialize_payment=mock.Mock(
+            side_effect=lambda email, amount, reference, *args: '' if amount == 666 else f'https://checkout.paystack.com/{reference}'))
+        self.router = routing.ProcessorRouter(['paystack'])
+        for patcher in (mock.patch.object(batch, 'get_router', return_value=self.router),
+                        mock.patch.object(routing.registry, 'get', return_value=self.processor),
+                        mock.patch.object(self.router, 'choose', side_effect=lambda exclude=(): None if 'paystack' in exclude else 'paystack')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_initializes_every_item(self):
+        users = [User.objects.create_user(username=f'payer{i}', email=f'payer{i}@example.com') for i in range(5)]
+        result = batch.initialize_payments([(user, 40000, {'invoice': i}) for i, user in enumerate(users)],
+                                           'http://testserver/payment_callback/', workers=2, batch_size=2)
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(len(set(result['references'])), 5)
+        self.assertEqual(Payment.objects.filter(reference__in=result['references'], amount=40000).count(), 5)
+        self.assertEqual(result['urls'][result['references'][0]], f"https://checkout.paystack.com/{result['references'][0]}")
+        self.assertEqual(self.processor.initialize_payment.call_args_list[0].args[4], '{"invoice": 0}')
+
+    def test_failed_items_are_reported_and_deleted(self):
+        no_email = User.objects.create_user(username='no-email')
+        items = [(self.user, 40000, None), (no_email, 40000, None), (self.user, 0, None), (self.user, 666, None)]
+        result = batch.initialize_payments(items, 'http://testserver/payment_callback/', rate_limits={})
+        self.assertEqual(sorted(result['errors']), [1, 2, 3])
+        self.assertEqual(result['references'][1:], [None, None, None])
+        self.assertEqual(list(Payment.objects.values_list('reference', flat=True)), [result['references'][0]])
+
+    def test_an_item_that_raises_does_not_abort_the_batch(self):
+        self.processor.initialize_payment.side_effect = lambda email, amount, reference, *args: (
+            1 / 0 if amount == 13 else f'https://checkout.paystack.com/{reference}')
+        items = [(self.user, 40000, None), (self.user, 13, None), (self.user, 50000, None)]
+        with self.assertLogs('payments.batch', 'ERROR'):
+            result = batch.initialize_payments(items, 'http://testserver/payment_callback/', workers=1, rate_limits={})
+        self.assertEqual(list(result['errors']), [1])
+        self.assertIsNone(result['references'][1])
+        self.assertEqual(sorted(Payment.objects.values_list('amount', flat=True)), [40000, 50000])
+
+    def test_failovers_are_rate_limited(self):
+        limiters = {'paystack': mock.Mock(), 'credo': mock.Mock()}
+        router = routing.ProcessorRouter(['paystack', 'credo'])
+        payment = Payment.objects.create(user=self.user, amount=40000, processor='paystack', reference='ref-1')
+        self.processor.initialize_payment.side_effect = ['', 'https://checkout.credocentral.com/ref-1']
+        with mock.patch.object(router, 'choose', side_effect=lambda exclude=(): 'credo' if exclude else 'paystack'):
+            payment_url = router.initialize_payment(payment, self.user.email, 'http://testserver/payment_callback/', limiters=limiters)
+        self.assertEqual(payment_url, 'https://checkout.credocentral.com/ref-1')
+        self.assertEqual(limiters['paystack'].acquire.call_count, 1)
+        self.assertEqual(limiters['credo'].acquire.call_count, 1)
+
+    def test_no_processor_available(self):
+        with mock.patch.object(self.router, 'choose', return_value=None):
+            result = batch.initialize_payments([(self.user, 40000, None)], 'http://testserver/payment_callback/')
+        self.assertEqual(result['errors'], {0: 'No payment processor is available'})
+        self.assertFalse(Payment.objects.exists())
+
+
+class EventDecodeTests(SimpleTestCase):
+
+    def test_paystack_charge_success(self):
+        body = b'{"event":"charge.success","data":{"reference":"ref-1","paid_at":"2026-10-18T09:30:00Z","id":7}}'
+        event = paystack.PaystackProcessor().decode_event(body)
+        self.assertEqual((event.processor, event.status, event.reference), ('paystack', OnlineTransactionStatus.SUCCESSFUL, 'ref-1'))
+        self.assertEqual(event.payment_date.isoformat(), '2026-10-18T09:30:00+00:00')
+        self.assertEqual(event.key, 'paystack:charge.success:ref-1')
+        payload = event.as_payload()
+        self.assertEqual((payload['event'], payload['data']['payment_date']), (OnlineTransactionStatus.SUCCESSFUL, event.payment_date))
+        self.assertEqual(event.payload['event'], 'charge.success') #  the decoded body is left as it is
+
+    def test_credo_events(self):
+        body = json.dumps({'event': 'TRANSACTION.FAILED', 'data': {'businessRef': 'ref-1', 'transactionDate': 1792315800000}})
+        event = credo.CredoProcessor().decode_event(body)
+        self.assertEqual((event.status, event.reference), (OnlineTransactionStatus.FAILED, 'ref-1'))
+        self.assertEqual(event.payment_date.timestamp(), 1792315800)
+
+    def test_events_the_flow_ignores(self):
+        event = paystack.PaystackProcessor().decode_event(b'{"event":"transfer.success","data":{"id":9}}')
+        self.assertIsNone(event.status)
+        self.assertEqual(event.key, 'paystack:transfer.success:9')
+
+    def test_malformed_events(self):
+        decoder = paystack.EVENT_DECODER
+        for body in (b'not json', b'[]', b'{"event":"charge.success"}', b'{"event":"charge.success","data":{}}',
+                     b'{"event":"charge.success","data":{"reference":7}}',
+                     b'{"event":"charge.success","data":{"reference":"ref-1","paid_at":"yesterday"}}'):
+            with self.subTest(body=body), self.assertRaises(events.MalformedEventError):
+                decoder.decode(body)
+        with self.assertRaises(events.MalformedEventError):
+            credo.EVENT_DECODER.decode(b'{"event":"transaction.successful","data":{"businessRef":"ref-1","transactionDate":"2026-10-18"}}')
+
+
+delivered = [] #  references handed to the test handlers
+
+
+def deliver(message):
+    delivered.append(message.payload['reference'])
+
+
+def fail(message):
+    raise ConnectionError('ERP unavailable')
+
+
+@outbox.batch_handler
+def deliver_batch(messages):
+    delivered.extend(message.payload['reference'] for message in messages)
+    return {message.id: 'rejected' for message in messages if message.payload['reference'] == 'ref-rejected'}
+
+
+@override_settings(
+    PAYMENT_OUTBOX_HANDLERS={'payment.completed': ['payments.tests.deliver', 'payments.tests.deliver_batch'], 'payment.failed': ['payments.tests.fail']},
+    PAYMENT_OUTBOX_MAX_ATTEMPTS=2, PAYMENT_OUTBOX_RETRY_DELAY=10,
+)
+class OutboxTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        delivered.clear()
+
+    def settle(self, payment, status):
+        transitions.transition(payment, status, timezone.now())
+
+    def test_messages_are_written_with_the_transition(self):
+        payment = self.make_payment()
+        self.settle(payment, PaymentStatus.COMPLETED)
+        self.assertEqual(sorted(OutboxMessage.objects.values_list('handler', flat=True)),
+                         ['payments.tests.deliver', 'payments.tests.deliver_batch'])
+        self.assertEqual(OutboxMessage.objects.first().payload['status'], PaymentStatus.COMPLETED)
+
+    def test_a_lost_transition_writes_nothing(self):
+        payment = self.make_payment()
+        stale = Payment.objects.get(pk=payment.pk) #  a concurrent caller that read the payment before it settled
+        with self.settings(PAYMENT_ROLLUPS=True):
+            self.assertTrue(transitions.transition(payment, PaymentStatus.COMPLETED, timezone.now()))
+            self.assertFalse(transitions.transition(stale, PaymentStatus.FAILED, timezone.now()))
+        self.assertEqual(stale.status, PaymentStatus.COMPLETED)
+        self.assertEqual(list(OutboxMessage.objects.values_list('event', flat=True).distinct()), ['payment.completed'])
+        self.assertEqual(OutboxMessage.objects.count(), 2) #  one per handler
+        today = timezone.localdate()
+        self.assertEqual(rollups.stored(today, today + timedelta(days=1)), {
+            (today, 'paystack', PaymentStatus.COMPLETED): (1, payment.amount),
+        })
+
+    def test_delivered_messages_are_deleted(self):
+        for i in range(3):
+            self.settle(self.make_payment(reference=f'ref-{i}'), PaymentStatus.COMPLETED)
+        self.assertEqual(outbox.dispatch_batch(), 6)
+        self.assertEqual(sorted(delivered), sorted([f'ref-{i}' for i in range(3)] * 2))
+        self.assertFalse(OutboxMessage.objects.exists())
+        self.assertEqual(outbox.dispatch_batch(), 0)
+
+    def test_failures_are_retried_then_dead(self):
+        payment = self.make_payment()
+        self.settle(payment, PaymentStatus.FAILED)
+        with self.assertLogs('payments.outbox', 'ERROR'):
+            outbox.dispatch_batch()
+        message = OutboxMessage.objects.get()
+        self.assertIn('ERP unavailable', message.last_error)
+        self.assertGreater(message.available_at, timezone.now() + timedelta(seconds=9))
+        self.assertEqual(outbox.dispatch_batch(), 0) #  not due yet
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        with self.assertLogs('payments.outbox', 'ERROR'):
+            outbox.dispatch_batch()
+        self.assertFalse(OutboxMessage.objects.exists())
+        letter = DeadLetter.objects.get()
+        self.assertEqual((letter.payment_id, letter.attempts), (payment.pk, 2))
+        self.assertEqual(outbox.outbox_stats()['dead'], 1)
+
+        self.assertEqual(outbox.requeue_dead_letters(), 1)
+        self.assertEqual(OutboxMessage.objects.get().attempts, 0)
+        self.assertFalse(DeadLetter.objects.exists())
+
+    def test_batch_handlers_report_failed_messages(self):
+        for reference in ('ref-1', 'ref-rejected'):
+            self.settle(self.make_payment(reference=reference), PaymentStatus.COMPLETED)
+        outbox.dispatch_batch()
+        self.assertEqual(list(OutboxMessage.objects.values_list('handler', 'last_error')), [('payments.tests.deliver_batch', 'rejected')])
+
+    def test_a_payments_messages_are_delivered_in_order(self):
+        payment = self.make_payment()
+        first = outbox.enqueue([payment], PaymentStatus.COMPLETED)
+        outbox.enqueue([payment], PaymentStatus.COMPLETED)
+        claimed = outbox.claim_messages(10)
+        self.assertEqual({message.id for message in claimed}, {message.id for message in first})
+        self.assertEqual(outbox.claim_messages(10), []) #  the second messages wait for the first
+        self.assertEqual(outbox.outbox_stats()['delivering'], 2)
+
+
+def gateway_event(reference):
+    return paystack.EVENT_DECODER.decode(json.dumps({'event': 'charge.success', 'data': {'reference': reference}}))
+
+
+class BloomFilterTests(SimpleTestCase):
+
+    def test_no_false_negatives_and_few_false_positives(self):
+        bloom = idempotency.BloomFilter(2000, 0.01)
+        for i in range(2000):
+            bloom.add(f'seen-{i}')
+        self.assertTrue(all(f'seen-{i}' in bloom for i in range(2000)))
+        false_positives = sum(f'new-{i}' in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.02)
+
+    def test_saved_filters(self):
+        bloom = idempotency.BloomFilter(100, 0.001)
+        bloom.add('ref-1')
+        saved = idempotency.BloomFilter.from_bits(bytes(bloom.bits), bloom.size, bloom.hashes)
+        self.assertIn('ref-1', saved)
+        self.assertNotIn('ref-2', saved)
+
+    def test_rotation_keeps_two_generations(self):
+        bloom = idempotency.RotatingBloomFilter(capacity=2, error_rate=0.001, period=3600)
+        bloom.add('a')
+        bloom.add('b')
+        bloom.add('c') #  the first generation is full
+        for key in 'abc':
+            self.assertIn(key, bloom)
+        bloom.add('d')
+        bloom.add('e') #  drops 'a' and 'b'
+        self.assertNotIn('a', bloom)
+        self.assertIn('e', bloom)
+
+    def test_rotation_by_age(self):
+        bloom = idempotency.RotatingBloomFilter(capacity=100, error_rate=0.001, period=60)
+        bloom.add('a')
+        bloom.started -= 61
+        self.assertIn('a', bloom) #  now in the previous generation
+        bloom.started -= 61
+        self.assertNotIn('a', bloom)
+
+
+class SeenEventsTests(PaymentTestCase):
+
+    def seen_events(self):
+        return idempotency.SeenEvents(capacity=1000, error_rate=0.0001, period=3600, sync_interval=0)
+
+    def test_keys_are_shared_through_the_table(self):
+        first, second = self.seen_events(), self.seen_events()
+        event = gateway_event('ref-1')
+        first.add(event)
+        self.assertNotIn(event.key, second)
+        first.sync()
+        self.assertEqual(SeenWebhookEvent.objects.get().key, event.key)
+        second.sync()
+        self.assertIn(event.key, second)
+
+    @override_settings(PAYMENT_WEBHOOK_DEDUP=True)
+    def test_events_are_marked_once_committed(self):
+        seen = self.seen_events()
+        event = gateway_event('ref-1')
+        with mock.patch.object(idempotency, '_seen', seen):
+            with self.captureOnCommitCallbacks(execute=False):
+                idempotency.mark_processed(event)
+            self.assertFalse(idempotency.is_duplicate(event)) #  rolled back
+            with self.captureOnCommitCallbacks(execute=True):
+                idempotency.mark_processed(event)
+            self.assertTrue(idempotency.is_duplicate(event))
+
+    def test_dedup_is_off_by_default(self):
+        self.assertFalse(idempotency.is_duplicate(gateway_event('ref-1')))
+
+    def test_prune(self):
+        seen = self.seen_events()
+        seen.add(gateway_event('ref-1'))
+        seen.add(gateway_event('ref-2'))
+        seen.sync()
+        SeenWebhookEvent.objects.filter(key__endswith='ref-1').update(seen_at=timezone.now() - timedelta(hours=3))
+        self.assertEqual(idempotency.prune(2 * 3600), 1)
+        self.assertEqual(SeenWebhookEvent.objects.get().key, gateway_event('ref-2').key)
+
+
+class ArchiveTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overridden = override_settings(PAYMENT_ARCHIVE_DIR=directory.name)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        patcher = mock.patch.dict(archive._filters, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.month = archive.cutoff(7)
+        self.payments = []
+        for i in range(5):
+            payment = self.make_payment(reference=f'ref-{i}', status=PaymentStatus.COMPLETED, date=self.month + timedelta(days=i))
+            ledger.record_event(payment, PaymentEventSource.VERIFICATION, verified(OnlineTransactionStatus.SUCCESSFUL, True))
+            self.payments.append(payment)
+
+    def archive(self, format):
+        return archive.archive_month(self.month, archive.next_month(self.month), format, batch_size=2)
+
+    def check_archived(self, format):
+        entry = self.archive(format)
+        self.assertEqual((entry['rows'], entry['min_reference'], entry['max_reference']), (5, 'ref-0', 'ref-4'))
+        self.assertTrue(entry['complete'])
+        self.assertFalse(Payment.objects.exists())
+
+        row = archive.find_payment('ref-3')
+        self.assertEqual((row['id'], row['amount'], row['status'], row['archive']), (self.payments[3].pk, 40000, PaymentStatus.COMPLETED, entry['file']))
+        self.assertEqual(row['date'], self.payments[3].date)
+        self.assertEqual(row['events'][0]['source'], PaymentEventSource.VERIFICATION)
+        self.assertIsNone(archive.find_archived('ref-9'))
+
+    def test_jsonl(self):
+        self.check_archived('jsonl')
+
+    def test_parquet(self):
+        if not archive.format_available('parquet'):
+            self.skipTest('needs pyarrow')
+        self.check_archived('parquet')
+
+    def test_unsettled_and_outbox_pending_payments_are_left(self):
+        self.make_payment(reference='ref-unprocessed', date=self.month)
+        OutboxMessage.objects.create(payment=self.payments[0], event='payment.completed', handler='store.side_effects.send_receipt')
+        self.assertEqual(self.archive('jsonl')['rows'], 4)
+        self.assertEqual(sorted(Payment.objects.values_list('reference', flat=True)), ['ref-0', 'ref-unprocessed'])
+
+    def test_interrupted_deletions_are_finished(self):
+        with mock.patch.object(archive, '_delete', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.archive('jsonl')
+        self.assertEqual(Payment.objects.count(), 5)
+        self.assertFalse(archive.load_manifest()['archives'][0]['complete'])
+
+        self.assertEqual(archive.finish_incomplete(), 1)
+        self.assertFalse(Payment.objects.exists())
+        self.assertTrue(archive.load_manifest()['archives'][0]['complete'])
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command('archive_payments', older_than_months=6, format='jsonl', dry_run=True, stdout=output)
+        self.assertIn('Would archive 5 payment(s)', output.getvalue())
+        self.assertEqual(Payment.objects.count(), 5)
+
+        call_command('archive_payments', older_than_months=6, format='jsonl', stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('archive_payments', lookup='ref-2', stdout=output)
+        self.assertIn('reference: ref-2', output.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('archive_payments', lookup='ref-9', stdout=io.StringIO())
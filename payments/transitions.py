@@ -0,0 +1,110 @@
+'''
+Payment state transitions.
+
+A payment can be settled by its callback, its webhook and reconciliation,
+possibly at the same time. Transitions are therefore applied with a
+conditional UPDATE that only matches rows still in a status the transition
+is allowed from, and the database decides which caller wins. Only the
+winner's transaction writes the side effects of the transition (emails,
+fulfilment) to the outbox, for `manage.py dispatch_outbox` to deliver (see
+outbox.py), and adds the payment to the daily totals (see rollups.py).
+Applied transitions drop the payments' cached statuses (see status.py).
+'''
+from collections import defaultdict
+
+from django.db import connection, models, transaction
+
+from . import outbox, rollups, status as payment_status
+from .models import Payment, PaymentStatus
+
+
+TRANSITIONS = {
+    PaymentStatus.UNPROCESSED: (PaymentStatus.COMPLETED, PaymentStatus.FAILED),
+}
+
+
+def allowed_from(status):
+    '''
+    The statuses a payment can move to [status] from.
+    '''
+    sources = [source for source, targets in TRANSITIONS.items() if status in targets]
+    if not sources:
+        raise ValueError(f"No transition leads to {status!r}")
+    return sources
+
+
+def transition(payment, status, date=None):
+    '''
+    Moves [payment] to [status] (and sets its [date], if given) unless another
+    caller got there first, writing its outbox messages in the same
+    transaction. Only the changed columns are written.
+
+    Returns True if this call made the transition. Otherwise [payment] is
+    refreshed with the status and date the winner stored.
+    '''
+    changes = {'status': status}
+    if date is not None:
+        changes['date'] = date
+
+    with transaction.atomic(savepoint=False): #  no savepoint when called in a transaction, which rolls back with it
+        won = Payment.objects.filter(pk=payment.pk, status__in=allowed_from(status)).update(**changes) == 1
+        if won:
+            for field, value in changes.items():
+                setattr(payment, field, value)
+            outbox.enqueue([payment], status)
+            rollups.record([payment], status)
+    if won:
+        payment_status.invalidate([payment.reference])
+    else:
+        payment.refresh_from_db(fields=['status', 'date'])
+    return won
+
+
+def bulk_transition(changes, batch_size=500):
+    '''
+    Applies many transitions at once. [changes] is an iterable of
+    (payment, status, date) and each batch of payments moving to the same
+    status is written with a single conditional UPDATE, with the outbox
+    messages of its applied transitions.
+
+    Returns the payments whose transition was applied by this call.
+    '''
+    by_status = defaultdict(list)
+    for payment, status, date in changes:
+        by_status[status].append((payment, date))
+
+    applied = []
+    for status, items in by_status.items():
+        sources = allowed_from(status)
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            with transaction.atomic():
+                # lock the rows that can still move so the ids read here are the
+                # ids the UPDATE changes; rows locked by a concurrent transition
+                # are left to it
+                qs = Payment.objects.filter(id__in=[payment.id for payment, _ in batch], status__in=sources)
+                if connection.features.has_select_for_update_skip_locked:
+                    qs = qs.select_for_update(skip_locked=True)
+                ids = set(qs.values_list('id', flat=True))
+                if not ids:
+                    continue
+
+                dates = [models.When(id=payment.id, then=models.Value(date)) for payment, date in batch if payment.id in ids and date is not None]
+                fields = {'status': status}
+                if dates:
+                    fields['date'] = models.Case(*dates, default=models.F('date'), output_field=models.DateTimeField())
+                Payment.objects.filter(id__in=ids, status__in=sources).update(**fields)
+
+                moved = []
+                for payment, date in batch:
+                    if payment.id in ids:
+                        payment.status = status
+                        if date is not None:
+                            payment.date = date
+                        moved.append(payment)
+                outbox.enqueue(moved, status)
+                rollups.record(moved, status)
+
+            applied.extend(moved)
+            payment_status.invalidate([payment.reference for payment, _ in batch if payment.id in ids])
+    return applied
@@ -0,0 +1,176 @@
+'''
+Shared HTTP transport for the payment processors.
+
+Each processor gets one long-lived HTTPAdapter (and so one urllib3 connection
+pool per gateway host) that lives for the life of the worker process, so TCP
+and TLS handshakes are only paid when a pooled connection is first opened.
+requests.Session objects are not safe to share between threads (the cookie
+jar is mutated on every response), so every thread gets its own session
+mounted on the processor's shared adapter. The adapter's pool manager is
+thread-safe.
+
+The async processor methods use an httpx.AsyncClient per processor instead.
+An AsyncClient's pool belongs to the event loop it was first used on, so
+clients are cached per running loop.
+
+Every call goes through the processor's circuit breaker and bulkhead (see
+payments/resilience.py), so callers must also expect GatewayUnavailable.
+Calls are timed and counted by HTTP status, or by why they failed, in
+payments/metrics.py.
+'''
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics, resilience
+
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+_local = threading.local()
+_async_clients = weakref.WeakKeyDictionary() #  event loop -> {processor name: AsyncClient}
+
+
+def _build_adapter():
+    retry = Retry(
+        total=settings.PAYMENT_HTTP_MAX_RETRIES,
+        backoff_factor=settings.PAYMENT_HTTP_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS, #  only idempotent methods are retried on read errors and bad statuses
+        raise_on_status=False,
+    )
+    return HTTPAdapter(
+        pool_connections=settings.PAYMENT_HTTP_POOL_CONNECTIONS,
+        pool_maxsize=settings.PAYMENT_HTTP_POOL_MAXSIZE,
+        pool_block=settings.PAYMENT_HTTP_POOL_BLOCK,
+        max_retries=retry,
+    )
+
+
+def get_adapter(name):
+    '''
+    Returns the process-wide connection pool adapter for the processor [name].
+    '''
+    adapter = _adapters.get(name)
+    if adapter is None:
+        with _adapters_lock:
+            adapter = _adapters.get(name)
+            if adapter is None:
+                adapter = _adapters[name] = _build_adapter()
+    return adapter
+
+
+def get_session(name):
+    '''
+    Returns this thread's session for the processor [name]. All sessions for
+    a processor share the same pooled adapter.
+    '''
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+
+    session = sessions.get(name)
+    if session is None:
+        adapter = get_adapter(name)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        sessions[name] = session
+    return session
+
+
+def get_timeout():
+    return (settings.PAYMENT_HTTP_CONNECT_TIMEOUT, settings.PAYMENT_HTTP_READ_TIMEOUT)
+
+
+def _error_status(error):
+    if isinstance(error, resilience.CircuitOpenError):
+        return 'circuit_open'
+    if isinstance(error, resilience.BulkheadFullError):
+        return 'bulkhead_full'
+    return 'error'
+
+
+def _observe(name, endpoint, started, status):
+    metrics.GATEWAY_REQUESTS.inc(name, endpoint, status)
+    metrics.GATEWAY_LATENCY.observe(time.perf_counter() - started, name, endpoint)
+
+
+def request(name, method, url, endpoint=None, **kwargs):
+    '''
+    Sends a request to a gateway through the pooled session for the processor
+    [name]. A (connect, read) timeout is always applied unless one is passed.
+
+    [endpoint] names the circuit breaker and the metrics the call counts
+    towards, it defaults to [method].
+    '''
+    kwargs.setdefault('timeout', get_timeout())
+    session = get_session(name)
+    endpoint = endpoint or method
+    started = time.perf_counter()
+    try:
+        response = resilience.call(name, endpoint, lambda: session.request(method, url, **kwargs))
+    except Exception as e:
+        _observe(name, endpoint, started, _error_status(e))
+        raise
+    _observe(name, endpoint, started, str(response.status_code))
+    return response
+
+
+def get_async_client(name):
+    '''
+    Returns the pooled async client for the processor [name] on the running
+    event loop.
+    '''
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+
+    client = clients.get(name)
+    if client is None:
+        client = clients[name] = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.PAYMENT_HTTP_POOL_MAXSIZE if settings.PAYMENT_HTTP_POOL_BLOCK else None,
+                max_keepalive_connections=settings.PAYMENT_HTTP_POOL_MAXSIZE,
+            ),
+            timeout=httpx.Timeout(
+                settings.PAYMENT_HTTP_READ_TIMEOUT,
+                connect=settings.PAYMENT_HTTP_CONNECT_TIMEOUT,
+            ),
+            transport=httpx.AsyncHTTPTransport(retries=settings.PAYMENT_HTTP_MAX_RETRIES), #  httpx only retries failed connects
+        )
+    return client
+
+
+async def arequest(name, method, url, endpoint=None, **kwargs):
+    '''
+    Async counterpart of request().
+    '''
+    client = get_async_client(name)
+    endpoint = endpoint or method
+    started = time.perf_counter()
+    try:
+        response = await resilience.acall(name, endpoint, lambda: client.request(method, url, **kwargs))
+    except Exception as e:
+        _observe(name, endpoint, started, _error_status(e))
+        raise
+    _observe(name, endpoint, started, str(response.status_code))
+    return response
+
+
+def close_adapters():
+    '''
+    Closes every pooled connection. Mostly useful after forking worker processes
+    so that children do not share sockets with their parent. The pools are
+    reopened on the next request.
+    '''
+    with _adapters_lock:
+        for adapter in _adapters.values():
+            adapter.close()
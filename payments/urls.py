@@ -0,0 +1,9 @@
+from django.urls import path
+from . import views
+
+
+app_name = 'payments'
+
+urlpatterns = [
+    path('export/', views.export_payments, name='export_payments'),
+]
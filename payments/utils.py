@@ -1,26 +1,86 @@
+import time
+
 from typing import Type
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.db.models import Model
 from django.http.response import JsonResponse
 from django.utils.crypto import get_random_string
 
 
-def generate_unique_reference(instance: Type[Model], new_ref=None, char_length=64) -> str:
-    ''' 
-    Generates a unique reference code of 64 [default] characters 
-    for the reference field of an instance Model.
+# ASCII-sorted so that time-ordered references sort by creation time
+REFERENCE_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+TIME_PREFIX_LENGTH = 7 #  62**7 milliseconds lasts until the year 2081
+
+
+def _encode_time(milliseconds):
+    chars = []
+    for _ in range(TIME_PREFIX_LENGTH):
+        milliseconds, remainder = divmod(milliseconds, len(REFERENCE_ALPHABET))
+        chars.append(REFERENCE_ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def _is_time_ordered(char_length):
+    return settings.PAYMENT_REFERENCE_FORMAT == 'time' and char_length > TIME_PREFIX_LENGTH
 
-    Note: The model MUST have a field [reference]
+
+def generate_reference(char_length=None) -> str:
+    '''
+    Generates a payment reference of [char_length] characters
+    (settings.PAYMENT_REFERENCE_LENGTH by default) without touching the database.
+
+    With settings.PAYMENT_REFERENCE_FORMAT = 'time' (the default) the reference
+    is a millisecond timestamp followed by random characters, so references
+    sort by creation time and only references created in the same millisecond
+    can collide. 'random' gives fully random references.
     '''
-    if new_ref:
-        ref = new_ref
-    else:
-        ref = get_random_string(char_length)
+    char_length = char_length or settings.PAYMENT_REFERENCE_LENGTH
+    if _is_time_ordered(char_length):
+        prefix = _encode_time(time.time_ns() // 1_000_000)
+        return prefix + get_random_string(char_length - TIME_PREFIX_LENGTH, REFERENCE_ALPHABET)
+    return get_random_string(char_length, REFERENCE_ALPHABET)
+
 
-    instance_class = instance.__class__
-    qs = instance_class.objects.filter(reference=ref)
+def save_with_unique_reference(instance: Model, char_length=None, attempts=5) -> Model:
+    '''
+    Gives [instance] a new reference and saves it. Instead of checking for
+    an existing reference first, this relies on the unique index on the
+    [reference] field and retries with a fresh reference on a collision.
+
+    Note: The model MUST have a unique field [reference]
+    '''
+    for attempt in range(attempts):
+        instance.reference = generate_reference(char_length)
+        try:
+            with transaction.atomic(): #  savepoint, so a collision does not break an enclosing transaction
+                instance.save()
+            return instance
+        except IntegrityError:
+            collided = instance.__class__.objects.filter(reference=instance.reference).exists()
+            if not collided or attempt == attempts - 1:
+                raise
+
+
+def allocate_references(model: Type[Model], count, char_length=None) -> list:
+    '''
+    Returns [count] references that no [model] row uses, for bulk flows that
+    create many rows at once. Collisions are checked with a single query
+    (time-ordered references only need a range scan over the current
+    millisecond window) and replaced.
+
+    The unique index on [reference] still has the final say, since another
+    process can take a reference between allocation and insert.
+    '''
+    char_length = char_length or settings.PAYMENT_REFERENCE_LENGTH
+    references = set()
+    while len(references) < count:
+        references.update(generate_reference(char_length) for _ in range(count - len(references)))
 
-    if qs.exists():
-        new_ref = get_random_string(char_length)
-        return generate_unique_reference(instance, new_ref=new_ref)
+        if _is_time_ordered(char_length):
+            taken = model.objects.filter(reference__range=(min(references), max(references)))
+        else:
+            taken = model.objects.filter(reference__in=references)
+        references.difference_update(taken.values_list('reference', flat=True))
 
-    return ref
+    return list(references)
@@ -0,0 +1,218 @@
+'''
+Cache for gateway verification results.
+
+A callback page refresh, a webhook and a reconciliation run can all verify
+the same reference within seconds of each other. Results that can no longer
+change are cached until evicted: successful or failed transactions whose
+gateway status the processor marked final (data["final"]). Any other result
+is cached for PAYMENT_VERIFICATION_CACHE_PENDING_TTL seconds only, and failed
+gateway calls are not cached at all. Concurrent
+verifications of the same reference share a single gateway call.
+
+Cached payloads are shared between callers and must not be mutated.
+'''
+import asyncio
+import threading
+import time
+import weakref
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from store.utils import OnlineTransactionStatus
+
+
+TERMINAL_STATUSES = (OnlineTransactionStatus.SUCCESSFUL, OnlineTransactionStatus.FAILED)
+
+
+class LRUCache:
+    '''
+    Thread-safe in-process LRU cache with per-entry expiry.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, timeout=None):
+        self.set(key, value, timeout)
+
+
+class DjangoCacheBackend:
+    '''
+    Adapter for a Django cache (settings.CACHES) so that verification results
+    are shared between worker processes.
+    '''
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value, timeout=None):
+        await self.cache.aset(key, value, timeout)
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = {}
+
+
+class VerificationCache:
+
+    def __init__(self, backend, pending_ttl):
+        self.backend = backend
+        self.pending_ttl = pending_ttl
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0 #  verifications that waited for an identical in-flight call
+        self._inflight = {}
+        self._async_inflight = weakref.WeakKeyDictionary() #  event loop -> {key: future}
+        self._lock = threading.Lock()
+
+    def key(self, processor, reference):
+        return f"payment-verification:{processor.name}:{reference}"
+
+    def timeout(self, payload):
+        data = payload["data"]
+        return None if data["status"] in TERMINAL_STATUSES and data.get("final") else self.pending_ttl
+
+    def verify(self, processor, reference):
+        '''
+        Returns processor.verify_payment(reference), from the cache when possible.
+        '''
+        key = self.key(processor, reference)
+        payload = self.backend.get(key)
+        with self._lock:
+            if payload is not None:
+                self.hits += 1
+                return payload
+
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight[key] = _InFlight()
+                self.misses += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            inflight.done.wait()
+            return inflight.result
+
+        try:
+            payload = processor.verify_payment(reference)
+            if payload:
+                self.backend.set(key, payload, self.timeout(payload))
+            inflight.result = payload
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            inflight.done.set()
+        return payload
+
+    async def averify(self, processor, reference):
+        '''
+        Async counterpart of verify(), using processor.averify_payment. Calls
+        are collapsed per event loop.
+        '''
+        key = self.key(processor, reference)
+        payload = await self.backend.aget(key)
+        if payload is not None:
+            self.hits += 1
+            return payload
+
+        inflight = self._async_inflight.setdefault(asyncio.get_running_loop(), {})
+        future = inflight.get(key)
+        if future is not None:
+            self.collapsed += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = inflight[key] = asyncio.get_running_loop().create_future()
+        payload = {}
+        try:
+            payload = await processor.averify_payment(reference)
+            if payload:
+                await self.backend.aset(key, payload, self.timeout(payload))
+        finally:
+            del inflight[key]
+            future.set_result(payload)
+        return payload
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'collapsed': self.collapsed}
+
+
+_verification_cache = None
+
+
+def get_verification_cache():
+    '''
+    Returns the process-wide VerificationCache configured by
+    settings.PAYMENT_VERIFICATION_CACHE ('memory', 'django' or '' to disable),
+    or None when caching is disabled.
+    '''
+    global _verification_cache
+    if _verification_cache is None and settings.PAYMENT_VERIFICATION_CACHE:
+        if settings.PAYMENT_VERIFICATION_CACHE == 'django':
+            backend = DjangoCacheBackend(settings.PAYMENT_VERIFICATION_CACHE_ALIAS)
+        else:
+            backend = LRUCache(settings.PAYMENT_VERIFICATION_CACHE_SIZE)
+        _verification_cache = VerificationCache(backend, settings.PAYMENT_VERIFICATION_CACHE_PENDING_TTL)
+    return _verification_cache
+
+
+def verify_payment(processor, reference):
+    '''
+    Verifies [reference] with [processor] through the verification cache.
+    '''
+    cache = get_verification_cache()
+    if cache is None:
+        return processor.verify_payment(reference)
+    return cache.verify(processor, reference)
+
+
+async def averify_payment(processor, reference):
+    cache = get_verification_cache()
+    if cache is None:
+        return await processor.averify_payment(reference)
+    return await cache.averify(processor, reference)
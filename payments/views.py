@@ -0,0 +1,67 @@
+from datetime import datetime, time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+
+from . import exports, metrics as payment_metrics
+from .models import PaymentStatus
+
+
+def _parse_day(value):
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d').date() #  raises ValueError
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+@staff_member_required
+@require_GET
+def export_payments(request):
+    '''
+    Streams payments (or their daily totals with ?daily_totals=1) as CSV,
+    JSON lines or Parquet. Filters: ?processor=, ?status=, ?from= and ?to=
+    (YYYY-MM-DD, [to] excluded).
+    '''
+    format = request.GET.get('format', 'csv')
+    if not exports.format_available(format):
+        return HttpResponseBadRequest(f'Unsupported export format {format!r}')
+
+    status = request.GET.get('status') or None
+    if status and status not in PaymentStatus.values:
+        return HttpResponseBadRequest(f'Unknown payment status {status!r}')
+
+    try:
+        date_from = _parse_day(request.GET.get('from'))
+        date_to = _parse_day(request.GET.get('to'))
+    except ValueError:
+        return HttpResponseBadRequest('Dates must be YYYY-MM-DD')
+
+    daily_totals = request.GET.get('daily_totals') in ('1', 'true', 'True')
+    filters = {'processor': request.GET.get('processor'), 'status': status, 'date_from': date_from, 'date_to': date_to}
+    if daily_totals:
+        chunks = exports.export_daily_totals(format, **filters)
+    else:
+        chunks = exports.export(exports.payments_queryset(**filters), format)
+
+    content_type, extension = exports.FORMATS[format]
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    filename = f"payment-{'totals' if daily_totals else 'export'}-{timezone.now():%Y%m%d%H%M%S}.{extension}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@require_GET
+def metrics(request):
+    '''
+    Payment metrics in the Prometheus text format, for every worker process
+    when PAYMENT_METRICS_DIR is set. Requires 'Authorization: Bearer
+    <PAYMENT_METRICS_TOKEN>' when the token is set.
+    '''
+    token = settings.PAYMENT_METRICS_TOKEN
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    return HttpResponse(payment_metrics.REGISTRY.render(), content_type=payment_metrics.CONTENT_TYPE)
@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments.middleware.metrics_middleware', #  first, so that it times the whole request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,16 +84,47 @@ WSGI_APPLICATION = 'processor_di.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# SQLite by default. Set DATABASE_ENGINE=django.db.backends.postgresql (needs psycopg) and the DATABASE_* variables
+# for PostgreSQL, e.g. to run the benchmarks against it
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': os.getenv('DATABASE_ENGINE', 'django.db.backends.sqlite3'),
+        'NAME': os.getenv('DATABASE_NAME') or BASE_DIR / 'db.sqlite3',
+        'USER': os.getenv('DATABASE_USER', ''),
+        'PASSWORD': os.getenv('DATABASE_PASSWORD', ''),
+        'HOST': os.getenv('DATABASE_HOST', ''),
+        'PORT': os.getenv('DATABASE_PORT', ''),
     }
 }
 
 
 PAYMENT_PROCESSOR = os.getenv('PAYMENT_PROCESSOR', 'payments.paystack.PaystackProcessor')
 
+# Every processor payments may have been made with, by Payment.processor name
+PAYMENT_PROCESSORS = {
+    'paystack': 'payments.paystack.PaystackProcessor',
+    'credo': 'payments.credo.CredoProcessor',
+}
+
+# Payment references (see payments/utils.py). 'time' references sort by creation time, 'random' ones do not
+PAYMENT_REFERENCE_FORMAT = os.getenv('PAYMENT_REFERENCE_FORMAT', 'time')
+PAYMENT_REFERENCE_LENGTH = int(os.getenv('PAYMENT_REFERENCE_LENGTH', 16)) #  at most 32, the size of Payment.reference
+
+# Route new payments across several processors by health (see payments/routing.py). Off routes everything to PAYMENT_PROCESSOR
+PAYMENT_ROUTING = os.getenv('PAYMENT_ROUTING', 'False') == 'True'
+PAYMENT_ROUTING_PROCESSORS = [name for name in os.getenv('PAYMENT_ROUTING_PROCESSORS', '').split(',') if name] #  empty means every processor in PAYMENT_PROCESSORS
+PAYMENT_ROUTING_WEIGHTS = {
+    'paystack': float(os.getenv('PAYSTACK_ROUTING_WEIGHT', 1)),
+    'credo': float(os.getenv('CREDO_ROUTING_WEIGHT', 1)),
+}
+PAYMENT_ROUTING_WINDOW = 50 #  recent calls per processor used to measure latency and error rate. A processor whose initialize circuit breaker is open is out of rotation (PAYMENT_CIRCUIT_BREAKER_*)
+
+# Max gateway API calls per second per processor for background jobs such as reconcile_payments
+PAYMENT_PROCESSOR_RATE_LIMITS = {
+    'paystack': float(os.getenv('PAYSTACK_RATE_LIMIT', 10)),
+    'credo': float(os.getenv('CREDO_RATE_LIMIT', 10)),
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -135,3 +167,106 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 PAYMENT_PROCESSOR_USE_CALLBACK = os.getenv("PAYMENT_PROCESSOR_USE_CALLBACK", True)
+
+# Serve the checkout/callback/webhook views as native async views. Only worth it under ASGI (processor_di/asgi.py)
+PAYMENT_ASYNC_VIEWS = os.getenv('PAYMENT_ASYNC_VIEWS', 'False') == 'True'
+
+# Pooled HTTP transport used by the payment processors (see payments/transport.py)
+PAYMENT_HTTP_POOL_CONNECTIONS = int(os.getenv('PAYMENT_HTTP_POOL_CONNECTIONS', 4)) #  number of gateway hosts to keep pools for
+PAYMENT_HTTP_POOL_MAXSIZE = int(os.getenv('PAYMENT_HTTP_POOL_MAXSIZE', 10)) #  connections kept alive per gateway host
+PAYMENT_HTTP_POOL_BLOCK = os.getenv('PAYMENT_HTTP_POOL_BLOCK', 'False') == 'True' #  True makes POOL_MAXSIZE a hard per-host connection limit
+PAYMENT_HTTP_CONNECT_TIMEOUT = float(os.getenv('PAYMENT_HTTP_CONNECT_TIMEOUT', 3.05))
+PAYMENT_HTTP_READ_TIMEOUT = float(os.getenv('PAYMENT_HTTP_READ_TIMEOUT', 15))
+PAYMENT_HTTP_MAX_RETRIES = int(os.getenv('PAYMENT_HTTP_MAX_RETRIES', 2))
+PAYMENT_HTTP_BACKOFF_FACTOR = float(os.getenv('PAYMENT_HTTP_BACKOFF_FACTOR', 0.3))
+
+# Gateway circuit breakers and bulkheads (see payments/resilience.py)
+PAYMENT_CIRCUIT_BREAKER_FAILURES = int(os.getenv('PAYMENT_CIRCUIT_BREAKER_FAILURES', 5)) #  failed calls within the window that open a breaker
+PAYMENT_CIRCUIT_BREAKER_WINDOW = 60 #  seconds
+PAYMENT_CIRCUIT_BREAKER_RESET_TIMEOUT = int(os.getenv('PAYMENT_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)) #  seconds open before a probe call
+PAYMENT_CIRCUIT_BREAKER_CACHE_ALIAS = os.getenv('PAYMENT_CIRCUIT_BREAKER_CACHE_ALIAS', 'default') #  a shared cache shares breaker state between processes
+PAYMENT_BULKHEAD_SIZE = int(os.getenv('PAYMENT_BULKHEAD_SIZE', PAYMENT_HTTP_POOL_MAXSIZE)) #  max calls in flight per gateway per process
+PAYMENT_BULKHEAD_TIMEOUT = float(os.getenv('PAYMENT_BULKHEAD_TIMEOUT', 1)) #  seconds to wait for a free slot
+
+# Webhook ingestion queue (see store/webhooks.py and manage.py process_webhooks)
+PAYMENT_WEBHOOK_QUEUE = os.getenv('PAYMENT_WEBHOOK_QUEUE', 'False') == 'True' #  False processes webhooks inline in the request
+PAYMENT_WEBHOOK_BATCH_SIZE = int(os.getenv('PAYMENT_WEBHOOK_BATCH_SIZE', 100))
+PAYMENT_WEBHOOK_MAX_ATTEMPTS = int(os.getenv('PAYMENT_WEBHOOK_MAX_ATTEMPTS', 5))
+PAYMENT_WEBHOOK_VISIBILITY_TIMEOUT = int(os.getenv('PAYMENT_WEBHOOK_VISIBILITY_TIMEOUT', 300)) #  seconds before a claimed event is handed to another worker
+
+# Webhook redeliveries are recognized by their event key for one to two filter periods and answered without processing (see payments/idempotency.py)
+PAYMENT_WEBHOOK_DEDUP = os.getenv('PAYMENT_WEBHOOK_DEDUP', 'False') == 'True' #  a filter hit is answered without checking the database, see payments/idempotency.py
+PAYMENT_WEBHOOK_DEDUP_TTL = int(os.getenv('PAYMENT_WEBHOOK_DEDUP_TTL', 2 * 3600)) #  seconds processed event keys are kept in the table. Processes only read back keys from the last filter period, so keeping them longer than two periods does not extend deduplication
+PAYMENT_WEBHOOK_DEDUP_FILTER_CAPACITY = int(os.getenv('PAYMENT_WEBHOOK_DEDUP_FILTER_CAPACITY', 100000)) #  keys per in-memory filter generation, about 350 KB each at the default error rate
+PAYMENT_WEBHOOK_DEDUP_FILTER_ERROR_RATE = float(os.getenv('PAYMENT_WEBHOOK_DEDUP_FILTER_ERROR_RATE', 1e-6)) #  chance of a new event being taken for a redelivery
+PAYMENT_WEBHOOK_DEDUP_FILTER_PERIOD = int(os.getenv('PAYMENT_WEBHOOK_DEDUP_FILTER_PERIOD', 3600)) #  seconds between filter generations
+PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL = float(os.getenv('PAYMENT_WEBHOOK_DEDUP_SYNC_INTERVAL', 5)) #  seconds between exchanges of processed keys with the other processes
+
+# Settled payments moved out of the database into compressed files by manage.py archive_payments (see payments/archive.py)
+PAYMENT_ARCHIVE_DIR = os.getenv('PAYMENT_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+PAYMENT_ARCHIVE_AFTER_MONTHS = int(os.getenv('PAYMENT_ARCHIVE_AFTER_MONTHS', 6)) #  whole months before the current one kept in the database
+PAYMENT_ARCHIVE_FORMAT = os.getenv('PAYMENT_ARCHIVE_FORMAT', '') #  'parquet' (needs pyarrow) or 'jsonl'. Empty picks parquet when pyarrow is installed
+PAYMENT_ARCHIVE_FILTER_ERROR_RATE = float(os.getenv('PAYMENT_ARCHIVE_FILTER_ERROR_RATE', 0.01)) #  chance of an archive file being read for a reference it does not hold
+
+# Daily totals per processor and status, updated as payments settle and read by the daily total exports (see payments/rollups.py). Totals of days before they were turned on are missing until manage.py backfill_rollups has run
+PAYMENT_ROLLUPS = os.getenv('PAYMENT_ROLLUPS', 'False') == 'True'
+PAYMENT_ROLLUP_SHARDS = int(os.getenv('PAYMENT_ROLLUP_SHARDS', 4)) #  rows each total is spread over, so that concurrent settlements do not wait on one row
+
+# Gateway verification result cache (see payments/verification.py). 'memory' is per process, 'django' uses CACHES[PAYMENT_VERIFICATION_CACHE_ALIAS], '' disables it
+PAYMENT_VERIFICATION_CACHE = os.getenv('PAYMENT_VERIFICATION_CACHE', 'memory')
+PAYMENT_VERIFICATION_CACHE_ALIAS = os.getenv('PAYMENT_VERIFICATION_CACHE_ALIAS', 'default')
+PAYMENT_VERIFICATION_CACHE_SIZE = int(os.getenv('PAYMENT_VERIFICATION_CACHE_SIZE', 10000))
+PAYMENT_VERIFICATION_CACHE_PENDING_TTL = int(os.getenv('PAYMENT_VERIFICATION_CACHE_PENDING_TTL', 5)) #  seconds to cache results that can still change
+
+# payment_callback redirects to the payment status page at once and verifies unprocessed payments in the background (see store/callbacks.py). False verifies inline, before redirecting
+PAYMENT_CALLBACK_BACKGROUND_VERIFY = os.getenv('PAYMENT_CALLBACK_BACKGROUND_VERIFY', 'True') == 'True'
+PAYMENT_CALLBACK_VERIFY_WORKERS = int(os.getenv('PAYMENT_CALLBACK_VERIFY_WORKERS', 4)) #  background verifications at once per process
+
+# Payment status page (see payments/status.py). Use a cache shared between processes (e.g. Redis) when running several
+PAYMENT_STATUS_CACHE_ALIAS = os.getenv('PAYMENT_STATUS_CACHE_ALIAS', 'default')
+PAYMENT_STATUS_CACHE_TTL = float(os.getenv('PAYMENT_STATUS_CACHE_TTL', 1)) #  seconds an unprocessed status is cached
+PAYMENT_STATUS_LONG_POLL_TIMEOUT = float(os.getenv('PAYMENT_STATUS_LONG_POLL_TIMEOUT', 10)) #  seconds a poll waits for a change. Holds a worker thread under WSGI
+PAYMENT_STATUS_POLL_INTERVAL = float(os.getenv('PAYMENT_STATUS_POLL_INTERVAL', 0.25)) #  seconds between status reads while waiting
+
+# Payment links initialized while the user is on the checkout page (see payments/links.py)
+PAYMENT_LINK_PREFETCH = os.getenv('PAYMENT_LINK_PREFETCH', 'False') == 'True'
+PAYMENT_LINK_TTL = int(os.getenv('PAYMENT_LINK_TTL', 600)) #  seconds a link is handed out for after it is made
+PAYMENT_LINK_PREFETCH_WORKERS = int(os.getenv('PAYMENT_LINK_PREFETCH_WORKERS', 4)) #  links made at once per process
+
+# Side effects of payment transitions, written to the transactional outbox with the status change and delivered by manage.py dispatch_outbox (see payments/outbox.py)
+PAYMENT_OUTBOX_HANDLERS = { #  dotted paths of the handlers of each event, e.g. 'payment.completed': ['store.side_effects.send_receipt']
+    'payment.completed': [],
+    'payment.failed': [],
+}
+PAYMENT_OUTBOX_BATCH_SIZE = int(os.getenv('PAYMENT_OUTBOX_BATCH_SIZE', 100))
+PAYMENT_OUTBOX_MAX_ATTEMPTS = int(os.getenv('PAYMENT_OUTBOX_MAX_ATTEMPTS', 10)) #  attempts before a message is moved to the dead letters
+PAYMENT_OUTBOX_RETRY_DELAY = float(os.getenv('PAYMENT_OUTBOX_RETRY_DELAY', 10)) #  seconds before the first retry, doubled on every retry up to an hour
+PAYMENT_OUTBOX_VISIBILITY_TIMEOUT = int(os.getenv('PAYMENT_OUTBOX_VISIBILITY_TIMEOUT', 300)) #  seconds before a claimed message is handed to another dispatcher
+PAYMENT_OUTBOX_CONCURRENCY = int(os.getenv('PAYMENT_OUTBOX_CONCURRENCY', 4)) #  deliveries in flight per handler per dispatcher process
+PAYMENT_OUTBOX_HANDLER_CONCURRENCY = {} #  per handler overrides of PAYMENT_OUTBOX_CONCURRENCY, by dotted path
+
+# Metrics served at /metrics (see payments/metrics.py). Set PAYMENT_METRICS_DIR when running several worker processes
+PAYMENT_METRICS_DIR = os.getenv('PAYMENT_METRICS_DIR') or None #  None keeps every process's metrics to itself
+PAYMENT_METRICS_FLUSH_INTERVAL = float(os.getenv('PAYMENT_METRICS_FLUSH_INTERVAL', 5)) #  seconds between writes to PAYMENT_METRICS_DIR
+PAYMENT_METRICS_TOKEN = os.getenv('PAYMENT_METRICS_TOKEN') #  when set, /metrics requires 'Authorization: Bearer <token>'
+
+# Structured JSON logs for the payments and store apps, written to stderr by a background thread (see payments/logs.py)
+PAYMENT_LOG_LEVEL = os.getenv('PAYMENT_LOG_LEVEL', 'INFO')
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'payments.logs.JSONFormatter'},
+    },
+    'handlers': {
+        'payments': {
+            'class': 'payments.logs.NonBlockingHandler',
+            'formatter': 'json',
+            'queue_size': int(os.getenv('PAYMENT_LOG_QUEUE_SIZE', 10000)), #  records dropped beyond this
+        },
+    },
+    'loggers': {
+        'payments': {'handlers': ['payments'], 'level': PAYMENT_LOG_LEVEL, 'propagate': False},
+        'store': {'handlers': ['payments'], 'level': PAYMENT_LOG_LEVEL, 'propagate': False},
+    },
+}
@@ -17,7 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from payments.views import metrics
+
 urlpatterns = [
+    path('metrics', metrics, name='metrics'),
     path('admin/', admin.site.urls),
     path('', include('store.urls')),
+    path('payments/', include('payments.urls')),
 ]
@@ -1,5 +1,12 @@
 from django.contrib import admin
-from payments.models import Payment
+from payments.models import DeadLetter, OutboxMessage, Payment, PaymentEvent, PaymentLink, PaymentRollup, SeenWebhookEvent, WebhookEvent
 
 admin.site.register(Payment)
+admin.site.register(WebhookEvent)
+admin.site.register(PaymentEvent)
+admin.site.register(PaymentLink)
+admin.site.register(OutboxMessage)
+admin.site.register(DeadLetter)
+admin.site.register(SeenWebhookEvent)
+admin.site.register(PaymentRollup)
 # Register your models here.
@@ -0,0 +1,94 @@
+'''
+Background verification for payment callbacks.
+
+With PAYMENT_CALLBACK_BACKGROUND_VERIFY on, payment_callback does not wait
+for the gateway: it redirects to the payment status page at once and, if
+the payment is still unprocessed, hands its verification to the thread
+pool here. The webhook usually settles the payment first; a verification
+that finds the payment settled when it starts skips the gateway call, and
+when both race the conditional UPDATE in payments/transitions.py picks
+the winner. Payments whose verification is lost with its process are
+left to reconcile_payments.
+'''
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from payments import ledger, verification
+from payments.factory import get_payment_processor_for
+from payments.models import Payment, PaymentEventSource, PaymentStatus
+
+from store.utils import OnlineTransactionStatus
+
+from .services import post_failed_payment_actions, post_successful_payment_actions
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = set() #  references being verified
+_in_flight_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.PAYMENT_CALLBACK_VERIFY_WORKERS, thread_name_prefix='payment-callbacks')
+    return _executor
+
+
+def settle_by_verification(reference):
+    '''
+    Verifies the payment with [reference] with its gateway and settles it,
+    unless it is unknown or already settled. Returns the result of the
+    successful or failed payment actions, or None if nothing was settled.
+    Failures to settle it are raised.
+    '''
+    payment = Payment.objects.filter(reference=reference).first()
+    if payment is None or payment.status != PaymentStatus.UNPROCESSED:
+        return None
+
+    payload = verification.verify_payment(get_payment_processor_for(payment), reference)
+    if not payload:
+        logger.error("Unable to verify payment.", extra={'reference': reference})
+        return None
+
+    ledger.record_event(payment, PaymentEventSource.VERIFICATION, payload)
+    payment_date = payload["data"].get("payment_date") or timezone.now()
+    if payload["data"]["status"] == OnlineTransactionStatus.SUCCESSFUL:
+        return post_successful_payment_actions(payment, payment_date, raise_errors=True)
+    if payload["data"]["status"] == OnlineTransactionStatus.FAILED:
+        return post_failed_payment_actions(payment, payment_date, raise_errors=True)
+    return None #  still pending at the gateway
+
+
+def _verify(reference):
+    try:
+        settle_by_verification(reference)
+    except Exception:
+        logger.exception("Failed to verify payment in the background", extra={'reference': reference})
+    finally:
+        with _in_flight_lock:
+            _in_flight.discard(reference)
+        close_old_connections()
+
+
+def verify_in_background(reference):
+    '''
+    Starts verifying the payment with [reference] unless it is already being
+    verified. Returns whether it did.
+    '''
+    with _in_flight_lock:
+        if reference in _in_flight:
+            return False
+        _in_flight.add(reference)
+    _get_executor().submit(_verify, reference)
+    return True
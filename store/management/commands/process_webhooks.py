@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from payments import transport
+from store.webhooks import drain_webhook_events, webhook_queue_stats
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.value += n
+
+
+def _drain_loop(stop, counter, batch_size, poll_interval, once):
+    try:
+        while not stop.is_set():
+            try:
+                drained = drain_webhook_events(batch_size)
+            except Exception:
+                logger.exception("Webhook worker failed to drain a batch")
+                stop.wait(poll_interval)
+                continue
+            counter.add(drained)
+            if not drained:
+                if once:
+                    break
+                stop.wait(poll_interval)
+    finally:
+        connections.close_all() #  connections are per thread
+
+
+def run_worker_pool(threads, batch_size, poll_interval, once, report_interval, write):
+    '''
+    Runs [threads] drain loops in this process and reports the drain rate and
+    queue depth every [report_interval] seconds through [write].
+    '''
+    stop = threading.Event()
+    counter = _Counter()
+    workers = [
+        threading.Thread(target=_drain_loop, args=(stop, counter, batch_size, poll_interval, once), daemon=True)
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+
+    started = last_report = time.monotonic()
+    last_value = 0
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(0.5)
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                rate = (counter.value - last_value) / (now - last_report)
+                stats = webhook_queue_stats()
+                connections.close_all()
+                write(
+                    f"[pid {os.getpid()}] drained={counter.value} rate={rate:.1f}/s "
+                    f"pending={stats['pending']} processing={stats['processing']} failed={stats['failed']} "
+                    f"oldest_pending_age={stats['oldest_pending_age']:.1f}s"
+                )
+                last_report, last_value = now, counter.value
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+    elapsed = time.monotonic() - started
+    write(f"[pid {os.getpid()}] drained {counter.value} events in {elapsed:.1f}s ({counter.value / elapsed if elapsed else 0:.1f}/s)")
+
+
+class Command(BaseCommand):
+    help = 'Drains the webhook queue (PAYMENT_WEBHOOK_QUEUE) with a pool of worker processes and threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='Number of worker processes')
+        parser.add_argument('--threads', type=int, default=4, help='Number of drain threads per process')
+        parser.add_argument('--batch-size', type=int, default=settings.PAYMENT_WEBHOOK_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--report-interval', type=float, default=30.0, help='Seconds between drain rate reports')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+        parser.add_argument('--stats', action='store_true', help='Print the queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in webhook_queue_stats().items():
+                self.stdout.write(f"{name}: {value}")
+            return
+
+        pool_args = (
+            options['threads'], options['batch_size'], options['poll_interval'],
+            options['once'], options['report_interval'], self.stdout.write,
+        )
+        if options['processes'] <= 1:
+            run_worker_pool(*pool_args)
+            return
+
+        # children must not inherit the parent's database or gateway sockets
+        connections.close_all()
+        transport.close_adapters()
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=run_worker_pool, args=pool_args) for _ in range(options['processes'])]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
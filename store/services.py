@@ -0,0 +1,76 @@
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from payments import transitions
+from payments.models import PaymentStatus
+
+from store.utils import MessageTypes
+
+
+logger = logging.getLogger(__name__)
+
+
+ALREADY_PROCESSED_MESSAGE = 'That payment has already been processed'
+
+
+ERROR_MESSAGE = 'Oops. An error occurred. Please report the issue to the developers.'
+
+
+def post_successful_payment_actions(payment, date, request=None, raise_errors=False):
+    '''
+    Completes [payment]. If a concurrent callback or webhook completed it
+    first, nothing else is done and an info result is returned.
+
+    A failure to complete it is returned as an error result for the
+    callback page to show, or raised if [raise_errors], for callers that
+    must not report the payment as handled (webhooks, which the gateway
+    then redelivers, and the webhook queue, which retries).
+    '''
+
+    try:
+        with transaction.atomic():
+
+            if not transitions.transition(payment, PaymentStatus.COMPLETED, date):
+                return {'status': MessageTypes.INFO.value, 'message': ALREADY_PROCESSED_MESSAGE, 'payment': payment}
+
+            # the transition wrote the outbox messages of the handlers subscribed to
+            # 'payment.completed' in PAYMENT_OUTBOX_HANDLERS (receipt email, enrollment...),
+            # so slow side effects are delivered by manage.py dispatch_outbox, not here
+            return {'status':MessageTypes.SUCCESS.value, 'message': 'Payment processed successfully', 'payment': payment}
+
+    except Exception:
+        if raise_errors:
+            raise
+        logger.exception("Failed to complete payment", extra={'reference': payment.reference})
+        return {'status': MessageTypes.ERROR.value, 'message': ERROR_MESSAGE, 'payment': payment}
+
+def post_failed_payment_actions(payment, date, request=None, raise_errors=False):
+    '''
+    Fails [payment], see post_successful_payment_actions().
+    '''
+
+    try:
+        with transaction.atomic():
+            if not transitions.transition(payment, PaymentStatus.FAILED, date):
+                return {'status': MessageTypes.INFO.value, 'message': ALREADY_PROCESSED_MESSAGE, 'payment': payment}
+            return {'status': MessageTypes.ERROR.value, 'message': 'Oops. Payment was unsuccessful.', 'payment':payment}
+    except Exception:
+        if raise_errors:
+            raise
+        logger.exception("Failed to fail payment", extra={'reference': payment.reference})
+        return {'status': MessageTypes.ERROR.value, 'message': ERROR_MESSAGE, 'payment':payment}
+
+
+def handle_webhook_payment(payment, event, request=None):
+    '''
+    Applies a successful-payment webhook [event] (a GatewayEvent) to [payment].
+    Used by the webhook view and by the webhook queue workers. Failures are
+    raised, so that the event is retried.
+    '''
+    if payment.status == PaymentStatus.UNPROCESSED:
+        logger.info("Processing payment via webhook")
+        payment_date = event.payment_date or timezone.now()
+        return post_successful_payment_actions(payment, payment_date, request, raise_errors=True)
+    logger.info("payment_webhook [charge.success] - payment already completed")
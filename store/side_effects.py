@@ -0,0 +1,30 @@
+'''
+Side effects of settled payments, delivered from the payment outbox (see
+payments/outbox.py). Subscribe a handler to a payment event by adding its
+dotted path to PAYMENT_OUTBOX_HANDLERS, e.g.
+
+    PAYMENT_OUTBOX_HANDLERS = {
+        'payment.completed': ['store.side_effects.send_receipt'],
+        'payment.failed': [],
+    }
+
+Handlers run in `manage.py dispatch_outbox`, outside the request and its
+transaction. Raising makes the outbox retry the message later.
+'''
+import logging
+
+from payments.models import Payment
+
+
+logger = logging.getLogger(__name__)
+
+
+def send_receipt(message):
+    '''
+    Sends the receipt of a completed payment.
+    '''
+    payment = Payment.objects.select_related('user').get(pk=message.payment_id)
+    # You can send transaction successful email to payment.user.email here, e.g. with
+    # django.core.mail.send_mail (message.id is unique to this receipt if the mail
+    # service takes an idempotency key)
+    logger.info("Receipt sent", extra={'reference': payment.reference, 'outbox_message': message.id})
@@ -1,3 +1,331 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import logging
 
-# Create your tests here.
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import OperationalError
+from django.test import AsyncRequestFactory, Client, TestCase, override_settings
+from django.utils import timezone
+
+from benchmarks.simulators import Behaviour, PaystackSimulator
+from payments import idempotency, paystack, signatures, verification
+from payments.models import Payment, PaymentEventSource, PaymentStatus, WebhookEvent, WebhookEventStatus
+
+from store import callbacks, views
+from store.services import handle_webhook_payment, post_failed_payment_actions, post_successful_payment_actions
+from store.utils import MessageTypes, OnlineTransactionStatus
+from store.webhooks import claim_webhook_events, drain_webhook_events, enqueue_webhook_event, webhook_queue_stats
+
+
+SECRET_KEY = 'sk_test_store'
+
+
+def paystack_webhook(reference, amount=40000):
+    '''
+    Returns (body, headers) of a Paystack charge.success webhook for [reference], signed with SECRET_KEY.
+    '''
+    body = json.dumps({'event': 'charge.success', 'data': {
+        'status': 'success', 'reference': reference, 'amount': amount, 'paid_at': timezone.now().isoformat(),
+    }}).encode()
+    return body, {'X-Paystack-Signature': hmac.new(SECRET_KEY.encode(), body, hashlib.sha512).hexdigest()}
+
+
+class PaymentTestCase(TestCase):
+
+    def setUp(self):
+        logging.disable(logging.INFO) #  expected errors are checked with assertLogs
+        self.addCleanup(logging.disable, logging.NOTSET)
+        for cache in caches.all(): #  cached statuses and breakers of earlier tests
+            cache.clear()
+        self.user = User.objects.create_user(username='customer', email='customer@example.com')
+        verifier = signatures.HMACSignatureVerifier([SECRET_KEY], hashlib.sha512)
+        patcher = mock.patch.object(paystack, 'WEBHOOK_VERIFIER', verifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_payment(self, reference='ref-1', status=PaymentStatus.UNPROCESSED, processor='paystack', **fields):
+        return Payment.objects.create(user=self.user, amount=40000, reference=reference, status=status, processor=processor, **fields)
+
+
+def failing_outbox():
+    return mock.patch('payments.outbox.enqueue', side_effect=OperationalError('database is locked'))
+
+
+class PaymentActionErrorTests(PaymentTestCase):
+
+    def test_callback_gets_an_error_result(self):
+        payment = self.make_payment()
+        with failing_outbox(), self.assertLogs('store.services', 'ERROR'):
+            result = post_successful_payment_actions(payment, timezone.now())
+        self.assertEqual(result['status'], MessageTypes.ERROR.value)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+
+    def test_failures_are_raised_when_asked(self):
+        payment = self.make_payment()
+        with failing_outbox():
+            with self.assertRaises(OperationalError):
+                post_failed_payment_actions(payment, timezone.now(), raise_errors=True)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+
+    def test_webhook_failures_are_raised(self):
+        payment = self.make_payment()
+        event = paystack.PaystackProcessor().decode_event(paystack_webhook(payment.reference)[0])
+        with failing_outbox():
+            with self.assertRaises(OperationalError):
+                handle_webhook_payment(payment, event)
+
+    def test_queue_retries_events_that_failed(self):
+        payment = self.make_payment()
+        body, _ = paystack_webhook(payment.reference)
+        enqueue_webhook_event(paystack.PaystackProcessor().decode_event(body), body)
+
+        with failing_outbox(), self.assertLogs('store.webhooks', 'ERROR'):
+            self.assertEqual(drain_webhook_events(), 1)
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEventStatus.PENDING)
+        self.assertIn('OperationalError', webhook_event.last_error)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+        self.assertFalse(payment.events.exists())
+
+        self.assertEqual(drain_webhook_events(), 1)
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEventStatus.DONE)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+        self.assertEqual(payment.events.count(), 1)
+
+
+@override_settings(PAYMENT_WEBHOOK_DEDUP=True, PAYMENT_WEBHOOK_QUEUE=False, PAYMENT_ASYNC_VIEWS=False)
+class WebhookDedupTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        idempotency._seen = None
+        self.addCleanup(setattr, idempotency, '_seen', None)
+        self.client = Client(raise_request_exception=False)
+
+    def deliver(self, body, headers):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/payment_webhook/paystack/', body, content_type='application/json', headers=headers)
+
+    def test_failed_delivery_is_not_taken_for_a_redelivery(self):
+        payment = self.make_payment()
+        body, headers = paystack_webhook(payment.reference)
+
+        with failing_outbox(), self.assertLogs('django.request', 'ERROR'):
+            response = self.deliver(body, headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+
+        response = self.deliver(body, headers)
+        self.assertEqual(response.content, b'Webhook processed successfully')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+
+        response = self.deliver(body, headers)
+        self.assertEqual(response.content, b'Webhook already processed')
+
+    def test_malformed_events_are_refused(self):
+        payment = self.make_payment()
+        body = json.dumps({'event': 'charge.success', 'data': {'reference': payment.reference, 'paid_at': 'yesterday'}}).encode()
+        headers = {'X-Paystack-Signature': hmac.new(SECRET_KEY.encode(), body, hashlib.sha512).hexdigest()}
+        with self.assertLogs('store.views', 'WARNING'):
+            self.assertEqual(self.deliver(body, headers).status_code, 400)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+        self.assertFalse(payment.events.exists())
+
+    def test_unknown_payment_is_not_marked_processed(self):
+        body, headers = paystack_webhook('unknown')
+        with self.assertLogs('store.views', 'ERROR'):
+            self.assertEqual(self.deliver(body, headers).status_code, 404)
+        payment = self.make_payment(reference='unknown')
+        self.assertEqual(self.deliver(body, headers).content, b'Webhook processed successfully')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+
+
+@override_settings(PAYMENT_WEBHOOK_QUEUE=False, PAYMENT_WEBHOOK_DEDUP=False)
+class AsyncViewTests(PaymentTestCase):
+
+    async def test_webhook(self):
+        payment = await Payment.objects.acreate(user=self.user, amount=40000, reference='ref-1', processor='paystack')
+        body, headers = paystack_webhook(payment.reference)
+        request = AsyncRequestFactory().post('/payment_webhook/paystack/', body, content_type='application/json', headers=headers)
+
+        response = await views.apayment_webhook(request, 'paystack')
+
+        self.assertEqual(response.content, b'Webhook processed successfully')
+        self.assertEqual((await Payment.objects.aget(pk=payment.pk)).status, PaymentStatus.COMPLETED)
+
+    async def test_webhook_with_a_bad_signature(self):
+        body, _ = paystack_webhook('ref-1')
+        request = AsyncRequestFactory().post('/payment_webhook/paystack/', body, content_type='application/json',
+                                             headers={'X-Paystack-Signature': '0' * 128})
+        with self.assertLogs('store.views', 'WARNING'):
+            self.assertEqual((await views.apayment_webhook(request, 'paystack')).status_code, 400)
+
+    async def test_status_poll_answers_once_settled(self):
+        payment = await Payment.objects.acreate(user=self.user, amount=40000, reference='ref-1', processor='paystack', status=PaymentStatus.COMPLETED)
+        request = AsyncRequestFactory().get(f'/payment_status/{payment.reference}/poll/', {'status': PaymentStatus.UNPROCESSED})
+        request.user = self.user
+        response = await views.apayment_status_poll(request, payment.reference)
+        self.assertEqual(json.loads(response.content)['status'], PaymentStatus.COMPLETED)
+
+    async def test_verify_on_the_async_client(self):
+        simulator = PaystackSimulator(Behaviour(latency=0, distribution='fixed', failed_rate=0)).start()
+        self.addCleanup(simulator.stop)
+        with mock.patch.object(paystack, 'URL_ROOT', simulator.url):
+            payload = await paystack.PaystackProcessor().averify_payment('ref-1')
+        self.assertEqual(payload['data']['status'], OnlineTransactionStatus.SUCCESSFUL)
+        self.assertEqual(simulator.stats['verify', 200], 1)
+
+
+@override_settings(PAYMENT_WEBHOOK_QUEUE=True, PAYMENT_WEBHOOK_DEDUP=False, PAYMENT_ASYNC_VIEWS=False)
+class WebhookQueueTests(PaymentTestCase):
+
+    def enqueue(self, reference):
+        body, _ = paystack_webhook(reference)
+        enqueue_webhook_event(paystack.PaystackProcessor().decode_event(body), body)
+
+    def test_view_only_queues_the_event(self):
+        payment = self.make_payment()
+        body, headers = paystack_webhook(payment.reference)
+        for _ in range(2):
+            response = self.client.post('/payment_webhook/paystack/', body, content_type='application/json', headers=headers)
+            self.assertEqual(response.content, b'Webhook received')
+        self.assertEqual(WebhookEvent.objects.count(), 1) #  the redelivery is dropped
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+
+        self.assertEqual(drain_webhook_events(), 1)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+        self.assertEqual(drain_webhook_events(), 0)
+
+    def test_events_are_claimed_once(self):
+        for i in range(3):
+            self.enqueue(f'ref-{i}')
+        first, second = claim_webhook_events(2), claim_webhook_events(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({event.id for event in first} & {event.id for event in second})
+        self.assertEqual(claim_webhook_events(2), [])
+        self.assertEqual(webhook_queue_stats()['processing'], 3)
+
+    @override_settings(PAYMENT_WEBHOOK_VISIBILITY_TIMEOUT=60)
+    def test_abandoned_claims_are_claimed_again(self):
+        self.enqueue('ref-1')
+        claim_webhook_events(10)
+        WebhookEvent.objects.update(claimed_at=timezone.now() - timedelta(seconds=61))
+        event, = claim_webhook_events(10)
+        self.assertEqual(event.attempts, 2)
+
+    def test_events_are_in_the_ledger_of_the_payments_they_settle(self):
+        payment = self.make_payment()
+        self.enqueue(payment.reference)
+        with mock.patch('payments.ledger.record_events', side_effect=OperationalError('disk I/O error')), self.assertLogs('store.webhooks', 'ERROR'):
+            drain_webhook_events()
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.UNPROCESSED)
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEventStatus.PENDING)
+
+        drain_webhook_events()
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+        self.assertEqual(list(payment.events.values_list('source', flat=True)), [PaymentEventSource.WEBHOOK])
+
+    def test_unknown_payments_fail_at_once(self):
+        self.enqueue('unknown')
+        drain_webhook_events()
+        event = WebhookEvent.objects.get()
+        self.assertEqual((event.status, event.last_error), (WebhookEventStatus.FAILED, 'Payment does not exist'))
+        self.assertEqual(webhook_queue_stats()['failed'], 1)
+
+    @override_settings(PAYMENT_WEBHOOK_MAX_ATTEMPTS=2)
+    def test_failing_events_give_up_after_max_attempts(self):
+        self.make_payment()
+        self.enqueue('ref-1')
+        with failing_outbox(), self.assertLogs('store.webhooks', 'ERROR'):
+            drain_webhook_events()
+            self.assertEqual(WebhookEvent.objects.get().status, WebhookEventStatus.PENDING)
+            drain_webhook_events()
+        self.assertEqual(WebhookEvent.objects.get().status, WebhookEventStatus.FAILED)
+
+
+@override_settings(PAYMENT_VERIFICATION_CACHE='', PAYMENT_CALLBACK_BACKGROUND_VERIFY=True)
+class CallbackTests(PaymentTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(verification, '_verification_cache', None) #  verify with the gateway every time
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def simulate(self, **behaviour):
+        simulator = PaystackSimulator(Behaviour(latency=0, distribution='fixed', **behaviour)).start()
+        self.addCleanup(simulator.stop)
+        patcher = mock.patch.object(paystack, 'URL_ROOT', simulator.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return simulator
+
+    def test_settles_by_verification(self):
+        self.simulate(failed_rate=0)
+        payment = self.make_payment()
+        result = callbacks.settle_by_verification(payment.reference)
+        self.assertEqual(result['status'], MessageTypes.SUCCESS.value)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.COMPLETED)
+        self.assertEqual(payment.events.get().source, PaymentEventSource.VERIFICATION)
+
+    def test_failed_payments(self):
+        self.simulate(failed_rate=1)
+        payment = self.make_payment()
+        callbacks.settle_by_verification(payment.reference)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, PaymentStatus.FAILED)
+
+    def test_pending_unknown_and_settled_payments_are_left(self):
+        simulator = self.simulate(failed_rate=0, pending_rate=1)
+        pending = self.make_payment()
+        self.make_payment(reference='ref-2', status=PaymentStatus.COMPLETED)
+        self.assertIsNone(callbacks.settle_by_verification(pending.reference))
+        self.assertEqual(Payment.objects.get(pk=pending.pk).status, PaymentStatus.UNPROCESSED)
+        self.assertIsNone(callbacks.settle_by_verification('ref-2'))
+        self.assertIsNone(callbacks.settle_by_verification('unknown'))
+        self.assertEqual(simulator.stats['verify', 200], 1) #  only the unprocessed payment is verified
+
+    def test_payments_are_verified_once_at_a_time(self):
+        with mock.patch.object(callbacks, '_get_executor') as executor, mock.patch.object(callbacks, '_in_flight', set()):
+            self.assertTrue(callbacks.verify_in_background('ref-1'))
+            self.assertFalse(callbacks.verify_in_background('ref-1'))
+            self.assertEqual(executor.return_value.submit.call_count, 1)
+            callbacks._verify('unknown') #  clears its own reference
+            callbacks._in_flight.discard('ref-1')
+            self.assertTrue(callbacks.verify_in_background('ref-1'))
+
+    def test_callback_redirects_at_once(self):
+        payment = self.make_payment()
+        with mock.patch.object(callbacks, 'verify_in_background') as verify:
+            response = self.client.get('/payment_callback/', {'reference': payment.reference})
+        self.assertRedirects(response, f'/payment_status/{payment.reference}/', fetch_redirect_response=False)
+        verify.assert_called_once_with(payment.reference)
+
+        Payment.objects.filter(pk=payment.pk).update(status=PaymentStatus.FAILED)
+        caches['default'].clear()
+        with mock.patch.object(callbacks, 'verify_in_background') as verify:
+            self.client.get('/payment_callback/', {'reference': payment.reference})
+        verify.assert_not_called()
+
+    def test_status_page(self):
+        payment = self.make_payment()
+        response = self.client.get(f'/payment_status/{payment.reference}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'payment_status.html')
+
+        Payment.objects.filter(pk=payment.pk).update(status=PaymentStatus.COMPLETED)
+        caches['default'].clear()
+        response = self.client.get(f'/payment_status/{payment.reference}/')
+        self.assertRedirects(response, f'/payment_confirmed/{payment.reference}/', fetch_redirect_response=False)
+
+    def test_status_page_of_someone_elses_payment(self):
+        other = User.objects.create_user(username='other', email='other@example.com')
+        payment = Payment.objects.create(user=other, amount=40000, reference='ref-9', processor='paystack')
+        response = self.client.get(f'/payment_status/{payment.reference}/')
+        self.assertRedirects(response, '/checkout/', fetch_redirect_response=False)
@@ -1,16 +1,31 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 
 app_name = 'store'
 
+if settings.PAYMENT_ASYNC_VIEWS:
+    payment_gateway_checkout = views.apayment_gateway_checkout
+    payment_callback = views.apayment_callback
+    payment_webhook = views.apayment_webhook
+    payment_status_poll = views.apayment_status_poll
+else:
+    payment_gateway_checkout = views.payment_gateway_checkout
+    payment_callback = views.payment_callback
+    payment_webhook = views.payment_webhook
+    payment_status_poll = views.payment_status_poll
+
 urlpatterns = [
     path('login/', views.login, name='login'),
     path('signup/', views.signup, name='signup'),
     path('checkout/', views.checkout, name='checkout'),
     path('payment_confirmed/<str:reference>/', views.payment_confirmed, name='payment_confirmed'),
-    path('payment_gateway_checkout/', views.payment_gateway_checkout, name='payment_gateway_checkout'),
-    path('payment_callback/', views.payment_callback, name='payment_callback'),
-    path('payment_webhook/', views.payment_webhook, name='payment_webhook'),
+    path('payment_gateway_checkout/', payment_gateway_checkout, name='payment_gateway_checkout'),
+    path('payment_callback/', payment_callback, name='payment_callback'),
+    path('payment_status/<str:reference>/', views.payment_status, name='payment_status'),
+    path('payment_status/<str:reference>/poll/', payment_status_poll, name='payment_status_poll'),
+    path('payment_webhook/', payment_webhook, name='payment_webhook'),
+    path('payment_webhook/<str:processor>/', payment_webhook, name='processor_payment_webhook'),
 
 ]
@@ -9,4 +9,5 @@ class MessageTypes(Enum):
     
 class OnlineTransactionStatus(Enum):
     SUCCESSFUL = 'successful'
-    FAILED = 'failed'
\ No newline at end of file
+    FAILED = 'failed'
+    PENDING = 'pending' #  still in progress at the gateway, may become successful or failed
\ No newline at end of file
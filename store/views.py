@@ -1,29 +1,40 @@
-import json
+import asyncio
 import logging
+import time
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.urls import reverse
-from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth import login as auth_login, authenticate
+from django.contrib.auth.views import redirect_to_login
+from django.utils import timezone
 
-from payments.factory import get_payment_processor
-from payments.models import Payment, PaymentStatus
-from payments.utils import generate_unique_reference
+from payments import idempotency, ledger, links, status as status_cache, verification
+from payments.events import MalformedEventError
+from payments.factory import get_payment_processor, get_payment_processor_for
+from payments.routing import get_router
+from payments.models import Payment, PaymentEventSource, PaymentStatus
+from payments.utils import save_with_unique_reference
 
 from store.utils import MessageTypes, OnlineTransactionStatus
 
+from . import callbacks
 from .forms import CustomSignupForm
-
-payment_processor = get_payment_processor()
+from .services import post_failed_payment_actions, post_successful_payment_actions
+from .webhooks import apply_webhook_event, enqueue_webhook_event
 
 logger = logging.getLogger(__name__)
 
+CHECKOUT_AMOUNT = 400 * 100 # Use the school fees amount here, in kobo
+STATUS_PAGE_WAIT = 120 #  seconds the payment status page waits for a settled status
+
 
 def login(request):
     if request.method == 'POST':
@@ -56,6 +67,8 @@ def checkout(request):
     # This view should have the button the user clicks to make payment
     # It could also contain form processing if you collect any additional info from them
     # If form is valid, render to the payment_gateway_checkout url
+    if settings.PAYMENT_LINK_PREFETCH and request.user.is_authenticated and request.user.email:
+        links.prefetch_link(request.user, CHECKOUT_AMOUNT, request.build_absolute_uri(reverse("store:payment_callback")))
     return render(request, 'checkout.html')
 
 def payment_confirmed(request, reference):
@@ -70,23 +83,88 @@ def payment_gateway_checkout(request):
             messages.error(request, "User has no email address")
             return redirect('store:checkout')
 
-        amount = 400 # Use the school fees amount here
+        started = time.perf_counter()
+        amount = CHECKOUT_AMOUNT
+
+        if settings.PAYMENT_LINK_PREFETCH:
+            link = links.claim_link(request.user, amount)
+            if link is not None:
+                links.observe_redirect('link', started)
+                return redirect(link.authorization_url)
+
+        router = get_router()
+        processor_name = router.choose()
+        if processor_name is None:
+            messages.error(request, "Cannot process payment at the moment.")
+            return redirect('store:checkout')
 
         # Initialize unprocessed payment to get reference for tracking payment
-        payment_processor = get_payment_processor()
         payment = Payment(
             user=request.user,
             amount=amount,
-            processor=payment_processor.name
+            processor=processor_name
+        )
+        save_with_unique_reference(payment)
+
+        callback_url = request.build_absolute_uri(reverse("store:payment_callback"))
+        payment_url = router.initialize_payment(
+            payment, request.user.email, callback_url)
+        if payment_url:
+            links.observe_redirect('gateway', started)
+            return redirect(payment_url)
+        messages.error(request, "Cannot process payment at the moment.")
+    return redirect('store:checkout')
+
+
+async def _aget_user(request):
+    # request.user is a lazy object that reads the session and user tables
+    # on first access, so it has to be resolved outside the event loop
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+async def apayment_gateway_checkout(request):
+    '''
+    Async version of payment_gateway_checkout, used when PAYMENT_ASYNC_VIEWS is on.
+    '''
+    user = await _aget_user(request)
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'store:login')
+
+    if request.method == "POST":
+
+        if not user.email:
+            messages.error(request, "User has no email address")
+            return redirect('store:checkout')
+
+        started = time.perf_counter()
+        amount = CHECKOUT_AMOUNT
+
+        if settings.PAYMENT_LINK_PREFETCH:
+            link = await sync_to_async(links.claim_link)(user, amount)
+            if link is not None:
+                links.observe_redirect('link', started)
+                return redirect(link.authorization_url)
+
+        router = get_router()
+        processor_name = await router.achoose()
+        if processor_name is None:
+            messages.error(request, "Cannot process payment at the moment.")
+            return redirect('store:checkout')
+
+        # Initialize unprocessed payment to get reference for tracking payment
+        payment = Payment(
+            user=user,
+            amount=amount,
+            processor=processor_name
         )
-        payment.reference = generate_unique_reference(
-            payment, char_length=8)
-        payment.save()
+        await sync_to_async(save_with_unique_reference)(payment)
 
         callback_url = request.build_absolute_uri(reverse("store:payment_callback"))
-        payment_url = payment_processor.initialize_payment(
-            request.user.email, amount, payment.reference, callback_url)
+        payment_url = await router.ainitialize_payment(
+            payment, user.email, callback_url)
         if payment_url:
+            links.observe_redirect('gateway', started)
             return redirect(payment_url)
         messages.error(request, "Cannot process payment at the moment.")
     return redirect('store:checkout')
@@ -102,100 +180,229 @@ def payment_callback(request):
 
     if request.method == 'GET' and 'reference' in request.GET:
         reference = request.GET.get("reference")
-        payload = payment_processor.verify_payment(reference)
+        if settings.PAYMENT_CALLBACK_BACKGROUND_VERIFY:
+            return _redirect_to_status(request, reference, status_cache.get_status(reference))
+        try:
+            payment = Payment.objects.get(reference=reference)
+        except Payment.DoesNotExist:
+            logger.error("payment_callback - payment does not exist")
+            messages.error(request, "Payment does not exist.")
+            return redirect('store:checkout')
 
+        payload = verification.verify_payment(get_payment_processor_for(payment), reference)
         if payload:
-            try:
-                payment = Payment.objects.get(reference=reference)
-                if payment.status == PaymentStatus.UNPROCESSED:
-                    logger.info("Processing payment via callback")
-                    print("Processing payment via callback")    
-                    if payload["data"]["status"] == OnlineTransactionStatus.SUCCESSFUL:
-                        result = _post_successful_payment_actions(payment, payload["data"]["payment_date"], request)
-                        if result['status'] == MessageTypes.SUCCESS.value:
-                            messages.success(request, result['message'])
-                            return redirect('store:payment_confirmed', reference=payment.reference)
-                        else:
-                            message = "Payment was successful but something went wrong."
-                            messages.error(request, message)
-                            logger.info(message)
-                            print(message)   
-                            return render(request, "payment-processing-result.html", result)
-                    elif payload["data"]["status"] == OnlineTransactionStatus.FAILED:
-                        message = "Payment was unsuccessful."
-                        messages.error(request, message)
-                        logger.info(message)
-                        print(message)   
-                        result = _post_failed_payment_actions(payment, payload["data"]["payment_date"], request)
-                        return render(request, "payment-processing-result.html", result)
-                else:
-                    logger.info("payment_callback - payment already processed")
-                    print("payment_callback - payment already processed")
-                    messages.info(request, "That payment has already been processed")
-
-            except Payment.DoesNotExist:
-                logger.error("payment_callback - payment does not exist")
-                messages.error(request, "Payment does not exist.")
-        else:
-            logger.error("Unable to verify payment.")
-            messages.error(request, "Unable to verify payment.")
+            return _handle_verified_payment(request, payment, payload)
+        logger.error("Unable to verify payment.")
+        messages.error(request, "Unable to verify payment.")
 
     return redirect('store:checkout')
 
 
-def _post_successful_payment_actions(payment, date, request):
+async def apayment_callback(request):
+    '''
+    Async version of payment_callback, used when PAYMENT_ASYNC_VIEWS is on.
+    '''
 
-    try:
-        with transaction.atomic():
+    if request.method == 'GET' and 'reference' in request.GET:
+        reference = request.GET.get("reference")
+        if settings.PAYMENT_CALLBACK_BACKGROUND_VERIFY:
+            return _redirect_to_status(request, reference, await status_cache.aget_status(reference))
+        try:
+            payment = await Payment.objects.aget(reference=reference)
+        except Payment.DoesNotExist:
+            logger.error("payment_callback - payment does not exist")
+            messages.error(request, "Payment does not exist.")
+            return redirect('store:checkout')
 
-            # get and update payment object
-            payment.date  = date
-            payment.status = PaymentStatus.COMPLETED
-            payment.save()
+        payload = await verification.averify_payment(get_payment_processor_for(payment), reference)
+        if payload:
+            return await sync_to_async(_handle_verified_payment)(request, payment, payload)
+        logger.error("Unable to verify payment.")
+        messages.error(request, "Unable to verify payment.")
 
-            # perform any other actions here that should happen after successful transaction
-            return {'status':MessageTypes.SUCCESS.value, 'message': 'Payment processed successfully', 'payment': payment}
-               
-        # You can send transaction successful email here
+    return redirect('store:checkout')
 
-    except Exception:
-        return {'status': MessageTypes.ERROR.value, 'message': 'Oops. An error occurred. Please report the issue to the developers.', 'payment': payment}    
 
-def _post_failed_payment_actions(payment, date, request):
-    
-    try:  
-        with transaction.atomic():  
-            payment.date = date                      
-            payment.status = PaymentStatus.FAILED
-            payment.save()
-            return {'status': MessageTypes.ERROR.value, 'message': 'Oops. Payment was unsuccessful.', 'payment':payment}
-    except Exception:
-        return {'status': MessageTypes.ERROR.value, 'message': 'Oops. An error occurred. Please report the issue to the developers.', 'payment':payment}    
+def _redirect_to_status(request, reference, entry):
+    if entry is None:
+        logger.error("payment_callback - payment does not exist")
+        messages.error(request, "Payment does not exist.")
+        return redirect('store:checkout')
+    if entry[1] == PaymentStatus.UNPROCESSED:
+        callbacks.verify_in_background(reference)
+    return redirect('store:payment_status', reference=reference)
+
+
+@login_required(login_url='store:login')
+def payment_status(request, reference):
+    '''
+    Status page the callback redirects to. Waits for an unprocessed payment
+    to be settled by polling payment_status_poll.
+    '''
+    entry = status_cache.get_status(reference)
+    if entry is None or entry[0] != request.user.pk:
+        messages.error(request, "Payment does not exist.")
+        return redirect('store:checkout')
+    if entry[1] == PaymentStatus.COMPLETED:
+        return redirect('store:payment_confirmed', reference=reference)
+    return render(request, 'payment_status.html', {
+        'reference': reference,
+        'status': entry[1],
+        'failed': entry[1] == PaymentStatus.FAILED,
+        'wait_seconds': STATUS_PAGE_WAIT,
+    })
+
+
+def _status_response(request, reference, entry):
+    if entry is None or entry[0] != request.user.pk:
+        return JsonResponse({'error': 'Payment does not exist'}, status=404)
+    status = entry[1]
+    return JsonResponse({
+        'reference': reference,
+        'status': status,
+        'settled': status != PaymentStatus.UNPROCESSED,
+        'url': reverse('store:payment_confirmed', args=[reference]) if status == PaymentStatus.COMPLETED else None,
+    })
+
+
+@login_required(login_url='store:login')
+def payment_status_poll(request, reference):
+    '''
+    Long-poll for the status of the payment with [reference]. Answers as
+    soon as its status differs from GET[status], the status the page knows,
+    or with the same status after PAYMENT_STATUS_LONG_POLL_TIMEOUT seconds.
+    '''
+    known = request.GET.get('status')
+    deadline = time.monotonic() + settings.PAYMENT_STATUS_LONG_POLL_TIMEOUT
+    while True:
+        entry = status_cache.get_status(reference)
+        if entry is None or entry[0] != request.user.pk or entry[1] != known or time.monotonic() >= deadline:
+            return _status_response(request, reference, entry)
+        time.sleep(settings.PAYMENT_STATUS_POLL_INTERVAL)
+
+
+async def apayment_status_poll(request, reference):
+    '''
+    Async version of payment_status_poll, used when PAYMENT_ASYNC_VIEWS is on.
+    Waiting polls only hold a task, not a thread.
+    '''
+    user = await _aget_user(request)
+    if not user.is_authenticated:
+        return redirect_to_login(request.get_full_path(), 'store:login')
+
+    known = request.GET.get('status')
+    deadline = time.monotonic() + settings.PAYMENT_STATUS_LONG_POLL_TIMEOUT
+    while True:
+        entry = await status_cache.aget_status(reference)
+        if entry is None or entry[0] != user.pk or entry[1] != known or time.monotonic() >= deadline:
+            return _status_response(request, reference, entry)
+        await asyncio.sleep(settings.PAYMENT_STATUS_POLL_INTERVAL)
+
+
+def _handle_verified_payment(request, payment, payload):
+    ledger.record_event(payment, PaymentEventSource.VERIFICATION, payload)
+    if payment.status == PaymentStatus.UNPROCESSED:
+        logger.info("Processing payment via callback")
+        if payload["data"]["status"] == OnlineTransactionStatus.SUCCESSFUL:
+            result = post_successful_payment_actions(payment, payload["data"].get("payment_date") or timezone.now(), request)
+            if result['status'] == MessageTypes.SUCCESS.value:
+                messages.success(request, result['message'])
+                return redirect('store:payment_confirmed', reference=payment.reference)
+            elif result['status'] == MessageTypes.INFO.value: #  completed by a concurrent webhook
+                messages.info(request, result['message'])
+                return redirect('store:checkout')
+            else:
+                message = "Payment was successful but something went wrong."
+                messages.error(request, message)
+                logger.info(message)
+                return render(request, "payment-processing-result.html", result)
+        elif payload["data"]["status"] == OnlineTransactionStatus.FAILED:
+            message = "Payment was unsuccessful."
+            messages.error(request, message)
+            logger.info(message)
+            result = post_failed_payment_actions(payment, payload["data"].get("payment_date") or timezone.now(), request)
+            return render(request, "payment-processing-result.html", result)
+        elif payload["data"]["status"] == OnlineTransactionStatus.PENDING:
+            messages.info(request, "Your payment is still being processed. Please check back shortly.")
+    else:
+        logger.info("payment_callback - payment already processed")
+        messages.info(request, "That payment has already been processed")
+    return redirect('store:checkout')
+
 
 @csrf_exempt
 @require_POST
-def payment_webhook(request):
-    
+def payment_webhook(request, processor=None):
+    '''
+    Webhook for [processor], or for the deployment's processor
+    (settings.PAYMENT_PROCESSOR) when it is not given.
+    '''
+    try:
+        payment_processor = get_payment_processor(processor)
+    except KeyError:
+        return HttpResponse('Unknown payment processor', status=404)
+
     if not payment_processor.verify_event(request):
         logger.warning("Event verification failed")
         return HttpResponse('Event verification failed', status=400)
 
-    payload = json.loads(request.body)
+    try:
+        event = payment_processor.decode_event(request.body)
+    except MalformedEventError as e:
+        logger.warning("Malformed event: %s", e, extra={'processor': payment_processor.name})
+        return HttpResponse('Malformed event', status=400)
 
-    # Handle [charge.success] event
-    if payload["event"] == "charge.success":
-        reference = payload["data"]["reference"]
-        try:
-            payment = Payment.objects.get(reference=reference)
+    if idempotency.is_duplicate(event):
+        return HttpResponse('Webhook already processed', status=200)
 
-            if payment.status == PaymentStatus.UNPROCESSED:
-                logger.info("Processing payment via webhook")
-                print("Processing payment via webhook")
-                _post_payment_action(payment, payload)
+    if settings.PAYMENT_WEBHOOK_QUEUE:
+        enqueue_webhook_event(event, request.body)
+        return HttpResponse('Webhook received', status=200)
 
-            logger.info("payment_webhook [charge.success] - payment already completed")
-        except Payment.DoesNotExist:
-            logger.error("payment_webhook [charge.success] - payment does not exist")
-            return HttpResponse('Payment does not exist', status=404)
+    try:
+        apply_webhook_event(event, request)
+    except Payment.DoesNotExist:
+        logger.error("payment_webhook [charge.success] - payment does not exist")
+        return HttpResponse('Payment does not exist', status=404)
     
-    return HttpResponse('Webhook processed successfully', status=200)
\ No newline at end of file
+    return HttpResponse('Webhook processed successfully', status=200)
+
+
+async def apayment_webhook(request, processor=None):
+    '''
+    Async version of payment_webhook, used when PAYMENT_ASYNC_VIEWS is on.
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        payment_processor = get_payment_processor(processor)
+    except KeyError:
+        return HttpResponse('Unknown payment processor', status=404)
+
+    if not await payment_processor.averify_event(request):
+        logger.warning("Event verification failed")
+        return HttpResponse('Event verification failed', status=400)
+
+    try:
+        event = payment_processor.decode_event(request.body)
+    except MalformedEventError as e:
+        logger.warning("Malformed event: %s", e, extra={'processor': payment_processor.name})
+        return HttpResponse('Malformed event', status=400)
+
+    if await idempotency.ais_duplicate(event):
+        return HttpResponse('Webhook already processed', status=200)
+
+    if settings.PAYMENT_WEBHOOK_QUEUE:
+        await sync_to_async(enqueue_webhook_event)(event, request.body)
+        return HttpResponse('Webhook received', status=200)
+
+    try:
+        await sync_to_async(apply_webhook_event)(event, request)
+    except Payment.DoesNotExist:
+        logger.error("payment_webhook [charge.success] - payment does not exist")
+        return HttpResponse('Payment does not exist', status=404)
+
+    return HttpResponse('Webhook processed successfully', status=200)
+
+apayment_webhook.csrf_exempt = True #  csrf_exempt() only wraps sync views on Django 4.2
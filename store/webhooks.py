@@ -0,0 +1,158 @@
+'''
+Database-backed webhook queue.
+
+With PAYMENT_WEBHOOK_QUEUE on, payment_webhook only checks the signature and
+stores the raw event here before answering the gateway, so slow processing
+can't turn into gateway retries. The workers started by
+`manage.py process_webhooks` claim events in batches and apply them.
+'''
+import logging
+import uuid
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from payments import idempotency, ledger
+from payments.events import MalformedEventError
+from payments.factory import get_payment_processor
+from payments.models import Payment, PaymentEventSource, WebhookEvent, WebhookEventStatus
+
+from store.services import handle_webhook_payment
+from store.utils import OnlineTransactionStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_webhook_event(event, body):
+    '''
+    Stores a verified webhook [body], decoded as [event], on the queue.
+    Duplicates of an already queued event are dropped by the unique
+    [event_key] index.
+    '''
+    webhook_event = WebhookEvent(
+        processor=event.processor,
+        event_key=event.key,
+        body=body.decode() if isinstance(body, bytes) else body,
+    )
+    WebhookEvent.objects.bulk_create([webhook_event], ignore_conflicts=True)
+
+
+def apply_webhook_event(event, request=None):
+    '''
+    Records a decoded webhook [event] in the payment ledger, applies it to
+    its payment and marks it processed (see payments/idempotency.py), all in
+    one transaction: a payment is never settled by an event missing from the
+    ledger, and an event is never skipped as processed before it is in the
+    ledger.
+
+    Raises Payment.DoesNotExist if a successful payment event is for an
+    unknown reference, and the error of a payment that could not be
+    settled: neither is recorded as processed, so the gateway's redelivery
+    is applied again.
+    '''
+    with transaction.atomic():
+        payment = Payment.objects.filter(reference=event.reference).first() if event.reference else None
+        if payment is not None:
+            ledger.record_event(payment, PaymentEventSource.WEBHOOK, event.as_payload(), event.processor)
+
+        # Handle successful payment event
+        if event.status == OnlineTransactionStatus.SUCCESSFUL:
+            if payment is None:
+                raise Payment.DoesNotExist(f"No payment with reference {event.reference!r}")
+            handle_webhook_payment(payment, event, request) #  settles the payment, or finds it settled, or raises
+        idempotency.mark_processed(event)
+
+
+def claim_webhook_events(batch_size):
+    '''
+    Claims up to [batch_size] pending events (and events whose claim has timed
+    out) for this worker. Safe to call from many threads and processes: an
+    event is only handed out by the conditional UPDATE that tags it with this
+    worker's claim token.
+    '''
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    claimable = Q(status=WebhookEventStatus.PENDING) | Q(
+        status=WebhookEventStatus.PROCESSING,
+        claimed_at__lt=now - timedelta(seconds=settings.PAYMENT_WEBHOOK_VISIBILITY_TIMEOUT),
+    )
+
+    with transaction.atomic():
+        qs = WebhookEvent.objects.filter(claimable).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            qs = qs.select_for_update(skip_locked=True)
+        ids = list(qs.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return []
+        WebhookEvent.objects.filter(claimable, id__in=ids).update(
+            status=WebhookEventStatus.PROCESSING,
+            claim_token=token,
+            claimed_at=now,
+            attempts=F('attempts') + 1,
+        )
+    return list(WebhookEvent.objects.filter(claim_token=token).order_by('id'))
+
+
+def drain_webhook_events(batch_size=None):
+    '''
+    Claims and applies one batch of events. Returns the number of events claimed.
+    '''
+    events = claim_webhook_events(batch_size or settings.PAYMENT_WEBHOOK_BATCH_SIZE)
+    if not events:
+        return 0
+
+    done, unfinished = [], []
+    for event in events:
+        try:
+            apply_webhook_event(get_payment_processor(event.processor).decode_event(event.body))
+            done.append(event.id)
+            continue
+        except Payment.DoesNotExist:
+            event.last_error = 'Payment does not exist'
+            event.attempts = settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS #  retrying will not help
+        except MalformedEventError as e:
+            event.last_error = f'Malformed event: {e}'
+            event.attempts = settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS
+        except Exception as e:
+            logger.exception("Failed to process webhook event %s", event.event_key)
+            event.last_error = repr(e)
+
+        if event.attempts >= settings.PAYMENT_WEBHOOK_MAX_ATTEMPTS:
+            event.status = WebhookEventStatus.FAILED
+        else:
+            event.status = WebhookEventStatus.PENDING
+        event.claim_token = ''
+        unfinished.append(event)
+
+    WebhookEvent.objects.filter(id__in=done).update(
+        status=WebhookEventStatus.DONE, processed_at=timezone.now(), claim_token='')
+    WebhookEvent.objects.bulk_update(unfinished, ['status', 'claim_token', 'last_error', 'attempts'])
+    return len(events)
+
+
+def webhook_queue_stats():
+    '''
+    Returns the queue depth per unfinished status and the age in seconds of
+    the oldest pending event.
+    '''
+    counts = dict(
+        WebhookEvent.objects
+        .filter(status__in=[WebhookEventStatus.PENDING, WebhookEventStatus.PROCESSING, WebhookEventStatus.FAILED])
+        .values_list('status')
+        .annotate(Count('id'))
+    )
+    oldest = (
+        WebhookEvent.objects.filter(status=WebhookEventStatus.PENDING)
+        .order_by('id').values_list('received_at', flat=True).first()
+    )
+    return {
+        'pending': counts.get(WebhookEventStatus.PENDING, 0),
+        'processing': counts.get(WebhookEventStatus.PROCESSING, 0),
+        'failed': counts.get(WebhookEventStatus.FAILED, 0),
+        'oldest_pending_age': (timezone.now() - oldest).total_seconds() if oldest else 0,
+    }